@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""This module generates synthetic PDF corpora for the benchmarks.
+
+The files are valid PDF 1.4 documents with a cross-reference table, so that Ghostscript treats
+them like any other upload. Three kinds of documents are generated, which put different loads on
+the pipeline:
+
+* ``text``: pages of uncompressed text, like those written by older PDF producers, which
+  Ghostscript compresses.
+* ``image``: pages with several losslessly compressed, photo-like images, which Ghostscript
+  downsamples and recompresses.
+* ``scanned``: one full-page grayscale image per page at 300 dpi, like the output of a
+  document scanner.
+
+The content is pseudo-random with a fixed seed, so the same corpus is generated every time.
+
+.. module:: corpus
+    :platform: Unix
+    :synopsis: Synthetic PDF corpora.
+
+.. moduleauthor:: Simon Larsén <slarse@kth.se>
+"""
+import os
+import random
+import zlib
+
+TEXT = 'text'
+IMAGE = 'image'
+SCANNED = 'scanned'
+KINDS = (TEXT, IMAGE, SCANNED)
+# Pages per document, chosen to put the documents above the size limit of pdfebc-core below
+# which files are not compressed at all
+DEFAULT_PAGES = {TEXT: 250, IMAGE: 4, SCANNED: 2}
+
+PAGE_WIDTH = 612
+PAGE_HEIGHT = 792
+SCAN_DPI = 300
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor '
+         'incididunt ut labore et dolore magna aliqua').split()
+
+
+class PdfWriter:
+    """Writes a PDF document object by object, keeping track of the offsets for the
+    cross-reference table.
+    """
+
+    def __init__(self, file):
+        """
+        Args:
+            file: A binary file object to write to.
+        """
+        self._file = file
+        self._offsets = []
+        self._file.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+
+    def reserve(self):
+        """Reserve the number of an object that is written later.
+
+        Returns:
+            int: The object number.
+        """
+        self._offsets.append(None)
+        return len(self._offsets)
+
+    def write(self, number, dictionary, stream=None):
+        """Write an object.
+
+        Args:
+            number (int): The object number, see reserve.
+            dictionary (str): The object. For stream objects, a dictionary without /Length.
+            stream (bytes): Content of the stream, if it is a stream object.
+        """
+        self._offsets[number - 1] = self._file.tell()
+        self._file.write('{} 0 obj\n'.format(number).encode('ascii'))
+        if stream is None:
+            self._file.write(dictionary.encode('ascii') + b'\nendobj\n')
+        else:
+            dictionary = dictionary[:-2] + '/Length {} >>'.format(len(stream))
+            self._file.write(dictionary.encode('ascii') + b'\nstream\n')
+            self._file.write(stream + b'\nendstream\nendobj\n')
+
+    def close(self, root):
+        """Write the cross-reference table and the trailer.
+
+        Args:
+            root (int): Number of the catalog object.
+        """
+        xref = self._file.tell()
+        size = len(self._offsets) + 1
+        self._file.write('xref\n0 {}\n0000000000 65535 f \n'.format(size).encode('ascii'))
+        for offset in self._offsets:
+            self._file.write('{:010d} 00000 n \n'.format(offset).encode('ascii'))
+        self._file.write('trailer\n<< /Size {} /Root {} 0 R >>\nstartxref\n{}\n%%EOF\n'
+                         .format(size, root, xref).encode('ascii'))
+
+
+def _text_content(rng, lines):
+    """Return the content stream operators of lines of text."""
+    operations = ['BT', '/F1 10 Tf', '12 TL', '50 750 Td']
+    for _ in range(lines):
+        operations.append("({}) '".format(' '.join(rng.choice(WORDS) for _ in range(12))))
+    operations.append('ET')
+    return '\n'.join(operations)
+
+
+def _noise(rng, size, low, high):
+    """Return size pseudo-random bytes in the range [low, high]."""
+    table = bytes(low + (value * (high - low + 1) >> 8) for value in range(256))
+    return rng.getrandbits(8 * size).to_bytes(size, 'little').translate(table)
+
+
+def _photo(rng, width, height):
+    """Return the samples of a photo-like RGB image: smooth gradients with noise in the low
+    bits, which compresses poorly without loss.
+    """
+    row_size = width * 3
+    gradient = bytes(value * 3 % 256 for value in range(row_size))
+    noise_mask = int.from_bytes(b'\x1f' * row_size, 'little')
+    base = rng.randrange(256)
+    rows = []
+    for y in range(height):
+        shade = (base + y * 255 // height) % 256
+        row = gradient.translate(bytes((value + shade) % 256 for value in range(256)))
+        noisy = int.from_bytes(row, 'little') ^ (rng.getrandbits(8 * row_size) & noise_mask)
+        rows.append(noisy.to_bytes(row_size, 'little'))
+    return b''.join(rows)
+
+
+def _write_image(writer, width, height, color_space, samples):
+    """Write a losslessly compressed image.
+
+    Returns:
+        int: The object number of the image.
+    """
+    number = writer.reserve()
+    writer.write(number, '<< /Type /XObject /Subtype /Image /Width {} /Height {} '
+                         '/ColorSpace {} /BitsPerComponent 8 /Filter /FlateDecode >>'
+                 .format(width, height, color_space), zlib.compress(samples, 6))
+    return number
+
+
+def _write_images(writer, rng, kind):
+    """Write the images of a page.
+
+    Returns:
+        List[Tuple[int, int, int, int, int]]: The object number of each image, and the
+        position and size that it is drawn with.
+    """
+    if kind == IMAGE:
+        return [(_write_image(writer, 600, 450, '/DeviceRGB', _photo(rng, 600, 450)),
+                 36 + (index % 2) * 276, 100 + (index // 2) * 320, 264, 198)
+                for index in range(4)]
+    if kind == SCANNED:
+        width = PAGE_WIDTH * SCAN_DPI // 72
+        height = PAGE_HEIGHT * SCAN_DPI // 72
+        return [(_write_image(writer, width, height, '/DeviceGray',
+                              _noise(rng, width * height, 224, 255)),
+                 0, 0, PAGE_WIDTH, PAGE_HEIGHT)]
+    return []
+
+
+def write_pdf(path, kind, pages=None, seed=0):
+    """Write a synthetic PDF document.
+
+    Args:
+        path (str): Path to the output file.
+        kind (str): One of KINDS.
+        pages (int): Amount of pages. Defaults to DEFAULT_PAGES of the kind.
+        seed (int): Seed for the pseudo-random content.
+    Returns:
+        int: Size of the file in bytes.
+    """
+    if kind not in KINDS:
+        raise ValueError("Unknown kind of document '{}'".format(kind))
+    rng = random.Random(seed)
+    pages = DEFAULT_PAGES[kind] if pages is None else pages
+    with open(path, 'wb') as file:
+        writer = PdfWriter(file)
+        catalog = writer.reserve()
+        page_tree = writer.reserve()
+        font = writer.reserve()
+        writer.write(font, '<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>')
+        page_numbers = []
+        for _ in range(pages):
+            images = _write_images(writer, rng, kind)
+            operations = [_text_content(rng, 50 if kind == TEXT else 5)]
+            operations.extend('q {} 0 0 {} {} {} cm /Im{} Do Q'.format(w, h, x, y, index)
+                              for index, (_, x, y, w, h) in enumerate(images))
+            content = '\n'.join(operations).encode('ascii')
+            contents = writer.reserve()
+            if kind == TEXT:
+                writer.write(contents, '<< >>', content)
+            else:
+                writer.write(contents, '<< /Filter /FlateDecode >>', zlib.compress(content))
+            xobjects = ' '.join('/Im{} {} 0 R'.format(index, number)
+                                for index, (number, *_) in enumerate(images))
+            page = writer.reserve()
+            writer.write(page, '<< /Type /Page /Parent {} 0 R /MediaBox [0 0 {} {}] '
+                               '/Contents {} 0 R /Resources << /Font << /F1 {} 0 R >> '
+                               '/XObject << {} >> >> >>'
+                         .format(page_tree, PAGE_WIDTH, PAGE_HEIGHT, contents, font, xobjects))
+            page_numbers.append(page)
+        writer.write(page_tree, '<< /Type /Pages /Kids [{}] /Count {} >>'.format(
+            ' '.join('{} 0 R'.format(number) for number in page_numbers), len(page_numbers)))
+        writer.write(catalog, '<< /Type /Catalog /Pages {} 0 R >>'.format(page_tree))
+        writer.close(catalog)
+    return os.stat(path).st_size
+
+
+def generate_corpus(directory, kind, files, pages=None, seed=0):
+    """Generate a corpus of synthetic PDF documents of one kind.
+
+    Args:
+        directory (str): Directory to put the documents in, which is created if needed.
+        kind (str): One of KINDS.
+        files (int): Amount of documents.
+        pages (int): Amount of pages per document. Defaults to DEFAULT_PAGES of the kind.
+        seed (int): Seed for the pseudo-random content.
+    Returns:
+        List[str]: Paths to the documents.
+    """
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for index in range(files):
+        path = os.path.join(directory, '{}-{:04d}.pdf'.format(kind, index))
+        write_pdf(path, kind, pages=pages, seed=seed + index)
+        paths.append(path)
+    return paths
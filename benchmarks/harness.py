@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""This module contains the measuring, reporting and comparing of benchmark results.
+
+Each benchmark runs in a fresh process, so that the peak resident set size that is reported is
+that of the benchmark alone, and not of whatever ran before it in the same interpreter. The peak
+RSS of child processes, such as Ghostscript, is reported separately.
+
+Results are written as JSON, together with the version of the code that they were measured on,
+so that the results of two versions can be compared with compare_results.
+
+.. module:: harness
+    :platform: Unix
+    :synopsis: Measuring and comparing benchmark results.
+
+.. moduleauthor:: Simon Larsén <slarse@kth.se>
+"""
+import datetime
+import json
+import math
+import multiprocessing
+import platform
+import resource
+import subprocess
+import time
+
+MIB = 1024**2
+# Metrics where a higher value is better, all other metrics are better when lower
+HIGHER_IS_BETTER = ('files_per_second', 'mb_per_second')
+COMPARED_METRICS = ('files_per_second', 'mb_per_second', 'p50', 'p95')
+DEFAULT_TOLERANCE = 0.1
+
+
+def percentile(values, fraction):
+    """Return a percentile of the values, by the nearest-rank method.
+
+    Args:
+        values (List[float]): The values, in any order.
+        fraction (float): The percentile as a fraction between 0 and 1, e.g. 0.95.
+    Returns:
+        float: The percentile, or None if there are no values.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, math.ceil(fraction * len(ordered)))
+    return ordered[rank - 1]
+
+
+def summarize(latencies, files, size):
+    """Summarize the latencies of the iterations of a benchmark.
+
+    Args:
+        latencies (List[float]): Seconds that each iteration took.
+        files (int): Amount of files processed by each iteration.
+        size (int): Amount of bytes processed by each iteration.
+    Returns:
+        dict: The metrics of the benchmark.
+    """
+    total = sum(latencies)
+    return {'iterations': len(latencies),
+            'files': files,
+            'bytes': size,
+            'files_per_second': files * len(latencies) / total if total else None,
+            'mb_per_second': size * len(latencies) / MIB / total if total else None,
+            'p50': percentile(latencies, 0.5),
+            'p95': percentile(latencies, 0.95)}
+
+
+def time_iterations(iteration, iterations, setup=None):
+    """Time the iterations of a benchmark.
+
+    Args:
+        iteration (function): Runs one iteration. Called with the return value of setup.
+        iterations (int): Amount of iterations.
+        setup (function): Run before each iteration without being timed.
+    Returns:
+        List[float]: Seconds that each iteration took.
+    """
+    latencies = []
+    for _ in range(iterations):
+        argument = setup() if setup is not None else None
+        start = time.perf_counter()
+        iteration(argument)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def _peak_rss():
+    """Return the peak RSS in MiB of this process and of its terminated child processes."""
+    # ru_maxrss is in KiB on Linux
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024)
+
+
+def _run_in_child(queue, benchmark, args):
+    try:
+        metrics = benchmark(*args)
+    except Exception as error:  # reported to the parent, which raises it
+        queue.put(('error', '{}: {}'.format(type(error).__name__, error)))
+    else:
+        metrics['peak_rss_mb'], metrics['peak_child_rss_mb'] = _peak_rss()
+        queue.put(('ok', metrics))
+
+
+def run_isolated(benchmark, *args):
+    """Run a benchmark in a fresh process and add its peak RSS to its metrics.
+
+    Args:
+        benchmark (function): A module level function that returns a dict of metrics.
+        args: Arguments to the benchmark, which must be picklable.
+    Returns:
+        dict: The metrics of the benchmark.
+    Raises:
+        RuntimeError
+    """
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=_run_in_child, args=(queue, benchmark, args))
+    process.start()
+    status, result = queue.get()
+    process.join()
+    if status != 'ok':
+        raise RuntimeError("Benchmark {} failed: {}".format(benchmark.__name__, result))
+    return result
+
+
+def get_version():
+    """Return a description of the checked out version of the code, or 'unknown'."""
+    try:
+        output = subprocess.run(['git', 'describe', '--always', '--dirty', '--tags'],
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return output.stdout.decode('utf-8').strip() or 'unknown'
+
+
+def create_report(results, parameters):
+    """Create a report of the results of a run.
+
+    Args:
+        results (dict): Metrics of each benchmark, by benchmark name.
+        parameters (dict): The parameters that the benchmarks were run with.
+    Returns:
+        dict: The report.
+    """
+    return {'version': get_version(),
+            'timestamp': datetime.datetime.utcnow().isoformat() + 'Z',
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'parameters': parameters,
+            'results': results}
+
+
+def write_report(report, path):
+    """Write a report as JSON."""
+    with open(path, 'w') as file:
+        json.dump(report, file, indent=2, sort_keys=True)
+
+
+def read_report(path):
+    """Read a report that was written by write_report."""
+    with open(path) as file:
+        return json.load(file)
+
+
+def compare_results(baseline, current, tolerance=DEFAULT_TOLERANCE):
+    """Compare the results of two reports. A metric has regressed if it is worse than in the
+    baseline by more than the tolerance. Benchmarks that are missing from either report are
+    not compared.
+
+    Args:
+        baseline (dict): The report to compare against.
+        current (dict): The report to compare.
+        tolerance (float): Allowed relative change for the worse, e.g. 0.1 for 10 %.
+    Returns:
+        List[str]: Descriptions of the regressions.
+    """
+    regressions = []
+    for name, metrics in sorted(current['results'].items()):
+        baseline_metrics = baseline['results'].get(name)
+        if baseline_metrics is None:
+            continue
+        for metric in COMPARED_METRICS:
+            old, new = baseline_metrics.get(metric), metrics.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            worse = -change if metric in HIGHER_IS_BETTER else change
+            if worse > tolerance:
+                regressions.append("{} {}: {:.4g} -> {:.4g} ({:+.1%})".format(
+                    name, metric, old, new, change))
+    return regressions
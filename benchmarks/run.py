@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""Command line interface for running the benchmarks.
+
+Generates a synthetic corpus of each kind, runs each benchmark on each corpus in a fresh process
+and writes the results as JSON. If a baseline report is given, the results are compared against
+it, and the exit status is 1 if anything regressed. Run from the root of the repository with
+e.g.::
+
+    python -m benchmarks.run --files 8 --output new.json --compare old.json
+
+Benchmarks that run Ghostscript are skipped if the Ghostscript binary can't be found.
+
+.. module:: run
+    :platform: Unix
+    :synopsis: Benchmark runner.
+
+.. moduleauthor:: Simon Larsén <slarse@kth.se>
+"""
+import argparse
+import functools
+import io
+import os
+import shutil
+import sys
+import tempfile
+from unittest import mock
+from . import corpus, harness
+from .smtp import StubSmtpServer
+
+DEFAULT_FILES = 4
+DEFAULT_ITERATIONS = 5
+DEFAULT_OUTPUT = 'benchmark-results.json'
+
+
+def _corpus_size(corpus_dir):
+    paths = [os.path.join(corpus_dir, name) for name in sorted(os.listdir(corpus_dir))]
+    return paths, sum(os.stat(path).st_size for path in paths)
+
+
+def _fresh_copy(corpus_dir, work_dir):
+    """Return a setup function that copies the corpus to a new directory in work_dir."""
+    def setup():
+        return shutil.copytree(corpus_dir, tempfile.mkdtemp(dir=work_dir) + '/files')
+    return setup
+
+
+def bench_compress(corpus_dir, iterations, gs_binary, workers):
+    """Benchmark compress_uploaded_files, with the engine if workers is given, and with
+    pdfebc-core otherwise.
+    """
+    from pdfebc_web.util.file import compress_uploaded_files
+    paths, size = _corpus_size(corpus_dir)
+    with tempfile.TemporaryDirectory() as work_dir:
+        latencies = harness.time_iterations(
+            lambda src_dir: compress_uploaded_files(src_dir, gs_binary, workers=workers),
+            iterations, setup=_fresh_copy(corpus_dir, work_dir))
+    return harness.summarize(latencies, len(paths), size)
+
+
+def bench_compress_to_tgz(corpus_dir, iterations, gs_binary):
+    """Benchmark compress_uploaded_files_to_tgz."""
+    from pdfebc_web.util.file import compress_uploaded_files_to_tgz
+    paths, size = _corpus_size(corpus_dir)
+    with tempfile.TemporaryDirectory() as work_dir:
+        latencies = harness.time_iterations(
+            lambda src_dir: compress_uploaded_files_to_tgz(src_dir, gs_binary),
+            iterations, setup=_fresh_copy(corpus_dir, work_dir))
+    return harness.summarize(latencies, len(paths), size)
+
+
+def bench_make_tarfile(corpus_dir, iterations):
+    """Benchmark make_tarfile."""
+    from pdfebc_web.util.file import make_tarfile
+    paths, size = _corpus_size(corpus_dir)
+    with tempfile.TemporaryDirectory() as work_dir:
+        out = os.path.join(work_dir, 'files.tgz')
+        latencies = harness.time_iterations(lambda _: make_tarfile(corpus_dir, out),
+                                            iterations, setup=lambda: None)
+    return harness.summarize(latencies, len(paths), size)
+
+
+def _write_core_config(path, smtp_port, gs_binary):
+    """Write a pdfebc-core config that sends email to the stub SMTP server."""
+    with open(path, 'w') as file:
+        file.write('[DEFAULTS]\ngs_binary = {}\n\n'
+                   '[EMAIL]\nuser = sender@example.com\npass = password\n'
+                   'receiver = receiver@example.com\nsmtp_server = localhost\n'
+                   'smtp_port = {}\n'.format(gs_binary, smtp_port))
+
+
+def bench_flask(corpus_dir, iterations, gs_binary):
+    """Benchmark the full pipeline through the Flask test client: upload the corpus through the
+    API, submit the compress form, and compress, archive and deliver the files by email to a
+    stub SMTP server. Celery runs the tasks eagerly with an in-memory broker, so the compress
+    request returns when the files have been delivered.
+    """
+    from pdfebc_web import factory
+    from pdfebc_web.util import file
+    paths, size = _corpus_size(corpus_dir)
+    with tempfile.TemporaryDirectory() as work_dir, StubSmtpServer() as smtp:
+        file.FILE_CACHE = work_dir
+        config_path = os.path.join(work_dir, 'config.cnf')
+        _write_core_config(config_path, smtp.port, gs_binary)
+        load_settings = functools.partial(factory.load_settings, config_path=config_path)
+        with mock.patch('pdfebc_web.factory.load_settings', load_settings):
+            _, app = factory.create_app({
+                'CELERY_BROKER_URL': 'memory://',
+                'CELERY_RESULT_BACKEND': 'cache+memory://',
+                'CELERY_ALWAYS_EAGER': True,
+                'MANIFEST_STORE': 'memory',
+                'LIMITS_STORE': 'memory',
+                'JOB_REGISTRY': 'memory',
+                'WTF_CSRF_ENABLED': False,
+                'GS_BINARY': gs_binary,
+                'COMPRESSION_CACHE_SIZE': 0,
+                'JANITOR_INTERVAL': 0,
+                'SESSION_COMPRESS_RATE': None,
+                'IP_COMPRESS_RATE': None,
+                'SMTP_STARTTLS': False})
+
+        def iteration(_):
+            # A new client is a new session
+            client = app.test_client()
+            uploads = []
+            for path in paths:
+                with open(path, 'rb') as pdf:
+                    uploads.append((io.BytesIO(pdf.read()), os.path.basename(path)))
+            response = client.post('/api/upload', data={'files': uploads},
+                                   content_type='multipart/form-data')
+            if response.status_code != 201:
+                raise RuntimeError("Upload failed: {}".format(response.data))
+            response = client.post('/', data={'compress': 'Compress files'})
+            if response.status_code != 302:
+                raise RuntimeError("Compression failed: {}".format(response.data))
+
+        latencies = harness.time_iterations(iteration, iterations)
+        if smtp.messages < iterations:
+            raise RuntimeError("Expected at least {} emails, got {}".format(iterations,
+                                                                         smtp.messages))
+    return harness.summarize(latencies, len(paths), size)
+
+
+def run_benchmarks(kinds, files, iterations, gs_binary, workers, log=print):
+    """Run all benchmarks on a generated corpus of each kind.
+
+    Args:
+        kinds (List[str]): Kinds of documents, see corpus.KINDS.
+        files (int): Amount of documents per corpus.
+        iterations (int): Amount of iterations per benchmark.
+        gs_binary (str): Name/alias of the Ghostscript binary.
+        workers (int): Amount of Ghostscript processes for the engine.
+        log (function): Called with a line of progress.
+    Returns:
+        dict: Metrics of each benchmark, by benchmark name.
+    """
+    has_gs = shutil.which(gs_binary) is not None
+    if not has_gs:
+        log("Ghostscript binary '{}' not found, skipping compression benchmarks"
+            .format(gs_binary))
+    results = {}
+    with tempfile.TemporaryDirectory() as corpus_root:
+        for kind in kinds:
+            corpus_dir = os.path.join(corpus_root, kind)
+            corpus.generate_corpus(corpus_dir, kind, files)
+            benchmarks = [('make_tarfile', bench_make_tarfile, (corpus_dir, iterations))]
+            if has_gs:
+                benchmarks.extend([
+                    ('compress_uploaded_files', bench_compress,
+                     (corpus_dir, iterations, gs_binary, None)),
+                    ('compress_uploaded_files_engine', bench_compress,
+                     (corpus_dir, iterations, gs_binary, workers)),
+                    ('compress_uploaded_files_to_tgz', bench_compress_to_tgz,
+                     (corpus_dir, iterations, gs_binary)),
+                    ('flask_pipeline', bench_flask, (corpus_dir, iterations, gs_binary))])
+            for name, bench, args in benchmarks:
+                key = '{}[{}]'.format(name, kind)
+                results[key] = harness.run_isolated(bench, *args)
+                log('{}: {files_per_second:.3g} files/s, {mb_per_second:.3g} MB/s, '
+                    'p50 {p50:.3g} s, p95 {p95:.3g} s, peak RSS {peak_rss_mb:.0f} MiB'
+                    .format(key, **results[key]))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.run',
+                                     description='Benchmark the pdfebc-web pipeline.')
+    parser.add_argument('--kinds', nargs='+', choices=corpus.KINDS, default=list(corpus.KINDS),
+                        help='kinds of documents to benchmark with')
+    parser.add_argument('--files', type=int, default=DEFAULT_FILES,
+                        help='documents per corpus')
+    parser.add_argument('--iterations', type=int, default=DEFAULT_ITERATIONS,
+                        help='iterations per benchmark')
+    parser.add_argument('--gs-binary', default='gs', help='Ghostscript binary')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='Ghostscript processes for the engine')
+    parser.add_argument('--output', default=DEFAULT_OUTPUT, help='file to write results to')
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help='results to compare against, exits with 1 on regressions')
+    parser.add_argument('--tolerance', type=float, default=harness.DEFAULT_TOLERANCE,
+                        help='allowed relative change for the worse when comparing')
+    args = parser.parse_args(argv)
+
+    parameters = {'kinds': args.kinds, 'files': args.files, 'iterations': args.iterations,
+                  'gs_binary': args.gs_binary, 'workers': args.workers}
+    results = run_benchmarks(args.kinds, args.files, args.iterations, args.gs_binary,
+                             args.workers)
+    report = harness.create_report(results, parameters)
+    harness.write_report(report, args.output)
+    print('Results written to {}'.format(args.output))
+    if args.compare:
+        regressions = harness.compare_results(harness.read_report(args.compare), report,
+                                              args.tolerance)
+        for regression in regressions:
+            print('Regression: {}'.format(regression))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
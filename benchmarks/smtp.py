@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""This module contains a stub SMTP server for the benchmarks.
+
+The server speaks just enough SMTP for smtplib to log in and send messages, and discards the
+messages after counting them, so the benchmarks measure the cost of building, encoding and
+transmitting the emails without depending on a real mail server. It does not support STARTTLS,
+so the app must be run with SMTP_STARTTLS disabled.
+
+.. module:: smtp
+    :platform: Unix
+    :synopsis: Stub SMTP server.
+
+.. moduleauthor:: Simon Larsén <slarse@kth.se>
+"""
+import socketserver
+import threading
+
+
+class _SmtpHandler(socketserver.StreamRequestHandler):
+    """Handles one SMTP connection."""
+
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        self.reply('220 localhost stub SMTP server')
+        for line in self.rfile:
+            command = line.decode('ascii', 'replace').strip().upper()
+            if command.startswith('EHLO'):
+                self.wfile.write(b'250-localhost\r\n250-AUTH PLAIN\r\n250 8BITMIME\r\n')
+            elif command.startswith('AUTH'):
+                self.reply('235 Authentication successful')
+            elif command.startswith('DATA'):
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                size = 0
+                for data in self.rfile:
+                    if data == b'.\r\n':
+                        break
+                    size += len(data)
+                self.server.record(size)
+                self.reply('250 OK')
+            elif command.startswith('QUIT'):
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('250 OK')
+
+
+class StubSmtpServer(socketserver.ThreadingTCPServer):
+    """A stub SMTP server that runs in a background thread, and counts the messages and bytes
+    that it receives.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='localhost', port=0):
+        """
+        Args:
+            host (str): Address to listen on.
+            port (int): Port to listen on, 0 for any free port.
+        """
+        super().__init__((host, port), _SmtpHandler)
+        self.messages = 0
+        self.bytes = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def port(self):
+        """The port that the server listens on."""
+        return self.server_address[1]
+
+    def record(self, size):
+        """Count a received message."""
+        with self._lock:
+            self.messages += 1
+            self.bytes += size
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
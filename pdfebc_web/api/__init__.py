@@ -0,0 +1,4 @@
+from . import views
+
+def construct_blueprint(celery, settings, manifest_store, limiter, storage, tasks):
+    return views.construct_blueprint(celery, settings, manifest_store, limiter, storage, tasks)
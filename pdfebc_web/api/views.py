@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+"""This module contains all views for the api blueprint.
+
+.. module:: views
+    :platform: Unix
+    :synopsis: Views for the api blueprint.
+
+.. moduleauthor:: Simon Larsén <slarse@kth.se>
+"""
+import functools
+import json
+import os
+import time
+from flask import (Blueprint, Response, jsonify, request, abort, session,
+                   stream_with_context, send_file)
+from werkzeug import secure_filename
+from ..util.archive import stream_archive, ARCHIVE_EXTENSIONS, ARCHIVE_MIMETYPES, TAR, ZIP
+from ..util.download import load_download_id, DownloadError, DownloadExpiredError
+from ..util.file import COMPRESSED_FILES_DIRNAME
+from ..main.tasks import get_job_status
+from ..util.limits import (get_upload_quotas, check_quota, stream_within_quota,
+                           reserve_upload, QuotaExceededError)
+from ..util import metrics
+from ..util.manifest import create_entry, get_replaced_size
+from ..util.session import get_session_id, JOB_ID_KEY, PROFILE_KEY
+from ..util.upload import (check_size, create_resumable_upload,
+                           get_resumable_upload, append_chunk, finalize_resumable_upload,
+                           UploadError, UploadTooLargeError, NotAPdfError, UploadNotFoundError,
+                           UploadOffsetError)
+
+PDF_EXTENSION = '.pdf'
+JOB_POLL_INTERVAL = 0.5
+MAX_LONG_POLL_WAIT = 30
+EVENT_STREAM_DURATION = 300
+
+
+def construct_blueprint(celery, settings, manifest_store, limiter, storage, tasks):
+    """Construct the api blueprint.
+
+    Args:
+        celery (Celery): A Celery instance.
+        settings (SettingsHolder): Holder of the settings of the app.
+        manifest_store: Store for the manifests of uploaded files.
+        limiter: Limiter for the upload quotas.
+        storage: Storage backend for the uploaded files and downloads.
+        tasks (Tasks): The Celery tasks, see pdfebc_web.main.tasks.construct_tasks.
+    Returns:
+        Blueprint: A Flask Blueprint.
+    """
+    api = Blueprint('api', __name__)
+
+    @api.errorhandler(UploadError)
+    def handle_upload_error(error):
+        """Turn a rejected upload into a JSON error response."""
+        return jsonify(get_upload_error_body(error)), get_upload_error_status(error)
+
+    def add_to_manifest(session_id, result):
+        """Store an uploaded file, add it to the manifest of the session and enqueue its
+        speculative compression in eager mode, with the profile that the session chose for its
+        last job.
+        """
+        filename = os.path.basename(result.path)
+        storage.save_upload(session_id, filename)
+        manifest_store.add(session_id, filename, create_entry(result.size, result.sha256))
+        tasks.precompress(session_id, filename, result.sha256, result.size,
+                          session.get(PROFILE_KEY))
+        metrics.record_upload(result.size)
+
+    def get_quotas(session_id):
+        """Return the upload quotas of the session and the client."""
+        return get_upload_quotas(settings.current, session_id, request.remote_addr)
+
+    def get_replaced(session_id, filename):
+        """Return the size of the earlier upload of the file in the session, if any."""
+        return get_replaced_size(manifest_store.get(session_id), filename)
+
+    @api.route('/upload', methods=['POST'])
+    def upload_multiple():
+        """Save every PDF file of a multipart request in the session upload directory. Each
+        file is accepted or rejected on its own.
+        """
+        files = request.files.getlist('files')
+        if not files:
+            raise UploadError("No files in the 'files' field")
+        max_upload_size = settings.current.max_upload_size
+        session_id = get_session_id()
+        session_upload_dir = storage.ensure_session_dir(session_id)
+        quotas = get_quotas(session_id)
+        results = []
+        for file in files:
+            filename = secure_filename(file.filename)
+            try:
+                check_filename(filename)
+                result = stream_within_quota(limiter, quotas, file.stream,
+                                             os.path.join(session_upload_dir, filename),
+                                             max_upload_size,
+                                             get_replaced(session_id, filename))
+            except UploadError as error:
+                results.append({'filename': filename, 'error': str(error)})
+            else:
+                add_to_manifest(session_id, result)
+                results.append({'filename': filename, 'size': result.size,
+                                'sha256': result.sha256})
+        status = 207 if any('error' in result for result in results) else 201
+        return jsonify(files=results), status
+
+    @api.route('/upload/<filename>', methods=['PUT', 'POST'])
+    def upload(filename):
+        """Stream the raw request body into the session upload directory."""
+        filename = secure_filename(filename)
+        check_filename(filename)
+        max_upload_size = settings.current.max_upload_size
+        if request.content_length is not None:
+            check_size(request.content_length, max_upload_size)
+        session_id = get_session_id()
+        out = os.path.join(storage.ensure_session_dir(session_id), filename)
+        result = stream_within_quota(limiter, get_quotas(session_id), request.stream, out,
+                                     max_upload_size, get_replaced(session_id, filename))
+        add_to_manifest(session_id, result)
+        return jsonify(filename=filename, size=result.size, sha256=result.sha256), 201
+
+    @api.route('/resumable', methods=['POST'])
+    def resumable_create():
+        """Start a resumable upload. Expects a JSON body with the filename and total size of
+        the file.
+        """
+        body = request.get_json(silent=True) or {}
+        filename = secure_filename(str(body.get('filename', '')))
+        check_filename(filename)
+        size = body.get('size')
+        if not isinstance(size, int) or size < 0:
+            raise UploadError("Size must be a non-negative integer")
+        session_id = get_session_id()
+        check_quota(limiter, get_quotas(session_id), size, get_replaced(session_id, filename))
+        session_upload_dir = storage.ensure_session_dir(session_id)
+        upload_id = create_resumable_upload(session_upload_dir, filename, size,
+                                            settings.current.max_upload_size)
+        return jsonify(upload_id=upload_id, filename=filename, size=size, offset=0), 201
+
+    @api.route('/resumable/<upload_id>', methods=['GET'])
+    def resumable_status(upload_id):
+        """Return the current offset of a resumable upload, so an interrupted upload can be
+        resumed from there.
+        """
+        session_upload_dir = storage.ensure_session_dir(get_session_id())
+        upload = get_resumable_upload(session_upload_dir, upload_id)
+        return jsonify(upload_id=upload_id, **upload)
+
+    @api.route('/resumable/<upload_id>', methods=['PATCH', 'PUT'])
+    def resumable_append(upload_id):
+        """Append the request body to a resumable upload. The offset of the chunk is given by
+        the offset query parameter.
+        """
+        offset = request.args.get('offset', type=int)
+        if offset is None:
+            raise UploadError("Missing offset")
+        session_upload_dir = storage.ensure_session_dir(get_session_id())
+        offset = append_chunk(session_upload_dir, upload_id, offset, request.stream)
+        return jsonify(upload_id=upload_id, offset=offset)
+
+    @api.route('/resumable/<upload_id>/finalize', methods=['POST'])
+    def resumable_finalize(upload_id):
+        """Move a completed resumable upload into the session upload directory, once it has
+        been counted against the quotas.
+        """
+        session_id = get_session_id()
+        session_upload_dir = storage.ensure_session_dir(session_id)
+        filename = get_resumable_upload(session_upload_dir, upload_id)['filename']
+        accept = functools.partial(reserve_upload, limiter, get_quotas(session_id),
+                                   replaced_size=get_replaced(session_id, filename))
+        result = finalize_resumable_upload(session_upload_dir, upload_id, accept)
+        add_to_manifest(session_id, result)
+        return jsonify(filename=os.path.basename(result.path), size=result.size,
+                       sha256=result.sha256), 201
+
+    @api.route('/download')
+    def download():
+        """Stream the compressed files of the session as an archive that is built on the fly.
+        The format is given by the format query parameter, and is either tar (default) or zip.
+        The files are kept in storage after they have been delivered, until the session expires
+        or compresses its next job.
+        """
+        archive_format = request.args.get('format', TAR)
+        if archive_format not in (TAR, ZIP):
+            abort(400)
+        filepaths = storage.fetch_compressed_files(get_session_id())
+        if not filepaths:
+            abort(404)
+        filename = COMPRESSED_FILES_DIRNAME + ARCHIVE_EXTENSIONS[archive_format]
+        chunks = stream_archive(os.path.dirname(filepaths[0]), archive_format,
+                                filepaths=filepaths)
+        return Response(stream_with_context(chunks), mimetype=ARCHIVE_MIMETYPES[archive_format],
+                        headers={'Content-Disposition':
+                                 'attachment; filename="{}"'.format(filename)})
+
+    @api.route('/downloads/<token>')
+    def download_link(token):
+        """Serve an archive of compressed files that was delivered as a signed download link.
+        Responds with 410 if the link has expired, and 404 if it is invalid.
+        """
+        current = settings.current
+        try:
+            download_id = load_download_id(current.secret_key, token,
+                                           current.download_link_ttl)
+            archive, size = storage.open_download(download_id)
+        except DownloadExpiredError:
+            abort(410)
+        except DownloadError:
+            abort(404)
+        filename = COMPRESSED_FILES_DIRNAME + ARCHIVE_EXTENSIONS[TAR]
+        response = send_file(archive, mimetype=ARCHIVE_MIMETYPES[TAR], as_attachment=True,
+                             attachment_filename=filename)
+        response.content_length = size
+        return response
+
+    def get_session_job_status(job_id):
+        """Return the status of the job, aborting with 404 if it is not the job of the
+        current session.
+        """
+        if job_id != session.get(JOB_ID_KEY):
+            abort(404)
+        return get_job_status(celery, job_id)
+
+    @api.route('/jobs/<job_id>')
+    def job_status(job_id):
+        """Return the status of a job. If the version query parameter is given, the request is
+        held for up to wait seconds until the status differs from that version (long polling).
+        Once the job is finished, it is no longer the job of the session.
+        """
+        status = get_session_job_status(job_id)
+        version = request.args.get('version')
+        wait = min(request.args.get('wait', 0, type=float), MAX_LONG_POLL_WAIT)
+        deadline = time.monotonic() + wait
+        while status['version'] == version and not status['ready'] and \
+                time.monotonic() < deadline:
+            time.sleep(JOB_POLL_INTERVAL)
+            status = get_job_status(celery, job_id)
+        if status['ready']:
+            session.pop(JOB_ID_KEY, None)
+        return jsonify(status)
+
+    @api.route('/jobs/<job_id>/events')
+    def job_events(job_id):
+        """Stream the status of a job as Server-Sent Events, one event per change, until the
+        job is done. Clients reconnect on their own if the stream times out first.
+        """
+        status = get_session_job_status(job_id)
+
+        def generate(status):
+            deadline = time.monotonic() + EVENT_STREAM_DURATION
+            version = None
+            while True:
+                if status['version'] != version:
+                    version = status['version']
+                    yield 'data: {}\n\n'.format(json.dumps(status))
+                if status['ready'] or time.monotonic() >= deadline:
+                    return
+                time.sleep(JOB_POLL_INTERVAL)
+                status = get_job_status(celery, job_id)
+
+        return Response(generate(status), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache'})
+
+    return api
+
+
+def get_upload_error_status(error):
+    """Return the HTTP status of a rejected upload.
+
+    Args:
+        error (UploadError): The reason the upload was rejected.
+    Returns:
+        int: The status code.
+    """
+    if isinstance(error, UploadOffsetError):
+        return 409
+    if isinstance(error, QuotaExceededError):
+        return 429
+    if isinstance(error, UploadTooLargeError):
+        return 413
+    if isinstance(error, NotAPdfError):
+        return 415
+    if isinstance(error, UploadNotFoundError):
+        return 404
+    return 400
+
+
+def get_upload_error_body(error):
+    """Return the JSON body of the response to a rejected upload.
+
+    Args:
+        error (UploadError): The reason the upload was rejected.
+    Returns:
+        dict: The body.
+    """
+    if isinstance(error, UploadOffsetError):
+        return {'error': str(error), 'offset': error.offset}
+    return {'error': str(error)}
+
+
+def check_filename(filename):
+    """Check that the filename is that of a PDF file.
+
+    Raises:
+        UploadError
+    """
+    if not filename.endswith(PDF_EXTENSION):
+        raise UploadError("Filename must end with {}".format(PDF_EXTENSION))
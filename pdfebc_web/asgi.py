@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+"""ASGI front end for pdfebc-web.
+
+A WSGI worker is tied up for as long as a request lasts, so a few clients that upload slowly or
+long poll the status of their jobs can occupy all workers of the site. The front end serves
+those routes asynchronously: upload bodies are streamed to disk as they arrive, long polls and
+event streams sleep on the event loop, and downloads are streamed from storage. Disk I/O and calls
+to the Redis-backed stores run on the default executor of the event loop, so the event loop
+never waits for them. All other requests are passed on to the Flask app through ``asgiref``,
+which is an optional dependency.
+
+The async routes share the session cookie, settings, stores and limiter with the Flask app, so
+the two can be used interchangeably.
+
+.. module:: asgi
+    :platform: Unix
+    :synopsis: ASGI front end for pdfebc-web.
+
+.. moduleauthor:: Simon Larsén <slarse@kth.se>
+"""
+import asyncio
+import functools
+import json
+import os
+import re
+import time
+import uuid
+from http.cookies import SimpleCookie
+from urllib.parse import parse_qs
+from itsdangerous import BadSignature
+from werkzeug import secure_filename
+from werkzeug.http import dump_cookie
+from .api.views import (check_filename, get_upload_error_status, get_upload_error_body,
+                        JOB_POLL_INTERVAL, MAX_LONG_POLL_WAIT, EVENT_STREAM_DURATION)
+from .factory import EXTENSION_KEY
+from .main.tasks import get_job_status
+from .util import metrics
+from .util.archive import ARCHIVE_EXTENSIONS, ARCHIVE_MIMETYPES, TAR
+from .util.download import load_download_id, DownloadError, DownloadExpiredError
+from .util.file import COMPRESSED_FILES_DIRNAME
+from .util.limits import get_upload_quotas, stream_within_quota_async
+from .util.manifest import create_entry, get_replaced_size
+from .util.session import SESSION_ID_KEY, JOB_ID_KEY, PROFILE_KEY
+from .util.upload import check_size, UploadError
+
+try:
+    from asgiref.wsgi import WsgiToAsgi
+except ImportError:
+    WsgiToAsgi = None
+
+READ_SIZE = 256 * 1024
+JSON_MIMETYPE = b'application/json'
+# Address that uploads are counted against when the address of the client is unknown
+UNKNOWN_CLIENT = 'unknown'
+
+
+class ClientDisconnectedError(UploadError):
+    """An error to be thrown when the client disconnects before the upload is complete."""
+    pass
+
+
+def _get_header(scope, name):
+    """Return the value of a request header, or None if it is missing."""
+    for key, value in scope['headers']:
+        if key == name:
+            return value.decode('latin-1')
+    return None
+
+
+def _get_client_ip(scope):
+    """Return the IP address of the client. If the server doesn't know it, e.g. when it listens
+    on a Unix socket behind a proxy, the address that the proxy appended to X-Forwarded-For is
+    used, and UNKNOWN_CLIENT if there is none.
+    """
+    client = scope.get('client')
+    if client:
+        return client[0]
+    forwarded_for = _get_header(scope, b'x-forwarded-for')
+    if forwarded_for and forwarded_for.split(',')[-1].strip():
+        return forwarded_for.split(',')[-1].strip()
+    return UNKNOWN_CLIENT
+
+
+async def _read_body(receive):
+    """Yield the chunks of a request body as they arrive.
+
+    Raises:
+        ClientDisconnectedError
+    """
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            raise ClientDisconnectedError("The client disconnected")
+        yield message.get('body', b'')
+        if not message.get('more_body'):
+            return
+
+
+async def _send_json(send, status, body, headers=()):
+    content = json.dumps(body).encode('utf-8')
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', JSON_MIMETYPE),
+                            (b'content-length', str(len(content)).encode('latin-1'))] +
+                           list(headers)})
+    await send({'type': 'http.response.body', 'body': content})
+
+
+def _run(function, *args):
+    """Run a blocking function on the default executor of the event loop."""
+    return asyncio.get_event_loop().run_in_executor(None, functools.partial(function, *args))
+
+
+class AsyncFrontEnd:
+    """An ASGI application that serves uploads, job statuses and download links
+    asynchronously, and passes all other requests on to another ASGI application.
+    """
+
+    def __init__(self, app, fallback):
+        """
+        Args:
+            app (Flask): The Flask app, see factory.create_app.
+            fallback: ASGI application for the other requests.
+        """
+        self.app = app
+        self.fallback = fallback
+        self.components = app.extensions[EXTENSION_KEY]
+        self._serializer = app.session_interface.get_signing_serializer(app)
+        self._routes = [(('PUT', 'POST'), re.compile(r'^/api/upload/(?P<filename>[^/]+)$'),
+                         self.upload),
+                        (('GET',), re.compile(r'^/api/jobs/(?P<job_id>[^/]+)$'),
+                         self.job_status),
+                        (('GET',), re.compile(r'^/api/jobs/(?P<job_id>[^/]+)/events$'),
+                         self.job_events),
+                        (('GET',), re.compile(r'^/api/downloads/(?P<token>[^/]+)$'),
+                         self.download_link)]
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] == 'http':
+            for methods, pattern, handler in self._routes:
+                match = pattern.match(scope['path'])
+                if match and scope['method'] in methods:
+                    await handler(scope, receive, send, **match.groupdict())
+                    return
+        await self.fallback(scope, receive, send)
+
+    async def upload(self, scope, receive, send, filename):
+        """Stream the raw request body into the session upload directory, like the upload
+        route of the api blueprint, and enqueue its speculative compression in eager mode.
+        """
+        settings, manifest_store, limiter, storage, tasks = (self.components.settings,
+                                                             self.components.manifest_store,
+                                                             self.components.limiter,
+                                                             self.components.storage,
+                                                             self.components.tasks)
+        session = self.load_session(scope)
+        headers = []
+        if SESSION_ID_KEY not in session:
+            session[SESSION_ID_KEY] = str(uuid.uuid4())
+            headers.append(self.dump_session(session))
+        session_id = session[SESSION_ID_KEY]
+        current = settings.current
+        filename = secure_filename(filename)
+        start = time.monotonic()
+        try:
+            check_filename(filename)
+            content_length = _get_header(scope, b'content-length')
+            if content_length is not None:
+                try:
+                    check_size(int(content_length), current.max_upload_size)
+                except ValueError:
+                    raise UploadError("Invalid Content-Length")
+            session_upload_dir = await _run(storage.ensure_session_dir, session_id)
+            quotas = get_upload_quotas(current, session_id, _get_client_ip(scope))
+            manifest = await _run(manifest_store.get, session_id)
+            result = await stream_within_quota_async(limiter, quotas, _read_body(receive),
+                                                     os.path.join(session_upload_dir, filename),
+                                                     current.max_upload_size,
+                                                     get_replaced_size(manifest, filename))
+            await _run(storage.save_upload, session_id, filename)
+            await _run(manifest_store.add, session_id, filename,
+                       create_entry(result.size, result.sha256))
+            await _run(tasks.precompress, session_id, filename, result.sha256, result.size,
+                       session.get(PROFILE_KEY))
+        except UploadError as error:
+            await _send_json(send, get_upload_error_status(error), get_upload_error_body(error),
+                             headers)
+            return
+        metrics.record_upload(result.size, time.monotonic() - start)
+        await _send_json(send, 201, {'filename': filename, 'size': result.size,
+                                     'sha256': result.sha256}, headers)
+
+    async def job_status(self, scope, receive, send, job_id):
+        """Return the status of a job, with the same long polling as the job status route of
+        the api blueprint, but sleeping on the event loop. Once the job is finished, it is
+        dropped from the session cookie.
+        """
+        celery = self.components.celery
+        session = self.load_session(scope)
+        if job_id != session.get(JOB_ID_KEY):
+            await _send_json(send, 404, {'error': 'No such job'})
+            return
+        query = parse_qs(scope['query_string'].decode('latin-1'))
+        version = query.get('version', [None])[0]
+        try:
+            wait = min(float(query.get('wait', ['0'])[0]), MAX_LONG_POLL_WAIT)
+        except ValueError:
+            wait = 0
+        deadline = time.monotonic() + wait
+        status = await _run(get_job_status, celery, job_id)
+        while status['version'] == version and not status['ready'] and \
+                time.monotonic() < deadline:
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+            status = await _run(get_job_status, celery, job_id)
+        headers = []
+        if status['ready']:
+            del session[JOB_ID_KEY]
+            headers.append(self.dump_session(session))
+        await _send_json(send, 200, status, headers)
+
+    async def job_events(self, scope, receive, send, job_id):
+        """Stream the status of a job as Server-Sent Events, like the job events route of the
+        api blueprint.
+        """
+        celery = self.components.celery
+        if job_id != self.load_session(scope).get(JOB_ID_KEY):
+            await _send_json(send, 404, {'error': 'No such job'})
+            return
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', b'text/event-stream'),
+                                (b'cache-control', b'no-cache')]})
+        deadline = time.monotonic() + EVENT_STREAM_DURATION
+        version = None
+        while True:
+            status = await _run(get_job_status, celery, job_id)
+            if status['version'] != version:
+                version = status['version']
+                await send({'type': 'http.response.body', 'more_body': True,
+                            'body': 'data: {}\n\n'.format(json.dumps(status)).encode('utf-8')})
+            if status['ready'] or time.monotonic() >= deadline:
+                break
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+        await send({'type': 'http.response.body', 'body': b''})
+
+    async def download_link(self, scope, receive, send, token):
+        """Stream an archive that was delivered as a signed download link, like the download
+        link route of the api blueprint.
+        """
+        current = self.components.settings.current
+        try:
+            download_id = load_download_id(current.secret_key, token,
+                                           current.download_link_ttl)
+            file, size = await _run(self.components.storage.open_download, download_id)
+        except DownloadExpiredError:
+            await _send_json(send, 410, {'error': 'The download link has expired'})
+            return
+        except DownloadError:
+            await _send_json(send, 404, {'error': 'No such download'})
+            return
+        filename = COMPRESSED_FILES_DIRNAME + ARCHIVE_EXTENSIONS[TAR]
+        try:
+            await send({'type': 'http.response.start', 'status': 200,
+                        'headers': [(b'content-type', ARCHIVE_MIMETYPES[TAR].encode('latin-1')),
+                                    (b'content-length', str(size).encode('latin-1')),
+                                    (b'content-disposition',
+                                     'attachment; filename="{}"'.format(filename)
+                                     .encode('latin-1'))]})
+            while True:
+                chunk = await _run(file.read, READ_SIZE)
+                await send({'type': 'http.response.body', 'body': chunk,
+                            'more_body': bool(chunk)})
+                if not chunk:
+                    return
+        finally:
+            file.close()
+
+    def load_session(self, scope):
+        """Load the Flask session of a request from its cookie.
+
+        Returns:
+            dict: The session, empty if the request has no valid session cookie.
+        """
+        cookie = SimpleCookie(_get_header(scope, b'cookie') or '')
+        morsel = cookie.get(self.app.session_cookie_name)
+        if morsel is None:
+            return {}
+        max_age = self.app.permanent_session_lifetime.total_seconds()
+        try:
+            return dict(self._serializer.loads(morsel.value, max_age=max_age))
+        except BadSignature:
+            return {}
+
+    def dump_session(self, session):
+        """Return a Set-Cookie header that stores the session like Flask does."""
+        interface = self.app.session_interface
+        cookie = dump_cookie(self.app.session_cookie_name, self._serializer.dumps(session),
+                             domain=interface.get_cookie_domain(self.app),
+                             path=interface.get_cookie_path(self.app),
+                             secure=interface.get_cookie_secure(self.app),
+                             httponly=interface.get_cookie_httponly(self.app),
+                             samesite=interface.get_cookie_samesite(self.app))
+        return (b'set-cookie', cookie.encode('latin-1'))
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+def create_asgi_app(app):
+    """Create the ASGI front end of a Flask app, which passes the requests that it doesn't
+    serve asynchronously on to the Flask app.
+
+    Args:
+        app (Flask): The Flask app, see factory.create_app.
+    Returns:
+        AsyncFrontEnd: An ASGI application.
+    Raises:
+        ImportError
+    """
+    if WsgiToAsgi is None:
+        raise ImportError("The ASGI front end requires asgiref, install pdfebc-web[asgi]")
+    return AsyncFrontEnd(app, WsgiToAsgi(app))
@@ -6,16 +6,32 @@
     :synopsis: Factory functions for pdfebc-web.
 .. moduleauthor:: Simon Larsén <slarse@kth.se>
 """
+import os
+from collections import namedtuple
 from celery import Celery
 from flask import Flask
 from flask_bootstrap import Bootstrap
-from .main import construct_blueprint
+from . import main, api
+from .main.tasks import construct_tasks
+from .util.jobs import create_job_registry
+from .util.limits import create_limiter
+from .util.manifest import create_manifest_store
+from .util.storage import create_storage, S3
+from .util import file, janitor, profiles, scheduling
+from .util.settings import SettingsHolder, load_settings, install_reload_handler
 
 bootstrap = Bootstrap()
+# Key of the shared components of the app in app.extensions, used by the ASGI front end
+EXTENSION_KEY = 'pdfebc_web'
 
-def create_app():
+Components = namedtuple('Components', ['celery', 'settings', 'manifest_store', 'limiter',
+                                       'job_registry', 'storage', 'tasks'])
+
+def create_app(config=None):
     """Instantiate the pdfebc-web app.
 
+    Args:
+        config (dict): Configuration values that override the defaults.
     Returns:
         Flask: A Flask application.
     """
@@ -23,12 +39,165 @@ def create_app():
     bootstrap.init_app(app)
     # TODO Make the secret key an actual secret key
     app.config['SECRET_KEY'] = 'dev_key'
+    # URL at which the app is reached from outside, used for links in emails
+    app.config['EXTERNAL_URL'] = 'http://localhost:5000'
     app.config['CELERY_BROKER_URL'] = 'redis://localhost:6379/0'
     app.config['CELERY_RESULT_BACKEND'] = 'redis://localhost:6379/0'
-    celery = Celery(app.name, broker=app.config['CELERY_BROKER_URL'])
+    # Celery task routes, None to route delivery and sweeps to the small job queue
+    app.config['CELERY_ROUTES'] = None
+    app.config['BROKER_TRANSPORT_OPTIONS'] = scheduling.BROKER_TRANSPORT_OPTIONS
+    # Tasks and resident kilobytes after which a worker process is replaced, so that memory
+    # leaked by a task doesn't accumulate
+    app.config['CELERYD_MAX_TASKS_PER_CHILD'] = 100
+    app.config['CELERYD_MAX_MEMORY_PER_CHILD'] = 1024**2
+    # Ghostscript binary, None to read it from the pdfebc-core config (or fall back to gs)
+    app.config['GS_BINARY'] = None
+    # Maximum amount of Ghostscript processes a single task runs at the same time
+    app.config['COMPRESSION_WORKERS'] = os.cpu_count() or 1
+    # Seconds before a single Ghostscript process is killed
+    app.config['COMPRESSION_TIMEOUT'] = 600
+    # Spread the files of a session across the workers as a chord of per-file tasks
+    app.config['COMPRESSION_FAN_OUT'] = False
+    # Maximum size in bytes of the cache of compression results, 0 disables the cache
+    app.config['COMPRESSION_CACHE_SIZE'] = 1024**3
+    # Pass files through untouched if a structural analysis predicts that they won't shrink
+    app.config['COMPRESSION_ANALYSIS'] = True
+    # Label, Ghostscript arguments and relative CPU cost of each compression profile that users
+    # can choose from, and the profile used when none is chosen
+    app.config['COMPRESSION_PROFILES'] = profiles.DEFAULT_PROFILES
+    app.config['DEFAULT_COMPRESSION_PROFILE'] = profiles.DEFAULT_PROFILE
+    # Start compressing each file as soon as it is uploaded, so that submitting only collects
+    # the results
+    app.config['EAGER_COMPRESSION'] = False
+    # Bytes of address space and seconds of CPU time that a single Ghostscript process may use,
+    # None for no limit. Interpreters of the pool are only limited in memory
+    app.config['GHOSTSCRIPT_MAX_MEMORY'] = 2 * 1024**3
+    app.config['GHOSTSCRIPT_MAX_CPU_SECONDS'] = 300
+    # Compress with long-lived Ghostscript interpreters instead of one process per file, falling
+    # back to one process per file if the interpreters can't be started
+    app.config['GHOSTSCRIPT_POOL'] = True
+    # Jobs and resident bytes after which an interpreter is replaced, None for no memory limit
+    app.config['GHOSTSCRIPT_POOL_MAX_JOBS'] = 100
+    app.config['GHOSTSCRIPT_POOL_MAX_MEMORY'] = 512 * 1024**2
+    # Seconds between sweeps of the file cache, 0 disables the sweeps
+    app.config['JANITOR_INTERVAL'] = 3600
+    # Seconds of inactivity after which a session upload directory is evicted
+    app.config['SESSION_TTL'] = 24 * 3600
+    # Maximum total size in bytes of the session upload directories, None for no limit
+    app.config['FILE_CACHE_QUOTA'] = None
+    # Maximum size in bytes of a single uploaded file
+    app.config['MAX_UPLOAD_SIZE'] = 100 * 1024**2
+    # Maximum amount of open SMTP connections per process
+    app.config['SMTP_POOL_SIZE'] = 2
+    # Seconds before a blocking SMTP operation times out
+    app.config['SMTP_TIMEOUT'] = 30
+    # Whether to run STARTTLS before logging in to the SMTP server
+    app.config['SMTP_STARTTLS'] = True
+    # Amount of times to retry delivery after a transient SMTP failure
+    app.config['SMTP_RETRIES'] = 3
+    # Seconds to wait before the first retry, doubled for each retry
+    app.config['SMTP_RETRY_BACKOFF'] = 1.0
+    # Maximum size in bytes of a single email, after encoding the attachments
+    app.config['MAX_MESSAGE_SIZE'] = 20 * 1024**2
+    # Total size in bytes of compressed files above which a download link is sent instead
+    app.config['LINK_DELIVERY_THRESHOLD'] = 50 * 1024**2
+    # Seconds for which download links are valid
+    app.config['DOWNLOAD_LINK_TTL'] = 7 * 24 * 3600
+    # Queues for jobs up to and above SMALL_JOB_THRESHOLD bytes of uploaded files
+    app.config['SMALL_JOB_QUEUE'] = 'pdfebc-small'
+    app.config['LARGE_JOB_QUEUE'] = 'pdfebc-large'
+    app.config['SMALL_JOB_THRESHOLD'] = 10 * 1024**2
+    # Maximum amount of compression tasks of a single session that run at the same time in
+    # fan-out mode, and amount of speculative compressions in eager mode per priority step
+    app.config['SESSION_CONCURRENCY'] = 4
+    # Maximum amount of files and bytes uploaded per session, None for no limit
+    app.config['SESSION_MAX_FILES'] = 100
+    app.config['SESSION_MAX_BYTES'] = 1024**3
+    # Maximum amount of files and bytes uploaded per IP address during the quota window
+    app.config['IP_MAX_FILES'] = 1000
+    app.config['IP_MAX_BYTES'] = 10 * 1024**3
+    app.config['QUOTA_WINDOW'] = 24 * 3600
+    # Compressions per second a session may trigger after a burst of them, None for no limit
+    app.config['SESSION_COMPRESS_RATE'] = 1 / 60
+    app.config['SESSION_COMPRESS_BURST'] = 3
+    # Compressions per second an IP address may trigger after a burst of them
+    app.config['IP_COMPRESS_RATE'] = 1 / 10
+    app.config['IP_COMPRESS_BURST'] = 20
+    # Seconds after which a job that never finished no longer blocks its session
+    app.config['JOB_TTL'] = 3600
+    # Where the jobs of each session are registered, either 'redis' or 'memory'
+    app.config['JOB_REGISTRY'] = 'redis'
+    # Where the rate limits and upload quotas are kept, either 'redis' or 'memory'
+    app.config['LIMITS_STORE'] = 'redis'
+    # Where the manifests of uploaded files are kept, either 'redis' or 'memory'
+    app.config['MANIFEST_STORE'] = 'redis'
+    app.config['REDIS_URL'] = 'redis://localhost:6379/0'
+    # Where uploads and downloads are stored, either 'local' for the file cache, which the web
+    # processes and the workers must share, or 's3' for a bucket of an S3-compatible store
+    app.config['STORAGE_BACKEND'] = 'local'
+    # URL of the S3-compatible store, None for AWS S3, and the bucket and key prefix to use
+    app.config['S3_ENDPOINT_URL'] = None
+    app.config['S3_BUCKET'] = None
+    app.config['S3_PREFIX'] = 'pdfebc-web/'
+    # Size in bytes of the parts of multipart uploads and ranged reads from the S3 store
+    app.config['S3_PART_SIZE'] = 8 * 1024**2
+    # Amount of ranges of a file that a worker fetches from the S3 store at the same time
+    app.config['S3_TRANSFER_WORKERS'] = 4
+    app.config.update(config or {})
+    if app.config['CELERY_ROUTES'] is None:
+        app.config['CELERY_ROUTES'] = scheduling.create_task_routes(app.config['SMALL_JOB_QUEUE'])
+    celery = Celery(app.name, broker=app.config['CELERY_BROKER_URL'],
+                    backend=app.config['CELERY_RESULT_BACKEND'])
     celery.conf.update(app.config)
 
-    main_blueprint = construct_blueprint(celery)
+    settings = SettingsHolder(lambda: load_settings(app.config))
+    install_reload_handler(settings, app.logger)
+    app.secret_key = settings.current.secret_key
+    manifest_store = create_manifest_store(app.config['MANIFEST_STORE'], app.config['REDIS_URL'],
+                                           settings.current.session_ttl)
+    limiter = create_limiter(app.config['LIMITS_STORE'], app.config['REDIS_URL'])
+    job_registry = create_job_registry(app.config['JOB_REGISTRY'], app.config['REDIS_URL'])
+    storage = create_storage(app.config['STORAGE_BACKEND'], app.config['S3_ENDPOINT_URL'],
+                             app.config['S3_BUCKET'], app.config['S3_PREFIX'],
+                             part_size=app.config['S3_PART_SIZE'],
+                             workers=app.config['S3_TRANSFER_WORKERS'])
+
+    tasks = construct_tasks(celery, settings, manifest_store, job_registry, storage)
+
+    main_blueprint = main.construct_blueprint(celery, settings, manifest_store, limiter,
+                                             job_registry, storage, tasks)
     app.register_blueprint(main_blueprint)
+    api_blueprint = api.construct_blueprint(celery, settings, manifest_store, limiter, storage,
+                                            tasks)
+    app.register_blueprint(api_blueprint, url_prefix='/api')
+    app.extensions[EXTENSION_KEY] = Components(celery, settings, manifest_store, limiter,
+                                               job_registry, storage, tasks)
+    if app.config['STORAGE_BACKEND'] == S3:
+        sweep_local = create_local_sweep(settings, job_registry)
+
+        @app.before_request
+        def sweep_file_cache():
+            """Sweep the file cache of this process in the background if a sweep is due."""
+            sweep_local()
 
     return celery, app
+
+
+def create_local_sweep(settings, job_registry):
+    """Create a function that sweeps the file cache of a web process in the background every
+    janitor interval, see janitor.create_background_sweep. Only needed with the S3 storage
+    backend, as the file cache of a web process is otherwise swept by the workers.
+
+    Args:
+        settings (SettingsHolder): Holder of the settings of the app.
+        job_registry: Registry of the jobs of each session.
+    Returns:
+        function: Starts a sweep if one is due.
+    """
+    def sweep():
+        current = settings.current
+        janitor.sweep_file_cache(
+            file.FILE_CACHE, current.session_ttl, current.file_cache_quota,
+            is_busy=lambda path: job_registry.get(os.path.basename(path)) is not None)
+
+    return janitor.create_background_sweep(sweep, lambda: settings.current.janitor_interval)
@@ -1,4 +1,5 @@
 from . import views
 
-def construct_blueprint(celery):
-    return views.construct_blueprint(celery)
+def construct_blueprint(celery, settings, manifest_store, limiter, job_registry, storage, tasks):
+    return views.construct_blueprint(celery, settings, manifest_store, limiter, job_registry,
+                                     storage, tasks)
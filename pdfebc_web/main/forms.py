@@ -8,7 +8,7 @@
 """
 from flask_wtf import FlaskForm
 from flask_wtf.file import FileAllowed, FileRequired, FileField
-from wtforms import SubmitField
+from wtforms import SelectField, SubmitField
 from wtforms.validators import Required
 
 ALLOWED_FILETYPES = set(['pdf'])
@@ -21,5 +21,10 @@ class FileUploadForm(FlaskForm):
     submit = SubmitField("Submit", validators=[Required()])
 
 class CompressFilesForm(FlaskForm):
-    """A form for compressing uploaded files."""
+    """A form for compressing uploaded files with a compression profile. The profiles are
+    configured server-side, so the choices must be set before the form is validated.
+    """
+    profile = SelectField("Compression profile", choices=[], description=(
+        "Files are compressed as they are uploaded with the profile you chose last, so "
+        "compressing them with that profile again is faster."))
     compress = SubmitField("Compress files", validators=[Required()])
@@ -0,0 +1,750 @@
+# -*- coding: utf-8 -*-
+"""This module contains the Celery tasks used by the main blueprint.
+
+.. module:: tasks
+    :platform: Unix
+    :synopsis: Celery tasks for the main blueprint.
+
+.. moduleauthor:: Simon Larsén <slarse@kth.se>
+"""
+import functools
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from celery import chord, states
+from celery.utils.log import get_task_logger
+from pdfebc_core import config_utils
+from ..util import eager, engine, file, gspool, janitor, mail, download, metrics, scheduling
+from ..util.archive import stream_archive, TAR
+from ..util.cache import CompressionCache
+from ..util.jobs import LocalJobRegistry
+from ..util.progress import ProgressReporter, QUEUED, FAILED
+from ..util.storage import LocalStorage
+from ..util.file import (get_compression_cache_path,
+                         get_downloads_path,
+                         compress_uploaded_files,
+                         COMPRESSED_FILES_DIRNAME)
+
+PROGRESS_STATE = 'PROGRESS'
+# State of a job that was never submitted, or whose results have expired from the backend
+EXPIRED_STATE = 'EXPIRED'
+EMAIL_SUBJECT = 'PDF files from pdfebc'
+EMAIL_PART_SUBJECT = 'PDF files from pdfebc ({}/{})'
+DOWNLOAD_LINK_TEXT = """Your compressed files are too large to be sent by email, but can be downloaded
+from the link below. The link is valid for {} hours.
+
+{}
+"""
+FAILED_FILES_TEXT = """The following files could not be compressed and are not included:
+
+{}
+"""
+DOWNLOAD_URL_PATH = '/api/downloads/'
+# Ways of delivering compressed files
+ATTACHMENTS = 'attachments'
+LINK = 'link'
+
+logger = get_task_logger(__name__)
+
+# What the compression tasks of this process have done with each file, by compression profile
+compression_stats = {}
+_compression_stats_lock = threading.Lock()
+
+Tasks = namedtuple('Tasks', ['process_uploaded_files', 'compress_uploaded_file',
+                             'compress_uploaded_chunk', 'deliver_compressed_files',
+                             'precompress_uploaded_file', 'collect_compressed_files',
+                             'sweep_file_cache', 'submit', 'precompress'])
+
+
+def _file_progress_id(job_id, filename):
+    """Return the id under which the progress of a file in a job is stored."""
+    return '{}:{}'.format(job_id, filename)
+
+
+def _filenames_id(job_id):
+    """Return the id under which the filenames of a job are stored."""
+    return '{}:files'.format(job_id)
+
+
+def publish_progress(celery, job_id, filename, progress):
+    """Store the progress of a file of a job in the result backend.
+
+    Args:
+        celery (Celery): A Celery instance.
+        job_id (str): Id of the job.
+        filename (str): Name of the file.
+        progress (dict): The progress, see the progress module.
+    """
+    celery.backend.store_result(_file_progress_id(job_id, filename), progress, PROGRESS_STATE)
+
+
+def create_progress_reporter(celery, job_id):
+    """Create a progress reporter that stores the progress of each file of a job in the result
+    backend.
+
+    Args:
+        celery (Celery): A Celery instance.
+        job_id (str): Id of the job.
+    Returns:
+        ProgressReporter: A progress reporter.
+    """
+    return ProgressReporter(functools.partial(publish_progress, celery, job_id))
+
+
+def get_job_status(celery, job_id):
+    """Read the status of a job and the progress of each of its files from the result backend.
+
+    Args:
+        celery (Celery): A Celery instance.
+        job_id (str): Id of the job.
+    Returns:
+        dict: A dict with the job id, the state of the job, whether the job is finished, the
+        progress of each file and a version that changes whenever any of the others do. A job
+        that the backend knows nothing about, not even its files, has the EXPIRED_STATE and is
+        finished, as the backend would otherwise report it as pending forever.
+    """
+    filenames = celery.AsyncResult(_filenames_id(job_id)).result
+    files = {}
+    for filename in filenames or []:
+        progress = celery.AsyncResult(_file_progress_id(job_id, filename)).result
+        files[filename] = progress if isinstance(progress, dict) else {'state': QUEUED}
+    state = celery.AsyncResult(job_id).state
+    ready = state in states.READY_STATES
+    if filenames is None and state == states.PENDING:
+        state, ready = EXPIRED_STATE, True
+    status = {'job_id': job_id, 'state': state, 'ready': ready, 'files': files}
+    status['version'] = hashlib.sha1(
+        json.dumps(status, sort_keys=True).encode('utf-8')).hexdigest()
+    return status
+
+
+def get_compression_stats(profile):
+    """Return the compression stats of this process for a compression profile.
+
+    Args:
+        profile (str): Name of the profile.
+    Returns:
+        CompressionStats: The stats.
+    """
+    with _compression_stats_lock:
+        if profile not in compression_stats:
+            compression_stats[profile] = engine.CompressionStats()
+        return compression_stats[profile]
+
+
+def get_failed_files(celery, job_id):
+    """Return the names of the files of a job that could not be compressed.
+
+    Args:
+        celery (Celery): A Celery instance.
+        job_id (str): Id of the job.
+    Returns:
+        List[str]: Names of the failed files, in order.
+    """
+    filenames = celery.AsyncResult(_filenames_id(job_id)).result or []
+    return [filename for filename in filenames
+            if _is_failed(celery.AsyncResult(_file_progress_id(job_id, filename)).result)]
+
+
+def _is_failed(progress):
+    return isinstance(progress, dict) and progress.get('state') == FAILED
+
+
+def construct_tasks(celery, settings, manifest_store=None, job_registry=None, storage=None):
+    """Construct and register the Celery tasks. The tasks read the current settings each time
+    they run, so reloaded settings take effect without restarting the workers.
+
+    Args:
+        celery (Celery): A Celery instance.
+        settings (SettingsHolder): Holder of the settings of the app.
+        manifest_store: Store for the manifests of uploaded files, which are cleared along
+            with the session upload directories.
+        job_registry: Registry of the jobs of each session. Defaults to a registry in the
+            memory of the current process.
+        storage: Storage backend for the uploaded files and downloads. The files of a session
+            are fetched from it before they are compressed. Defaults to the local file cache.
+    Returns:
+        Tasks: The registered tasks, a submit function that enqueues the compression of a
+        session's files with a compression profile in the mode given by the settings, and a
+        precompress function that enqueues the speculative compression of an uploaded file in
+        eager mode.
+    """
+    if job_registry is None:
+        job_registry = LocalJobRegistry()
+    if storage is None:
+        storage = LocalStorage()
+    cache = CompressionCache(get_compression_cache_path(),
+                             settings.current.compression_cache_size)
+
+    def get_cache():
+        """Return the compression cache with the current maximum size, or None if the cache
+        is disabled.
+        """
+        cache.max_size = settings.current.compression_cache_size
+        return cache if cache.max_size else None
+
+    pools = {}
+    pools_lock = threading.Lock()
+
+    def get_profile(name=None):
+        """Return the compression profile with the given name, or the default profile if no
+        name is given. A profile that has since been removed from the settings falls back to
+        the default profile, so that jobs that were submitted before a reload still run.
+        """
+        current = settings.current
+        if name is not None and name not in current.compression_profiles:
+            logger.warning("Unknown compression profile %s, using %s instead", name,
+                           current.default_compression_profile)
+            name = None
+        return current.compression_profiles[name or current.default_compression_profile]
+
+    def get_interpreter_on_start():
+        """Return the function that sets the resource limits of interpreters in the pool when
+        they start. Only the memory is limited, as CPU time adds up over all jobs of an
+        interpreter.
+        """
+        memory = settings.current.ghostscript_max_memory
+        if memory is None:
+            return None
+        return functools.partial(engine.set_resource_limits,
+                                 limits=engine.ResourceLimits(memory, None))
+
+    def get_pool(profile):
+        """Return the Ghostscript interpreter pool of the current process for the current
+        settings and the given compression profile, or None if the pool is disabled. The
+        arguments of an interpreter are fixed when it starts, so each profile has a pool of its
+        own, which is started the first time the profile is used. Like the SMTP pools,
+        interpreters can't be shared across forks, and are replaced when the settings are
+        reloaded.
+        """
+        current = settings.current
+        if not current.ghostscript_pool:
+            return None
+        pid = os.getpid()
+        with pools_lock:
+            if pools.get('pid') != pid or pools.get('settings') is not current:
+                if pools.get('pid') == pid:
+                    for pool in pools['pools'].values():
+                        pool.close()
+                pools.update(pid=pid, settings=current, pools={})
+            if profile.name not in pools['pools']:
+                pools['pools'][profile.name] = gspool.GhostscriptPool(
+                    current.gs_binary, profile.gs_args, [file.FILE_CACHE],
+                    current.compression_workers,
+                    max_jobs=current.ghostscript_pool_max_jobs,
+                    max_memory=current.ghostscript_pool_max_memory,
+                    on_start=get_interpreter_on_start())
+            return pools['pools'][profile.name]
+
+    mailers = {}
+
+    def get_mailer():
+        """Return the mailer of the current process for the current settings. Pools of SMTP
+        connections can't be shared across forks, and are replaced when the settings are
+        reloaded.
+        """
+        current = settings.current
+        if current.email_config is None:
+            raise config_utils.ConfigurationError(
+                "No email settings, check the pdfebc-core config file!")
+        pid = os.getpid()
+        if mailers.get('pid') != pid or mailers.get('settings') is not current:
+            if mailers.get('pid') == pid:
+                mailers['mailer'].pool.close()
+            pool = mail.SmtpPool(mail.get_smtp_config(current.email_config),
+                                 size=current.smtp_pool_size, timeout=current.smtp_timeout,
+                                 starttls=current.smtp_starttls)
+            mailers.update(pid=pid, settings=current,
+                           mailer=mail.Mailer(pool, retries=current.smtp_retries,
+                                              backoff=current.smtp_retry_backoff))
+        return mailers['mailer']
+
+    def get_limits():
+        """Return the resource limits of Ghostscript processes for the current settings, or
+        None if there are none.
+        """
+        current = settings.current
+        if current.ghostscript_max_memory is None and current.ghostscript_max_cpu_seconds is None:
+            return None
+        return engine.ResourceLimits(current.ghostscript_max_memory,
+                                     current.ghostscript_max_cpu_seconds)
+
+    def log_compression_stats(profile):
+        """Log how many files this process has compressed, skipped or passed through with a
+        compression profile, along with the compression ratio and the Ghostscript seconds per
+        megabyte, which the cost of the profile can be tuned by.
+        """
+        summary = get_compression_stats(profile.name).summary()
+        logger.info("Compression decisions so far with the %s profile: %s, ratio: %s, "
+                    "Ghostscript seconds per MB: %s, estimated Ghostscript seconds saved: %s",
+                    profile.name,
+                    ', '.join('{} {}'.format(summary[decision]['files'], decision)
+                              for decision in engine.DECISIONS),
+                    summary['ratio'], summary['seconds_per_megabyte'],
+                    summary['estimated_seconds_saved'])
+
+    def clear_manifest(session_id):
+        """Clear the manifest of the session, if there is a manifest store."""
+        if manifest_store is not None:
+            manifest_store.clear(session_id)
+
+    def save_compressed_files(session_id, filepaths):
+        """Store the compressed files of a session, so that they can be downloaded from the
+        web processes until the session expires.
+        """
+        for path in filepaths:
+            storage.save_compressed(session_id, os.path.basename(path))
+
+    def compress_file(src, out, progress, profile):
+        """Compress a single file with the current settings and a compression profile."""
+        current = settings.current
+        return engine.compress_pdf(src, out, current.gs_binary, current.compression_timeout,
+                                   cache=get_cache(),
+                                   progress=progress,
+                                   analyze=current.compression_analysis,
+                                   stats=get_compression_stats(profile.name),
+                                   pool=get_pool(profile),
+                                   limits=get_limits(),
+                                   profile=profile)
+
+    @celery.task(bind=True)
+    def process_uploaded_files(self, session_id, profile=None):
+        """Compress the files uploaded to the session upload directory and send them
+        by email with the email settings from the pdfebc-core config. The progress of
+        each file is published to the result backend under the id of the task.
+
+        Also clears the session upload directory when done. Does nothing if another task
+        holds the lock of the session.
+
+        Args:
+            session_id (str): Id of the session.
+            profile (str): Name of the compression profile, None for the default profile.
+        """
+        current = settings.current
+        with job_registry.session_lock(session_id, current.job_ttl) as acquired:
+            if not acquired:
+                logger.warning("Session %s is locked by another task, skipping job %s",
+                               session_id, self.request.id)
+                return
+            try:
+                session_upload_dir = storage.fetch_session(session_id)
+                progress = create_progress_reporter(celery, self.request.id)
+                profile = get_profile(profile)
+                failures = []
+                filepaths = compress_uploaded_files(session_upload_dir, current.gs_binary,
+                                                    workers=current.compression_workers,
+                                                    timeout=current.compression_timeout,
+                                                    cache=get_cache(),
+                                                    progress=progress,
+                                                    analyze=current.compression_analysis,
+                                                    stats=get_compression_stats(profile.name),
+                                                    pool=get_pool(profile),
+                                                    limits=get_limits(),
+                                                    failures=failures,
+                                                    profile=profile)
+                log_compression_stats(profile)
+                save_compressed_files(session_id, filepaths)
+                deliver([filepaths], session_id,
+                        [os.path.basename(src) for src, _ in failures])
+            finally:
+                job_registry.release(session_id, self.request.id)
+
+    @celery.task
+    def compress_uploaded_file(session_id, filename, job_id, profile=None):
+        """Compress a single file in the session upload directory, and store the compressed
+        file so that it can be delivered by another worker.
+
+        Args:
+            session_id (str): Id of the session.
+            filename (str): Name of the file in the session upload directory.
+            job_id (str): Id of the job to publish the progress of the file under.
+            profile (str): Name of the compression profile, None for the default profile.
+        Returns:
+            str: Path to the compressed file.
+        """
+        src = storage.fetch_upload(session_id, filename)
+        out_dir = os.path.join(storage.get_session_dir(session_id), COMPRESSED_FILES_DIRNAME)
+        os.makedirs(out_dir, exist_ok=True)
+        out = compress_file(src, os.path.join(out_dir, filename),
+                            create_progress_reporter(celery, job_id), get_profile(profile))
+        storage.save_compressed(session_id, filename)
+        return out
+
+    @celery.task
+    def compress_uploaded_chunk(session_id, filenames, job_id, profile=None):
+        """Compress a chunk of the files in the session upload directory, one at a time. Used
+        as the header of the chord that is submitted in fan-out mode. Files that fail for any
+        reason are left out, and are reported as failed in their progress, as an exception
+        would fail the chord, so that its body never delivers the job or releases it.
+
+        Args:
+            session_id (str): Id of the session.
+            filenames (List[str]): Names of the files in the session upload directory.
+            job_id (str): Id of the job to publish the progress of the files under.
+            profile (str): Name of the compression profile, None for the default profile.
+        Returns:
+            List[str]: Names of the compressed files, which are stored in the storage backend
+            as the worker that delivers them may not be the one that compressed them.
+        """
+        compressed = []
+        for filename in filenames:
+            try:
+                compress_uploaded_file(session_id, filename, job_id, profile)
+                compressed.append(filename)
+            except engine.CompressionError as exc:
+                logger.warning("Could not compress %s of session %s: %s", filename, session_id,
+                               exc)
+            except Exception as exc:
+                logger.exception("Unexpected error when compressing %s of session %s",
+                                 filename, session_id)
+                publish_progress(celery, job_id, filename,
+                                 {'state': FAILED, 'bytes_in': None, 'bytes_out': None,
+                                  'elapsed': None, 'error': str(exc), 'reason': None})
+        log_compression_stats(get_profile(profile))
+        return compressed
+
+    @celery.task
+    def precompress_uploaded_file(session_id, filename, sha256, profile=None):
+        """Speculatively compress a file right after it has been uploaded, see the eager
+        module. Does nothing if the file has since been removed or replaced, or if the job of
+        the session has already claimed it. Counts the task out of the tasks that the session
+        has in flight, see precompress.
+
+        Args:
+            session_id (str): Id of the session.
+            filename (str): Name of the file in the session upload directory.
+            sha256 (str): Hex digest of the SHA-256 of the uploaded file.
+            profile (str): Name of the compression profile, None for the default profile.
+        """
+        try:
+            if manifest_store is not None and \
+                    manifest_store.get(session_id).get(filename, {}).get('sha256') != sha256:
+                logger.info("%s of session %s was removed or replaced, not compressing it",
+                            filename, session_id)
+                return
+            try:
+                src = storage.fetch_upload(session_id, filename)
+                profile = get_profile(profile)
+                eager.precompress(src, sha256,
+                                  eager.get_eager_dir_path(os.path.dirname(src), profile.name),
+                                  functools.partial(compress_file, profile=profile))
+            except FileNotFoundError:
+                logger.info("%s of session %s was removed, not compressing it",
+                            filename, session_id)
+            except engine.CompressionError as exc:
+                logger.warning("Speculative compression of %s of session %s failed, leaving "
+                               "it to the job: %s", filename, session_id, exc)
+        finally:
+            job_registry.add_in_flight(session_id, -1, settings.current.job_ttl)
+
+    def collect_uploaded_files(session_id, job_id, profile):
+        """Collect the speculative results of the files in the session upload directory that
+        were compressed with the profile of the job, waiting for those that are still being
+        compressed, and compress the rest.
+
+        Returns:
+            Tuple[List[str], List[str]]: Paths to the compressed files and names of the files
+            that could not be compressed.
+        """
+        current = settings.current
+        session_upload_dir = storage.fetch_session(session_id)
+        eager_dir = eager.get_eager_dir_path(session_upload_dir, profile.name)
+        out_dir = os.path.join(session_upload_dir, COMPRESSED_FILES_DIRNAME)
+        os.makedirs(out_dir, exist_ok=True)
+        manifest = manifest_store.get(session_id) if manifest_store is not None else {}
+        src_paths = engine.get_pdf_paths(session_upload_dir)
+        progress = create_progress_reporter(celery, job_id)
+        hashes = {}
+        for src in src_paths:
+            progress.queued(src)
+            sha256 = manifest.get(os.path.basename(src), {}).get('sha256')
+            # Only the first of several identical files collects their result, so that none
+            # of the others waits for a claim held by this job
+            if sha256 is not None and sha256 not in hashes.values():
+                hashes[src] = sha256
+
+        def collect(src):
+            filename = os.path.basename(src)
+            out = os.path.join(out_dir, filename)
+            sha256 = hashes.get(src)
+            final_progress = None if sha256 is None else \
+                eager.collect(sha256, eager_dir, out, current.compression_timeout)
+            if final_progress is not None:
+                publish_progress(celery, job_id, filename, final_progress)
+                return out
+            try:
+                return compress_file(src, out, progress, profile)
+            except engine.CompressionError as exc:
+                logger.warning("Could not compress %s of session %s: %s", filename,
+                               session_id, exc)
+                return None
+
+        with ThreadPoolExecutor(max_workers=current.compression_workers) as executor:
+            results = list(executor.map(collect, src_paths))
+        return ([path for path in results if path is not None],
+                [os.path.basename(src) for src, path in zip(src_paths, results) if path is None])
+
+    @celery.task(bind=True)
+    def collect_compressed_files(self, session_id, profile=None):
+        """Collect the files that were compressed speculatively in eager mode, compress those
+        that weren't and deliver them, see process_uploaded_files. The progress of each file is
+        published to the result backend under the id of the task.
+
+        Args:
+            session_id (str): Id of the session.
+            profile (str): Name of the compression profile, None for the default profile.
+        """
+        with job_registry.session_lock(session_id, settings.current.job_ttl) as acquired:
+            if not acquired:
+                logger.warning("Session %s is locked by another task, skipping job %s",
+                               session_id, self.request.id)
+                return
+            try:
+                profile = get_profile(profile)
+                with metrics.COMPRESS_SECONDS.time():
+                    filepaths, failed = collect_uploaded_files(session_id, self.request.id,
+                                                               profile)
+                log_compression_stats(profile)
+                save_compressed_files(session_id, filepaths)
+                deliver([filepaths], session_id, failed)
+            finally:
+                job_registry.release(session_id, self.request.id)
+
+    def send_download_link(mailer, filepaths, note=''):
+        """Stream an archive of the compressed files straight into the storage backend and
+        send a signed link to it, followed by the note. Only the given files are archived, so
+        nothing else that is in their directory is delivered.
+        """
+        current = settings.current
+        download_id = download.create_download_id()
+        storage.save_download(download_id, stream_archive(os.path.dirname(filepaths[0]), TAR,
+                                                          filepaths=filepaths))
+        url = current.external_url.rstrip('/') + DOWNLOAD_URL_PATH + \
+            download.sign_download_id(current.secret_key, download_id)
+        text = DOWNLOAD_LINK_TEXT.format(current.download_link_ttl // 3600, url) + note
+        smtp_config = mailer.pool.smtp_config
+        mailer.send(mail.build_message(smtp_config.user, smtp_config.receiver, EMAIL_SUBJECT,
+                                       text, []))
+
+    def send_attachments(mailer, filepaths, note=''):
+        """Send the compressed files as attachments, split into as many messages as needed
+        to stay below the maximum message size. Each message is built right before it is sent,
+        so only one encoded message is held in memory at a time. The note is the text of the
+        first message.
+
+        Raises:
+            pdfebc_web.util.mail.AttachmentTooLargeError
+        """
+        plan = mail.plan_messages(filepaths, settings.current.max_message_size)
+        smtp_config = mailer.pool.smtp_config
+        for number, paths in enumerate(plan, start=1):
+            subject = EMAIL_SUBJECT if len(plan) == 1 else \
+                EMAIL_PART_SUBJECT.format(number, len(plan))
+            mailer.send(mail.build_message(smtp_config.user, smtp_config.receiver, subject,
+                                           note if number == 1 else '', paths))
+
+    def deliver(chunks, session_id, failed=()):
+        """Send the compressed files by email over the pooled SMTP connections of the worker,
+        and clear the uploads of the session and its manifest. The compressed files are kept
+        until the session expires, so that they can still be downloaded.
+
+        The files are split across several messages if they don't fit in one. If they are
+        larger in total than the link delivery threshold, or any single file is too large for
+        a message, a download link is sent instead. Files that could not be compressed are
+        listed in the email, and the rest are delivered as usual.
+
+        Args:
+            chunks (List[List[str]]): Paths to the compressed files, in the chunks that they
+                were compressed in. The files are delivered in order of their names.
+            session_id (str): Id of the session.
+            failed (List[str]): Names of the files that could not be compressed.
+        Raises:
+            pdfebc_web.util.engine.CompressionError: If no file could be compressed.
+        """
+        mailer = get_mailer()
+        filepaths = sorted((path for chunk in chunks for path in chunk), key=os.path.basename)
+        if not filepaths and failed:
+            raise engine.CompressionError("None of the files of session {} could be compressed"
+                                          .format(session_id))
+        note = FAILED_FILES_TEXT.format('\n'.join(sorted(failed))) if failed else ''
+        total_size = sum(os.stat(path).st_size for path in filepaths)
+        start = time.monotonic()
+        method = LINK
+        if total_size > settings.current.link_delivery_threshold:
+            send_download_link(mailer, filepaths, note)
+        else:
+            try:
+                send_attachments(mailer, filepaths, note)
+                method = ATTACHMENTS
+            except mail.AttachmentTooLargeError:
+                send_download_link(mailer, filepaths, note)
+        metrics.DELIVERY_SECONDS.labels(method).observe(time.monotonic() - start)
+        metrics.DELIVERED_BYTES.labels(method).inc(total_size)
+        storage.delete_uploads(session_id)
+        clear_manifest(session_id)
+
+    @celery.task(bind=True)
+    def deliver_compressed_files(self, chunks, session_id):
+        """Fetch the compressed files from the storage backend and deliver them, see deliver,
+        and release the job. Used as the body of the chord that is submitted in fan-out mode,
+        where the id of the task is the id of the job. Does nothing if another task holds the
+        lock of the session.
+
+        Args:
+            chunks (List[List[str]]): Names of the compressed files, in the chunks that they
+                were compressed in.
+            session_id (str): Id of the session.
+        """
+        with job_registry.session_lock(session_id, settings.current.job_ttl) as acquired:
+            if not acquired:
+                logger.warning("Session %s is locked by another task, skipping delivery of "
+                               "job %s", session_id, self.request.id)
+                return
+            try:
+                chunks = [[storage.fetch_compressed(session_id, filename) for filename in chunk]
+                          for chunk in chunks]
+                deliver(chunks, session_id, get_failed_files(celery, self.request.id))
+            finally:
+                job_registry.release(session_id, self.request.id)
+
+    def is_session_busy(path):
+        """Return True if a job is registered for the session of a session upload directory,
+        or a task holds its lock.
+        """
+        session_id = os.path.basename(path)
+        if job_registry.get(session_id) is not None:
+            return True
+        with job_registry.session_lock(session_id, settings.current.job_ttl) as acquired:
+            return not acquired
+
+    @celery.task
+    def sweep_file_cache():
+        """Evict session upload directories that have been inactive for longer than the
+        session TTL, and then the least recently active ones while the file cache is over its
+        quota. Sessions with a running job are kept. Also deletes downloads whose links have
+        expired, and expired sessions and downloads in the storage backend. Scheduled to run
+        periodically with Celery beat.
+
+        Returns:
+            dict: The amount of directories, bytes and inodes that were reclaimed, the amount
+            of deleted downloads and the amount of deleted sessions and downloads in storage.
+        """
+        current = settings.current
+        report = janitor.sweep_file_cache(
+            file.FILE_CACHE, current.session_ttl, current.file_cache_quota,
+            on_evict=lambda path: clear_manifest(os.path.basename(path)),
+            is_busy=is_session_busy)
+        logger.info("Evicted %d session directories, reclaiming %d bytes and %d inodes",
+                    report.directories, report.bytes, report.inodes)
+        downloads = download.sweep_downloads(get_downloads_path(), current.download_link_ttl)
+        logger.info("Deleted %d expired downloads", downloads)
+        stored = storage.sweep(current.session_ttl, current.download_link_ttl,
+                               on_evict=clear_manifest)
+        logger.info("Deleted %d expired sessions and downloads from storage", stored)
+        return dict(report._asdict(), downloads=downloads, stored=stored)
+
+    if settings.current.janitor_interval:
+        celery.add_periodic_task(settings.current.janitor_interval, sweep_file_cache.s(),
+                                 name='sweep file cache')
+
+    def submit(session_id, profile=None):
+        """Enqueue the compression of the files in the session upload directory with a
+        compression profile. The job is sent to the small or large job queue depending on the
+        total size of the files weighed by the cost of the profile, with a priority that drops
+        as the weighed size grows. In fan-out mode, the files are split into at most
+        as many chunks as the session concurrency allows, one task per chunk is spread across
+        the workers and the files are delivered when all of them are done. In eager mode, a
+        single task collects the files that were compressed speculatively as they were
+        uploaded. Otherwise, a single task handles the whole session.
+
+        If a job is already registered for the session, nothing is enqueued and the id of that
+        job is returned instead.
+
+        Args:
+            session_id (str): Id of the session.
+            profile (str): Name of the compression profile, None for the default profile.
+        Returns:
+            str: Id of the job, which can be passed to get_job_status.
+        Raises:
+            ValueError: If there is no compression profile with the given name.
+        """
+        if profile is not None and profile not in settings.current.compression_profiles:
+            raise ValueError("Unknown compression profile '{}'".format(profile))
+        job_id = str(uuid.uuid4())
+        registered = job_registry.register(session_id, job_id, settings.current.job_ttl)
+        if registered != job_id:
+            logger.info("Session %s already has job %s, not submitting another one",
+                        session_id, registered)
+            return registered
+        try:
+            _submit(session_id, job_id, profile)
+        except Exception:
+            job_registry.release(session_id, job_id)
+            raise
+        return job_id
+
+    def _submit(session_id, job_id, profile):
+        """Enqueue the tasks of a registered job, see submit. The compressed files of the
+        previous job of the session are deleted first, so they aren't downloaded along with
+        those of this job.
+        """
+        current = settings.current
+        storage.delete_compressed_files(session_id)
+        cost = get_profile(profile).cost
+        sizes = storage.list_uploads(session_id)
+        filenames = [filename for filename, _ in sizes]
+        celery.backend.store_result(_filenames_id(job_id), filenames, PROGRESS_STATE)
+        plan = scheduling.plan_job(sizes, current.small_job_threshold, current.small_job_queue,
+                                   current.large_job_queue, current.session_concurrency, cost)
+        logger.info("Submitting job %s of session %s as a %s job with priority %d",
+                    job_id, session_id, plan.size_class, plan.priority)
+        if current.eager_compression:
+            collect_compressed_files.apply_async((session_id, profile), task_id=job_id,
+                                                 queue=plan.queue, priority=plan.priority)
+        elif not current.compression_fan_out:
+            process_uploaded_files.apply_async((session_id, profile), task_id=job_id,
+                                               queue=plan.queue, priority=plan.priority)
+        else:
+            header = [compress_uploaded_chunk.s(session_id, chunk, job_id, profile)
+                      .set(queue=plan.queue, priority=plan.priority)
+                      for chunk in plan.chunks]
+            chord(header)(deliver_compressed_files.s(session_id).set(task_id=job_id,
+                                                                     priority=plan.priority))
+
+    def precompress(session_id, filename, sha256, size, profile=None):
+        """Enqueue the speculative compression of an uploaded file with a compression profile,
+        if eager mode is enabled. The task is routed like a job with only that file, and its
+        priority drops with the amount of speculative compressions that the session already
+        has in flight, so that a session uploading many files doesn't hold up the others.
+
+        Args:
+            session_id (str): Id of the session.
+            filename (str): Name of the file in the session upload directory.
+            sha256 (str): Hex digest of the SHA-256 of the uploaded file.
+            size (int): Size of the uploaded file in bytes.
+            profile (str): Name of the compression profile that the session is expected to
+                choose, None for the default profile.
+        """
+        current = settings.current
+        if not current.eager_compression:
+            return
+        cost = get_profile(profile).cost
+        in_flight = job_registry.add_in_flight(session_id, 1, current.job_ttl) - 1
+        plan = scheduling.plan_job([(filename, size)], current.small_job_threshold,
+                                   current.small_job_queue, current.large_job_queue,
+                                   current.session_concurrency, cost, in_flight)
+        try:
+            precompress_uploaded_file.apply_async((session_id, filename, sha256, profile),
+                                                  queue=plan.queue, priority=plan.priority)
+        except Exception:
+            job_registry.add_in_flight(session_id, -1, current.job_ttl)
+            raise
+
+    return Tasks(process_uploaded_files, compress_uploaded_file, compress_uploaded_chunk,
+                 deliver_compressed_files, precompress_uploaded_file, collect_compressed_files,
+                 sweep_file_cache, submit, precompress)
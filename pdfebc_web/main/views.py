@@ -8,82 +8,117 @@
 .. moduleauthor:: Simon Larsén <slarse@kth.se>
 """
 import os
-import uuid
-from pdfebc_core import email_utils, config_utils
-from flask import render_template, session, flash, Blueprint, redirect, url_for
+import time
+from flask import (render_template, flash, Blueprint, redirect, url_for, session, request,
+                   Response, abort)
 from werkzeug import secure_filename
 from .forms import FileUploadForm, CompressFilesForm
-from ..util.file import (create_session_upload_dir,
-                         session_upload_dir_exists,
-                         get_session_upload_dir_path,
-                         delete_session_upload_dir,
-                         compress_uploaded_files)
+from .tasks import get_job_status
+from ..util import file, metrics
+from ..util.limits import (get_upload_quotas, get_compress_buckets, stream_within_quota,
+                           RateLimitError)
+from ..util.manifest import create_entry, get_replaced_size
+from ..util.session import get_session_id, JOB_ID_KEY, PROFILE_KEY
+from ..util.upload import UploadError
 
 PDFEBC_CORE_GITHUB = 'https://github.com/slarse/pdfebc-core'
 PDFEBC_WEB_GITHUB = 'https://github.com/slarse/pdfebc-web'
 
 
-SESSION_ID_KEY = 'session_id'
-
-
-def construct_blueprint(celery):
+def construct_blueprint(celery, settings, manifest_store, limiter, job_registry, storage, tasks):
     """Construct the main blueprint.
 
     Args:
         celery (Celery): A Celery instance.
+        settings (SettingsHolder): Holder of the settings of the app.
+        manifest_store: Store for the manifests of uploaded files.
+        limiter: Limiter for the upload quotas and compression triggers.
+        job_registry: Registry of the jobs of each session.
+        storage: Storage backend for the uploaded files and downloads.
+        tasks (Tasks): The Celery tasks, see tasks.construct_tasks.
     Returns:
         Blueprint: A Flask Blueprint.
     """
     main = Blueprint('main', __name__)
-    #TODO This is a suboptimal way of reading the config, fix it!
-    if config_utils.valid_config_exists():
-        config = config_utils.read_config()
-        gs_binary = config_utils.get_attribute_from_config(config, config_utils.DEFAULT_SECTION_KEY,
-                                                           config_utils.GS_DEFAULT_BINARY_KEY)
-    else:
-        gs_binary = 'gs'
-
-    @celery.task
-    def process_uploaded_files(session_id):
-        """Compress the files uploaded to the session upload directory and send them
-        by email with the preconfigured values in the pdfebc-core config.
-
-        Also clears the session upload directory when done.
-
-        Args:
-            session_id (str): Id of the session.
-        """
-        session_upload_dir = get_session_upload_dir_path(session_id)
-        filepaths = compress_uploaded_files(session_upload_dir, gs_binary)
-        email_utils.send_files_preconf(filepaths)
-        delete_session_upload_dir(session_id)
+    pipeline_collector = metrics.PipelineCollector(
+        celery, lambda: [settings.current.small_job_queue, settings.current.large_job_queue],
+        lambda: file.FILE_CACHE)
 
     @main.route('/', methods=['GET', 'POST'])
+    @metrics.REQUEST_SECONDS.labels('main.index').time()
     def index():
-        """View for the index page."""
-        compress_form = CompressFilesForm()
+        """View for the index page. The session upload directory is created on the first
+        upload, and the uploaded files are listed from the manifest of the session. In eager
+        mode, each uploaded file is enqueued for compression right away with the profile that
+        the session chose for its last job. The files are compressed with the profile chosen in
+        the compress form, which defaults to that same profile. The progress of the last job
+        of the session is shown until it is finished.
+        """
+        profiles = settings.current.compression_profiles
+        last_profile = session.get(PROFILE_KEY)
+        if last_profile not in profiles:
+            last_profile = settings.current.default_compression_profile
+        compress_form = CompressFilesForm(profile=last_profile)
+        compress_form.profile.choices = [
+            (profile.name, profile.label) for profile in profiles.values()]
         form = FileUploadForm()
-        if SESSION_ID_KEY not in session:
-            session[SESSION_ID_KEY] = str(uuid.uuid4())
-        session_id = session[SESSION_ID_KEY]
-        session_upload_dir_path = get_session_upload_dir_path(session_id)
-        if not session_upload_dir_exists(session_id):
-            create_session_upload_dir(session_id)
+        session_id = get_session_id()
         if form.validate_on_submit():
-            file = form.upload.data
-            filename = secure_filename(file.filename)
-            file.save(
-                os.path.join(session_upload_dir_path, filename))
-            flash("{} was successfully uploaded!".format(filename))
+            upload = form.upload.data
+            filename = secure_filename(upload.filename)
+            out = os.path.join(storage.ensure_session_dir(session_id), filename)
+            quotas = get_upload_quotas(settings.current, session_id, request.remote_addr)
+            start = time.monotonic()
+            try:
+                result = stream_within_quota(
+                    limiter, quotas, upload.stream, out, settings.current.max_upload_size,
+                    get_replaced_size(manifest_store.get(session_id), filename))
+            except UploadError as error:
+                flash("{} was not uploaded: {}".format(filename, error))
+            else:
+                metrics.record_upload(result.size, time.monotonic() - start)
+                storage.save_upload(session_id, filename)
+                manifest_store.add(session_id, filename, create_entry(result.size, result.sha256))
+                tasks.precompress(session_id, filename, result.sha256, result.size,
+                                  last_profile)
+                flash("{} was successfully uploaded!".format(filename))
+        manifest = manifest_store.get(session_id)
         if compress_form.validate_on_submit():
-            process_uploaded_files.delay(session_id)
-            flash("Your files are being compressed and will be sent by email upon completion.")
+            if not manifest:
+                flash("There are no uploaded files to compress.")
+            elif job_registry.get(session_id) is not None:
+                flash("Your files are already being compressed.")
+            else:
+                try:
+                    limiter.consume(get_compress_buckets(settings.current, session_id,
+                                                         request.remote_addr))
+                except RateLimitError as error:
+                    flash("You are compressing files too often, please try again in {} "
+                          "seconds.".format(error.retry_after))
+                else:
+                    session[PROFILE_KEY] = compress_form.profile.data
+                    session[JOB_ID_KEY] = tasks.submit(session_id, compress_form.profile.data)
+                    flash("Your files are being compressed and will be sent by email upon "
+                          "completion.")
             return redirect(url_for('main.index'))
-        uploaded_files = [] if not os.path.isdir(session_upload_dir_path) else [
-            file for file in os.listdir(session_upload_dir_path) if file.endswith('.pdf')]
+        job_id = session.get(JOB_ID_KEY)
+        if job_id is not None and get_job_status(celery, job_id)['ready']:
+            del session[JOB_ID_KEY]
+            job_id = None
         return render_template('index.html', form=form,
-                               uploaded_files=uploaded_files,
-                               compress_form=compress_form)
+                               uploaded_files=sorted(manifest),
+                               compress_form=compress_form,
+                               job_id=job_id)
+
+    @main.route('/metrics')
+    def metrics_view():
+        """View for scraping the metrics of the app and the workers in the Prometheus text
+        format. Not found if prometheus_client is not installed.
+        """
+        latest = metrics.generate_latest([pipeline_collector])
+        if latest is None:
+            abort(404)
+        return Response(latest, content_type=metrics.CONTENT_TYPE)
 
     @main.route('/about')
     def about():
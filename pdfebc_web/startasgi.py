@@ -0,0 +1,11 @@
+"""Module for serving the pdfebc-web application with an ASGI server.
+
+.. module:: startasgi
+    :platform: Linux
+    :synopsis: Single-script module for serving pdfebc-web with an ASGI server.
+.. moduleauthor: Simon Larsén <slarse@kth.se>
+"""
+from .asgi import create_asgi_app
+from .startapp import app
+
+asgi_app = create_asgi_app(app)
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""This module contains a cheap structural analysis of PDF files, used to predict whether
+Ghostscript will make a file any smaller.
+
+Ghostscript mostly saves space by downsampling images and compressing what is not already
+compressed. The analysis scans the dictionaries of the stream objects in a file, without
+decoding any streams, and counts the images, their filters and resolution, the streams that
+have no filter at all and the object streams. A file whose images are all lossily (or bilevel)
+compressed at no more than the target resolution, and whose other streams are all compressed,
+has most likely been optimized already, and is predicted not to shrink.
+
+.. module:: analysis
+    :platform: Unix
+    :synopsis: Prediction of the gain of compressing PDF files.
+
+.. moduleauthor:: Simon Larsén <slarse@kth.se>
+"""
+import mmap
+import os
+import re
+from collections import namedtuple, Counter
+
+# Only this many bytes of a file are scanned, larger files are always compressed
+MAX_ANALYSIS_SIZE = 64 * 1024**2
+# Resolution that Ghostscript downsamples images to with -dPDFSETTINGS=/ebook
+TARGET_DPI = 150
+# Images up to this factor above the target resolution aren't worth downsampling
+DPI_MARGIN = 1.5
+POINTS_PER_INCH = 72
+PRECOMPRESSED_IMAGE_FILTERS = frozenset(['DCTDecode', 'JPXDecode', 'JBIG2Decode',
+                                         'CCITTFaxDecode'])
+
+_STREAM_DICT = re.compile(rb'\d+\s+\d+\s+obj\s*<<(.{0,4096}?)>>\s*stream\r?\n', re.DOTALL)
+_FILTER = re.compile(rb'/Filter\s*(\[[^\]]*\]|/\w+)')
+_FILTER_NAME = re.compile(rb'/(\w+)')
+_IMAGE = re.compile(rb'/Subtype\s*/Image\b')
+_OBJECT_STREAM = re.compile(rb'/Type\s*/ObjStm\b')
+_WIDTH = re.compile(rb'/Width\s+(\d+)')
+_MEDIA_BOX = re.compile(rb'/MediaBox\s*\[\s*([-\d.]+)\s+[-\d.]+\s+([-\d.]+)\s+[-\d.]+\s*\]')
+
+PdfAnalysis = namedtuple('PdfAnalysis', ['streams', 'unfiltered_streams', 'images',
+                                         'image_filters', 'max_image_dpi', 'object_streams',
+                                         'complete'])
+
+
+def analyze_pdf(path):
+    """Scan the structure of a PDF file.
+
+    Args:
+        path (str): Path to the PDF file.
+    Returns:
+        PdfAnalysis: The analysis. Files larger than MAX_ANALYSIS_SIZE are only partially
+        scanned, and are marked as incomplete.
+    """
+    size = os.stat(path).st_size
+    if size == 0:
+        return PdfAnalysis(0, 0, 0, {}, None, 0, True)
+    with open(path, 'rb') as file, \
+            mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        end = min(size, MAX_ANALYSIS_SIZE)
+        streams = unfiltered_streams = images = object_streams = 0
+        image_filters = Counter()
+        max_image_width = None
+        for match in _STREAM_DICT.finditer(data, 0, end):
+            dictionary = match.group(1)
+            streams += 1
+            filters = _get_filters(dictionary)
+            if not filters:
+                unfiltered_streams += 1
+            if _OBJECT_STREAM.search(dictionary):
+                object_streams += 1
+            elif _IMAGE.search(dictionary):
+                images += 1
+                image_filters.update(filters or ['None'])
+                width = _WIDTH.search(dictionary)
+                if width is not None:
+                    max_image_width = max(max_image_width or 0, int(width.group(1)))
+        media_box = _MEDIA_BOX.search(data, 0, end)
+        page_width = abs(float(media_box.group(2)) - float(media_box.group(1))) \
+            if media_box is not None else 0
+    max_image_dpi = None
+    if max_image_width is not None and page_width > 0:
+        max_image_dpi = max_image_width / (page_width / POINTS_PER_INCH)
+    return PdfAnalysis(streams, unfiltered_streams, images, dict(image_filters),
+                       max_image_dpi, object_streams, size <= MAX_ANALYSIS_SIZE)
+
+
+def is_worth_compressing(analysis, target_dpi=TARGET_DPI):
+    """Predict whether Ghostscript will make a file smaller. When in doubt, it will.
+
+    Args:
+        analysis (PdfAnalysis): Analysis of the file.
+        target_dpi (int): Resolution that Ghostscript downsamples images to.
+    Returns:
+        bool: False if the file is predicted not to shrink.
+    """
+    if not analysis.complete or analysis.unfiltered_streams:
+        return True
+    if any(image_filter not in PRECOMPRESSED_IMAGE_FILTERS
+           for image_filter in analysis.image_filters):
+        return True
+    if analysis.max_image_dpi is not None and \
+            analysis.max_image_dpi > target_dpi * DPI_MARGIN:
+        return True
+    # A file without images or object streams may still have fonts and content to spare
+    return not (analysis.images or analysis.object_streams)
+
+
+def _get_filters(dictionary):
+    """Return the names of the filters in a stream dictionary."""
+    match = _FILTER.search(dictionary)
+    if match is None:
+        return []
+    return [name.decode('ascii') for name in _FILTER_NAME.findall(match.group(1))]
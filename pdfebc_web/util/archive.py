@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""This module contains functions for archiving directories.
+
+Gzipped tarballs are compressed in parallel: the tar stream is cut into fixed-size blocks that
+are deflated on a pool of threads (zlib releases the GIL) and written out in order as separate
+gzip members, which any gzip reader concatenates transparently. As the compressed PDFs gain very
+little from a second deflate pass, plain tar and stored zip archives are also supported.
+
+.. module:: archive
+    :platform: Unix
+    :synopsis: Archiving utility functions.
+
+.. moduleauthor:: Simon Larsén <slarse@kth.se>
+"""
+import gzip
+import io
+import os
+import tarfile
+import time
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from . import metrics
+
+TGZ = 'tgz'
+TAR = 'tar'
+ZIP = 'zip'
+ARCHIVE_EXTENSIONS = {TGZ: '.tgz', TAR: '.tar', ZIP: '.zip'}
+DEFAULT_LEVEL = 6
+BLOCK_SIZE = 1024**2
+STREAM_CHUNK_SIZE = 64 * 1024
+ARCHIVE_MIMETYPES = {TGZ: 'application/gzip', TAR: 'application/x-tar',
+                     ZIP: 'application/zip'}
+
+
+class ArchivingError(Exception):
+    """An error to be thrown something goes wrong when archiving a directory."""
+    pass
+
+
+class _ParallelGzipWriter:
+    """A write-only file object that gzips everything written to it in parallel blocks. Use it
+    as a context manager, so that its threads are shut down even if archiving fails.
+    """
+
+    def __init__(self, file, level, workers):
+        self._file = file
+        self._level = level
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._max_pending = 2 * workers
+        self._pending = deque()
+        self._buffer = bytearray()
+
+    def write(self, data):
+        """Buffer the data, and submit a block for compression whenever there is a full one."""
+        self._buffer += data
+        while len(self._buffer) >= BLOCK_SIZE:
+            self._submit(bytes(self._buffer[:BLOCK_SIZE]))
+            del self._buffer[:BLOCK_SIZE]
+        return len(data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        """Drop the blocks that are still pending if close wasn't reached, and shut down the
+        threads.
+        """
+        for future in self._pending:
+            future.cancel()
+        self._pending.clear()
+        self._executor.shutdown()
+
+    def close(self):
+        """Compress what is left in the buffer and write all pending blocks in order."""
+        if self._buffer or not self._pending:
+            self._submit(bytes(self._buffer))
+            self._buffer = bytearray()
+        while self._pending:
+            self._file.write(self._pending.popleft().result())
+
+    def _submit(self, block):
+        """Submit a block for compression, first writing the oldest block if too many are
+        pending, so memory usage stays bounded.
+        """
+        if len(self._pending) >= self._max_pending:
+            self._file.write(self._pending.popleft().result())
+        self._pending.append(self._executor.submit(gzip.compress, block, self._level))
+
+
+class _StreamBuffer(io.RawIOBase):
+    """A write-only, unseekable file object that hands out what has been written to it."""
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        """Return and forget everything written since the last drain."""
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def get_archive_path(out, archive_format):
+    """Return the output path with the extension of the archive format.
+
+    Args:
+        out (str): Path to the output file, with or without extension.
+        archive_format (str): One of 'tgz', 'tar' or 'zip'.
+    Returns:
+        str: Path to the output file.
+    """
+    extension = ARCHIVE_EXTENSIONS[archive_format]
+    return out if out.endswith(extension) else out + extension
+
+
+def make_archive(src_dir, out, archive_format=TGZ, level=DEFAULT_LEVEL, workers=None):
+    """Make an archive from the src_dir. The archive contains the src_dir itself, so the
+    files end up in a directory named after it.
+
+    Args:
+        src_dir (str): Path to the source directory.
+        out (str): Path to the output file. The extension of the archive format is added if
+            it is missing.
+        archive_format (str): One of 'tgz', 'tar' or 'zip'.
+        level (int): Compression level for 'tgz'. Tar and zip archives are always stored
+            without compression.
+        workers (int): Amount of threads to compress 'tgz' archives with. Defaults to the amount
+            of CPUs.
+    Returns:
+        str: Path to the archive.
+    Raises:
+        ArchivingError
+    """
+    if archive_format not in ARCHIVE_EXTENSIONS:
+        raise ArchivingError("Unknown archive format '{}'!".format(archive_format))
+    if not os.path.isdir(src_dir):
+        raise ArchivingError("'{}' is not a directory!".format(src_dir))
+    if not os.listdir(src_dir):
+        raise ArchivingError("The source directory is empty!")
+    out = get_archive_path(out, archive_format)
+    arcname = os.path.basename(src_dir)
+    with metrics.ARCHIVE_SECONDS.labels(archive_format).time():
+        if archive_format == ZIP:
+            with zipfile.ZipFile(out, 'w', zipfile.ZIP_STORED) as zip_:
+                for path, name in walk_archive_members(src_dir, arcname):
+                    zip_.write(path, name)
+        elif archive_format == TAR:
+            with tarfile.open(out, 'w') as tar:
+                tar.add(src_dir, arcname=arcname)
+        else:
+            with open(out, 'wb') as file, \
+                    _ParallelGzipWriter(file, level, workers or os.cpu_count() or 1) as writer:
+                with tarfile.open(fileobj=writer, mode='w|') as tar:
+                    tar.add(src_dir, arcname=arcname)
+                writer.close()
+    return out
+
+
+def walk_archive_members(src_dir, arcname):
+    """Walk the files of the source directory in a stable order.
+
+    Args:
+        src_dir (str): Path to the source directory.
+        arcname (str): Name of the source directory in the archive.
+    Returns:
+        Iterable[Tuple[str, str]]: Pairs of the path to each file and its name in the archive.
+    """
+    for dirpath, dirnames, filenames in os.walk(src_dir):
+        dirnames.sort()
+        relpath = os.path.relpath(dirpath, src_dir)
+        for filename in sorted(filenames):
+            name = filename if relpath == os.curdir else os.path.join(relpath, filename)
+            yield os.path.join(dirpath, filename), os.path.join(arcname, name)
+
+
+def stream_archive(src_dir, archive_format, chunk_size=STREAM_CHUNK_SIZE, filepaths=None):
+    """Generate an archive of the src_dir on the fly, without writing it to disk. Only the
+    chunk that is currently being read is kept in memory.
+
+    Args:
+        src_dir (str): Path to the source directory.
+        archive_format (str): Either 'tar' or 'zip'.
+        chunk_size (int): Amount of bytes to read from the files at a time.
+        filepaths (List[str]): Paths to the files directly in src_dir to archive, or None to
+            archive all of its files.
+    Returns:
+        Iterable[bytes]: The archive, in chunks.
+    Raises:
+        ArchivingError
+    """
+    arcname = os.path.basename(src_dir)
+    if filepaths is None:
+        members = walk_archive_members(src_dir, arcname)
+    else:
+        members = [(path, os.path.join(arcname, os.path.basename(path)))
+                   for path in sorted(filepaths, key=os.path.basename)]
+    if archive_format == TAR:
+        return _stream_tar(arcname, members, chunk_size)
+    elif archive_format == ZIP:
+        return _stream_zip(members, chunk_size)
+    raise ArchivingError("Archive format '{}' can't be streamed!".format(archive_format))
+
+
+def _stream_tar(arcname, members, chunk_size):
+    """Generate a tar archive of the members in a directory named arcname. See
+    stream_archive.
+    """
+    directory = tarfile.TarInfo(arcname)
+    directory.type = tarfile.DIRTYPE
+    directory.mode = 0o755
+    directory.mtime = int(time.time())
+    header = directory.tobuf(tarfile.GNU_FORMAT)
+    offset = len(header)
+    yield header
+    for path, name in members:
+        with open(path, 'rb') as file:
+            stat = os.fstat(file.fileno())
+            info = tarfile.TarInfo(name)
+            info.size = stat.st_size
+            info.mtime = int(stat.st_mtime)
+            info.mode = 0o644
+            header = info.tobuf(tarfile.GNU_FORMAT)
+            offset += len(header)
+            yield header
+            remaining = info.size
+            for chunk in iter(lambda: file.read(min(chunk_size, remaining)), b''):
+                remaining -= len(chunk)
+                offset += len(chunk)
+                yield chunk
+        if remaining:
+            raise ArchivingError("'{}' shrank while it was being archived!".format(path))
+        padding = -offset % tarfile.BLOCKSIZE
+        offset += padding
+        yield tarfile.NUL * padding
+    end = 2 * tarfile.BLOCKSIZE
+    end += -(offset + end) % tarfile.RECORDSIZE
+    yield tarfile.NUL * end
+
+
+def _stream_zip(members, chunk_size):
+    """Generate a stored zip archive of the members. See stream_archive."""
+    buffer = _StreamBuffer()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as zip_:
+        for path, name in members:
+            info = zipfile.ZipInfo.from_file(path, name)
+            with open(path, 'rb') as file, zip_.open(info, 'w', force_zip64=True) as member:
+                for chunk in iter(lambda: file.read(chunk_size), b''):
+                    member.write(chunk)
+                    yield buffer.drain()
+            yield buffer.drain()
+    yield buffer.drain()
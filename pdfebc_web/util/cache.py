@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""This module contains a content-addressed on-disk cache for compression results.
+
+Results are keyed by the SHA-256 of the source file together with the Ghostscript binary and
+arguments used to compress it, so re-uploads of the same file never go through Ghostscript twice.
+The least recently used results are evicted when the cache grows past its size limit. The total
+size is tracked as results are stored, so the cache directory is only scanned when it is first
+used and when entries are evicted.
+
+.. module:: cache
+    :platform: Unix
+    :synopsis: On-disk cache for compression results.
+
+.. moduleauthor:: Simon Larsén <slarse@kth.se>
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+
+CHUNK_SIZE = 1024**2
+ENTRY_EXTENSION = '.pdf'
+# Fraction of the size limit that eviction shrinks the cache to, so that the next few results
+# can be stored without another scan
+EVICTION_TARGET = 0.9
+
+
+def hash_file(path, digest=None):
+    """Compute the SHA-256 of a file without reading all of it into memory.
+
+    Args:
+        path (str): Path to the file.
+        digest: A hashlib object to update. A new SHA-256 object is created if none is given.
+    Returns:
+        hashlib object: The updated digest.
+    """
+    digest = digest if digest is not None else hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest
+
+
+class CompressionCache:
+    """A size-limited, content-addressed cache of compressed files with LRU eviction.
+
+    Entries are stored as ``<cache_dir>/<key[:2]>/<key>.pdf``, and the modification time of an
+    entry is bumped every time it is used. Writes are atomic, so several workers can safely
+    share the same cache directory. Each worker keeps its own running total of the cache size,
+    which misses the results of the others until the next eviction rescans the directory.
+    """
+
+    def __init__(self, cache_dir, max_size):
+        """
+        Args:
+            cache_dir (str): Path to the cache directory. Created on the first write.
+            max_size (int): Maximum total size of the cached files, in bytes.
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._total = None
+
+    def key(self, src, gs_binary, gs_args):
+        """Compute the cache key for compressing the source file with the given settings.
+
+        Args:
+            src (str): Path to the source file.
+            gs_binary (str): Name/alias of the Ghostscript binary.
+            gs_args (List[str]): Ghostscript arguments, excluding input and output paths.
+        Returns:
+            str: The key.
+        """
+        digest = hash_file(src)
+        digest.update('\0'.join([gs_binary] + list(gs_args)).encode('utf-8'))
+        return digest.hexdigest()
+
+    def get(self, key, out):
+        """Place the cached result for the key at out, hard-linking if possible. The result is
+        placed next to out under a temporary name and then moved over it, so a file that is
+        already at out is replaced rather than written to, which would change the entry if
+        they are linked.
+
+        Args:
+            key (str): A cache key.
+            out (str): Path to put the cached file at.
+        Returns:
+            bool: True on a cache hit, False on a miss.
+        """
+        entry = self._entry_path(key)
+        tmp = '{}.{}.tmp'.format(out, uuid.uuid4().hex)
+        try:
+            os.utime(entry)
+            try:
+                os.link(entry, tmp)
+            except OSError:
+                shutil.copyfile(entry, tmp)
+            os.replace(tmp, out)
+        except FileNotFoundError:
+            self._count(hit=False)
+            return False
+        finally:
+            # Renaming does nothing if out already is a link to the entry
+            try:
+                os.remove(tmp)
+            except FileNotFoundError:
+                pass
+        self._count(hit=True)
+        return True
+
+    def put(self, key, src):
+        """Store a copy of src as the result for the key, and evict old entries if the running
+        total of the cache size has grown past the limit.
+
+        Args:
+            key (str): A cache key.
+            src (str): Path to the compressed file.
+        """
+        size = os.stat(src).st_size
+        if size > self.max_size:
+            return
+        entry = self._entry_path(key)
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(entry), suffix='.tmp')
+        os.close(fd)
+        try:
+            shutil.copyfile(src, tmp)
+            try:
+                replaced_size = os.stat(entry).st_size
+            except FileNotFoundError:
+                replaced_size = 0
+            os.replace(tmp, entry)
+        except OSError:
+            os.remove(tmp)
+            raise
+        with self._lock:
+            if self._total is None:
+                self._total = self.size()
+            else:
+                self._total += size - replaced_size
+            if self._total <= self.max_size:
+                return
+        self.evict()
+
+    def size(self):
+        """Return the total size of the cached files in bytes."""
+        return sum(stat.st_size for _, stat in self._entries())
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits within its size limit,
+        shrinking it to EVICTION_TARGET of the limit, and reset the running total to what is
+        left.
+
+        Returns:
+            int: The amount of bytes freed.
+        """
+        entries = sorted(self._entries(), key=lambda entry: entry[1].st_mtime)
+        total = sum(stat.st_size for _, stat in entries)
+        target = self.max_size * EVICTION_TARGET if total > self.max_size else total
+        freed = 0
+        for path, stat in entries:
+            if total - freed <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            freed += stat.st_size
+        with self._lock:
+            self._total = total - freed
+        return freed
+
+    def _entries(self):
+        """Return (path, stat) pairs for all entries in the cache."""
+        entries = []
+        if not os.path.isdir(self.cache_dir):
+            return entries
+        for shard in os.scandir(self.cache_dir):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith(ENTRY_EXTENSION):
+                    try:
+                        entries.append((entry.path, entry.stat()))
+                    except FileNotFoundError:
+                        pass
+        return entries
+
+    def _entry_path(self, key):
+        """Return the path to the entry for the key."""
+        return os.path.join(self.cache_dir, key[:2], key + ENTRY_EXTENSION)
+
+    def _count(self, hit):
+        """Update the hit/miss counters."""
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""This module contains functions for delivering compressed files as downloads.
+
+When the compressed files are too large to be sent by email, a tar archive of them is streamed
+straight into the storage backend, and a signed link to the archive is sent instead. The local
+backend keeps the archives in the downloads directory of the file cache. Links carry only the id
+of the archive, signed with the secret key of the app, and expire after a TTL, after which the
+janitor deletes the archive.
+
+.. module:: download
+    :platform: Unix
+    :synopsis: Signed, expiring download links.
+
+.. moduleauthor:: Simon Larsén <slarse@kth.se>
+"""
+import os
+import tempfile
+import time
+import uuid
+from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
+from .archive import stream_archive, get_archive_path, TAR
+
+SALT = 'pdfebc-web-download'
+
+
+class DownloadError(Exception):
+    """An error to be thrown when a download link is invalid."""
+    pass
+
+
+class DownloadExpiredError(DownloadError):
+    """An error to be thrown when a download link has expired."""
+    pass
+
+
+def create_download_id():
+    """Return the id of a new download."""
+    return uuid.uuid4().hex
+
+
+def write_download(downloads_dir, download_id, chunks):
+    """Write a streamed tar archive into the downloads directory. The archive only appears
+    under its id once it is complete.
+
+    Args:
+        downloads_dir (str): Path to the downloads directory.
+        download_id (str): Id of the download.
+        chunks (Iterable[bytes]): The archive, in chunks.
+    Returns:
+        str: Path to the archive.
+    """
+    os.makedirs(downloads_dir, exist_ok=True)
+    path = get_archive_path(os.path.join(downloads_dir, check_download_id(download_id)), TAR)
+    fd, tmp = tempfile.mkstemp(dir=downloads_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            for chunk in chunks:
+                file.write(chunk)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+    return path
+
+
+def create_download(downloads_dir, src_dir):
+    """Stream a tar archive of the source directory into the downloads directory.
+
+    Args:
+        downloads_dir (str): Path to the downloads directory.
+        src_dir (str): Path to the directory to archive.
+    Returns:
+        str: Id of the download.
+    """
+    download_id = create_download_id()
+    write_download(downloads_dir, download_id, stream_archive(src_dir, TAR))
+    return download_id
+
+
+def check_download_id(download_id):
+    """Check that a download id is well-formed.
+
+    Args:
+        download_id (str): Id of a download.
+    Returns:
+        str: The id in its canonical form.
+    Raises:
+        DownloadError
+    """
+    try:
+        return uuid.UUID(hex=download_id).hex
+    except ValueError:
+        raise DownloadError("Invalid download id")
+
+
+def get_download_path(downloads_dir, download_id):
+    """Return the path to the archive of a download.
+
+    Args:
+        downloads_dir (str): Path to the downloads directory.
+        download_id (str): Id of the download.
+    Returns:
+        str: Path to the archive.
+    Raises:
+        DownloadError
+    """
+    path = get_archive_path(os.path.join(downloads_dir, check_download_id(download_id)), TAR)
+    if not os.path.isfile(path):
+        raise DownloadError("The download does not exist")
+    return path
+
+
+def sign_download_id(secret_key, download_id):
+    """Sign the id of a download for use in a link.
+
+    Args:
+        secret_key (str): Secret key of the app.
+        download_id (str): Id of the download.
+    Returns:
+        str: A URL safe token.
+    """
+    return URLSafeTimedSerializer(secret_key, salt=SALT).dumps(download_id)
+
+
+def load_download_id(secret_key, token, max_age):
+    """Check the signature and age of a token, and return the id of the download.
+
+    Args:
+        secret_key (str): Secret key of the app.
+        token (str): A token created by sign_download_id.
+        max_age (int): Maximum age of the token in seconds.
+    Returns:
+        str: Id of the download.
+    Raises:
+        DownloadError
+    """
+    serializer = URLSafeTimedSerializer(secret_key, salt=SALT)
+    try:
+        return serializer.loads(token, max_age=max_age)
+    except SignatureExpired:
+        raise DownloadExpiredError("The download link has expired")
+    except BadSignature:
+        raise DownloadError("Invalid download link")
+
+
+def sweep_downloads(downloads_dir, ttl, now=None):
+    """Delete archives that are older than the TTL of download links.
+
+    Args:
+        downloads_dir (str): Path to the downloads directory.
+        ttl (float): Seconds for which download links are valid.
+        now (float): The current time. Defaults to time.time().
+    Returns:
+        int: Amount of deleted archives.
+    """
+    if not os.path.isdir(downloads_dir):
+        return 0
+    now = time.time() if now is None else now
+    deleted = 0
+    for entry in os.scandir(downloads_dir):
+        try:
+            if now - entry.stat().st_mtime > ttl:
+                os.remove(entry.path)
+                deleted += 1
+        except FileNotFoundError:
+            continue
+    return deleted
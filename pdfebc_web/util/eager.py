@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""This module contains the speculative compression of files as soon as they are uploaded.
+
+In eager mode, every uploaded file is compressed by a task of its own right after it has been
+saved, so that by the time the user submits the session, most of its files are already done.
+The file is compressed with the compression profile that the session chose for its last job,
+as that is the best guess of what it will choose next. The results are kept in a hidden
+directory per profile in the session upload directory, named after the SHA-256 of the source
+file, so a file that is replaced by another upload with the same name never picks up a stale
+result, and a job with another profile compresses its files itself. Results of files that are
+no longer in the session are never collected, and are deleted along with the session upload
+directory.
+
+Whoever starts compressing a file first claims it by creating a claim file. If the job of the
+session gets to a file that no speculative task has claimed yet, it claims and compresses the
+file itself, and the speculative task skips it when it eventually runs. If the file is claimed
+but not done, the job waits for the result, and compresses the file itself if the result
+doesn't show up in time. A speculative task that fails releases its claim, so the job retries
+the file and reports the error.
+
+.. module:: eager
+    :platform: Unix
+    :synopsis: Speculative compression of uploaded files.
+
+.. moduleauthor:: Simon Larsén <slarse@kth.se>
+"""
+import json
+import os
+import shutil
+import tempfile
+import time
+from .progress import ProgressReporter, DONE
+
+EAGER_DIRNAME = '.eager'
+CLAIM_EXTENSION = '.claim'
+RESULT_EXTENSION = '.pdf'
+PROGRESS_EXTENSION = '.json'
+POLL_INTERVAL = 0.5
+
+
+def get_eager_dir_path(session_upload_dir, profile):
+    """Return the path to the directory of speculative results of a compression profile in a
+    session upload directory.
+
+    Args:
+        session_upload_dir (str): Path to the session upload directory.
+        profile (str): Name of the compression profile.
+    """
+    return os.path.join(session_upload_dir, '{}-{}'.format(EAGER_DIRNAME, profile))
+
+
+def _get_path(eager_dir, sha256, extension):
+    return os.path.join(eager_dir, sha256 + extension)
+
+
+def claim(eager_dir, sha256):
+    """Claim the compression of a file, without waiting for it. The directory of speculative
+    results is created if needed, but the session upload directory is not.
+
+    Args:
+        eager_dir (str): Path to the directory of speculative results.
+        sha256 (str): Hex digest of the SHA-256 of the file.
+    Returns:
+        bool: True if the file was claimed, False if it was already claimed.
+    Raises:
+        FileNotFoundError: If the session upload directory doesn't exist.
+    """
+    try:
+        os.mkdir(eager_dir)
+    except FileExistsError:
+        pass
+    try:
+        fd = os.open(_get_path(eager_dir, sha256, CLAIM_EXTENSION),
+                     os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    os.close(fd)
+    return True
+
+
+def _release(eager_dir, sha256):
+    """Release the claim of a file and remove anything it left behind."""
+    for extension in (RESULT_EXTENSION, CLAIM_EXTENSION):
+        try:
+            os.remove(_get_path(eager_dir, sha256, extension))
+        except FileNotFoundError:
+            pass
+
+
+def _store_progress(eager_dir, sha256, progress):
+    """Store the final progress of a file, which marks its result as done."""
+    fd, tmp = tempfile.mkstemp(dir=eager_dir, suffix='.tmp')
+    with os.fdopen(fd, 'w') as file:
+        json.dump(progress, file)
+    os.replace(tmp, _get_path(eager_dir, sha256, PROGRESS_EXTENSION))
+
+
+def load_progress(eager_dir, sha256):
+    """Load the final progress of a file that has been compressed speculatively.
+
+    Args:
+        eager_dir (str): Path to the directory of speculative results.
+        sha256 (str): Hex digest of the SHA-256 of the file.
+    Returns:
+        dict: The progress, see the progress module, or None if the file is not done.
+    """
+    try:
+        with open(_get_path(eager_dir, sha256, PROGRESS_EXTENSION)) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+
+def precompress(src, sha256, eager_dir, compress):
+    """Compress an uploaded file speculatively, unless it has already been claimed.
+
+    Args:
+        src (str): Path to the uploaded file.
+        sha256 (str): Hex digest of the SHA-256 of the file.
+        eager_dir (str): Path to the directory of speculative results.
+        compress (function): Called with the source path, the output path and a
+            ProgressReporter to compress the file.
+    Returns:
+        bool: True if the file was compressed, False if it was already claimed.
+    Raises:
+        FileNotFoundError: If the session upload directory doesn't exist.
+    """
+    if not claim(eager_dir, sha256):
+        return False
+
+    def publish(filename, progress):
+        if progress['state'] == DONE:
+            _store_progress(eager_dir, sha256, progress)
+
+    try:
+        compress(src, _get_path(eager_dir, sha256, RESULT_EXTENSION), ProgressReporter(publish))
+    except Exception:
+        _release(eager_dir, sha256)
+        raise
+    return True
+
+
+def collect(sha256, eager_dir, out, timeout, poll_interval=POLL_INTERVAL,
+            clock=time.monotonic, sleep=time.sleep):
+    """Place the speculative result of a file at out. If the file is still being compressed,
+    wait for it for up to timeout seconds. If the file hasn't been claimed, or the result
+    doesn't show up in time, the caller is left to compress the file itself.
+
+    Args:
+        sha256 (str): Hex digest of the SHA-256 of the file.
+        eager_dir (str): Path to the directory of speculative results.
+        out (str): Path to put the result at.
+        timeout (float): Seconds to wait for a claimed file.
+        poll_interval (float): Seconds between checks for the result.
+        clock (function): Returns the current time in seconds.
+        sleep (function): Sleeps for the given amount of seconds.
+    Returns:
+        dict: The final progress of the file, or None if the caller must compress it.
+    """
+    deadline = clock() + timeout
+    while True:
+        progress = load_progress(eager_dir, sha256)
+        if progress is not None:
+            result = _get_path(eager_dir, sha256, RESULT_EXTENSION)
+            if os.path.lexists(out):
+                os.remove(out)
+            try:
+                os.link(result, out)
+            except OSError:
+                shutil.copyfile(result, out)
+            return progress
+        try:
+            if claim(eager_dir, sha256):
+                return None
+        except FileNotFoundError:
+            return None
+        if clock() >= deadline:
+            return None
+        sleep(poll_interval)
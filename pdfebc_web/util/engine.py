@@ -0,0 +1,412 @@
+# -*- coding: utf-8 -*-
+"""This module contains the parallel compression engine used by pdfebc-web.
+
+Where pdfebc-core compresses the files of a directory one at a time, this module runs one
+Ghostscript subprocess per PDF file on a bounded pool of worker threads. The threads only wait
+for the subprocesses, so the work is spread across all available cores. If a pool of
+long-lived Ghostscript interpreters is given, see the gspool module, the files are handed to
+the interpreters instead, and only run in a fresh subprocess if the pool can't take them.
+
+Each Ghostscript subprocess can be given resource limits, so that a pathological file fails on
+its own instead of exhausting the memory of the machine. Failed files are classified by why
+they failed, and batches can be compressed so that failed files are left out rather than failing
+the whole batch.
+
+Files are compressed with the ebook profile of pdfebc-core unless another compression profile
+is given, see the profiles module. The arguments of the profile are part of the cache key, so
+results of one profile are never used for another.
+
+.. module:: engine
+    :platform: Unix
+    :synopsis: Bounded parallel compression of PDF files.
+
+.. moduleauthor:: Simon Larsén <slarse@kth.se>
+"""
+import os
+import resource
+import shutil
+import signal
+import subprocess
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from pdfebc_core import compress
+from . import analysis, gspool, metrics, profiles
+
+DEFAULT_TIMEOUT = 600
+# The arguments of pdfebc-core
+GS_ARGS = profiles.build_gs_args(profiles.DEFAULT_PROFILES[profiles.EBOOK]['args'])
+
+COMPRESSING = "Compressing '{}' ..."
+FILE_DONE = "File done! Result saved to '{}'"
+NOT_COMPRESSING = "Not compressing '{}', it is smaller than {} bytes."
+CACHE_HIT = "Found '{}' in the cache."
+NOT_WORTH_COMPRESSING = "Not compressing '{}', it is not expected to shrink."
+KEEPING_ORIGINAL = "Keeping the original of '{}', it did not shrink."
+
+# What was done with each file
+SMALL = 'small'
+SKIPPED = 'skipped'
+CACHED = 'cached'
+COMPRESSED = 'compressed'
+KEPT_ORIGINAL = 'kept_original'
+DECISIONS = (SMALL, SKIPPED, CACHED, COMPRESSED, KEPT_ORIGINAL)
+
+# Why a file failed
+TIMED_OUT = 'timed_out'
+MEMORY_LIMIT = 'memory_limit'
+CPU_LIMIT = 'cpu_limit'
+BROKEN = 'broken'
+NOT_INSTALLED = 'not_installed'
+FAILURE_REASONS = (TIMED_OUT, MEMORY_LIMIT, CPU_LIMIT, BROKEN, NOT_INSTALLED)
+# Printed by Ghostscript when it runs out of memory
+VMERROR = b'VMerror'
+
+ResourceLimits = namedtuple('ResourceLimits', ['memory', 'cpu_seconds'])
+ResourceLimits.__doc__ = """Resource limits of a Ghostscript process. memory is the maximum
+size of its address space in bytes, and cpu_seconds the maximum CPU time it may use. Either may
+be None for no limit.
+"""
+
+
+class CompressionError(Exception):
+    """An error to be thrown when Ghostscript fails to compress a file. The reason is one of
+    FAILURE_REASONS.
+    """
+
+    def __init__(self, message, reason=BROKEN):
+        super().__init__(message)
+        self.reason = reason
+
+
+class CompressionStats:
+    """Collects what was done with each compressed file, and how long Ghostscript ran. Safe to
+    use from several threads.
+    """
+
+    def __init__(self):
+        self._totals = {decision: {'files': 0, 'bytes_in': 0, 'bytes_out': 0, 'seconds': 0.0}
+                        for decision in DECISIONS}
+        self._lock = threading.Lock()
+
+    def record(self, decision, bytes_in, bytes_out, seconds=0.0):
+        """Record the decision for a file.
+
+        Args:
+            decision (str): One of DECISIONS.
+            bytes_in (int): Size of the source file.
+            bytes_out (int): Size of the output file.
+            seconds (float): Seconds spent running Ghostscript on the file.
+        """
+        with self._lock:
+            totals = self._totals[decision]
+            totals['files'] += 1
+            totals['bytes_in'] += bytes_in
+            totals['bytes_out'] += bytes_out
+            totals['seconds'] += seconds
+
+    def summary(self):
+        """Return the totals per decision, the compression ratio and the Ghostscript seconds
+        per megabyte of the files that Ghostscript ran on, and an estimate of the Ghostscript
+        seconds that skipping files saved, based on that throughput. The ratio, throughput and
+        estimate are None if Ghostscript hasn't run on anything.
+
+        Returns:
+            dict: The summary.
+        """
+        with self._lock:
+            summary = {decision: dict(totals) for decision, totals in self._totals.items()}
+        ran = [summary[COMPRESSED], summary[KEPT_ORIGINAL]]
+        gs_bytes = sum(totals['bytes_in'] for totals in ran)
+        gs_seconds = sum(totals['seconds'] for totals in ran)
+        summary['ratio'] = \
+            sum(totals['bytes_out'] for totals in ran) / gs_bytes if gs_bytes else None
+        summary['seconds_per_megabyte'] = gs_seconds * 1024**2 / gs_bytes if gs_bytes else None
+        summary['estimated_seconds_saved'] = \
+            summary[SKIPPED]['bytes_in'] * gs_seconds / gs_bytes if gs_bytes else None
+        return summary
+
+
+def get_pdf_paths(src_dir):
+    """Return the paths to all PDF files in the source directory.
+
+    Args:
+        src_dir (str): Path to the source directory.
+    Returns:
+        List[str]: Paths to the PDF files, sorted by filename.
+    """
+    return [os.path.join(src_dir, filename) for filename in sorted(os.listdir(src_dir))
+            if filename.endswith(compress.PDF_EXTENSION)]
+
+
+def set_resource_limits(pid, limits):
+    """Apply resource limits to a running process with prlimit, right after it has been
+    spawned. Setting them in a preexec_fn instead is unsafe when the parent has threads, as the
+    forked child may deadlock on a lock that another thread held. The hard CPU limit is one
+    second above the soft one, so that a process that ignores SIGXCPU is killed. Does nothing if
+    the process has already exited.
+
+    Args:
+        pid (int): Id of the process.
+        limits (ResourceLimits): The limits.
+    """
+    try:
+        if limits.memory is not None:
+            resource.prlimit(pid, resource.RLIMIT_AS, (limits.memory, limits.memory))
+        if limits.cpu_seconds is not None:
+            cpu_seconds = int(limits.cpu_seconds)
+            resource.prlimit(pid, resource.RLIMIT_CPU, (cpu_seconds, cpu_seconds + 1))
+    except ProcessLookupError:
+        pass
+
+
+def classify_failure(returncode, stderr, limits=None):
+    """Classify why a Ghostscript process failed.
+
+    Args:
+        returncode (int): Exit status of the process, negative if it was killed by a signal.
+        stderr (bytes): What the process wrote to stderr.
+        limits (ResourceLimits): The resource limits of the process.
+    Returns:
+        str: One of FAILURE_REASONS.
+    """
+    if limits is not None and limits.cpu_seconds is not None and \
+            returncode in (-signal.SIGXCPU, -signal.SIGKILL):
+        return CPU_LIMIT
+    if VMERROR in (stderr or b''):
+        return MEMORY_LIMIT
+    # Allocations that fail outside of the memory management of Ghostscript tend to crash it
+    if limits is not None and limits.memory is not None and \
+            returncode in (-signal.SIGSEGV, -signal.SIGABRT, -signal.SIGKILL):
+        return MEMORY_LIMIT
+    return BROKEN
+
+
+def build_gs_command(gs_binary, src, out, gs_args=GS_ARGS):
+    """Build the Ghostscript command for compressing a single file. The arguments default to
+    those used by pdfebc-core.
+
+    Args:
+        gs_binary (str): Name/alias of the Ghostscript binary.
+        src (str): Path to the source PDF.
+        out (str): Path to the output PDF.
+        gs_args (List[str]): The arguments of the compression profile.
+    Returns:
+        List[str]: The command.
+    """
+    return [gs_binary] + list(gs_args) + ['-sOutputFile={}'.format(out), src]
+
+
+def compress_pdf(src, out, gs_binary, timeout=DEFAULT_TIMEOUT, status_callback=None,
+                 cache=None, progress=None, analyze=False, stats=None, pool=None, limits=None,
+                 profile=None):
+    """Compress a single PDF file with Ghostscript. Files that are smaller than
+    pdfebc-core's lower size limit are copied as-is. If a cache is given, Ghostscript is
+    skipped for files that have been compressed with the same settings before. If Ghostscript
+    makes a file larger, the original is kept. If the file can't be compressed, whatever
+    Ghostscript managed to write to out is removed, so it isn't delivered with the other files.
+
+    Args:
+        src (str): Path to the source PDF.
+        out (str): Path to the output PDF.
+        gs_binary (str): Name/alias of the Ghostscript binary.
+        timeout (float): Seconds to wait for Ghostscript before killing it.
+        status_callback (function): A callback function for passing status messages to a view.
+        cache (CompressionCache): A cache of compression results.
+        progress (ProgressReporter): Reporter for the progress of the file.
+        analyze (bool): Whether to analyze the file first, and pass it through untouched if
+            it is not expected to shrink to the target resolution of the profile. Files are
+            never analyzed for profiles without a target resolution.
+        stats (CompressionStats): Collects what was done with the file.
+        pool (GhostscriptPool): Long-lived Ghostscript interpreters to compress with.
+        limits (ResourceLimits): Resource limits of Ghostscript subprocesses.
+        profile (Profile): The compression profile, None for the arguments of pdfebc-core.
+    Returns:
+        str: Path to the output PDF.
+    Raises:
+        CompressionError
+    """
+    gs_args = GS_ARGS if profile is None else profile.gs_args
+    target_dpi = analysis.TARGET_DPI if profile is None else profile.target_dpi
+    if progress is not None:
+        progress.started(src)
+    try:
+        decision, seconds = _compress_pdf(src, out, gs_binary, timeout, status_callback, cache,
+                                          analyze and target_dpi is not None, pool, limits,
+                                          gs_args, target_dpi)
+    except CompressionError as exc:
+        try:
+            os.remove(out)
+        except FileNotFoundError:
+            pass
+        metrics.FAILED_FILES.labels(exc.reason).inc()
+        if progress is not None:
+            progress.failed(src, exc)
+        raise
+    bytes_in, bytes_out = os.stat(src).st_size, os.stat(out).st_size
+    metrics.record_compression(decision, bytes_in, bytes_out, seconds,
+                               profiles.DEFAULT_PROFILE if profile is None else profile.name)
+    if stats is not None:
+        stats.record(decision, bytes_in, bytes_out, seconds)
+    if progress is not None:
+        progress.finished(src, out, decision)
+    return out
+
+
+def _compress_pdf(src, out, gs_binary, timeout, status_callback, cache, analyze, pool, limits,
+                  gs_args=GS_ARGS, target_dpi=analysis.TARGET_DPI):
+    """Compress a single PDF file, see compress_pdf.
+
+    Returns:
+        Tuple[str, float]: The decision that was made for the file, and the seconds spent
+        running Ghostscript.
+    """
+    size = os.stat(src).st_size
+    seconds = 0.0
+    try:
+        # Left behind by an earlier attempt, and possibly linked to a cache entry, which
+        # writing to it would change
+        os.remove(out)
+    except FileNotFoundError:
+        pass
+    small = size < compress.FILE_SIZE_LOWER_LIMIT
+    key = cache.key(src, gs_binary, gs_args) if cache is not None and not small else None
+    if small:
+        _call(status_callback, NOT_COMPRESSING.format(src, compress.FILE_SIZE_LOWER_LIMIT))
+        shutil.copyfile(src, out)
+        decision = SMALL
+    elif key is not None and cache.get(key, out):
+        _call(status_callback, CACHE_HIT.format(src))
+        decision = CACHED
+    elif analyze and not analysis.is_worth_compressing(analysis.analyze_pdf(src), target_dpi):
+        _call(status_callback, NOT_WORTH_COMPRESSING.format(src))
+        shutil.copyfile(src, out)
+        decision = SKIPPED
+    else:
+        _call(status_callback, COMPRESSING.format(src))
+        start = time.monotonic()
+        run_ghostscript(gs_binary, src, out, timeout, pool, limits, gs_args)
+        seconds = time.monotonic() - start
+        decision = COMPRESSED
+        if os.stat(out).st_size >= size:
+            _call(status_callback, KEEPING_ORIGINAL.format(src))
+            shutil.copyfile(src, out)
+            decision = KEPT_ORIGINAL
+        if key is not None:
+            cache.put(key, out)
+    _call(status_callback, FILE_DONE.format(out))
+    return decision, seconds
+
+
+def run_ghostscript(gs_binary, src, out, timeout, pool=None, limits=None, gs_args=GS_ARGS):
+    """Run Ghostscript on a single file. If a pool is given, runs with the same arguments and
+    accepts the file, the file is compressed by one of its interpreters. If the interpreter
+    fails for any other reason than a timeout, the file is run again in a fresh Ghostscript
+    process, which also reports the error if the file itself is broken.
+
+    Args:
+        gs_binary (str): Name/alias of the Ghostscript binary.
+        src (str): Path to the source PDF.
+        out (str): Path to the output PDF.
+        timeout (float): Seconds to wait for Ghostscript.
+        pool (GhostscriptPool): Long-lived Ghostscript interpreters to compress with.
+        limits (ResourceLimits): Resource limits of the Ghostscript subprocess.
+        gs_args (List[str]): The arguments of the compression profile.
+    Raises:
+        CompressionError
+    """
+    if pool is not None and pool.gs_args == list(gs_args) and pool.accepts(src, out):
+        try:
+            pool.compress(src, out, timeout)
+            return
+        except gspool.GhostscriptTimeoutError:
+            raise CompressionError("Ghostscript timed out after {} seconds on '{}'"
+                                   .format(timeout, src), TIMED_OUT)
+        except gspool.GhostscriptPoolError:
+            pass
+    try:
+        process = subprocess.Popen(build_gs_command(gs_binary, src, out, gs_args),
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    except FileNotFoundError:
+        raise CompressionError("Ghostscript not installed or not aliased to '{}'"
+                               .format(gs_binary), NOT_INSTALLED)
+    with process:
+        try:
+            if limits is not None:
+                set_resource_limits(process.pid, limits)
+            _, stderr = process.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.communicate()
+            raise CompressionError("Ghostscript timed out after {} seconds on '{}'"
+                                   .format(timeout, src), TIMED_OUT)
+        except BaseException:
+            process.kill()
+            raise
+    if process.returncode:
+        reason = classify_failure(process.returncode, stderr, limits)
+        raise CompressionError("Ghostscript exited with status {} on '{}' ({})"
+                               .format(process.returncode, src, reason), reason)
+
+
+def compress_pdfs(src_paths, out_dir, gs_binary, workers=1, timeout=DEFAULT_TIMEOUT,
+                  status_callback=None, cache=None, progress=None, analyze=False, stats=None,
+                  pool=None, limits=None, failures=None, profile=None):
+    """Compress the given PDF files in parallel and place the output in out_dir. At most
+    ``workers`` Ghostscript processes run at the same time.
+
+    Args:
+        src_paths (List[str]): Paths to the source PDFs.
+        out_dir (str): Path to the output directory.
+        gs_binary (str): Name/alias of the Ghostscript binary.
+        workers (int): Maximum amount of concurrent Ghostscript processes.
+        timeout (float): Per-file timeout in seconds.
+        status_callback (function): A callback function for passing status messages to a view.
+        cache (CompressionCache): A cache of compression results.
+        progress (ProgressReporter): Reporter for the progress of the files.
+        analyze (bool): Whether to pass files that are not expected to shrink through
+            untouched.
+        stats (CompressionStats): Collects what was done with each file.
+        pool (GhostscriptPool): Long-lived Ghostscript interpreters to compress with.
+        limits (ResourceLimits): Resource limits of each Ghostscript subprocess.
+        failures (list): If given, files that fail are appended to it as tuples of the source
+            path and the CompressionError, and left out of the result, instead of failing the
+            whole batch.
+        profile (Profile): The compression profile, None for the arguments of pdfebc-core.
+    Returns:
+        List[str]: Paths to the compressed files, in the same order as src_paths.
+    Raises:
+        CompressionError
+    """
+    if workers < 1:
+        raise ValueError("workers must be at least 1, was {}".format(workers))
+    out_paths = [os.path.join(out_dir, os.path.basename(src)) for src in src_paths]
+    if progress is not None:
+        for src in src_paths:
+            progress.queued(src)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(compress_pdf, src, out, gs_binary, timeout, status_callback,
+                                   cache, progress, analyze, stats, pool, limits, profile)
+                   for src, out in zip(src_paths, out_paths)]
+        failed = set()
+        try:
+            for src, future in zip(src_paths, futures):
+                try:
+                    future.result()
+                except CompressionError as exc:
+                    if failures is None:
+                        raise
+                    failures.append((src, exc))
+                    failed.add(src)
+        except CompressionError:
+            for future in futures:
+                future.cancel()
+            raise
+    return [out for src, out in zip(src_paths, out_paths) if src not in failed]
+
+
+def _call(callback, message):
+    """Call the callback with the message if it is callable."""
+    if callable(callback):
+        callback(message)
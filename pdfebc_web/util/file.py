@@ -9,35 +9,31 @@
 """
 import os
 import tempfile
-import tarfile
 import shutil
 from pdfebc_core import compress, config_utils
+from . import engine, metrics
+from .archive import ArchivingError, make_archive, TGZ, DEFAULT_LEVEL
 
 FILE_CACHE = os.path.join(os.path.dirname(config_utils.CONFIG_PATH), 'pdfebc-web')
+COMPRESSED_FILES_DIRNAME = 'compressed_files'
+COMPRESSION_CACHE_DIRNAME = '.compression_cache'
+DOWNLOADS_DIRNAME = '.downloads'
 
-class ArchivingError(Exception):
-    """An error to be thrown something goes wrong when archiving a directory."""
-    pass
-
-def make_tarfile(src_dir, out):
-    """Make a tar archive from the src_dir.
+def make_tarfile(src_dir, out, level=DEFAULT_LEVEL, workers=None):
+    """Make a gzipped tar archive from the src_dir. The gzip compression is done in parallel,
+    see the archive module.
 
     Args:
         src_dir (str): Path to the source directory.
         out: Path to the output file.
+        level (int): The gzip compression level.
+        workers (int): Amount of threads to compress with. Defaults to the amount of CPUs.
     Returns:
         str: Path to the tarball.
     Raises:
         ArchivingError
     """
-    if not os.path.isdir(src_dir):
-        raise ArchivingError("'{}' is not a directory!".format(src_dir))
-    if not os.listdir(src_dir):
-        raise ArchivingError("The source directory is empty!")
-    if not out.endswith('.tgz'):
-        out += '.tgz'
-    with tarfile.open(out, 'w:gz') as tar:
-        tar.add(src_dir, arcname=os.path.basename(src_dir))
+    return make_archive(src_dir, out, TGZ, level=level, workers=workers)
 
 
 def compress_uploaded_files_to_tgz(src_dir, gs_binary, status_callback=None):
@@ -55,19 +51,66 @@ def compress_uploaded_files_to_tgz(src_dir, gs_binary, status_callback=None):
     return out
 
 
-def compress_uploaded_files(src_dir, gs_binary, status_callback=None):
+def compress_uploaded_files(src_dir, gs_binary, status_callback=None, workers=None,
+                            timeout=engine.DEFAULT_TIMEOUT, cache=None, progress=None,
+                            analyze=False, stats=None, pool=None, limits=None, failures=None,
+                            profile=None):
     """Compress the pdf files in the given source directory and place them in a
     subdirectory.
 
+    If workers is given, the files are compressed in parallel by the engine module, with at most
+    that many Ghostscript processes running at the same time. Otherwise, the files are compressed
+    one at a time by pdfebc-core.
+
     Args:
         src_dir (str): Path to the source directory.
+        gs_binary (str): Name/alias of the Ghostscript binary.
+        status_callback (function): A callback function for passing status messages to a view.
+        workers (int): Maximum amount of concurrent Ghostscript processes.
+        timeout (float): Per-file timeout in seconds, only used if workers is given.
+        cache (CompressionCache): A cache of compression results, only used if workers is given.
+        progress (ProgressReporter): Reporter for the progress of the files, only used if
+            workers is given.
+        analyze (bool): Whether to pass files that are not expected to shrink through
+            untouched, only used if workers is given.
+        stats (CompressionStats): Collects what was done with each file, only used if workers
+            is given.
+        pool (GhostscriptPool): Long-lived Ghostscript interpreters to compress with, only used
+            if workers is given.
+        limits (ResourceLimits): Resource limits of each Ghostscript subprocess, only used if
+            workers is given.
+        failures (list): If given, files that fail are appended to it instead of failing the
+            whole batch, only used if workers is given. See engine.compress_pdfs.
+        profile (Profile): The compression profile, only used if workers is given.
     Returns:
         List[str]: Paths to the compressed files.
     """
-    out_dir = os.path.join(src_dir, 'compressed_files')
-    os.mkdir(out_dir)
-    return compress.compress_multiple_pdfs(
-        src_dir, out_dir, gs_binary, status_callback=status_callback)
+    out_dir = os.path.join(src_dir, COMPRESSED_FILES_DIRNAME)
+    try:
+        os.mkdir(out_dir)
+    except FileExistsError:
+        # Left behind by an earlier attempt that didn't finish
+        pass
+    with metrics.COMPRESS_SECONDS.time():
+        if workers is None:
+            return compress.compress_multiple_pdfs(
+                src_dir, out_dir, gs_binary, status_callback=status_callback)
+        return engine.compress_pdfs(engine.get_pdf_paths(src_dir), out_dir, gs_binary,
+                                    workers=workers, timeout=timeout,
+                                    status_callback=status_callback, cache=cache,
+                                    progress=progress, analyze=analyze, stats=stats,
+                                    pool=pool, limits=limits, failures=failures,
+                                    profile=profile)
+
+
+def get_compression_cache_path():
+    """Return the path to the compression cache directory."""
+    return os.path.join(FILE_CACHE, COMPRESSION_CACHE_DIRNAME)
+
+
+def get_downloads_path():
+    """Return the path to the directory of archives that are delivered as downloads."""
+    return os.path.join(FILE_CACHE, DOWNLOADS_DIRNAME)
 
 
 def create_session_upload_dir(session_id):
@@ -80,6 +123,19 @@ def create_session_upload_dir(session_id):
     os.makedirs(directory)
 
 
+def ensure_session_upload_dir(session_id):
+    """Create the upload directory for the session if it does not already exist.
+
+    Args:
+        session_id (str): The id for the session.
+    Returns:
+        str: Path to the session upload directory.
+    """
+    directory = get_session_upload_dir_path(session_id)
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
 def get_session_upload_dir_path(session_id):
     """Return the path to the session upload directory
 
@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+"""This module contains a pool of long-lived Ghostscript interpreters.
+
+Starting Ghostscript for every file means initializing the interpreter and its fonts every
+time, which for small files takes longer than compressing them. Instead, each interpreter in the
+pool is started once and then reads jobs as PostScript from a pipe on its stdin. For each job,
+the output file of the pdfwrite device is switched to the output PDF, the source PDF is run, and
+the device is closed so that the output is written, after which the interpreter prints a line
+that says whether the job succeeded.
+
+The interpreters run with ``-dSAFER``, and are only allowed to read and write files in the
+directories that the pool is created for. Jobs with files elsewhere are not accepted. An
+interpreter that crashes, times out or fails a job is replaced by a fresh one, as is an
+interpreter that has run a maximum amount of jobs or grown past a memory ceiling, since
+Ghostscript state may leak between jobs. If the interpreters can't be started at all, e.g.
+because the Ghostscript version doesn't support the file permission options, the pool disables
+itself, and the callers compress with a fresh Ghostscript process per file instead.
+
+.. module:: gspool
+    :platform: Unix
+    :synopsis: Pool of long-lived Ghostscript interpreters.
+
+.. moduleauthor:: Simon Larsén <slarse@kth.se>
+"""
+import itertools
+import logging
+import os
+import queue
+import select
+import subprocess
+import threading
+import time
+
+DEFAULT_MAX_JOBS = 100
+DEFAULT_MAX_MEMORY = 512 * 1024**2
+START_TIMEOUT = 10
+NULL_OUTPUT = '/dev/null'
+# Prefix of the lines that interpreters print when they are done with a job
+DONE_MARKER = 'pdfebc-job'
+SUCCEEDED = 'ok'
+FAILED = 'failed'
+READY = 'ready'
+READ_SIZE = 65536
+
+logger = logging.getLogger(__name__)
+
+
+class GhostscriptPoolError(Exception):
+    """An error to be thrown when an interpreter fails a job, crashes or can't be started."""
+    pass
+
+
+class GhostscriptTimeoutError(GhostscriptPoolError):
+    """An error to be thrown when an interpreter doesn't finish a job in time."""
+    pass
+
+
+def ps_string(text):
+    """Quote text as a PostScript string literal.
+
+    Args:
+        text (str): The text.
+    Returns:
+        str: The string literal, including the parentheses.
+    """
+    escaped = text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+    return '({})'.format(escaped.replace('\n', '\\n').replace('\r', '\\r'))
+
+
+def build_job(job_number, src, out):
+    """Build the PostScript program of a job. Errors while running the source file are caught,
+    and the device is closed by switching it to a null output either way.
+
+    Args:
+        job_number (int): Number of the job, echoed in the line that marks its end.
+        src (str): Path to the source PDF.
+        out (str): Path to the output PDF.
+    Returns:
+        str: The program, on a single line.
+    """
+    return ('{{ << /OutputFile {out} >> setpagedevice {src} run }} stopped '
+            '/pdfebc_failed exch def clear '
+            '<< /OutputFile {null} >> setpagedevice '
+            'pdfebc_failed {{ {failed} }} {{ {ok} }} ifelse print flush\n'
+            .format(out=ps_string(out), src=ps_string(src), null=ps_string(NULL_OUTPUT),
+                    failed=ps_string('{} {} {}\n'.format(DONE_MARKER, job_number, FAILED)),
+                    ok=ps_string('{} {} {}\n'.format(DONE_MARKER, job_number, SUCCEEDED))))
+
+
+def build_interpreter_command(gs_binary, gs_args, allowed_dirs):
+    """Build the command that starts an interpreter reading jobs from stdin.
+
+    Args:
+        gs_binary (str): Name/alias of the Ghostscript binary.
+        gs_args (List[str]): The arguments of a one-off Ghostscript run. -dBATCH is dropped, as
+            it would make the interpreter exit after the first job.
+        allowed_dirs (List[str]): Directories that the interpreter may read and write in.
+    Returns:
+        List[str]: The command.
+    """
+    permissions = ['--permit-file-write={}'.format(NULL_OUTPUT)]
+    for directory in allowed_dirs:
+        pattern = os.path.join(os.path.realpath(directory), '')
+        permissions += ['--permit-file-read={}'.format(pattern),
+                        '--permit-file-write={}'.format(pattern)]
+    return ([gs_binary] + [arg for arg in gs_args if arg != '-dBATCH'] +
+            ['-dSAFER', '-dNOPROMPT', '-sOutputFile={}'.format(NULL_OUTPUT)] +
+            permissions + ['-'])
+
+
+def get_rss(pid):
+    """Return the resident set size of a process in bytes, or None if it can't be read."""
+    try:
+        with open('/proc/{}/status'.format(pid)) as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+class Interpreter:
+    """A single long-lived Ghostscript interpreter. Not safe to use from several threads."""
+
+    def __init__(self, command, on_start=None):
+        """Start the interpreter and wait for it to be ready.
+
+        Args:
+            command (List[str]): The command, see build_interpreter_command.
+            on_start (function): Called with the pid of the interpreter process right after it
+                has been spawned, e.g. to set its resource limits.
+        Raises:
+            GhostscriptPoolError
+        """
+        self.jobs = 0
+        self._job_numbers = itertools.count(1)
+        self._buffer = b''
+        try:
+            self._process = subprocess.Popen(command, stdin=subprocess.PIPE,
+                                             stdout=subprocess.PIPE,
+                                             stderr=subprocess.DEVNULL)
+        except OSError as exc:
+            raise GhostscriptPoolError("Could not start Ghostscript: {}".format(exc))
+        try:
+            if on_start is not None:
+                on_start(self._process.pid)
+        except OSError as exc:
+            self.close()
+            raise GhostscriptPoolError("Could not set up Ghostscript: {}".format(exc))
+        try:
+            self._send('{} print flush\n'.format(ps_string('{} 0 {}\n'.format(DONE_MARKER,
+                                                                                READY))))
+            self._wait_for(0, time.monotonic() + START_TIMEOUT)
+        except GhostscriptPoolError:
+            self.close()
+            raise
+
+    @property
+    def pid(self):
+        return self._process.pid
+
+    def run(self, src, out, timeout):
+        """Compress a PDF file.
+
+        Args:
+            src (str): Path to the source PDF.
+            out (str): Path to the output PDF.
+            timeout (float): Seconds to wait for the job.
+        Raises:
+            GhostscriptPoolError
+        """
+        job_number = next(self._job_numbers)
+        self.jobs += 1
+        self._send(build_job(job_number, os.path.abspath(src), os.path.abspath(out)))
+        if self._wait_for(job_number, time.monotonic() + timeout) != SUCCEEDED:
+            raise GhostscriptPoolError("Ghostscript failed on '{}'".format(src))
+
+    def rss(self):
+        """Return the resident set size of the interpreter in bytes, or None if unknown."""
+        return get_rss(self._process.pid)
+
+    def close(self):
+        """Stop the interpreter."""
+        if self._process.poll() is None:
+            self._process.kill()
+        self._process.wait()
+        for stream in (self._process.stdin, self._process.stdout):
+            try:
+                stream.close()
+            except OSError:
+                pass
+
+    def _send(self, program):
+        try:
+            self._process.stdin.write(program.encode('utf-8'))
+            self._process.stdin.flush()
+        except OSError as exc:
+            raise GhostscriptPoolError("Ghostscript exited: {}".format(exc))
+
+    def _wait_for(self, job_number, deadline):
+        """Read the output of the interpreter until the end of a job is marked.
+
+        Returns:
+            str: The status of the job.
+        """
+        prefix = '{} {} '.format(DONE_MARKER, job_number).encode('utf-8')
+        fd = self._process.stdout.fileno()
+        while True:
+            *lines, self._buffer = self._buffer.split(b'\n')
+            for line in lines:
+                if line.startswith(prefix):
+                    return line[len(prefix):].decode('utf-8').strip()
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise GhostscriptTimeoutError("Ghostscript timed out")
+            readable, _, _ = select.select([fd], [], [], remaining)
+            if readable:
+                data = os.read(fd, READ_SIZE)
+                if not data:
+                    raise GhostscriptPoolError("Ghostscript exited with status {}".format(
+                        self._process.wait()))
+                self._buffer += data
+
+
+class GhostscriptPool:
+    """A pool of Ghostscript interpreters, started on demand. Safe to use from several
+    threads, where each job is run by an interpreter that no other thread is using.
+    """
+
+    def __init__(self, gs_binary, gs_args, allowed_dirs, size, max_jobs=DEFAULT_MAX_JOBS,
+                 max_memory=DEFAULT_MAX_MEMORY, on_start=None):
+        """
+        Args:
+            gs_binary (str): Name/alias of the Ghostscript binary.
+            gs_args (List[str]): The arguments of a one-off Ghostscript run.
+            allowed_dirs (List[str]): Directories that the files of jobs may be in.
+            size (int): Maximum amount of interpreters.
+            max_jobs (int): Jobs after which an interpreter is replaced.
+            max_memory (int): Resident set size in bytes above which an interpreter is
+                replaced, None for no limit.
+            on_start (function): Called with the pid of each interpreter process right after
+                it has been spawned, e.g. to set its resource limits.
+        """
+        self.gs_binary = gs_binary
+        self.gs_args = list(gs_args)
+        self.allowed_dirs = [os.path.realpath(directory) for directory in allowed_dirs]
+        self.size = size
+        self.max_jobs = max_jobs
+        self.max_memory = max_memory
+        self.on_start = on_start
+        self.disabled = False
+        self._command = build_interpreter_command(gs_binary, gs_args, allowed_dirs)
+        self._idle = queue.LifoQueue()
+        self._started = 0
+        self._lock = threading.Lock()
+
+    def accepts(self, src, out):
+        """Return True if the pool can run a job with the given files."""
+        return not self.disabled and all(self._is_allowed(path) for path in (src, out))
+
+    def compress(self, src, out, timeout):
+        """Compress a PDF file with an interpreter from the pool.
+
+        Args:
+            src (str): Path to the source PDF.
+            out (str): Path to the output PDF.
+            timeout (float): Seconds to wait for the job.
+        Raises:
+            GhostscriptPoolError
+        """
+        interpreter = self._checkout()
+        try:
+            interpreter.run(src, out, timeout)
+        except GhostscriptPoolError:
+            self._discard(interpreter)
+            raise
+        if self._is_worn_out(interpreter):
+            self._discard(interpreter)
+        else:
+            self._idle.put(interpreter)
+
+    def close(self):
+        """Stop all idle interpreters. Interpreters that are running jobs are stopped when they
+        are returned to the pool.
+        """
+        with self._lock:
+            self.disabled = True
+        while True:
+            try:
+                interpreter = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            if interpreter is not None:
+                self._discard(interpreter)
+
+    def _is_allowed(self, path):
+        path = os.path.realpath(path)
+        return any(os.path.commonpath([path, directory]) == directory
+                   for directory in self.allowed_dirs)
+
+    def _is_worn_out(self, interpreter):
+        if self.disabled or interpreter.jobs >= self.max_jobs:
+            return True
+        if self.max_memory is None:
+            return False
+        rss = interpreter.rss()
+        return rss is not None and rss > self.max_memory
+
+    def _checkout(self):
+        """Take an idle interpreter, start a new one if there is room for it, or wait for one
+        to become idle.
+        """
+        while True:
+            try:
+                interpreter = self._idle.get_nowait()
+            except queue.Empty:
+                interpreter = self._start_or_wait()
+            # None is put in the queue to wake a waiting thread when an interpreter is discarded
+            if interpreter is not None:
+                return interpreter
+
+    def _start_or_wait(self):
+        with self._lock:
+            if self.disabled:
+                raise GhostscriptPoolError("The Ghostscript pool is disabled")
+            start = self._started < self.size
+            if start:
+                self._started += 1
+        if not start:
+            return self._idle.get()
+        try:
+            return Interpreter(self._command, self.on_start)
+        except GhostscriptPoolError as exc:
+            with self._lock:
+                self._started -= 1
+                if not self._started:
+                    # No interpreter is running, so they can't be started at all
+                    self.disabled = True
+            self._idle.put(None)
+            logger.warning("Could not start a Ghostscript interpreter, falling back to one "
+                           "Ghostscript process per file: %s", exc)
+            raise
+
+    def _discard(self, interpreter):
+        interpreter.close()
+        with self._lock:
+            self._started -= 1
+        self._idle.put(None)
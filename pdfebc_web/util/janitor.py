@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""This module contains functions for evicting stale session upload directories from the
+file cache.
+
+Session upload directories are evicted when they have been inactive for longer than a TTL, and
+then oldest first for as long as the file cache exceeds its disk quota. Directories that are
+busy, i.e. that a job is working in, are never evicted, as their last activity only shows when
+the job last wrote a file. Hidden entries in the file cache, such as the compression cache, are
+never touched.
+
+The Celery workers sweep their file cache periodically with Celery beat. With the S3 storage
+backend, the web processes have file caches of their own, with partial uploads and local copies
+of compressed files for download, which they sweep in the background as requests come in.
+
+.. module:: janitor
+    :platform: Unix
+    :synopsis: Eviction of stale session upload directories.
+
+.. moduleauthor:: Simon Larsén <slarse@kth.se>
+"""
+import os
+import shutil
+import threading
+import time
+from collections import namedtuple
+
+DEFAULT_BATCH_SIZE = 100
+
+SessionDir = namedtuple('SessionDir', ['path', 'last_activity', 'size', 'inodes'])
+JanitorReport = namedtuple('JanitorReport', ['directories', 'bytes', 'inodes'])
+
+
+def scan_session_dir(path):
+    """Find the last activity, total size and amount of inodes of a session upload directory.
+
+    Args:
+        path (str): Path to the session upload directory.
+    Returns:
+        SessionDir: The scanned directory.
+    """
+    last_activity = os.stat(path).st_mtime
+    size = 0
+    inodes = 1
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in dirnames + filenames:
+            try:
+                stat = os.lstat(os.path.join(dirpath, name))
+            except FileNotFoundError:
+                continue
+            last_activity = max(last_activity, stat.st_mtime)
+            size += stat.st_size if name in filenames else 0
+            inodes += 1
+    return SessionDir(path, last_activity, size, inodes)
+
+
+def scan_file_cache(file_cache):
+    """Scan all session upload directories in the file cache.
+
+    Args:
+        file_cache (str): Path to the file cache.
+    Returns:
+        List[SessionDir]: The scanned directories, least recently active first.
+    """
+    if not os.path.isdir(file_cache):
+        return []
+    session_dirs = []
+    for entry in os.scandir(file_cache):
+        if entry.name.startswith('.') or not entry.is_dir(follow_symlinks=False):
+            continue
+        try:
+            session_dirs.append(scan_session_dir(entry.path))
+        except FileNotFoundError:
+            continue
+    return sorted(session_dirs, key=lambda session_dir: session_dir.last_activity)
+
+
+def select_evictions(session_dirs, ttl, quota=None, now=None, is_busy=None):
+    """Select the session upload directories to evict.
+
+    Args:
+        session_dirs (List[SessionDir]): Scanned directories, least recently active first.
+        ttl (float): Seconds of inactivity after which a directory is evicted.
+        quota (int): Maximum total size in bytes of the directories that are kept, if any.
+        now (float): The current time. Defaults to time.time().
+        is_busy (function): Called with the path to a directory that would be evicted, and
+            returns True if it must be kept.
+    Returns:
+        List[SessionDir]: The directories to evict.
+    """
+    now = time.time() if now is None else now
+    total = sum(session_dir.size for session_dir in session_dirs)
+    evictions = []
+    for session_dir in session_dirs:
+        expired = now - session_dir.last_activity > ttl
+        over_quota = quota is not None and total > quota
+        if not (expired or over_quota):
+            break
+        if is_busy is not None and is_busy(session_dir.path):
+            continue
+        evictions.append(session_dir)
+        total -= session_dir.size
+    return evictions
+
+
+def sweep_file_cache(file_cache, ttl, quota=None, batch_size=DEFAULT_BATCH_SIZE, pause=0,
+                     on_evict=None, is_busy=None):
+    """Evict stale session upload directories from the file cache. The directories are deleted
+    in batches, with a pause between batches so the sweep doesn't starve other disk I/O.
+
+    Args:
+        file_cache (str): Path to the file cache.
+        ttl (float): Seconds of inactivity after which a directory is evicted.
+        quota (int): Maximum total size in bytes of the directories that are kept, if any.
+        batch_size (int): Amount of directories to delete per batch.
+        pause (float): Seconds to sleep between batches.
+        on_evict (function): Called with the path to each directory that has been evicted.
+        is_busy (function): Called with the path to a directory that would be evicted, and
+            returns True if it must be kept.
+    Returns:
+        JanitorReport: The amount of directories, bytes and inodes that were reclaimed.
+    """
+    evictions = select_evictions(scan_file_cache(file_cache), ttl, quota, is_busy=is_busy)
+    directories = size = inodes = 0
+    for start in range(0, len(evictions), batch_size):
+        if start and pause:
+            time.sleep(pause)
+        for session_dir in evictions[start:start + batch_size]:
+            if is_busy is not None and is_busy(session_dir.path):
+                # A job was submitted since the directory was selected
+                continue
+            try:
+                shutil.rmtree(session_dir.path)
+            except FileNotFoundError:
+                continue
+            if on_evict is not None:
+                on_evict(session_dir.path)
+            directories += 1
+            size += session_dir.size
+            inodes += session_dir.inodes
+    return JanitorReport(directories, size, inodes)
+
+
+def create_background_sweep(sweep, get_interval, clock=time.monotonic):
+    """Create a function that starts a sweep in a background thread when it is called, if at
+    least the interval has passed since the last sweep started and no sweep is running.
+
+    Args:
+        sweep (function): Sweeps the file cache.
+        get_interval (function): Returns the seconds between sweeps, 0 to disable them.
+        clock (function): Returns the current time in seconds.
+    Returns:
+        function: Starts a sweep if one is due, and returns True if it did.
+    """
+    lock = threading.Lock()
+    state = {'last': None, 'running': False}
+
+    def run():
+        try:
+            sweep()
+        finally:
+            with lock:
+                state['running'] = False
+
+    def maybe_sweep():
+        interval = get_interval()
+        now = clock()
+        with lock:
+            if not interval or state['running'] or \
+                    (state['last'] is not None and now - state['last'] < interval):
+                return False
+            state['last'] = now
+            state['running'] = True
+        threading.Thread(target=run, daemon=True).start()
+        return True
+
+    return maybe_sweep
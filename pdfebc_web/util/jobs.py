@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+"""This module contains registries of the compression jobs of each session.
+
+Each session has at most one registered job at a time. Submitting a session's files while a job
+is registered for it returns the registered job instead of starting another one, so double
+clicks and resubmitted forms don't enqueue duplicate work. A job is released when its files have
+been delivered, or when its registration expires, in case the job died on the way. On top of
+that, a per-session lock makes sure that only one task at a time works in a session upload
+directory, and a per-session counter keeps track of the compression tasks that are queued or
+running, so that the scheduling can let other sessions go first.
+
+Registries are kept either in Redis, which is shared between the web processes and the Celery
+workers, or in memory for single-process setups.
+
+.. module:: jobs
+    :platform: Unix
+    :synopsis: Registries of compression jobs.
+
+.. moduleauthor:: Simon Larsén <slarse@kth.se>
+"""
+import threading
+import time
+from contextlib import contextmanager
+import redis
+from redis.exceptions import LockError
+
+KEY_PREFIX = 'pdfebc:jobs:'
+LOCK_KEY_PREFIX = 'pdfebc:jobs:lock:'
+IN_FLIGHT_KEY_PREFIX = 'pdfebc:jobs:in-flight:'
+MEMORY = 'memory'
+REDIS = 'redis'
+
+# KEYS[1] is the registration of a session, ARGV[1] a job id. Deletes the registration if it is
+# that of the job.
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# KEYS[1] is the in-flight count of a session, ARGV[1] the amount to add and ARGV[2] the TTL.
+# Keeps the count from dropping below 0 and deletes it when it reaches 0.
+ADD_IN_FLIGHT_SCRIPT = """
+local count = math.max(0, tonumber(redis.call('GET', KEYS[1]) or '0') + tonumber(ARGV[1]))
+if count == 0 then
+    redis.call('DEL', KEYS[1])
+else
+    redis.call('SET', KEYS[1], count, 'EX', ARGV[2])
+end
+return count
+"""
+
+
+class LocalJobRegistry:
+    """A job registry that keeps the jobs in the memory of the current process."""
+
+    def __init__(self, clock=time.monotonic):
+        """
+        Args:
+            clock (function): Returns the current time in seconds.
+        """
+        self._clock = clock
+        self._jobs = {}
+        self._locked = set()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def register(self, session_id, job_id, ttl):
+        """Register a job for a session, unless another job is already registered for it.
+
+        Args:
+            session_id (str): Id of the session.
+            job_id (str): Id of the job.
+            ttl (int): Seconds after which the registration expires.
+        Returns:
+            str: Id of the registered job, which is job_id if it was registered.
+        """
+        with self._lock:
+            registered = self._get(session_id)
+            if registered is not None:
+                return registered
+            self._jobs[session_id] = (job_id, self._clock() + ttl)
+            return job_id
+
+    def get(self, session_id):
+        """Return the id of the job that is registered for a session.
+
+        Args:
+            session_id (str): Id of the session.
+        Returns:
+            str: Id of the job, or None if there is none.
+        """
+        with self._lock:
+            return self._get(session_id)
+
+    def release(self, session_id, job_id):
+        """Release a job, if it is the one registered for the session.
+
+        Args:
+            session_id (str): Id of the session.
+            job_id (str): Id of the job.
+        """
+        with self._lock:
+            if job_id is not None and self._get(session_id) == job_id:
+                del self._jobs[session_id]
+
+    @contextmanager
+    def session_lock(self, session_id, ttl):
+        """Try to take the lock of a session, without waiting for it.
+
+        Args:
+            session_id (str): Id of the session.
+            ttl (int): Seconds after which the lock expires, only used by the Redis registry.
+        Yields:
+            bool: True if the lock was taken.
+        """
+        with self._lock:
+            acquired = session_id not in self._locked
+            self._locked.add(session_id)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                with self._lock:
+                    self._locked.discard(session_id)
+
+    def add_in_flight(self, session_id, amount, ttl):
+        """Add to the amount of compression tasks of a session that are queued or running. The
+        count is reset when it hasn't been added to for ttl seconds, in case tasks died on the
+        way, and never drops below 0.
+
+        Args:
+            session_id (str): Id of the session.
+            amount (int): Amount to add, negative when tasks are done.
+            ttl (int): Seconds after which the count expires.
+        Returns:
+            int: The amount of tasks in flight after adding.
+        """
+        with self._lock:
+            count, expires = self._in_flight.get(session_id, (0, None))
+            if expires is not None and expires <= self._clock():
+                count = 0
+            count = max(0, count + amount)
+            if count:
+                self._in_flight[session_id] = (count, self._clock() + ttl)
+            else:
+                self._in_flight.pop(session_id, None)
+            return count
+
+    def _get(self, session_id):
+        """Return the registered job of a session, dropping it if it has expired."""
+        job_id, expires = self._jobs.get(session_id, (None, None))
+        if job_id is not None and expires <= self._clock():
+            del self._jobs[session_id]
+            return None
+        return job_id
+
+
+class RedisJobRegistry:
+    """A job registry that keeps the jobs and session locks in Redis keys with expiry times."""
+
+    def __init__(self, redis_client):
+        """
+        Args:
+            redis_client (redis.StrictRedis): A Redis client.
+        """
+        self._redis = redis_client
+        self._release = redis_client.register_script(RELEASE_SCRIPT)
+        self._add_in_flight = redis_client.register_script(ADD_IN_FLIGHT_SCRIPT)
+
+    def register(self, session_id, job_id, ttl):
+        """See LocalJobRegistry.register."""
+        key = KEY_PREFIX + session_id
+        while not self._redis.set(key, job_id, ex=ttl, nx=True):
+            registered = self._redis.get(key)
+            if registered is not None:
+                return _decode(registered)
+        return job_id
+
+    def get(self, session_id):
+        """See LocalJobRegistry.get."""
+        registered = self._redis.get(KEY_PREFIX + session_id)
+        return _decode(registered) if registered is not None else None
+
+    def release(self, session_id, job_id):
+        """See LocalJobRegistry.release."""
+        self._release(keys=[KEY_PREFIX + session_id], args=[job_id])
+
+    @contextmanager
+    def session_lock(self, session_id, ttl):
+        """See LocalJobRegistry.session_lock."""
+        lock = self._redis.lock(LOCK_KEY_PREFIX + session_id, timeout=ttl)
+        acquired = lock.acquire(blocking=False)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                try:
+                    lock.release()
+                except LockError:
+                    # The lock expired and may have been taken by someone else
+                    pass
+
+    def add_in_flight(self, session_id, amount, ttl):
+        """See LocalJobRegistry.add_in_flight."""
+        return int(self._add_in_flight(keys=[IN_FLIGHT_KEY_PREFIX + session_id],
+                                       args=[amount, ttl]))
+
+
+def _decode(value):
+    """Decode a value read from Redis, if it is bytes."""
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+def create_job_registry(backend, redis_url=None):
+    """Create a job registry.
+
+    Args:
+        backend (str): Either 'redis' or 'memory'.
+        redis_url (str): URL of the Redis server, if the backend is 'redis'.
+    Returns:
+        A job registry.
+    Raises:
+        ValueError
+    """
+    if backend == MEMORY:
+        return LocalJobRegistry()
+    if backend == REDIS:
+        return RedisJobRegistry(redis.StrictRedis.from_url(redis_url))
+    raise ValueError("Unknown job registry '{}'!".format(backend))
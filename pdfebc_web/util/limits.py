@@ -0,0 +1,399 @@
+# -*- coding: utf-8 -*-
+"""This module contains rate limits and upload quotas.
+
+Uploads are counted against quotas on the amount of files and bytes, per session and per client
+IP address. A quota is a counter that starts when it is first used and expires after a fixed
+window. Compression triggers are rate limited per session and per IP with token buckets, which
+allow a burst of triggers and then refill at a steady rate.
+
+The limits are kept either in Redis, where each check is a single Lua script that is evaluated
+atomically for all of the involved counters, or in memory for single-process setups. A limit of
+None disables that limit.
+
+.. module:: limits
+    :platform: Unix
+    :synopsis: Rate limits and upload quotas.
+
+.. moduleauthor:: Simon Larsén <slarse@kth.se>
+"""
+import asyncio
+import functools
+import math
+import threading
+import time
+from collections import namedtuple
+import redis
+from .upload import stream_to_file, stream_to_file_async, UploadError, UploadTooLargeError
+
+KEY_PREFIX = 'pdfebc:limits:'
+MEMORY = 'memory'
+REDIS = 'redis'
+
+# A quota on the files and bytes uploaded under a key during a window of seconds
+Quota = namedtuple('Quota', ['key', 'max_files', 'max_bytes', 'window'])
+# A token bucket that holds at most burst tokens, and refills with rate tokens per second
+Bucket = namedtuple('Bucket', ['key', 'rate', 'burst'])
+
+# KEYS are the buckets, ARGV the current time in milliseconds followed by the rate (in tokens
+# per millisecond) and burst of each bucket. Takes a token from every bucket if all of them have
+# one, and otherwise returns the milliseconds until they do.
+TOKEN_BUCKET_SCRIPT = """
+local now = tonumber(ARGV[1])
+local wait = 0
+local tokens = {}
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[2 * i])
+    local burst = tonumber(ARGV[2 * i + 1])
+    local bucket = redis.call('HMGET', key, 'tokens', 'updated')
+    local updated = tonumber(bucket[2]) or now
+    tokens[i] = math.min(burst, (tonumber(bucket[1]) or burst) +
+                         math.max(0, now - updated) * rate)
+    if tokens[i] < 1 then
+        wait = math.max(wait, (1 - tokens[i]) / rate)
+    end
+end
+if wait > 0 then
+    return math.ceil(wait)
+end
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[2 * i])
+    local burst = tonumber(ARGV[2 * i + 1])
+    redis.call('HMSET', key, 'tokens', tostring(tokens[i] - 1), 'updated', tostring(now))
+    redis.call('PEXPIRE', key, math.ceil(burst / rate))
+end
+return 0
+"""
+
+# KEYS are the quotas, ARGV the files and bytes to reserve followed by the maximum files,
+# maximum bytes and window of each quota, where a negative maximum means no limit. Adds to every
+# quota if none of them would be exceeded, and otherwise returns the index of the first one that
+# would be.
+QUOTA_SCRIPT = """
+local files = tonumber(ARGV[1])
+local bytes = tonumber(ARGV[2])
+for i, key in ipairs(KEYS) do
+    local max_files = tonumber(ARGV[3 * i])
+    local max_bytes = tonumber(ARGV[3 * i + 1])
+    local usage = redis.call('HMGET', key, 'files', 'bytes')
+    if (max_files >= 0 and (tonumber(usage[1]) or 0) + files > max_files) or
+            (max_bytes >= 0 and (tonumber(usage[2]) or 0) + bytes > max_bytes) then
+        return i
+    end
+end
+for i, key in ipairs(KEYS) do
+    redis.call('HINCRBY', key, 'files', files)
+    redis.call('HINCRBY', key, 'bytes', bytes)
+    if redis.call('TTL', key) < 0 then
+        redis.call('EXPIRE', key, ARGV[3 * i + 2])
+    end
+end
+return 0
+"""
+
+
+class QuotaExceededError(UploadError):
+    """An error to be thrown when an upload would exceed a quota."""
+    pass
+
+
+class RateLimitError(Exception):
+    """An error to be thrown when an action is performed too often."""
+
+    def __init__(self, message, retry_after):
+        """
+        Args:
+            message (str): The error message.
+            retry_after (int): Seconds until the action is allowed again.
+        """
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def get_upload_quotas(settings, session_id, ip):
+    """Return the upload quotas of a session and an IP address.
+
+    Args:
+        settings (Settings): The current settings.
+        session_id (str): Id of the session.
+        ip (str): IP address of the client.
+    Returns:
+        List[Quota]: The quotas.
+    """
+    return [Quota(KEY_PREFIX + 'session:' + session_id, settings.session_max_files,
+                  settings.session_max_bytes, settings.session_ttl),
+            Quota(KEY_PREFIX + 'ip:' + ip, settings.ip_max_files, settings.ip_max_bytes,
+                  settings.quota_window)]
+
+
+def get_compress_buckets(settings, session_id, ip):
+    """Return the token buckets that limit the compression triggers of a session and an IP
+    address.
+
+    Args:
+        settings (Settings): The current settings.
+        session_id (str): Id of the session.
+        ip (str): IP address of the client.
+    Returns:
+        List[Bucket]: The buckets.
+    """
+    return [Bucket(KEY_PREFIX + 'compress:session:' + session_id,
+                   settings.session_compress_rate, settings.session_compress_burst),
+            Bucket(KEY_PREFIX + 'compress:ip:' + ip, settings.ip_compress_rate,
+                   settings.ip_compress_burst)]
+
+
+def _enabled(buckets):
+    """Return the buckets that actually limit anything."""
+    return [bucket for bucket in buckets if bucket.rate and bucket.burst]
+
+
+def _remaining(quotas, usages):
+    """Return the amount of files and bytes that can be added to all of the quotas, with None
+    meaning no limit.
+    """
+    files = bytes_ = None
+    for quota, usage in zip(quotas, usages):
+        used_files, used_bytes = usage[:2]
+        if quota.max_files is not None:
+            files = min(files if files is not None else math.inf, quota.max_files - used_files)
+        if quota.max_bytes is not None:
+            bytes_ = min(bytes_ if bytes_ is not None else math.inf, quota.max_bytes - used_bytes)
+    return files, bytes_
+
+
+class LocalLimiter:
+    """A limiter that keeps the limits in the memory of the current process."""
+
+    def __init__(self, clock=time.time):
+        """
+        Args:
+            clock (function): Returns the current time in seconds.
+        """
+        self._clock = clock
+        self._buckets = {}
+        self._quotas = {}
+        self._lock = threading.Lock()
+
+    def consume(self, buckets):
+        """Take a token from every bucket, if all of them have one.
+
+        Args:
+            buckets (List[Bucket]): The buckets.
+        Raises:
+            RateLimitError
+        """
+        buckets = _enabled(buckets)
+        with self._lock:
+            now = self._clock()
+            tokens = []
+            for bucket in buckets:
+                current, updated = self._buckets.get(bucket.key, (bucket.burst, now))
+                tokens.append(min(bucket.burst, current + max(0, now - updated) * bucket.rate))
+            wait = max([(1 - token) / bucket.rate
+                        for bucket, token in zip(buckets, tokens) if token < 1] or [0])
+            if wait > 0:
+                raise RateLimitError("Rate limit exceeded", math.ceil(wait))
+            for bucket, token in zip(buckets, tokens):
+                self._buckets[bucket.key] = (token - 1, now)
+
+    def remaining(self, quotas):
+        """Return the amount of files and bytes that can be added to all of the quotas.
+
+        Args:
+            quotas (List[Quota]): The quotas.
+        Returns:
+            Tuple[int, int]: The amount of files and bytes, where None means no limit.
+        """
+        with self._lock:
+            now = self._clock()
+            return _remaining(quotas, [self._get_usage(quota, now) for quota in quotas])
+
+    def reserve(self, quotas, files, bytes_):
+        """Add files and bytes to every quota, if none of them would be exceeded.
+
+        Args:
+            quotas (List[Quota]): The quotas.
+            files (int): Amount of files.
+            bytes_ (int): Amount of bytes.
+        Raises:
+            QuotaExceededError
+        """
+        with self._lock:
+            now = self._clock()
+            usages = [self._get_usage(quota, now) for quota in quotas]
+            remaining_files, remaining_bytes = _remaining(quotas, usages)
+            if (remaining_files is not None and files > remaining_files) or \
+                    (remaining_bytes is not None and bytes_ > remaining_bytes):
+                raise QuotaExceededError("Upload quota exceeded")
+            for quota, (used_files, used_bytes, expires) in zip(quotas, usages):
+                self._quotas[quota.key] = (used_files + files, used_bytes + bytes_, expires)
+
+    def _get_usage(self, quota, now):
+        """Return the files and bytes used of a quota and when it expires."""
+        used_files, used_bytes, expires = self._quotas.get(quota.key, (0, 0, None))
+        if expires is None or expires <= now:
+            return 0, 0, now + quota.window
+        return used_files, used_bytes, expires
+
+
+class RedisLimiter:
+    """A limiter that keeps the limits in Redis, and checks them with Lua scripts."""
+
+    def __init__(self, redis_client, clock=time.time):
+        """
+        Args:
+            redis_client (redis.StrictRedis): A Redis client.
+            clock (function): Returns the current time in seconds.
+        """
+        self._redis = redis_client
+        self._clock = clock
+        self._token_bucket = redis_client.register_script(TOKEN_BUCKET_SCRIPT)
+        self._quota = redis_client.register_script(QUOTA_SCRIPT)
+
+    def consume(self, buckets):
+        """See LocalLimiter.consume."""
+        buckets = _enabled(buckets)
+        if not buckets:
+            return
+        args = [int(self._clock() * 1000)]
+        for bucket in buckets:
+            args.extend([repr(bucket.rate / 1000), bucket.burst])
+        wait = self._token_bucket(keys=[bucket.key for bucket in buckets], args=args)
+        if wait:
+            raise RateLimitError("Rate limit exceeded", math.ceil(wait / 1000))
+
+    def remaining(self, quotas):
+        """See LocalLimiter.remaining."""
+        pipeline = self._redis.pipeline()
+        for quota in quotas:
+            pipeline.hmget(quota.key, 'files', 'bytes')
+        usages = [(int(files or 0), int(bytes_ or 0)) for files, bytes_ in pipeline.execute()]
+        return _remaining(quotas, usages)
+
+    def reserve(self, quotas, files, bytes_):
+        """See LocalLimiter.reserve."""
+        args = [files, bytes_]
+        for quota in quotas:
+            args.extend([-1 if quota.max_files is None else quota.max_files,
+                         -1 if quota.max_bytes is None else quota.max_bytes,
+                         quota.window])
+        if self._quota(keys=[quota.key for quota in quotas], args=args):
+            raise QuotaExceededError("Upload quota exceeded")
+
+
+def create_limiter(backend, redis_url=None):
+    """Create a limiter.
+
+    Args:
+        backend (str): Either 'redis' or 'memory'.
+        redis_url (str): URL of the Redis server, if the backend is 'redis'.
+    Returns:
+        A limiter.
+    Raises:
+        ValueError
+    """
+    if backend == MEMORY:
+        return LocalLimiter()
+    if backend == REDIS:
+        return RedisLimiter(redis.StrictRedis.from_url(redis_url))
+    raise ValueError("Unknown limiter '{}'!".format(backend))
+
+
+def check_quota(limiter, quotas, size=0, replaced_size=None):
+    """Check that one more file of the given size fits in the quotas, without reserving it.
+
+    Args:
+        limiter: A limiter.
+        quotas (List[Quota]): The quotas.
+        size (int): Size of the file in bytes.
+        replaced_size (int): Size in bytes of an earlier upload that the file replaces, None if
+            it is a new file. A replacement adds no file, and only the bytes it adds.
+    Returns:
+        int: The amount of bytes that the file may have and still fit in the quotas, or None if
+        there is no limit.
+    Raises:
+        QuotaExceededError
+    """
+    files, bytes_ = limiter.remaining(quotas)
+    if replaced_size is not None:
+        files = None
+        bytes_ = None if bytes_ is None else max(bytes_, 0) + replaced_size
+    if (files is not None and files < 1) or (bytes_ is not None and bytes_ < max(size, 1)):
+        raise QuotaExceededError("Upload quota exceeded")
+    return bytes_
+
+
+def reserve_upload(limiter, quotas, size, replaced_size=None):
+    """Count an uploaded file against the quotas. A file that replaces an earlier upload is only
+    counted for the bytes that it adds, as the earlier upload has already been counted.
+
+    Args:
+        limiter: A limiter.
+        quotas (List[Quota]): The quotas.
+        size (int): Size of the file in bytes.
+        replaced_size (int): Size in bytes of the upload that the file replaces, None if it is
+            a new file.
+    Raises:
+        QuotaExceededError
+    """
+    if replaced_size is None:
+        limiter.reserve(quotas, 1, size)
+    else:
+        limiter.reserve(quotas, 0, max(size - replaced_size, 0))
+
+
+def stream_within_quota(limiter, quotas, stream, out, max_size, replaced_size=None):
+    """Stream an upload to a file like upload.stream_to_file, and count it against the quotas.
+    The upload is cut off as soon as it no longer fits in the quotas, and is only moved to out
+    once it has been counted, so an upload that a concurrent upload left no room for never
+    replaces an earlier file at out.
+
+    Args:
+        limiter: A limiter.
+        quotas (List[Quota]): The quotas.
+        stream: A file-like object with a read method.
+        out (str): Path to the output file.
+        max_size (int): Maximum size of the upload in bytes.
+        replaced_size (int): Size in bytes of the earlier upload at out, None if there is none.
+    Returns:
+        UploadResult: The path, size and SHA-256 of the saved file.
+    Raises:
+        UploadError
+    """
+    remaining = check_quota(limiter, quotas, replaced_size=replaced_size)
+    accept = functools.partial(reserve_upload, limiter, quotas, replaced_size=replaced_size)
+    if remaining is None or remaining >= max_size:
+        return stream_to_file(stream, out, max_size, accept=accept)
+    try:
+        return stream_to_file(stream, out, remaining, accept=accept)
+    except UploadTooLargeError:
+        raise QuotaExceededError("Upload quota exceeded")
+
+
+async def stream_within_quota_async(limiter, quotas, chunks, out, max_size, replaced_size=None):
+    """Like stream_within_quota, but for asynchronous servers, see
+    upload.stream_to_file_async. The limiter is called on the default executor of the event
+    loop.
+
+    Args:
+        limiter: A limiter.
+        quotas (List[Quota]): The quotas.
+        chunks: An asynchronous iterator of bytes.
+        out (str): Path to the output file.
+        max_size (int): Maximum size of the upload in bytes.
+        replaced_size (int): Size in bytes of the earlier upload at out, None if there is none.
+    Returns:
+        UploadResult: The path, size and SHA-256 of the saved file.
+    Raises:
+        UploadError
+    """
+    loop = asyncio.get_event_loop()
+    remaining = await loop.run_in_executor(None, functools.partial(
+        check_quota, limiter, quotas, replaced_size=replaced_size))
+    accept = functools.partial(reserve_upload, limiter, quotas, replaced_size=replaced_size)
+    if remaining is None or remaining >= max_size:
+        return await stream_to_file_async(chunks, out, max_size, accept=accept)
+    try:
+        return await stream_to_file_async(chunks, out, remaining, accept=accept)
+    except UploadTooLargeError:
+        raise QuotaExceededError("Upload quota exceeded")
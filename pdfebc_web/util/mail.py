@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+"""This module contains the delivery of compressed files by email.
+
+Instead of connecting, running STARTTLS and logging in for every message, each process keeps a
+small pool of authenticated SMTP connections. A connection is health checked with NOOP before
+it is reused, and transient failures are retried with exponential backoff.
+
+.. module:: mail
+    :platform: Unix
+    :synopsis: Pooled SMTP delivery.
+
+.. moduleauthor:: Simon Larsén <slarse@kth.se>
+"""
+import contextlib
+import os
+import smtplib
+import threading
+import time
+from collections import namedtuple, deque
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from pdfebc_core import config_utils
+
+DEFAULT_POOL_SIZE = 2
+DEFAULT_TIMEOUT = 30
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 1.0
+NOOP_OK = 250
+# Bytes of headers and MIME boundaries that each message and attachment adds, roughly
+MESSAGE_OVERHEAD = 2048
+ATTACHMENT_OVERHEAD = 512
+
+SmtpConfig = namedtuple('SmtpConfig', ['host', 'port', 'user', 'password', 'receiver'])
+
+
+class DeliveryError(Exception):
+    """An error to be thrown when a message can't be delivered."""
+    pass
+
+
+class AttachmentTooLargeError(DeliveryError):
+    """An error to be thrown when a file is too large to be sent in any message."""
+    pass
+
+
+def get_smtp_config(email_config):
+    """Read the SMTP settings from the email section of a pdfebc-core config.
+
+    Args:
+        email_config (dict): A pdfebc-core config.
+    Returns:
+        SmtpConfig: The SMTP settings.
+    Raises:
+        pdfebc_core.config_utils.ConfigurationError
+    """
+    def get(key):
+        return config_utils.get_attribute_from_config(email_config,
+                                                      config_utils.EMAIL_SECTION_KEY, key)
+    return SmtpConfig(get(config_utils.SMTP_SERVER_KEY), int(get(config_utils.SMTP_PORT_KEY)),
+                      get(config_utils.USER_KEY), get(config_utils.PASSWORD_KEY),
+                      get(config_utils.RECEIVER_KEY))
+
+
+def build_message(sender, receiver, subject, text, filepaths):
+    """Build a message with the files as attachments.
+
+    Args:
+        sender (str): Address of the sender.
+        receiver (str): Address of the receiver.
+        subject (str): Subject of the message.
+        text (str): Body of the message.
+        filepaths (List[str]): Paths to the files to attach.
+    Returns:
+        email.mime.multipart.MIMEMultipart: The message.
+    """
+    message = MIMEMultipart()
+    message.attach(MIMEText(text))
+    message['Subject'] = subject
+    message['From'] = sender
+    message['To'] = receiver
+    for filepath in filepaths:
+        filename = os.path.basename(filepath)
+        with open(filepath, 'rb') as file:
+            part = MIMEApplication(file.read(), Name=filename)
+        part['Content-Disposition'] = 'attachment; filename="{}"'.format(filename)
+        message.attach(part)
+    return message
+
+
+def get_encoded_size(size):
+    """Return the size of a file once it is base64-encoded as an attachment, with 76 character
+    lines and some room for its headers.
+
+    Args:
+        size (int): Size of the file in bytes.
+    Returns:
+        int: Size of the attachment in bytes.
+    """
+    encoded = (size + 2) // 3 * 4
+    return encoded + (encoded + 75) // 76 * 2 + ATTACHMENT_OVERHEAD
+
+
+def plan_messages(filepaths, max_message_size):
+    """Split the files into as few messages as possible, such that each message stays below the
+    maximum message size. The files are packed first-fit by decreasing size, and keep their
+    original order within each message.
+
+    Args:
+        filepaths (List[str]): Paths to the files.
+        max_message_size (int): Maximum size in bytes of a message, after encoding.
+    Returns:
+        List[List[str]]: The files of each message.
+    Raises:
+        AttachmentTooLargeError
+    """
+    sizes = {path: get_encoded_size(os.stat(path).st_size) for path in filepaths}
+    messages = []
+    for path in sorted(filepaths, key=lambda path: sizes[path], reverse=True):
+        if MESSAGE_OVERHEAD + sizes[path] > max_message_size:
+            raise AttachmentTooLargeError(
+                "'{}' is too large to be sent by email".format(os.path.basename(path)))
+        for message in messages:
+            if message['size'] + sizes[path] <= max_message_size:
+                message['paths'].append(path)
+                message['size'] += sizes[path]
+                break
+        else:
+            messages.append({'paths': [path], 'size': MESSAGE_OVERHEAD + sizes[path]})
+    order = {path: index for index, path in enumerate(filepaths)}
+    return [sorted(message['paths'], key=order.get) for message in messages]
+
+
+def is_transient(error):
+    """Return True if the error is worth retrying, i.e. if the connection was lost or the
+    server replied with a 4xx code.
+    """
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, _ in error.recipients.values())
+    return isinstance(error, (smtplib.SMTPServerDisconnected, OSError))
+
+
+class SmtpPool:
+    """A pool of authenticated SMTP connections. Safe to use from several threads, but not
+    across forks: each process must have its own pool.
+    """
+
+    def __init__(self, smtp_config, size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT,
+                 starttls=True, smtp_factory=None):
+        """
+        Args:
+            smtp_config (SmtpConfig): Where and as whom to connect.
+            size (int): Maximum amount of open connections.
+            timeout (float): Seconds before a blocking SMTP operation times out.
+            starttls (bool): Whether to run STARTTLS before logging in.
+            smtp_factory (function): Called with the host, port and timeout to open a
+                connection. Defaults to smtplib.SMTP.
+        """
+        self.smtp_config = smtp_config
+        self.connections_opened = 0
+        self._timeout = timeout
+        self._starttls = starttls
+        self._smtp_factory = smtp_factory
+        self._idle = deque()
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Check out a healthy connection, opening a new one if no idle connection is healthy.
+        The connection is returned to the pool afterwards, unless an error was raised while it
+        was checked out.
+
+        Yields:
+            smtplib.SMTP: An authenticated connection.
+        """
+        with self._slots:
+            smtp = self._checkout()
+            try:
+                yield smtp
+            except BaseException:
+                _close(smtp)
+                raise
+            with self._lock:
+                self._idle.append(smtp)
+
+    def close(self):
+        """Close all idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, deque()
+        for smtp in idle:
+            _close(smtp)
+
+    def _checkout(self):
+        """Return the most recently used idle connection that passes a health check, or a new
+        connection.
+        """
+        while True:
+            with self._lock:
+                smtp = self._idle.pop() if self._idle else None
+            if smtp is None:
+                return self._connect()
+            if _is_healthy(smtp):
+                return smtp
+            _close(smtp)
+
+    def _connect(self):
+        """Open and authenticate a new connection."""
+        smtp_factory = self._smtp_factory or smtplib.SMTP
+        smtp = smtp_factory(self.smtp_config.host, self.smtp_config.port, timeout=self._timeout)
+        try:
+            if self._starttls:
+                smtp.starttls()
+            smtp.login(self.smtp_config.user, self.smtp_config.password)
+        except BaseException:
+            _close(smtp)
+            raise
+        with self._lock:
+            self.connections_opened += 1
+        return smtp
+
+
+class Mailer:
+    """Sends messages over a pool of connections, retrying transient failures with
+    exponential backoff.
+    """
+
+    def __init__(self, pool, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF, sleep=time.sleep):
+        """
+        Args:
+            pool (SmtpPool): The connection pool.
+            retries (int): Amount of times to retry after a transient failure.
+            backoff (float): Seconds to wait before the first retry, doubled for each retry.
+            sleep (function): Used to wait between retries.
+        """
+        self.pool = pool
+        self._retries = retries
+        self._backoff = backoff
+        self._sleep = sleep
+
+    def send(self, message):
+        """Send a message, blocking until it has been sent.
+
+        Args:
+            message (email.message.Message): The message.
+        Raises:
+            DeliveryError
+        """
+        self.send_batch([message])
+
+    def send_batch(self, messages):
+        """Send the messages over a single connection. After a transient failure, the
+        messages that were not yet sent are retried over a new connection.
+
+        Args:
+            messages (List[email.message.Message]): The messages.
+        Raises:
+            DeliveryError
+        """
+        remaining = list(messages)
+        for attempt in range(self._retries + 1):
+            try:
+                with self.pool.connection() as smtp:
+                    while remaining:
+                        smtp.send_message(remaining[0])
+                        remaining.pop(0)
+                return
+            except (smtplib.SMTPException, OSError) as error:
+                if not is_transient(error) or attempt == self._retries:
+                    raise DeliveryError("Failed to send {} of {} messages: {}".format(
+                        len(remaining), len(messages), error)) from error
+            self._sleep(self._backoff * 2**attempt)
+
+
+def _is_healthy(smtp):
+    """Check that a connection is still alive with NOOP."""
+    try:
+        return smtp.noop()[0] == NOOP_OK
+    except (smtplib.SMTPException, OSError):
+        return False
+
+
+def _close(smtp):
+    """Close a connection, politely if possible."""
+    try:
+        smtp.quit()
+    except (smtplib.SMTPException, OSError):
+        smtp.close()
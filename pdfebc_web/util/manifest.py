@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""This module contains stores for per-session manifests of uploaded files.
+
+A manifest maps the filename of each file in a session upload directory to its size, SHA-256
+and upload time. It is updated whenever a file is saved, so listing a session's files never has
+to touch the file system. Manifests are kept either in Redis, which is shared between the web
+processes and the Celery workers, or in memory for single-process setups.
+
+.. module:: manifest
+    :platform: Unix
+    :synopsis: Per-session manifests of uploaded files.
+
+.. moduleauthor:: Simon Larsén <slarse@kth.se>
+"""
+import json
+import threading
+import time
+import redis
+
+KEY_PREFIX = 'pdfebc:manifest:'
+MEMORY = 'memory'
+REDIS = 'redis'
+
+
+def create_entry(size, sha256, uploaded=None):
+    """Create a manifest entry.
+
+    Args:
+        size (int): Size of the file in bytes.
+        sha256 (str): Hex digest of the SHA-256 of the file.
+        uploaded (float): Upload time as a UNIX timestamp. Defaults to now.
+    Returns:
+        dict: The entry.
+    """
+    return {'size': size, 'sha256': sha256,
+            'uploaded': time.time() if uploaded is None else uploaded}
+
+
+def get_replaced_size(manifest, filename):
+    """Return the size of the earlier upload that a new upload of a file replaces.
+
+    Args:
+        manifest (dict): The manifest of the session.
+        filename (str): Name of the file.
+    Returns:
+        int: The size in bytes, or None if the file has not been uploaded before.
+    """
+    entry = manifest.get(filename)
+    return None if entry is None else entry['size']
+
+
+class LocalManifestStore:
+    """A manifest store that keeps the manifests in the memory of the current process."""
+
+    def __init__(self):
+        self._manifests = {}
+        self._lock = threading.Lock()
+
+    def add(self, session_id, filename, entry):
+        """Add or replace the entry of a file in the manifest of a session.
+
+        Args:
+            session_id (str): Id of the session.
+            filename (str): Name of the file.
+            entry (dict): The entry, see create_entry.
+        """
+        with self._lock:
+            self._manifests.setdefault(session_id, {})[filename] = dict(entry)
+
+    def remove(self, session_id, filename):
+        """Remove the entry of a file from the manifest of a session, if it is there.
+
+        Args:
+            session_id (str): Id of the session.
+            filename (str): Name of the file.
+        """
+        with self._lock:
+            self._manifests.get(session_id, {}).pop(filename, None)
+
+    def get(self, session_id):
+        """Return the manifest of a session.
+
+        Args:
+            session_id (str): Id of the session.
+        Returns:
+            dict: A dict mapping filenames to entries.
+        """
+        with self._lock:
+            return {filename: dict(entry)
+                    for filename, entry in self._manifests.get(session_id, {}).items()}
+
+    def clear(self, session_id):
+        """Remove the manifest of a session.
+
+        Args:
+            session_id (str): Id of the session.
+        """
+        with self._lock:
+            self._manifests.pop(session_id, None)
+
+
+class RedisManifestStore:
+    """A manifest store that keeps each manifest in a Redis hash, which expires when the
+    session has been inactive for as long as session upload directories are kept.
+    """
+
+    def __init__(self, redis_client, ttl):
+        """
+        Args:
+            redis_client (redis.StrictRedis): A Redis client.
+            ttl (int): Seconds after the last change at which a manifest expires.
+        """
+        self._redis = redis_client
+        self._ttl = ttl
+
+    def add(self, session_id, filename, entry):
+        """See LocalManifestStore.add."""
+        key = KEY_PREFIX + session_id
+        pipeline = self._redis.pipeline()
+        pipeline.hset(key, filename, json.dumps(entry))
+        pipeline.expire(key, self._ttl)
+        pipeline.execute()
+
+    def remove(self, session_id, filename):
+        """See LocalManifestStore.remove."""
+        self._redis.hdel(KEY_PREFIX + session_id, filename)
+
+    def get(self, session_id):
+        """See LocalManifestStore.get."""
+        return {_decode(filename): json.loads(_decode(entry))
+                for filename, entry in self._redis.hgetall(KEY_PREFIX + session_id).items()}
+
+    def clear(self, session_id):
+        """See LocalManifestStore.clear."""
+        self._redis.delete(KEY_PREFIX + session_id)
+
+
+def _decode(value):
+    """Decode a value read from Redis, if it is bytes."""
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+def create_manifest_store(backend, redis_url=None, ttl=None):
+    """Create a manifest store.
+
+    Args:
+        backend (str): Either 'redis' or 'memory'.
+        redis_url (str): URL of the Redis server, if the backend is 'redis'.
+        ttl (int): Seconds after the last change at which a manifest in Redis expires.
+    Returns:
+        A manifest store.
+    Raises:
+        ValueError
+    """
+    if backend == MEMORY:
+        return LocalManifestStore()
+    if backend == REDIS:
+        return RedisManifestStore(redis.StrictRedis.from_url(redis_url), ttl)
+    raise ValueError("Unknown manifest store '{}'!".format(backend))
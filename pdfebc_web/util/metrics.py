@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+"""This module contains the Prometheus metrics of the web processes and the Celery workers.
+
+The metrics are kept with ``prometheus_client``, which is an optional dependency. Without it,
+all metrics are no-ops and there is nothing to expose. The web processes and the worker
+processes each record their own metrics. To expose the metrics of all of them on the
+``/metrics`` endpoint, point the ``PROMETHEUS_MULTIPROC_DIR`` environment variable at the same
+empty directory for all processes before they start, and ``prometheus_client`` aggregates the
+metrics that each process writes there.
+
+Queue depths and the disk usage of the file cache are not recorded as they change, but measured
+when the metrics are scraped.
+
+.. module:: metrics
+    :platform: Unix
+    :synopsis: Prometheus metrics.
+
+.. moduleauthor:: Simon Larsén <slarse@kth.se>
+"""
+import contextlib
+import logging
+import os
+import threading
+import time
+from celery import signals
+from . import janitor
+
+try:
+    import prometheus_client
+    from prometheus_client import multiprocess
+    from prometheus_client.core import GaugeMetricFamily
+except ImportError:
+    prometheus_client = None
+
+MULTIPROC_DIR_ENV = 'PROMETHEUS_MULTIPROC_DIR'
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# Task message header with the time at which the task was published
+PUBLISHED_AT_HEADER = 'pdfebc_published_at'
+SECONDS_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+RATIO_BUCKETS = (0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0)
+# Seconds for which a measurement of the disk usage of the file cache is reused
+FILE_CACHE_SCAN_INTERVAL = 300
+
+logger = logging.getLogger(__name__)
+
+
+class _NoopMetric:
+    """Stands in for all metrics when prometheus_client is not installed."""
+
+    def labels(self, *labelvalues, **labelkwargs):
+        return self
+
+    def inc(self, amount=1):
+        pass
+
+    def observe(self, amount):
+        pass
+
+    def time(self):
+        return _NoopTimer()
+
+
+class _NoopTimer(contextlib.ContextDecorator):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+def _create_metric(metric_type, name, documentation, labelnames=(), **kwargs):
+    """Create a metric, or a no-op stand-in if prometheus_client is not installed."""
+    if prometheus_client is None:
+        return _NoopMetric()
+    return getattr(prometheus_client, metric_type)(name, documentation, labelnames, **kwargs)
+
+
+REQUEST_SECONDS = _create_metric('Histogram', 'pdfebc_request_duration_seconds',
+                                 'Time spent handling requests', ['view'],
+                                 buckets=SECONDS_BUCKETS)
+UPLOAD_SECONDS = _create_metric('Histogram', 'pdfebc_upload_duration_seconds',
+                                'Time spent saving an uploaded file', buckets=SECONDS_BUCKETS)
+UPLOADED_FILES = _create_metric('Counter', 'pdfebc_uploaded_files', 'Files uploaded')
+UPLOADED_BYTES = _create_metric('Counter', 'pdfebc_uploaded_bytes', 'Bytes uploaded')
+QUEUE_WAIT_SECONDS = _create_metric('Histogram', 'pdfebc_task_queue_wait_seconds',
+                                    'Time from publishing a task until a worker starts it',
+                                    ['task'], buckets=SECONDS_BUCKETS)
+TASK_SECONDS = _create_metric('Histogram', 'pdfebc_task_duration_seconds',
+                              'Time spent running tasks', ['task'], buckets=SECONDS_BUCKETS)
+TASK_FAILURES = _create_metric('Counter', 'pdfebc_task_failures', 'Tasks that raised',
+                               ['task'])
+COMPRESS_SECONDS = _create_metric('Histogram', 'pdfebc_compress_duration_seconds',
+                                  'Time spent compressing the files of a session',
+                                  buckets=SECONDS_BUCKETS)
+GHOSTSCRIPT_SECONDS = _create_metric('Histogram', 'pdfebc_ghostscript_duration_seconds',
+                                     'Time spent running Ghostscript on a file',
+                                     buckets=SECONDS_BUCKETS)
+COMPRESSED_FILES = _create_metric('Counter', 'pdfebc_compressed_files',
+                                  'Files passed through compression, by what was done with them',
+                                  ['decision'])
+COMPRESSION_BYTES_IN = _create_metric('Counter', 'pdfebc_compression_bytes_in',
+                                      'Bytes passed into compression', ['decision'])
+COMPRESSION_BYTES_OUT = _create_metric('Counter', 'pdfebc_compression_bytes_out',
+                                       'Bytes coming out of compression', ['decision'])
+FAILED_FILES = _create_metric('Counter', 'pdfebc_failed_files',
+                              'Files that could not be compressed, by why they failed',
+                              ['reason'])
+COMPRESSION_RATIO = _create_metric('Histogram', 'pdfebc_compression_ratio',
+                                   'Output size over input size of files run through '
+                                   'Ghostscript', buckets=RATIO_BUCKETS)
+PROFILE_COMPRESSED_FILES = _create_metric('Counter', 'pdfebc_profile_compressed_files',
+                                          'Files passed through compression, by compression '
+                                          'profile and what was done with them',
+                                          ['profile', 'decision'])
+PROFILE_GHOSTSCRIPT_SECONDS = _create_metric('Histogram',
+                                             'pdfebc_profile_ghostscript_duration_seconds',
+                                             'Time spent running Ghostscript on a file, by '
+                                             'compression profile', ['profile'],
+                                             buckets=SECONDS_BUCKETS)
+PROFILE_COMPRESSION_RATIO = _create_metric('Histogram', 'pdfebc_profile_compression_ratio',
+                                           'Output size over input size of files run through '
+                                           'Ghostscript, by compression profile', ['profile'],
+                                           buckets=RATIO_BUCKETS)
+ARCHIVE_SECONDS = _create_metric('Histogram', 'pdfebc_archive_duration_seconds',
+                                 'Time spent building archives', ['format'],
+                                 buckets=SECONDS_BUCKETS)
+DELIVERY_SECONDS = _create_metric('Histogram', 'pdfebc_delivery_duration_seconds',
+                                  'Time spent delivering the files of a job by email',
+                                  ['method'], buckets=SECONDS_BUCKETS)
+DELIVERED_BYTES = _create_metric('Counter', 'pdfebc_delivered_bytes',
+                                 'Bytes of compressed files delivered', ['method'])
+
+
+def is_enabled():
+    """Return True if prometheus_client is installed."""
+    return prometheus_client is not None
+
+
+def is_multiprocess():
+    """Return True if the metrics are aggregated across processes."""
+    return bool(os.environ.get(MULTIPROC_DIR_ENV))
+
+
+def record_upload(size, seconds=None):
+    """Record an uploaded file.
+
+    Args:
+        size (int): Size of the file in bytes.
+        seconds (float): Seconds spent saving the file, if measured.
+    """
+    UPLOADED_FILES.inc()
+    UPLOADED_BYTES.inc(size)
+    if seconds is not None:
+        UPLOAD_SECONDS.observe(seconds)
+
+
+def record_compression(decision, bytes_in, bytes_out, seconds, profile=None):
+    """Record what was done with a file passed through compression.
+
+    Args:
+        decision (str): One of pdfebc_web.util.engine.DECISIONS.
+        bytes_in (int): Size of the source file.
+        bytes_out (int): Size of the output file.
+        seconds (float): Seconds spent running Ghostscript on the file, 0 if it didn't run.
+        profile (str): Name of the compression profile, if any.
+    """
+    COMPRESSED_FILES.labels(decision).inc()
+    COMPRESSION_BYTES_IN.labels(decision).inc(bytes_in)
+    COMPRESSION_BYTES_OUT.labels(decision).inc(bytes_out)
+    if profile is not None:
+        PROFILE_COMPRESSED_FILES.labels(profile, decision).inc()
+    if seconds:
+        GHOSTSCRIPT_SECONDS.observe(seconds)
+        if profile is not None:
+            PROFILE_GHOSTSCRIPT_SECONDS.labels(profile).observe(seconds)
+        if bytes_in:
+            COMPRESSION_RATIO.observe(bytes_out / bytes_in)
+            if profile is not None:
+                PROFILE_COMPRESSION_RATIO.labels(profile).observe(bytes_out / bytes_in)
+
+
+class PipelineCollector:
+    """Measures the depths of the job queues and the disk usage of the file cache when the
+    metrics are scraped. Measuring the disk usage walks the whole file cache, so it is done at
+    most once per scan interval, and scrapes in between report the last measurement.
+    """
+
+    def __init__(self, celery, queues, get_file_cache, scan_interval=FILE_CACHE_SCAN_INTERVAL,
+                 clock=time.monotonic):
+        """
+        Args:
+            celery (Celery): A Celery instance.
+            queues (function): Returns the names of the queues to measure.
+            get_file_cache (function): Returns the path to the file cache.
+            scan_interval (float): Seconds for which a measurement of the disk usage is reused.
+            clock (function): Returns the current time in seconds.
+        """
+        self._celery = celery
+        self._queues = queues
+        self._get_file_cache = get_file_cache
+        self._scan_interval = scan_interval
+        self._clock = clock
+        self._scan_lock = threading.Lock()
+        self._file_cache_size = None
+        self._scanned_at = None
+
+    def collect(self):
+        depth = GaugeMetricFamily('pdfebc_queue_depth', 'Messages waiting in a queue',
+                                  labels=['queue'])
+        for queue, messages in self.get_queue_depths().items():
+            depth.add_metric([queue], messages)
+        yield depth
+        yield GaugeMetricFamily('pdfebc_file_cache_bytes', 'Bytes used by the file cache',
+                                value=self.get_file_cache_size())
+
+    def get_file_cache_size(self):
+        """Return the bytes used by the file cache, as last measured. The file cache is only
+        scanned if the last measurement is older than the scan interval.
+
+        Returns:
+            int: Total size of the files in the file cache.
+        """
+        with self._scan_lock:
+            now = self._clock()
+            if self._scanned_at is None or now - self._scanned_at >= self._scan_interval:
+                file_cache = self._get_file_cache()
+                self._file_cache_size = janitor.scan_session_dir(file_cache).size \
+                    if os.path.isdir(file_cache) else 0
+                self._scanned_at = now
+            return self._file_cache_size
+
+    def get_queue_depths(self):
+        """Return the amount of messages waiting in each queue. Queues that can't be measured,
+        e.g. because the broker is down, are left out.
+
+        Returns:
+            dict: Amount of messages by queue name.
+        """
+        depths = {}
+        try:
+            with self._celery.connection_for_read() as connection:
+                connection.ensure_connection(max_retries=1)
+                channel = connection.default_channel
+                for queue in self._queues():
+                    try:
+                        depths[queue] = channel.queue_declare(queue=queue,
+                                                              passive=True).message_count
+                    except connection.channel_errors:
+                        # The queue doesn't exist until something is published to it
+                        depths[queue] = 0
+        except Exception as error:
+            logger.warning("Could not measure queue depths: %s", error)
+        return depths
+
+
+def generate_latest(collectors=()):
+    """Render the metrics in the Prometheus text format. In multiprocess mode, the metrics of
+    all processes are aggregated.
+
+    Args:
+        collectors (list): Extra collectors, measured at the time of the call.
+    Returns:
+        bytes: The metrics, or None if prometheus_client is not installed.
+    """
+    if prometheus_client is None:
+        return None
+    registry = prometheus_client.CollectorRegistry()
+    if is_multiprocess():
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry.register(prometheus_client.REGISTRY)
+    for collector in collectors:
+        registry.register(collector)
+    return prometheus_client.generate_latest(registry)
+
+
+_task_starts = {}
+_task_starts_lock = threading.Lock()
+
+
+def _short_name(task):
+    return task.name.rsplit('.', 1)[-1]
+
+
+@signals.before_task_publish.connect(weak=False, dispatch_uid='pdfebc_web.metrics.publish')
+def _on_publish(headers=None, **kwargs):
+    if headers is not None:
+        headers[PUBLISHED_AT_HEADER] = time.time()
+
+
+@signals.task_prerun.connect(weak=False, dispatch_uid='pdfebc_web.metrics.prerun')
+def _on_task_start(task_id=None, task=None, **kwargs):
+    published_at = getattr(task.request, PUBLISHED_AT_HEADER, None)
+    if published_at is not None:
+        QUEUE_WAIT_SECONDS.labels(_short_name(task)).observe(max(0, time.time() - published_at))
+    with _task_starts_lock:
+        _task_starts[task_id] = time.monotonic()
+
+
+@signals.task_postrun.connect(weak=False, dispatch_uid='pdfebc_web.metrics.postrun')
+def _on_task_end(task_id=None, task=None, **kwargs):
+    with _task_starts_lock:
+        start = _task_starts.pop(task_id, None)
+    if start is not None:
+        TASK_SECONDS.labels(_short_name(task)).observe(time.monotonic() - start)
+
+
+@signals.task_failure.connect(weak=False, dispatch_uid='pdfebc_web.metrics.failure')
+def _on_task_failure(sender=None, **kwargs):
+    TASK_FAILURES.labels(_short_name(sender)).inc()
+
+
+@signals.worker_process_shutdown.connect(weak=False, dispatch_uid='pdfebc_web.metrics.shutdown')
+def _on_worker_process_shutdown(**kwargs):
+    if prometheus_client is not None and is_multiprocess():
+        multiprocess.mark_process_dead(os.getpid())
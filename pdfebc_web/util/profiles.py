@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""This module contains the compression profiles that users choose between when compressing
+their files.
+
+A profile is a set of Ghostscript arguments that trade quality for size and speed, along with
+the expected CPU cost of compressing a byte with it relative to the ebook profile, which is what
+pdfebc-core uses, and the resolution that it downsamples images to. The structural analysis
+predicts whether a file will shrink from that resolution, and is skipped for profiles that don't
+downsample. The scheduler weighs the size of a job by the cost of its profile, so jobs with
+cheap profiles are routed to the small job queue more often. The profiles are configured
+server-side, and the costs are meant to be tuned with the per-profile Ghostscript time and
+compression ratio metrics.
+
+.. module:: profiles
+    :platform: Unix
+    :synopsis: Compression profiles.
+
+.. moduleauthor:: Simon Larsén <slarse@kth.se>
+"""
+from collections import namedtuple, OrderedDict
+from types import MappingProxyType
+
+SCREEN = 'screen'
+EBOOK = 'ebook'
+PRINTER = 'printer'
+LOSSLESS = 'lossless'
+DEFAULT_PROFILE = EBOOK
+# Ghostscript arguments that come before and after the arguments of every profile
+GS_ARGS_BEFORE = ['-sDEVICE=pdfwrite', '-dCompatabilityLevel=1.4']
+GS_ARGS_AFTER = ['-dNOPAUSE', '-dQUIET', '-dBATCH']
+DEFAULT_PROFILES = OrderedDict([
+    (SCREEN, {'label': 'Screen (smallest files, 72 dpi images)',
+              'args': ['-dPDFSETTINGS=/screen'],
+              'cost': 0.8,
+              'target_dpi': 72}),
+    (EBOOK, {'label': 'Ebook (small files, 150 dpi images)',
+             'args': ['-dPDFSETTINGS=/ebook'],
+             'cost': 1.0,
+             'target_dpi': 150}),
+    (PRINTER, {'label': 'Printer (high quality, 300 dpi images)',
+               'args': ['-dPDFSETTINGS=/printer'],
+               'cost': 1.5,
+               'target_dpi': 300}),
+    (LOSSLESS, {'label': 'Lossless (only rewrite the document structure)',
+                'args': ['-dPDFSETTINGS=/default',
+                         '-dPassThroughJPEGImages=true',
+                         '-dPassThroughJPXImages=true',
+                         '-dDownsampleColorImages=false',
+                         '-dDownsampleGrayImages=false',
+                         '-dDownsampleMonoImages=false',
+                         '-dAutoFilterColorImages=false',
+                         '-dAutoFilterGrayImages=false',
+                         '-dColorImageFilter=/FlateEncode',
+                         '-dGrayImageFilter=/FlateEncode'],
+                'cost': 0.6,
+                'target_dpi': None}),
+])
+
+Profile = namedtuple('Profile', ['name', 'label', 'gs_args', 'cost', 'target_dpi'])
+Profile.__doc__ = """A compression profile. gs_args are the complete Ghostscript arguments of a
+one-off run, cost is the expected CPU cost of the profile relative to the ebook profile, and
+target_dpi is the resolution that images are downsampled to, None if they aren't.
+"""
+
+
+def build_gs_args(args):
+    """Build the complete Ghostscript arguments of a profile.
+
+    Args:
+        args (List[str]): The arguments of the profile.
+    Returns:
+        List[str]: The arguments of a one-off Ghostscript run.
+    """
+    return GS_ARGS_BEFORE + list(args) + GS_ARGS_AFTER
+
+
+def load_profiles(config, default=DEFAULT_PROFILE):
+    """Load the profiles from their configuration.
+
+    Args:
+        config (dict): The label, Ghostscript arguments, cost and optionally the target
+            resolution of each profile by name, see DEFAULT_PROFILES. Profiles are listed in the
+            order of the config.
+        default (str): Name of the profile to use when none is chosen.
+    Returns:
+        Mapping[str, Profile]: A read-only mapping of the profiles by name.
+    Raises:
+        ValueError: If a profile is malformed, or the default profile is missing.
+    """
+    profiles = OrderedDict()
+    for name, profile in config.items():
+        try:
+            label, args, cost = profile['label'], profile['args'], float(profile['cost'])
+            target_dpi = profile.get('target_dpi')
+            target_dpi = None if target_dpi is None else float(target_dpi)
+        except (KeyError, TypeError, ValueError, AttributeError) as exc:
+            raise ValueError("Malformed compression profile '{}': {}".format(name, exc))
+        if cost <= 0:
+            raise ValueError("Compression profile '{}' must have a positive cost, was {}"
+                             .format(name, cost))
+        if isinstance(args, str) or not all(isinstance(arg, str) for arg in args):
+            raise ValueError("Arguments of compression profile '{}' must be a list of strings"
+                             .format(name))
+        profiles[name] = Profile(name, label, build_gs_args(args), cost, target_dpi)
+    if default not in profiles:
+        raise ValueError("Default compression profile '{}' is not configured".format(default))
+    return MappingProxyType(profiles)
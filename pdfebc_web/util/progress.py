@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""This module contains the progress reporting used while compressing files.
+
+.. module:: progress
+    :platform: Unix
+    :synopsis: Per-file progress reporting.
+
+.. moduleauthor:: Simon Larsén <slarse@kth.se>
+"""
+import os
+import threading
+import time
+
+QUEUED = 'queued'
+COMPRESSING = 'compressing'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class ProgressReporter:
+    """Keeps track of the progress of each file in a job, and publishes the progress of a file
+    every time it changes. Safe to use from several threads.
+    """
+
+    def __init__(self, publish):
+        """
+        Args:
+            publish (function): Called with the filename and a dict with the keys 'state',
+                'bytes_in', 'bytes_out' and 'elapsed' whenever the progress of a file changes.
+        """
+        self._publish = publish
+        self._start_times = {}
+        self._lock = threading.Lock()
+
+    def queued(self, src):
+        """Report that the source file is waiting to be compressed."""
+        self._report(src, QUEUED)
+
+    def started(self, src):
+        """Report that compression of the source file has started."""
+        with self._lock:
+            self._start_times[src] = time.monotonic()
+        self._report(src, COMPRESSING)
+
+    def finished(self, src, out, decision=None):
+        """Report that the source file has been compressed to out, and what was done with it
+        (see the decisions in the engine module).
+        """
+        self._report(src, DONE, bytes_out=os.stat(out).st_size, decision=decision)
+
+    def failed(self, src, error):
+        """Report that compression of the source file failed, and why if the error says so
+        (see the failure reasons in the engine module).
+        """
+        self._report(src, FAILED, error=str(error), reason=getattr(error, 'reason', None))
+
+    def _report(self, src, state, **extra):
+        """Publish the progress of the source file."""
+        with self._lock:
+            start_time = self._start_times.get(src)
+        progress = {'state': state,
+                    'bytes_in': os.stat(src).st_size,
+                    'bytes_out': None,
+                    'elapsed': None if start_time is None else time.monotonic() - start_time}
+        progress.update(extra)
+        self._publish(os.path.basename(src), progress)
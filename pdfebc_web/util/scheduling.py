@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""This module contains the scheduling of compression jobs across the Celery queues.
+
+Jobs are split into two queues by the total size of their uploaded files, so that workers
+dedicated to the small job queue keep the latency of small jobs low even when every other worker
+is busy with bulk work. The size is weighed by the expected CPU cost of the compression profile
+of the job, so a job with a cheap profile takes the fast lane at sizes where one with an
+expensive profile doesn't. Within a queue, jobs are prioritized by their size on a logarithmic
+scale, so a job with a couple of large files overtakes one with hundreds of them. In fan-out
+mode, the files of a job are packed into at most as many chunks as the per-session concurrency
+cap allows, so that a single session never occupies more than that many worker slots at a time.
+A session that already has tasks in flight, such as the speculative compressions of eager mode,
+drops one priority step for every session concurrency worth of them, so that one session
+uploading many files doesn't keep other sessions waiting.
+
+Priorities follow the Redis transport of Celery, where 0 is the highest priority.
+
+.. module:: scheduling
+    :platform: Unix
+    :synopsis: Queue routing, prioritization and chunking of compression jobs.
+
+.. moduleauthor:: Simon Larsén <slarse@kth.se>
+"""
+import math
+from collections import namedtuple
+
+SMALL = 'small'
+LARGE = 'large'
+MAX_PRIORITY = 9
+# Transport options that make the Redis transport of Celery respect message priorities
+BROKER_TRANSPORT_OPTIONS = {'priority_steps': list(range(MAX_PRIORITY + 1)),
+                            'queue_order_strategy': 'priority'}
+# Tasks that are routed to the small job queue, as they are short and I/O bound
+SMALL_QUEUE_TASKS = ('pdfebc_web.main.tasks.deliver_compressed_files',
+                     'pdfebc_web.main.tasks.sweep_file_cache')
+
+JobPlan = namedtuple('JobPlan', ['size_class', 'queue', 'priority', 'chunks'])
+
+
+def create_task_routes(small_job_queue):
+    """Create the default Celery task routes, which send the tasks that don't compress
+    anything to the small job queue. The compression tasks are routed when they are submitted.
+
+    Args:
+        small_job_queue (str): Name of the small job queue.
+    Returns:
+        dict: The task routes.
+    """
+    return {task_name: {'queue': small_job_queue} for task_name in SMALL_QUEUE_TASKS}
+
+
+def get_priority(total_size, small_job_threshold):
+    """Return the priority of a job. Small jobs get the highest priority, and every doubling of
+    the size beyond the threshold lowers it by one step.
+
+    Args:
+        total_size (int): Total size in bytes of the files of the job.
+        small_job_threshold (int): Total size in bytes up to which a job is small.
+    Returns:
+        int: The priority, from 0 (highest) to MAX_PRIORITY.
+    """
+    if total_size <= small_job_threshold:
+        return 0
+    return min(MAX_PRIORITY, 1 + int(math.log2(total_size / max(small_job_threshold, 1))))
+
+
+def split_into_chunks(sizes, max_chunks):
+    """Split files into at most max_chunks chunks of roughly equal total size, by placing the
+    largest remaining file in the currently smallest chunk. The files of each chunk keep their
+    original order.
+
+    Args:
+        sizes (List[Tuple[str, int]]): Names and sizes in bytes of the files.
+        max_chunks (int): Maximum amount of chunks.
+    Returns:
+        List[List[str]]: The names of the files of each chunk.
+    """
+    if max_chunks < 1:
+        raise ValueError("max_chunks must be at least 1, was {}".format(max_chunks))
+    order = {name: index for index, (name, _) in enumerate(sizes)}
+    chunks = [[] for _ in range(min(max_chunks, len(sizes)))]
+    totals = [0] * len(chunks)
+    for name, size in sorted(sizes, key=lambda item: item[1], reverse=True):
+        smallest = totals.index(min(totals))
+        chunks[smallest].append(name)
+        totals[smallest] += size
+    return [sorted(chunk, key=order.get) for chunk in chunks]
+
+
+def plan_job(sizes, small_job_threshold, small_job_queue, large_job_queue,
+             session_concurrency=1, cost=1.0, in_flight=0):
+    """Plan the queue, priority and chunks of a compression job.
+
+    Args:
+        sizes (List[Tuple[str, int]]): Names and sizes in bytes of the files of the job.
+        small_job_threshold (int): Total size in bytes up to which a job is small.
+        small_job_queue (str): Name of the queue for small jobs.
+        large_job_queue (str): Name of the queue for large jobs.
+        session_concurrency (int): Maximum amount of tasks of the job that may run at the same
+            time.
+        cost (float): Expected CPU cost of the compression profile of the job, relative to
+            the default profile. The total size is multiplied by it.
+        in_flight (int): Amount of compression tasks of the session that are already queued
+            or running. The priority drops one step for every session_concurrency of them.
+    Returns:
+        JobPlan: The plan.
+    """
+    total_size = sum(size for _, size in sizes) * cost
+    size_class = SMALL if total_size <= small_job_threshold else LARGE
+    queue = small_job_queue if size_class == SMALL else large_job_queue
+    chunks = split_into_chunks(sizes, session_concurrency)
+    priority = min(MAX_PRIORITY, get_priority(total_size, small_job_threshold) +
+                   in_flight // session_concurrency)
+    return JobPlan(size_class, queue, priority, chunks)
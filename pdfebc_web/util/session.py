@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+"""This module contains functions for identifying the session of a request.
+
+.. module:: session
+    :platform: Unix
+    :synopsis: Session utility functions.
+
+.. moduleauthor:: Simon Larsén <slarse@kth.se>
+"""
+import uuid
+from flask import session
+
+SESSION_ID_KEY = 'session_id'
+JOB_ID_KEY = 'job_id'
+# Name of the compression profile that the session chose for its last job
+PROFILE_KEY = 'compression_profile'
+
+
+def get_session_id():
+    """Return the id of the current session, assigning a new id if the session does not
+    have one.
+
+    Returns:
+        str: Id of the session.
+    """
+    if SESSION_ID_KEY not in session:
+        session[SESSION_ID_KEY] = str(uuid.uuid4())
+    return session[SESSION_ID_KEY]
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""This module contains the settings of pdfebc-web.
+
+The settings are loaded once at startup from the Flask config, the pdfebc-core config file and
+environment variables. The pdfebc-core config provides the email settings, and the Ghostscript
+binary unless GS_BINARY is set in the Flask config. Environment variables named after the Flask
+config keys with the prefix ``PDFEBC_WEB_`` (e.g. ``PDFEBC_WEB_COMPRESSION_WORKERS=8``) take
+precedence over both. Settings whose defaults are dicts, like the compression profiles, are
+given as JSON in the environment. Loaded settings are immutable. A SettingsHolder keeps the current
+settings, and can swap in freshly loaded ones on SIGHUP without a restart.
+
+.. module:: settings
+    :platform: Unix
+    :synopsis: Settings of pdfebc-web.
+
+.. moduleauthor:: Simon Larsén <slarse@kth.se>
+"""
+import json
+import os
+import signal
+import threading
+from collections import namedtuple
+from types import MappingProxyType
+from pdfebc_core import config_utils
+from . import profiles
+
+ENV_PREFIX = 'PDFEBC_WEB_'
+DEFAULT_GS_BINARY = 'gs'
+SETTINGS_KEYS = ('SECRET_KEY',
+                 'EXTERNAL_URL',
+                 'GS_BINARY',
+                 'COMPRESSION_WORKERS',
+                 'COMPRESSION_TIMEOUT',
+                 'COMPRESSION_FAN_OUT',
+                 'COMPRESSION_CACHE_SIZE',
+                 'COMPRESSION_ANALYSIS',
+                 'COMPRESSION_PROFILES',
+                 'DEFAULT_COMPRESSION_PROFILE',
+                 'EAGER_COMPRESSION',
+                 'GHOSTSCRIPT_MAX_MEMORY',
+                 'GHOSTSCRIPT_MAX_CPU_SECONDS',
+                 'GHOSTSCRIPT_POOL',
+                 'GHOSTSCRIPT_POOL_MAX_JOBS',
+                 'GHOSTSCRIPT_POOL_MAX_MEMORY',
+                 'JANITOR_INTERVAL',
+                 'SESSION_TTL',
+                 'FILE_CACHE_QUOTA',
+                 'MAX_UPLOAD_SIZE',
+                 'SMTP_POOL_SIZE',
+                 'SMTP_TIMEOUT',
+                 'SMTP_STARTTLS',
+                 'SMTP_RETRIES',
+                 'SMTP_RETRY_BACKOFF',
+                 'MAX_MESSAGE_SIZE',
+                 'LINK_DELIVERY_THRESHOLD',
+                 'DOWNLOAD_LINK_TTL',
+                 'SMALL_JOB_QUEUE',
+                 'LARGE_JOB_QUEUE',
+                 'SMALL_JOB_THRESHOLD',
+                 'SESSION_CONCURRENCY',
+                 'SESSION_MAX_FILES',
+                 'SESSION_MAX_BYTES',
+                 'IP_MAX_FILES',
+                 'IP_MAX_BYTES',
+                 'QUOTA_WINDOW',
+                 'SESSION_COMPRESS_RATE',
+                 'SESSION_COMPRESS_BURST',
+                 'IP_COMPRESS_RATE',
+                 'IP_COMPRESS_BURST',
+                 'JOB_TTL')
+TRUE_STRINGS = {'1', 'true', 'yes', 'on'}
+FALSE_STRINGS = {'0', 'false', 'no', 'off'}
+
+Settings = namedtuple('Settings', [key.lower() for key in SETTINGS_KEYS] + ['email_config'])
+
+
+class SettingsError(Exception):
+    """An error to be thrown when a setting can't be parsed."""
+    pass
+
+
+def load_settings(app_config, config_path=config_utils.CONFIG_PATH, environ=os.environ):
+    """Load the settings.
+
+    Args:
+        app_config (dict): The configuration of the app, which must contain all of the
+            SETTINGS_KEYS. A GS_BINARY of None means that it is read from the pdfebc-core config.
+        config_path (str): Path to the pdfebc-core config file.
+        environ (dict): The environment variables.
+    Returns:
+        Settings: The settings.
+    Raises:
+        SettingsError
+    """
+    values = {key: app_config[key] for key in SETTINGS_KEYS}
+    email_config = None
+    if os.path.isfile(config_path):
+        core_config = config_utils.read_config(config_path)
+        defaults = core_config.get(config_utils.DEFAULT_SECTION_KEY) or {}
+        if values['GS_BINARY'] is None:
+            values['GS_BINARY'] = defaults.get(config_utils.GS_DEFAULT_BINARY_KEY) or None
+        if core_config.get(config_utils.EMAIL_SECTION_KEY):
+            email_config = _freeze_config(core_config)
+    if values['GS_BINARY'] is None:
+        values['GS_BINARY'] = DEFAULT_GS_BINARY
+    for key in SETTINGS_KEYS:
+        raw_value = environ.get(ENV_PREFIX + key)
+        if raw_value is not None:
+            values[key] = _parse_value(key, raw_value, values[key])
+    try:
+        values['COMPRESSION_PROFILES'] = profiles.load_profiles(
+            values['COMPRESSION_PROFILES'], values['DEFAULT_COMPRESSION_PROFILE'])
+    except ValueError as exc:
+        raise SettingsError(str(exc))
+    return Settings(email_config=email_config,
+                    **{key.lower(): value for key, value in values.items()})
+
+
+class SettingsHolder:
+    """Holds the current settings. The settings themselves are immutable, so reloading them
+    swaps in a new Settings object, and anyone who has read the current settings keeps a
+    consistent snapshot.
+    """
+
+    def __init__(self, load):
+        """
+        Args:
+            load (function): Called without arguments to load the settings.
+        """
+        self._load = load
+        self.current = load()
+
+    def reload(self):
+        """Load the settings again and make them current.
+
+        Returns:
+            Settings: The new settings.
+        """
+        self.current = self._load()
+        return self.current
+
+
+def install_reload_handler(holder, logger=None):
+    """Reload the settings of the holder when the process receives SIGHUP. Signal handlers
+    can only be installed from the main thread, so nothing is installed from other threads.
+
+    Args:
+        holder (SettingsHolder): The holder to reload.
+        logger (logging.Logger): Logger for failed reloads, if any.
+    Returns:
+        bool: True if the handler was installed.
+    """
+    if threading.current_thread() is not threading.main_thread():
+        return False
+
+    def handle_sighup(signum, frame):
+        try:
+            holder.reload()
+        except (SettingsError, config_utils.ConfigurationError, IOError) as error:
+            if logger is not None:
+                logger.error("Failed to reload settings, keeping the old ones: %s", error)
+
+    signal.signal(signal.SIGHUP, handle_sighup)
+    return True
+
+
+def _parse_value(key, raw_value, default):
+    """Parse the raw value of a setting from an environment variable to the type of its
+    default value. A missing default is parsed as an integer.
+    """
+    if isinstance(default, bool):
+        if raw_value.lower() in TRUE_STRINGS:
+            return True
+        if raw_value.lower() in FALSE_STRINGS:
+            return False
+        raise SettingsError("{} must be a boolean, got '{}'".format(key, raw_value))
+    if isinstance(default, str):
+        return raw_value
+    if isinstance(default, dict):
+        try:
+            value = json.loads(raw_value)
+        except ValueError:
+            value = None
+        if not isinstance(value, dict):
+            raise SettingsError("{} must be a JSON object, got '{}'".format(key, raw_value))
+        return value
+    if raw_value.lower() in ('', 'none'):
+        return None
+    try:
+        return type(default)(raw_value) if default is not None else int(raw_value)
+    except ValueError:
+        raise SettingsError("{} must be a number, got '{}'".format(key, raw_value))
+
+
+def _freeze_config(config):
+    """Return a read-only copy of a pdfebc-core config."""
+    return MappingProxyType({section: MappingProxyType(dict(content))
+                             for section, content in config.items()})
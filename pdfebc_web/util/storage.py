@@ -0,0 +1,603 @@
+# -*- coding: utf-8 -*-
+"""This module contains the storage backends for uploaded files and downloads.
+
+Uploads are always streamed to the session upload directory of the local file cache first, and
+Ghostscript always runs on local files. The storage backend decides how the files get from the
+process that received them to the processes that compress and serve them:
+
+* The local backend keeps everything in the file cache, which must then be shared by the web
+  processes and the Celery workers, i.e. they run on the same machine or share a file system.
+* The S3 backend keeps the uploads and downloads in a bucket of an S3-compatible object store,
+  so the web processes and the workers can run on separate machines. Each upload is copied to
+  the bucket with a multipart upload once it has been saved, and the local copy is removed.
+  Workers fetch the uploads of a session into their own file cache with parallel ranged reads
+  before compressing them, and downloads are streamed from the bucket with ranged reads. Every
+  object carries the SHA-256 of its content as metadata, and a local copy is only reused if it
+  has the same digest, so a file that is replaced by another of the same size is fetched again.
+  The
+  backend requires ``boto3``, which is an optional dependency, and reads the credentials from
+  the usual places, e.g. the ``AWS_ACCESS_KEY_ID`` and ``AWS_SECRET_ACCESS_KEY`` environment
+  variables.
+
+The compressed files of a session are also stored in the backend, as the chunks of a job in
+fan-out mode may be compressed on other workers than the one that delivers the job, and as the
+files can be downloaded from the web processes until the session expires. Archives for download
+links are streamed straight into the backend.
+
+.. module:: storage
+    :platform: Unix
+    :synopsis: Storage backends for uploaded files and downloads.
+
+.. moduleauthor:: Simon Larsén <slarse@kth.se>
+"""
+import io
+import itertools
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pdfebc_core import compress
+from . import download, engine, file
+from .cache import hash_file
+from .file import COMPRESSED_FILES_DIRNAME
+from .archive import get_archive_path, TAR
+
+try:
+    import boto3
+except ImportError:
+    boto3 = None
+
+LOCAL = 'local'
+S3 = 's3'
+SESSIONS_PREFIX = 'sessions/'
+DOWNLOADS_PREFIX = 'downloads/'
+# S3 requires all parts of a multipart upload but the last to be at least 5 MiB
+MIN_PART_SIZE = 5 * 1024**2
+DEFAULT_PART_SIZE = 8 * 1024**2
+DEFAULT_WORKERS = 4
+# Maximum amount of keys in a single delete request
+DELETE_BATCH_SIZE = 1000
+NOT_FOUND_CODES = ('404', 'NoSuchKey', 'NotFound')
+# Key of the metadata that holds the hex digest of the SHA-256 of an object
+SHA256_METADATA_KEY = 'sha256'
+
+
+def _is_not_found(exc):
+    """Return True if an error raised by an S3 client means that the object doesn't exist."""
+    response = getattr(exc, 'response', None) or {}
+    return str(response.get('Error', {}).get('Code')) in NOT_FOUND_CODES
+
+
+def _open_file(path):
+    """Open a file for reading and return it along with its size."""
+    stream = open(path, 'rb')
+    return stream, os.fstat(stream.fileno()).st_size
+
+
+class LocalStorage:
+    """A storage backend that keeps the uploads and downloads in the local file cache."""
+
+    def ensure_session_dir(self, session_id):
+        """Create the session upload directory in the local file cache, if it doesn't exist.
+
+        Args:
+            session_id (str): Id of the session.
+        Returns:
+            str: Path to the session upload directory.
+        """
+        return file.ensure_session_upload_dir(session_id)
+
+    def get_session_dir(self, session_id):
+        """Return the path to the session upload directory in the local file cache.
+
+        Args:
+            session_id (str): Id of the session.
+        """
+        return file.get_session_upload_dir_path(session_id)
+
+    def save_upload(self, session_id, filename):
+        """Store a file that has been saved in the local session upload directory, so that it
+        can be fetched by other processes.
+
+        Args:
+            session_id (str): Id of the session.
+            filename (str): Name of the file.
+        """
+        pass
+
+    def list_uploads(self, session_id):
+        """Return the names and sizes of the stored PDF files of a session.
+
+        Args:
+            session_id (str): Id of the session.
+        Returns:
+            List[Tuple[str, int]]: Names and sizes in bytes of the files, sorted by name.
+        """
+        session_upload_dir = self.get_session_dir(session_id)
+        if not os.path.isdir(session_upload_dir):
+            return []
+        return [(os.path.basename(path), os.stat(path).st_size)
+                for path in engine.get_pdf_paths(session_upload_dir)]
+
+    def fetch_upload(self, session_id, filename):
+        """Make a stored file of a session available in the local session upload directory.
+
+        Args:
+            session_id (str): Id of the session.
+            filename (str): Name of the file.
+        Returns:
+            str: Path to the local file.
+        Raises:
+            FileNotFoundError
+        """
+        path = os.path.join(self.get_session_dir(session_id), filename)
+        if not os.path.isfile(path):
+            raise FileNotFoundError("No such upload: '{}'".format(path))
+        return path
+
+    def fetch_session(self, session_id):
+        """Make all stored files of a session available in the local session upload directory.
+
+        Args:
+            session_id (str): Id of the session.
+        Returns:
+            str: Path to the session upload directory.
+        """
+        return self.get_session_dir(session_id)
+
+    def save_compressed(self, session_id, filename):
+        """Store a file that has been compressed into the local compressed files directory of
+        a session, so that it can be fetched by other processes.
+
+        Args:
+            session_id (str): Id of the session.
+            filename (str): Name of the file.
+        """
+        pass
+
+    def fetch_compressed(self, session_id, filename):
+        """Make a stored compressed file of a session available in the local compressed files
+        directory of the session.
+
+        Args:
+            session_id (str): Id of the session.
+            filename (str): Name of the file.
+        Returns:
+            str: Path to the local file.
+        Raises:
+            FileNotFoundError
+        """
+        path = os.path.join(self.get_session_dir(session_id), COMPRESSED_FILES_DIRNAME, filename)
+        if not os.path.isfile(path):
+            raise FileNotFoundError("No such compressed file: '{}'".format(path))
+        return path
+
+    def fetch_compressed_files(self, session_id):
+        """Make all stored compressed files of a session available in the local compressed
+        files directory of the session.
+
+        Args:
+            session_id (str): Id of the session.
+        Returns:
+            List[str]: Paths to the local files, in order of their names. Empty if the session
+            has no compressed files.
+        """
+        out_dir = os.path.join(self.get_session_dir(session_id), COMPRESSED_FILES_DIRNAME)
+        if not os.path.isdir(out_dir):
+            return []
+        return [os.path.join(out_dir, filename) for filename in sorted(os.listdir(out_dir))
+                if filename.endswith(compress.PDF_EXTENSION)]
+
+    def delete_compressed_files(self, session_id):
+        """Delete the stored compressed files of a session, along with the local compressed
+        files directory.
+
+        Args:
+            session_id (str): Id of the session.
+        """
+        shutil.rmtree(os.path.join(self.get_session_dir(session_id), COMPRESSED_FILES_DIRNAME),
+                      ignore_errors=True)
+
+    def delete_uploads(self, session_id):
+        """Delete the stored uploads of a session along with everything but the compressed
+        files in the local session upload directory. The compressed files are kept until the
+        session expires.
+
+        Args:
+            session_id (str): Id of the session.
+        """
+        _delete_all_but_compressed_files(self.get_session_dir(session_id))
+
+    def delete_session(self, session_id):
+        """Delete the stored files of a session, along with the local session upload directory.
+
+        Args:
+            session_id (str): Id of the session.
+        """
+        file.delete_session_upload_dir(session_id)
+
+    def save_download(self, download_id, chunks):
+        """Store an archive for a download, so that it can be served by other processes. The
+        archive is written to the local downloads directory as it is streamed.
+
+        Args:
+            download_id (str): Id of the download.
+            chunks (Iterable[bytes]): The archive, in chunks.
+        """
+        download.write_download(file.get_downloads_path(), download_id, chunks)
+
+    def open_download(self, download_id):
+        """Open the archive of a download for reading.
+
+        Args:
+            download_id (str): Id of the download.
+        Returns:
+            Tuple[file, int]: A binary file object and the size of the archive in bytes.
+        Raises:
+            pdfebc_web.util.download.DownloadError
+        """
+        return _open_file(download.get_download_path(file.get_downloads_path(), download_id))
+
+    def sweep(self, session_ttl, download_ttl, on_evict=None):
+        """Delete stored sessions and downloads that have expired. Does nothing, as the janitor
+        sweeps the local file cache.
+
+        Args:
+            session_ttl (float): Seconds of inactivity after which a session expires.
+            download_ttl (float): Seconds after which a download expires.
+            on_evict (function): Called with the id of each deleted session.
+        Returns:
+            int: Amount of deleted sessions and downloads.
+        """
+        return 0
+
+
+def _delete_all_but_compressed_files(session_dir):
+    """Delete everything in a local session directory but the compressed files directory."""
+    if not os.path.isdir(session_dir):
+        return
+    for entry in os.scandir(session_dir):
+        if entry.name == COMPRESSED_FILES_DIRNAME:
+            continue
+        if entry.is_dir(follow_symlinks=False):
+            shutil.rmtree(entry.path, ignore_errors=True)
+        else:
+            os.remove(entry.path)
+
+
+def _split_parts(chunks, part_size):
+    """Regroup chunks of data into parts of the given size, all but the last of which are
+    full. Yields a single empty part if there is no data.
+    """
+    buffer = bytearray()
+    empty = True
+    for chunk in chunks:
+        buffer += chunk
+        while len(buffer) >= part_size:
+            yield bytes(buffer[:part_size])
+            del buffer[:part_size]
+            empty = False
+    if buffer or empty:
+        yield bytes(buffer)
+
+
+class ObjectReader(io.RawIOBase):
+    """A read-only file object for an object in an S3 bucket, which reads the object with one
+    ranged request per read. Wrap it in an io.BufferedReader to read in larger ranges.
+    """
+
+    def __init__(self, client, bucket, key, size):
+        """
+        Args:
+            client: An S3 client.
+            bucket (str): Name of the bucket.
+            key (str): Key of the object.
+            size (int): Size of the object in bytes.
+        """
+        super().__init__()
+        self._client = client
+        self._bucket = bucket
+        self._key = key
+        self._size = size
+        self._offset = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        length = min(len(buffer), self._size - self._offset)
+        if length <= 0:
+            return 0
+        data = _get_range(self._client, self._bucket, self._key, self._offset, length)
+        buffer[:len(data)] = data
+        self._offset += len(data)
+        return len(data)
+
+
+def _get_range(client, bucket, key, offset, length):
+    """Read a range of an object in an S3 bucket."""
+    response = client.get_object(Bucket=bucket, Key=key,
+                                 Range='bytes={}-{}'.format(offset, offset + length - 1))
+    return response['Body'].read()
+
+
+class S3Storage:
+    """A storage backend that keeps the uploads and downloads in a bucket of an S3-compatible
+    object store, and uses the local file cache as a staging area.
+    """
+
+    def __init__(self, client, bucket, prefix='', part_size=DEFAULT_PART_SIZE,
+                 workers=DEFAULT_WORKERS, clock=time.time):
+        """
+        Args:
+            client: An S3 client, e.g. from boto3.client('s3').
+            bucket (str): Name of the bucket.
+            prefix (str): Prefix of the keys of all objects.
+            part_size (int): Size in bytes of the parts of multipart uploads and ranged reads.
+            workers (int): Amount of ranges of a file that are fetched at the same time.
+            clock (function): Returns the current time as a UNIX timestamp.
+        """
+        if part_size < MIN_PART_SIZE:
+            raise ValueError("part_size must be at least {}, was {}".format(MIN_PART_SIZE,
+                                                                             part_size))
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.part_size = part_size
+        self.workers = workers
+        self._clock = clock
+
+    def ensure_session_dir(self, session_id):
+        """See LocalStorage.ensure_session_dir."""
+        return file.ensure_session_upload_dir(session_id)
+
+    def get_session_dir(self, session_id):
+        """See LocalStorage.get_session_dir."""
+        return file.get_session_upload_dir_path(session_id)
+
+    def save_upload(self, session_id, filename):
+        """See LocalStorage.save_upload. The local file is removed once it has been stored."""
+        path = os.path.join(self.get_session_dir(session_id), filename)
+        self._put(self._session_prefix(session_id) + filename, path)
+        os.remove(path)
+
+    def list_uploads(self, session_id):
+        """See LocalStorage.list_uploads. Compressed files are not listed."""
+        prefix = self._session_prefix(session_id)
+        return sorted((obj['Key'][len(prefix):], obj['Size']) for obj in self._list(prefix)
+                      if obj['Key'].endswith(compress.PDF_EXTENSION) and
+                      '/' not in obj['Key'][len(prefix):])
+
+    def fetch_upload(self, session_id, filename):
+        """See LocalStorage.fetch_upload. A local file with the same SHA-256 as the stored
+        file is not fetched again.
+        """
+        return self._fetch(self._session_prefix(session_id) + filename,
+                           os.path.join(self.ensure_session_dir(session_id), filename))
+
+    def fetch_session(self, session_id):
+        """See LocalStorage.fetch_session."""
+        for filename, _ in self.list_uploads(session_id):
+            self.fetch_upload(session_id, filename)
+        return self.ensure_session_dir(session_id)
+
+    def save_compressed(self, session_id, filename):
+        """See LocalStorage.save_compressed. The local file is kept, so it isn't fetched again
+        if the job is delivered by the same process.
+        """
+        self._put(self._compressed_prefix(session_id) + filename,
+                  os.path.join(self.get_session_dir(session_id), COMPRESSED_FILES_DIRNAME,
+                               filename))
+
+    def fetch_compressed(self, session_id, filename):
+        """See LocalStorage.fetch_compressed. A local file with the same SHA-256 as the
+        stored file is not fetched again.
+        """
+        out_dir = os.path.join(self.ensure_session_dir(session_id), COMPRESSED_FILES_DIRNAME)
+        os.makedirs(out_dir, exist_ok=True)
+        return self._fetch(self._compressed_prefix(session_id) + filename,
+                           os.path.join(out_dir, filename))
+
+    def fetch_compressed_files(self, session_id):
+        """See LocalStorage.fetch_compressed_files. Only the stored files are returned, not
+        whatever else is in the local directory.
+        """
+        prefix = self._compressed_prefix(session_id)
+        return sorted(self.fetch_compressed(session_id, obj['Key'][len(prefix):])
+                      for obj in self._list(prefix))
+
+    def delete_compressed_files(self, session_id):
+        """See LocalStorage.delete_compressed_files."""
+        self._delete([obj['Key'] for obj in self._list(self._compressed_prefix(session_id))])
+        shutil.rmtree(os.path.join(self.get_session_dir(session_id), COMPRESSED_FILES_DIRNAME),
+                      ignore_errors=True)
+
+    def delete_uploads(self, session_id):
+        """See LocalStorage.delete_uploads."""
+        compressed_prefix = self._compressed_prefix(session_id)
+        self._delete([obj['Key'] for obj in self._list(self._session_prefix(session_id))
+                      if not obj['Key'].startswith(compressed_prefix)])
+        _delete_all_but_compressed_files(self.get_session_dir(session_id))
+
+    def delete_session(self, session_id):
+        """See LocalStorage.delete_session."""
+        self._delete([obj['Key'] for obj in self._list(self._session_prefix(session_id))])
+        shutil.rmtree(self.get_session_dir(session_id), ignore_errors=True)
+
+    def save_download(self, download_id, chunks):
+        """See LocalStorage.save_download. The archive is stored with a multipart upload as it
+        is streamed, so nothing is written to local disk and only about two parts are held in
+        memory.
+        """
+        self._put_chunks(self._download_key(download.check_download_id(download_id)), chunks)
+
+    def open_download(self, download_id):
+        """See LocalStorage.open_download. The archive is read from the bucket in ranges of
+        the part size.
+        """
+        key = self._download_key(download.check_download_id(download_id))
+        try:
+            size = self.client.head_object(Bucket=self.bucket, Key=key)['ContentLength']
+        except Exception as exc:
+            if _is_not_found(exc):
+                raise download.DownloadError("The download does not exist")
+            raise
+        reader = ObjectReader(self.client, self.bucket, key, size)
+        return io.BufferedReader(reader, buffer_size=self.part_size), size
+
+    def sweep(self, session_ttl, download_ttl, on_evict=None):
+        """See LocalStorage.sweep. A session expires when none of its files have been stored
+        for session_ttl seconds.
+        """
+        now = self._clock()
+        keys = {}
+        newest = {}
+        sessions_prefix = self.prefix + SESSIONS_PREFIX
+        for obj in self._list(sessions_prefix):
+            session_id = obj['Key'][len(sessions_prefix):].split('/', 1)[0]
+            keys.setdefault(session_id, []).append(obj['Key'])
+            newest[session_id] = max(newest.get(session_id, 0),
+                                     obj['LastModified'].timestamp())
+        expired_sessions = [session_id for session_id in keys
+                            if now - newest[session_id] > session_ttl]
+        expired_downloads = [obj['Key'] for obj in self._list(self.prefix + DOWNLOADS_PREFIX)
+                             if now - obj['LastModified'].timestamp() > download_ttl]
+        self._delete([key for session_id in expired_sessions for key in keys[session_id]] +
+                     expired_downloads)
+        if on_evict is not None:
+            for session_id in expired_sessions:
+                on_evict(session_id)
+        return len(expired_sessions) + len(expired_downloads)
+
+    def _session_prefix(self, session_id):
+        return '{}{}{}/'.format(self.prefix, SESSIONS_PREFIX, session_id)
+
+    def _compressed_prefix(self, session_id):
+        return self._session_prefix(session_id) + COMPRESSED_FILES_DIRNAME + '/'
+
+    def _download_key(self, download_id):
+        return self.prefix + DOWNLOADS_PREFIX + get_archive_path(download_id, TAR)
+
+    def _list(self, prefix):
+        """Yield the objects whose keys start with the prefix."""
+        kwargs = {'Bucket': self.bucket, 'Prefix': prefix}
+        while True:
+            response = self.client.list_objects_v2(**kwargs)
+            yield from response.get('Contents', [])
+            if not response.get('IsTruncated'):
+                return
+            kwargs['ContinuationToken'] = response['NextContinuationToken']
+
+    def _delete(self, keys):
+        for start in range(0, len(keys), DELETE_BATCH_SIZE):
+            batch = keys[start:start + DELETE_BATCH_SIZE]
+            self.client.delete_objects(Bucket=self.bucket, Delete={
+                'Objects': [{'Key': key} for key in batch], 'Quiet': True})
+
+    def _put(self, key, path):
+        """Store a local file along with its SHA-256, see _put_chunks. The file is read one
+        part at a time.
+        """
+        metadata = {SHA256_METADATA_KEY: hash_file(path).hexdigest()}
+        with open(path, 'rb') as stream:
+            self._put_chunks(key, iter(lambda: stream.read(self.part_size), b''), metadata)
+
+    def _put_chunks(self, key, chunks, metadata=None):
+        """Store chunks of data, with a multipart upload if they add up to more than one part.
+        The data is regrouped into parts as it is read, so at most the part that is being
+        uploaded and the next one are held in memory.
+        """
+        metadata = metadata or {}
+        parts = _split_parts(chunks, self.part_size)
+        first = next(parts)
+        second = next(parts, None)
+        if second is None:
+            self.client.put_object(Bucket=self.bucket, Key=key, Body=first, Metadata=metadata)
+            return
+        upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=key,
+                                                        Metadata=metadata)['UploadId']
+        try:
+            uploaded = []
+            for number, data in enumerate(itertools.chain([first, second], parts), start=1):
+                response = self.client.upload_part(Bucket=self.bucket, Key=key,
+                                                   UploadId=upload_id, PartNumber=number,
+                                                   Body=data)
+                uploaded.append({'ETag': response['ETag'], 'PartNumber': number})
+            self.client.complete_multipart_upload(Bucket=self.bucket, Key=key,
+                                                  UploadId=upload_id,
+                                                  MultipartUpload={'Parts': uploaded})
+        except Exception:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=key,
+                                               UploadId=upload_id)
+            raise
+
+    def _fetch(self, key, path):
+        """Fetch an object into a local file, unless the local file has the same content. Local
+        files of objects without a SHA-256 are always fetched again.
+
+        Raises:
+            FileNotFoundError
+        """
+        try:
+            head = self.client.head_object(Bucket=self.bucket, Key=key)
+        except Exception as exc:
+            if _is_not_found(exc):
+                raise FileNotFoundError("No such object: '{}'".format(key))
+            raise
+        size = head['ContentLength']
+        sha256 = head.get('Metadata', {}).get(SHA256_METADATA_KEY)
+        if not (os.path.isfile(path) and os.stat(path).st_size == size and
+                sha256 is not None and hash_file(path).hexdigest() == sha256):
+            self._get(key, size, path)
+        return path
+
+    def _get(self, key, size, path):
+        """Fetch an object into a local file with parallel ranged reads. The file only appears
+        at path once it is complete.
+        """
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            os.ftruncate(fd, size)
+
+            def fetch_range(offset):
+                data = _get_range(self.client, self.bucket, key, offset,
+                                  min(self.part_size, size - offset))
+                os.pwrite(fd, data, offset)
+
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                list(executor.map(fetch_range, range(0, size, self.part_size)))
+        except BaseException:
+            os.close(fd)
+            os.remove(tmp)
+            raise
+        os.close(fd)
+        os.replace(tmp, path)
+
+
+def create_storage(backend, endpoint_url=None, bucket=None, prefix='',
+                   part_size=DEFAULT_PART_SIZE, workers=DEFAULT_WORKERS):
+    """Create a storage backend.
+
+    Args:
+        backend (str): Either 'local' or 's3'.
+        endpoint_url (str): URL of the S3-compatible object store, None for AWS S3.
+        bucket (str): Name of the bucket, if the backend is 's3'.
+        prefix (str): Prefix of the keys of all objects in the bucket.
+        part_size (int): Size in bytes of the parts of multipart uploads and ranged reads.
+        workers (int): Amount of ranges of a file that are fetched at the same time.
+    Returns:
+        A storage backend.
+    Raises:
+        ValueError, ImportError
+    """
+    if backend == LOCAL:
+        return LocalStorage()
+    if backend == S3:
+        if boto3 is None:
+            raise ImportError("The S3 storage backend requires boto3, install pdfebc-web[s3]")
+        if not bucket:
+            raise ValueError("The S3 storage backend requires a bucket!")
+        return S3Storage(boto3.client(S3, endpoint_url=endpoint_url), bucket, prefix,
+                         part_size=part_size, workers=workers)
+    raise ValueError("Unknown storage backend '{}'!".format(backend))
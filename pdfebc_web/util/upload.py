@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+"""This module contains functions for streaming uploads to disk.
+
+The request body is copied to the session upload directory in fixed-size chunks, and the content
+is hashed and validated along the way, so memory usage per upload stays flat no matter how large
+the uploaded file is.
+
+.. module:: upload
+    :platform: Unix
+    :synopsis: Streaming upload utility functions.
+
+.. moduleauthor:: Simon Larsén <slarse@kth.se>
+"""
+import asyncio
+import functools
+import hashlib
+import json
+import os
+import tempfile
+import uuid
+from collections import namedtuple
+
+CHUNK_SIZE = 64 * 1024
+PDF_MAGIC = b'%PDF'
+RESUMABLE_UPLOADS_DIRNAME = '.uploads'
+PART_EXTENSION = '.part'
+META_EXTENSION = '.json'
+
+UploadResult = namedtuple('UploadResult', ['path', 'size', 'sha256'])
+
+
+class UploadError(Exception):
+    """An error to be thrown when an upload is rejected."""
+    pass
+
+
+class UploadTooLargeError(UploadError):
+    """An error to be thrown when an upload exceeds the size limit."""
+    pass
+
+
+class NotAPdfError(UploadError):
+    """An error to be thrown when an upload does not start with the PDF magic bytes."""
+    pass
+
+
+class UploadNotFoundError(UploadError):
+    """An error to be thrown when a resumable upload does not exist."""
+    pass
+
+
+class UploadOffsetError(UploadError):
+    """An error to be thrown when a chunk does not start where the resumable upload left off,
+    or when a resumable upload is finalized before all of its bytes have arrived.
+    """
+
+    def __init__(self, message, offset):
+        """
+        Args:
+            message (str): The error message.
+            offset (int): The current offset of the resumable upload.
+        """
+        super().__init__(message)
+        self.offset = offset
+
+
+def check_size(size, max_size):
+    """Check that the size is within the size limit.
+
+    Args:
+        size (int): A size in bytes.
+        max_size (int): The size limit in bytes.
+    Raises:
+        UploadTooLargeError
+    """
+    if size > max_size:
+        raise UploadTooLargeError("Upload exceeds the size limit of {} bytes".format(max_size))
+
+
+def _copy_stream(stream, file, max_size, chunk_size, digest=None, head=b''):
+    """Copy the stream to the file in chunks, checking the size limit and the PDF magic bytes.
+
+    Args:
+        stream: A binary file-like object to read from.
+        file: A binary file-like object to write to.
+        max_size (int): Maximum amount of bytes to accept.
+        chunk_size (int): Amount of bytes to read at a time.
+        digest: A hashlib object to update with the content, if any.
+        head (bytes): The first bytes of the content that have already been written.
+    Returns:
+        Tuple[int, bytes]: The amount of bytes copied, and the (up to) first four bytes of the
+        content.
+    Raises:
+        UploadTooLargeError, NotAPdfError
+    """
+    size = 0
+    for chunk in iter(lambda: stream.read(chunk_size), b''):
+        size += len(chunk)
+        head = _check_chunk(chunk, size, head, max_size)
+        if digest is not None:
+            digest.update(chunk)
+        file.write(chunk)
+    return size, head
+
+
+def _check_chunk(chunk, size, head, max_size):
+    """Check the size limit and the PDF magic bytes after another chunk has been received.
+
+    Args:
+        chunk (bytes): The chunk.
+        size (int): The amount of bytes received so far, including the chunk.
+        head (bytes): The (up to) first four bytes of the content before the chunk.
+        max_size (int): Maximum amount of bytes to accept.
+    Returns:
+        bytes: The (up to) first four bytes of the content including the chunk.
+    Raises:
+        UploadTooLargeError, NotAPdfError
+    """
+    check_size(size, max_size)
+    if len(head) < len(PDF_MAGIC):
+        head += chunk[:len(PDF_MAGIC) - len(head)]
+        if not PDF_MAGIC.startswith(head):
+            raise NotAPdfError("Upload is not a PDF file")
+    return head
+
+
+def stream_to_file(stream, out, max_size, chunk_size=CHUNK_SIZE, accept=None):
+    """Copy the stream to out in chunks, while computing the SHA-256 of the content and checking
+    the PDF magic bytes. The content is written to a temporary file in the same directory and
+    only moved to out once the whole stream has been accepted, so a rejected upload never
+    replaces an earlier file at out.
+
+    Args:
+        stream: A binary file-like object to read from.
+        out (str): Path to the output file.
+        max_size (int): Maximum amount of bytes to accept.
+        chunk_size (int): Amount of bytes to read at a time.
+        accept (function): Called with the size of the content before it is moved to out, and
+            rejects it by raising an UploadError.
+    Returns:
+        UploadResult: The path, size and SHA-256 of the written file.
+    Raises:
+        UploadTooLargeError, NotAPdfError
+    """
+    digest = hashlib.sha256()
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(out), prefix='.', suffix=PART_EXTENSION)
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            size, head = _copy_stream(stream, file, max_size, chunk_size, digest)
+        if head != PDF_MAGIC:
+            raise NotAPdfError("Upload is not a PDF file")
+        if accept is not None:
+            accept(size)
+        os.replace(tmp, out)
+    except BaseException:
+        os.remove(tmp)
+        raise
+    return UploadResult(out, size, digest.hexdigest())
+
+
+async def stream_to_file_async(chunks, out, max_size, accept=None):
+    """Like stream_to_file, but for asynchronous servers. The content is read from an
+    asynchronous iterator, and the file is written and moved on the default executor of the
+    event loop, so that the event loop never waits for the disk. The accept function is called
+    on the executor as well.
+
+    Args:
+        chunks: An asynchronous iterator of bytes.
+        out (str): Path to the output file.
+        max_size (int): Maximum amount of bytes to accept.
+        accept (function): See stream_to_file.
+    Returns:
+        UploadResult: The path, size and SHA-256 of the written file.
+    Raises:
+        UploadTooLargeError, NotAPdfError
+    """
+    loop = asyncio.get_event_loop()
+    digest = hashlib.sha256()
+    fd, tmp = await loop.run_in_executor(None, functools.partial(
+        tempfile.mkstemp, dir=os.path.dirname(out), prefix='.', suffix=PART_EXTENSION))
+    try:
+        size = 0
+        head = b''
+        with os.fdopen(fd, 'wb') as file:
+            async for chunk in chunks:
+                size += len(chunk)
+                head = _check_chunk(chunk, size, head, max_size)
+                digest.update(chunk)
+                await loop.run_in_executor(None, file.write, chunk)
+        if head != PDF_MAGIC:
+            raise NotAPdfError("Upload is not a PDF file")
+        if accept is not None:
+            await loop.run_in_executor(None, accept, size)
+        await loop.run_in_executor(None, os.replace, tmp, out)
+    except BaseException:
+        os.remove(tmp)
+        raise
+    return UploadResult(out, size, digest.hexdigest())
+
+
+def create_resumable_upload(upload_dir, filename, size, max_size):
+    """Start a resumable upload of a file into the upload directory. The chunks are collected in
+    a hidden subdirectory until the upload is finalized.
+
+    Args:
+        upload_dir (str): Path to the directory that the file is finally placed in.
+        filename (str): Name of the file.
+        size (int): Total size of the file in bytes.
+        max_size (int): Maximum amount of bytes to accept.
+    Returns:
+        str: Id of the upload.
+    Raises:
+        UploadTooLargeError
+    """
+    check_size(size, max_size)
+    upload_id = uuid.uuid4().hex
+    part, meta = _resumable_upload_paths(upload_dir, upload_id)
+    os.makedirs(os.path.dirname(part), exist_ok=True)
+    with open(meta, 'w') as file:
+        json.dump({'filename': filename, 'size': size}, file)
+    open(part, 'wb').close()
+    return upload_id
+
+
+def get_resumable_upload(upload_dir, upload_id):
+    """Return the filename, total size and current offset of a resumable upload.
+
+    Args:
+        upload_dir (str): Path to the directory that the file is finally placed in.
+        upload_id (str): Id of the upload.
+    Returns:
+        dict: A dict with the keys 'filename', 'size' and 'offset'.
+    Raises:
+        UploadNotFoundError
+    """
+    part, meta = _resumable_upload_paths(upload_dir, upload_id)
+    try:
+        with open(meta) as file:
+            upload = json.load(file)
+        upload['offset'] = os.stat(part).st_size
+    except FileNotFoundError:
+        raise UploadNotFoundError("No upload with id '{}'".format(upload_id))
+    return upload
+
+
+def append_chunk(upload_dir, upload_id, offset, stream, chunk_size=CHUNK_SIZE):
+    """Append a chunk to a resumable upload. The chunk must start exactly where the upload
+    left off, which lets a client resume an interrupted upload by first asking for the current
+    offset.
+
+    Args:
+        upload_dir (str): Path to the directory that the file is finally placed in.
+        upload_id (str): Id of the upload.
+        offset (int): Offset of the first byte of the chunk.
+        stream: A binary file-like object to read the chunk from.
+        chunk_size (int): Amount of bytes to read at a time.
+    Returns:
+        int: The new offset of the upload.
+    Raises:
+        UploadNotFoundError, UploadOffsetError, UploadTooLargeError, NotAPdfError
+    """
+    upload = get_resumable_upload(upload_dir, upload_id)
+    if offset != upload['offset']:
+        raise UploadOffsetError("Expected offset {}, got {}".format(upload['offset'], offset),
+                                upload['offset'])
+    part, _ = _resumable_upload_paths(upload_dir, upload_id)
+    with open(part, 'r+b') as file:
+        head = file.read(len(PDF_MAGIC))
+        file.seek(offset)
+        try:
+            size, _ = _copy_stream(stream, file, upload['size'] - offset, chunk_size, head=head)
+        except UploadError:
+            file.truncate(offset)
+            raise
+    return offset + size
+
+
+def finalize_resumable_upload(upload_dir, upload_id, accept=None):
+    """Move a completed resumable upload into the upload directory.
+
+    Args:
+        upload_dir (str): Path to the directory that the file is finally placed in.
+        upload_id (str): Id of the upload.
+        accept (function): See stream_to_file. A rejected upload is left as it is.
+    Returns:
+        UploadResult: The path, size and SHA-256 of the file.
+    Raises:
+        UploadNotFoundError, UploadOffsetError, NotAPdfError
+    """
+    upload = get_resumable_upload(upload_dir, upload_id)
+    if upload['offset'] != upload['size']:
+        raise UploadOffsetError("Upload is incomplete, {} of {} bytes received"
+                                .format(upload['offset'], upload['size']), upload['offset'])
+    part, meta = _resumable_upload_paths(upload_dir, upload_id)
+    digest = hashlib.sha256()
+    with open(part, 'rb') as file:
+        if file.read(len(PDF_MAGIC)) != PDF_MAGIC:
+            raise NotAPdfError("Upload is not a PDF file")
+        file.seek(0)
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    if accept is not None:
+        accept(upload['size'])
+    out = os.path.join(upload_dir, upload['filename'])
+    os.replace(part, out)
+    os.remove(meta)
+    return UploadResult(out, upload['size'], digest.hexdigest())
+
+
+def _resumable_upload_paths(upload_dir, upload_id):
+    """Return the paths to the partial file and the metadata file of a resumable upload.
+
+    Raises:
+        UploadNotFoundError
+    """
+    try:
+        upload_id = uuid.UUID(hex=upload_id).hex
+    except ValueError:
+        raise UploadNotFoundError("No upload with id '{}'".format(upload_id))
+    base = os.path.join(upload_dir, RESUMABLE_UPLOADS_DIRNAME, upload_id)
+    return base + PART_EXTENSION, base + META_EXTENSION
@@ -16,6 +16,9 @@ required = [
     'pdfebc-core==0.2.0',
     'redis==2.10.5',
     'celery==4.0.2']
+extras = {'metrics': ['prometheus_client>=0.4.0'],
+          'asgi': ['asgiref>=3.2', 'uvicorn>=0.11'],
+          's3': ['boto3>=1.9']}
 
 setup(
     name='pdfebc-web',
@@ -27,10 +30,11 @@ setup(
     url='https://github.com/slarse/pdfebc-web',
     download_url='https://github.com/slarse/pdfebc-web/archive/v0.1.2.tar.gz',
     license=license,
-    packages=find_packages(exclude=('tests', 'docs')),
-    scripts=['bin/pdfebc-web', 'bin/pdfebc-web-start-celery-redis'],
+    packages=find_packages(exclude=('tests', 'docs', 'benchmarks')),
+    scripts=['bin/pdfebc-web', 'bin/pdfebc-web-serve', 'bin/pdfebc-web-start-celery-redis'],
     tests_require=test_requirements,
     install_requires=required,
+    extras_require=extras,
     include_package_data=True,
     zip_safe=False
 )
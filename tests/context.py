@@ -4,7 +4,30 @@ import os
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 import pdfebc_web
 import pdfebc_web.util.file
+import pdfebc_web.util.engine
+import pdfebc_web.util.gspool
+import pdfebc_web.util.cache
+import pdfebc_web.util.eager
+import pdfebc_web.util.profiles
+import pdfebc_web.util.archive
+import pdfebc_web.util.upload
+import pdfebc_web.util.session
+import pdfebc_web.util.progress
+import pdfebc_web.util.janitor
+import pdfebc_web.util.manifest
+import pdfebc_web.util.settings
+import pdfebc_web.util.mail
+import pdfebc_web.util.download
+import pdfebc_web.util.storage
+import pdfebc_web.util.analysis
+import pdfebc_web.util.scheduling
+import pdfebc_web.util.limits
+import pdfebc_web.util.jobs
+import pdfebc_web.util.metrics
 import pdfebc_web.main.views
+import pdfebc_web.main.tasks
 import pdfebc_web.main.forms
+import pdfebc_web.api.views
 import pdfebc_web.factory
+import pdfebc_web.asgi
 import pdfebc_web.startapp
@@ -0,0 +1,78 @@
+"""Unit tests for the pdfebc_web.util.analysis module.
+
+Author: Simon Larsén <slarse@kth.se>
+"""
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+from .context import pdfebc_web
+
+PAGE = b'1 0 obj\n<< /Type /Page /MediaBox [0 0 612 792] /Contents 2 0 R >>\nendobj\n'
+CONTENT_STREAM = b'2 0 obj\n<< /Length 10 /Filter /FlateDecode >>\nstream\n0123456789\nendstream\nendobj\n'
+UNFILTERED_STREAM = b'2 0 obj\n<< /Length 10 >>\nstream\n0123456789\nendstream\nendobj\n'
+OBJECT_STREAM = (b'3 0 obj\n<< /Type /ObjStm /N 2 /First 9 /Length 10 /Filter /FlateDecode >>\n'
+                 b'stream\n0123456789\nendstream\nendobj\n')
+
+
+def image(width, filters=b'/DCTDecode'):
+    return (b'4 0 obj\n<< /Type /XObject /Subtype /Image /Width ' + str(width).encode() +
+            b' /Height 100 /BitsPerComponent 8 /ColorSpace /DeviceRGB /Filter ' + filters +
+            b' /DecodeParms << /Columns 3 >> /Length 10 >>\nstream\n0123456789\nendstream\n'
+            b'endobj\n')
+
+
+class AnalysisTest(TestCase):
+    def setUp(self):
+        self.trash_can = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.trash_can.cleanup()
+
+    def analyze(self, *objects):
+        path = os.path.join(self.trash_can.name, 'file.pdf')
+        with open(path, 'wb') as file:
+            file.write(b'%PDF-1.5\n' + b''.join(objects) + b'%%EOF\n')
+        return pdfebc_web.util.analysis.analyze_pdf(path)
+
+    def test_analyze(self):
+        analysis = self.analyze(PAGE, CONTENT_STREAM, OBJECT_STREAM, image(1275),
+                                image(600, b'[/FlateDecode /DCTDecode]'))
+        self.assertEqual(4, analysis.streams)
+        self.assertEqual(0, analysis.unfiltered_streams)
+        self.assertEqual(2, analysis.images)
+        self.assertEqual({'DCTDecode': 2, 'FlateDecode': 1}, analysis.image_filters)
+        self.assertAlmostEqual(150, analysis.max_image_dpi)
+        self.assertEqual(1, analysis.object_streams)
+        self.assertTrue(analysis.complete)
+
+    def test_optimized_file_is_not_worth_compressing(self):
+        analysis = self.analyze(PAGE, CONTENT_STREAM, OBJECT_STREAM, image(1275))
+        self.assertFalse(pdfebc_web.util.analysis.is_worth_compressing(analysis))
+
+    def test_high_resolution_image_is_worth_compressing(self):
+        analysis = self.analyze(PAGE, CONTENT_STREAM, OBJECT_STREAM, image(3000))
+        self.assertTrue(pdfebc_web.util.analysis.is_worth_compressing(analysis))
+
+    def test_lossless_image_is_worth_compressing(self):
+        analysis = self.analyze(PAGE, CONTENT_STREAM, image(600, b'/FlateDecode'))
+        self.assertTrue(pdfebc_web.util.analysis.is_worth_compressing(analysis))
+
+    def test_unfiltered_stream_is_worth_compressing(self):
+        analysis = self.analyze(PAGE, UNFILTERED_STREAM, OBJECT_STREAM)
+        self.assertTrue(pdfebc_web.util.analysis.is_worth_compressing(analysis))
+
+    def test_plain_file_is_worth_compressing(self):
+        analysis = self.analyze(PAGE, CONTENT_STREAM)
+        self.assertTrue(pdfebc_web.util.analysis.is_worth_compressing(analysis))
+
+    def test_partially_analyzed_file_is_worth_compressing(self):
+        with patch('pdfebc_web.util.analysis.MAX_ANALYSIS_SIZE', 10):
+            analysis = self.analyze(PAGE, CONTENT_STREAM, OBJECT_STREAM, image(1275))
+        self.assertFalse(analysis.complete)
+        self.assertTrue(pdfebc_web.util.analysis.is_worth_compressing(analysis))
+
+    def test_empty_file(self):
+        path = os.path.join(self.trash_can.name, 'empty.pdf')
+        open(path, 'wb').close()
+        self.assertEqual(0, pdfebc_web.util.analysis.analyze_pdf(path).streams)
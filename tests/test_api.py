@@ -0,0 +1,292 @@
+"""Unit tests for the pdfebc_web.api.views module.
+
+Author: Simon Larsén <slarse@kth.se>
+"""
+import hashlib
+import io
+import json
+import os
+import tarfile
+import tempfile
+import time
+import uuid
+import zipfile
+from unittest import TestCase
+from unittest.mock import patch
+from .context import pdfebc_web
+from .test_storage import FakeS3Client
+
+CONTENT = b'%PDF-1.4\n' + b'x' * 1000
+
+
+class ApiTest(TestCase):
+    def setUp(self):
+        self.trash_can = tempfile.TemporaryDirectory()
+        pdfebc_web.util.file.FILE_CACHE = self.trash_can.name
+        self.manifest_store = pdfebc_web.util.manifest.LocalManifestStore()
+        with patch('pdfebc_web.factory.create_manifest_store', autospec=True,
+                   return_value=self.manifest_store):
+            _, self.app = pdfebc_web.factory.create_app({'MAX_UPLOAD_SIZE': 2000,
+                                                          'LIMITS_STORE': 'memory',
+                                                          'JOB_REGISTRY': 'memory'})
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        self.trash_can.cleanup()
+
+    def get_session_upload_dir(self):
+        """Return the upload directory of the test client's session."""
+        with self.client.session_transaction() as session:
+            session_id = session[pdfebc_web.util.session.SESSION_ID_KEY]
+        return pdfebc_web.util.file.get_session_upload_dir_path(session_id)
+
+    def test_upload(self):
+        response = self.client.put('/api/upload/file.pdf', data=CONTENT)
+        self.assertEqual(201, response.status_code)
+        self.assertEqual({'filename': 'file.pdf', 'size': len(CONTENT),
+                          'sha256': hashlib.sha256(CONTENT).hexdigest()},
+                         response.get_json())
+        with open(os.path.join(self.get_session_upload_dir(), 'file.pdf'), 'rb') as file:
+            self.assertEqual(CONTENT, file.read())
+
+    def test_upload_adds_to_manifest(self):
+        self.client.put('/api/upload/file.pdf', data=CONTENT)
+        self.client.put('/api/upload/bad.pdf', data=b'not a pdf')
+        with self.client.session_transaction() as session:
+            session_id = session[pdfebc_web.util.session.SESSION_ID_KEY]
+        manifest = self.manifest_store.get(session_id)
+        self.assertEqual(['file.pdf'], list(manifest))
+        self.assertEqual(len(CONTENT), manifest['file.pdf']['size'])
+        self.assertEqual(hashlib.sha256(CONTENT).hexdigest(), manifest['file.pdf']['sha256'])
+
+    def test_upload_is_precompressed(self):
+        components = self.app.extensions['pdfebc_web']
+        components.settings.current = components.settings.current._replace(
+            eager_compression=True)
+        with patch.object(components.tasks.precompress_uploaded_file,
+                          'apply_async') as mock_apply_async:
+            self.client.put('/api/upload/file.pdf', data=CONTENT)
+        self.assertEqual('file.pdf', mock_apply_async.call_args[0][0][1])
+
+    def test_upload_quota_exceeded(self):
+        with patch('pdfebc_web.api.views.get_upload_quotas', autospec=True,
+                   return_value=[pdfebc_web.util.limits.Quota('session', 1, None, 60)]):
+            self.assertEqual(201, self.client.put('/api/upload/a.pdf', data=CONTENT).status_code)
+            response = self.client.put('/api/upload/b.pdf', data=CONTENT)
+        self.assertEqual(429, response.status_code)
+        self.assertEqual(['a.pdf'], os.listdir(self.get_session_upload_dir()))
+
+    def test_reupload_is_counted_as_replacement(self):
+        quota = pdfebc_web.util.limits.Quota('session', 1, len(CONTENT) + 10, 60)
+        with patch('pdfebc_web.api.views.get_upload_quotas', autospec=True,
+                   return_value=[quota]):
+            self.assertEqual(201, self.client.put('/api/upload/a.pdf', data=CONTENT).status_code)
+            response = self.client.put('/api/upload/a.pdf', data=CONTENT + b'x' * 10)
+            self.assertEqual(201, response.status_code)
+            response = self.client.put('/api/upload/a.pdf', data=CONTENT + b'x' * 20)
+        self.assertEqual(429, response.status_code)
+        with open(os.path.join(self.get_session_upload_dir(), 'a.pdf'), 'rb') as file:
+            self.assertEqual(CONTENT + b'x' * 10, file.read())
+
+    def test_upload_not_a_pdf(self):
+        response = self.client.put('/api/upload/file.pdf', data=b'not a pdf')
+        self.assertEqual(415, response.status_code)
+        self.assertEqual([], os.listdir(self.get_session_upload_dir()))
+
+    def test_upload_bad_extension(self):
+        response = self.client.put('/api/upload/file.exe', data=CONTENT)
+        self.assertEqual(400, response.status_code)
+
+    def test_upload_too_large(self):
+        response = self.client.put('/api/upload/file.pdf', data=CONTENT * 2)
+        self.assertEqual(413, response.status_code)
+
+    def test_upload_multiple(self):
+        data = {'files': [(io.BytesIO(CONTENT), 'a.pdf'), (io.BytesIO(CONTENT), 'b.pdf')]}
+        response = self.client.post('/api/upload', data=data,
+                                    content_type='multipart/form-data')
+        self.assertEqual(201, response.status_code)
+        self.assertEqual(['a.pdf', 'b.pdf'],
+                         [file['filename'] for file in response.get_json()['files']])
+        self.assertEqual(['a.pdf', 'b.pdf'], sorted(os.listdir(self.get_session_upload_dir())))
+
+    def test_upload_multiple_partial_failure(self):
+        data = {'files': [(io.BytesIO(CONTENT), 'a.pdf'), (io.BytesIO(b'nope'), 'b.pdf')]}
+        response = self.client.post('/api/upload', data=data,
+                                    content_type='multipart/form-data')
+        self.assertEqual(207, response.status_code)
+        files = response.get_json()['files']
+        self.assertNotIn('error', files[0])
+        self.assertIn('error', files[1])
+        self.assertEqual(['a.pdf'], os.listdir(self.get_session_upload_dir()))
+
+    def test_resumable_upload(self):
+        response = self.client.post('/api/resumable',
+                                    json={'filename': 'file.pdf', 'size': len(CONTENT)})
+        self.assertEqual(201, response.status_code)
+        upload_id = response.get_json()['upload_id']
+        url = '/api/resumable/{}'.format(upload_id)
+        response = self.client.patch(url + '?offset=0', data=CONTENT[:500])
+        self.assertEqual(500, response.get_json()['offset'])
+        response = self.client.patch(url + '?offset=0', data=CONTENT[:500])
+        self.assertEqual(409, response.status_code)
+        self.assertEqual(500, response.get_json()['offset'])
+        self.assertEqual(500, self.client.get(url).get_json()['offset'])
+        response = self.client.patch(url + '?offset=500', data=CONTENT[500:])
+        self.assertEqual(len(CONTENT), response.get_json()['offset'])
+        response = self.client.post(url + '/finalize')
+        self.assertEqual(201, response.status_code)
+        self.assertEqual(hashlib.sha256(CONTENT).hexdigest(), response.get_json()['sha256'])
+        with open(os.path.join(self.get_session_upload_dir(), 'file.pdf'), 'rb') as file:
+            self.assertEqual(CONTENT, file.read())
+
+    def test_resumable_upload_not_found(self):
+        response = self.client.get('/api/resumable/{}'.format('0' * 32))
+        self.assertEqual(404, response.status_code)
+
+    def create_compressed_file(self):
+        """Put a file in the compressed files directory of the test client's session."""
+        self.client.put('/api/upload/file.pdf', data=CONTENT)
+        compressed_files_dir = os.path.join(self.get_session_upload_dir(), 'compressed_files')
+        os.mkdir(compressed_files_dir)
+        with open(os.path.join(compressed_files_dir, 'file.pdf'), 'wb') as file:
+            file.write(CONTENT)
+
+    def test_download_tar(self):
+        self.create_compressed_file()
+        response = self.client.get('/api/download?format=tar')
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(response.is_streamed)
+        self.assertIn('compressed_files.tar', response.headers['Content-Disposition'])
+        with tarfile.open(fileobj=io.BytesIO(response.data)) as tar:
+            self.assertEqual(CONTENT, tar.extractfile('compressed_files/file.pdf').read())
+
+    def test_download_zip(self):
+        self.create_compressed_file()
+        response = self.client.get('/api/download?format=zip')
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(response.is_streamed)
+        self.assertIn('compressed_files.zip', response.headers['Content-Disposition'])
+        with zipfile.ZipFile(io.BytesIO(response.data)) as zip_:
+            self.assertEqual(CONTENT, zip_.read('compressed_files/file.pdf'))
+
+    def test_download_compressed_files_from_storage(self):
+        s3_client = FakeS3Client()
+        storage = pdfebc_web.util.storage.S3Storage(s3_client, 'bucket')
+        with patch('pdfebc_web.factory.create_storage', autospec=True, return_value=storage):
+            _, app = pdfebc_web.factory.create_app({'LIMITS_STORE': 'memory',
+                                                    'JOB_REGISTRY': 'memory'})
+        client = app.test_client()
+        client.put('/api/upload/file.pdf', data=CONTENT)
+        with client.session_transaction() as session:
+            session_id = session[pdfebc_web.util.session.SESSION_ID_KEY]
+        # Compressed and delivered by a worker on another machine
+        s3_client.put_object('bucket', 'sessions/{}/compressed_files/file.pdf'.format(session_id),
+                             CONTENT)
+        storage.delete_uploads(session_id)
+        # Left behind locally by a file that failed, and was never stored
+        compressed_files_dir = os.path.join(storage.get_session_dir(session_id),
+                                            'compressed_files')
+        os.makedirs(compressed_files_dir, exist_ok=True)
+        with open(os.path.join(compressed_files_dir, 'failed.pdf'), 'wb') as file:
+            file.write(b'%PDF-1.4\ntruncated')
+        response = client.get('/api/download')
+        self.assertEqual(200, response.status_code)
+        with tarfile.open(fileobj=io.BytesIO(response.data)) as tar:
+            self.assertEqual(CONTENT, tar.extractfile('compressed_files/file.pdf').read())
+            self.assertEqual(['compressed_files/file.pdf'],
+                             [member.name for member in tar.getmembers() if member.isfile()])
+
+    def test_web_process_sweeps_its_file_cache_with_s3_storage(self):
+        storage = pdfebc_web.util.storage.S3Storage(FakeS3Client(), 'bucket')
+        with patch('pdfebc_web.factory.create_storage', autospec=True, return_value=storage):
+            _, app = pdfebc_web.factory.create_app({'LIMITS_STORE': 'memory',
+                                                    'JOB_REGISTRY': 'memory',
+                                                    'STORAGE_BACKEND': 's3',
+                                                    'SESSION_TTL': 60})
+        stale_dir = storage.ensure_session_dir(str(uuid.uuid4()))
+        os.utime(stale_dir, (time.time() - 120, time.time() - 120))
+        with patch('threading.Thread.start', autospec=True,
+                   side_effect=lambda thread: thread.run()):
+            self.assertEqual(404, app.test_client().get('/api/download').status_code)
+        self.assertFalse(os.path.exists(stale_dir))
+
+    def test_download_nothing_compressed(self):
+        self.assertEqual(404, self.client.get('/api/download').status_code)
+
+    def create_download_token(self):
+        """Archive a compressed file into the downloads directory and sign a link to it."""
+        self.create_compressed_file()
+        download_id = pdfebc_web.util.download.create_download(
+            pdfebc_web.util.file.get_downloads_path(),
+            os.path.join(self.get_session_upload_dir(), 'compressed_files'))
+        return pdfebc_web.util.download.sign_download_id(self.app.config['SECRET_KEY'],
+                                                         download_id)
+
+    def test_download_link(self):
+        token = self.create_download_token()
+        response = self.client.get('/api/downloads/' + token)
+        self.assertEqual(200, response.status_code)
+        self.assertIn('compressed_files.tar', response.headers['Content-Disposition'])
+        with tarfile.open(fileobj=io.BytesIO(response.data)) as tar:
+            self.assertEqual(CONTENT, tar.extractfile('compressed_files/file.pdf').read())
+        response.close()
+
+    def test_download_link_tampered(self):
+        token = self.create_download_token()
+        self.assertEqual(404, self.client.get('/api/downloads/x' + token).status_code)
+
+    def test_download_link_expired(self):
+        token = self.create_download_token()
+        with patch('itsdangerous.TimestampSigner.get_timestamp', return_value=10**10):
+            response = self.client.get('/api/downloads/' + token)
+        self.assertEqual(410, response.status_code)
+
+    def test_download_bad_format(self):
+        self.assertEqual(400, self.client.get('/api/download?format=rar').status_code)
+
+    def set_job_id(self, job_id):
+        """Make the job the current job of the test client's session."""
+        with self.client.session_transaction() as session:
+            session[pdfebc_web.util.session.JOB_ID_KEY] = job_id
+
+    @patch('pdfebc_web.api.views.get_job_status', autospec=True)
+    def test_job_status(self, mock_get_job_status):
+        status = {'job_id': 'job', 'state': 'SUCCESS', 'ready': True, 'files': {},
+                  'version': 'v1'}
+        mock_get_job_status.return_value = status
+        self.set_job_id('job')
+        response = self.client.get('/api/jobs/job?version=v1&wait=10')
+        self.assertEqual(status, response.get_json())
+        self.assertEqual(1, mock_get_job_status.call_count)
+        # The finished job is dropped from the session
+        self.assertEqual(404, self.client.get('/api/jobs/job').status_code)
+
+    @patch('pdfebc_web.api.views.JOB_POLL_INTERVAL', 0)
+    @patch('pdfebc_web.api.views.get_job_status', autospec=True)
+    def test_job_status_long_poll(self, mock_get_job_status):
+        pending = {'job_id': 'job', 'state': 'PENDING', 'ready': False, 'files': {},
+                   'version': 'v1'}
+        done = dict(pending, state='SUCCESS', ready=True, version='v2')
+        mock_get_job_status.side_effect = [pending, pending, done]
+        self.set_job_id('job')
+        response = self.client.get('/api/jobs/job?version=v1&wait=10')
+        self.assertEqual(done, response.get_json())
+
+    def test_job_status_of_other_session(self):
+        self.set_job_id('job')
+        self.assertEqual(404, self.client.get('/api/jobs/other').status_code)
+
+    @patch('pdfebc_web.api.views.JOB_POLL_INTERVAL', 0)
+    @patch('pdfebc_web.api.views.get_job_status', autospec=True)
+    def test_job_events(self, mock_get_job_status):
+        pending = {'job_id': 'job', 'state': 'PENDING', 'ready': False, 'files': {},
+                   'version': 'v1'}
+        done = dict(pending, state='SUCCESS', ready=True, version='v2')
+        mock_get_job_status.side_effect = [pending, pending, done]
+        self.set_job_id('job')
+        response = self.client.get('/api/jobs/job/events')
+        self.assertEqual('text/event-stream', response.mimetype)
+        events = [line[len('data: '):] for line in response.data.decode().split('\n\n')
+                  if line]
+        self.assertEqual([pending, done], [json.loads(event) for event in events])
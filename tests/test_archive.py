@@ -0,0 +1,134 @@
+"""Unit tests for the pdfebc_web.util.archive module.
+
+Author: Simon Larsén <slarse@kth.se>
+"""
+import gzip
+import os
+import tarfile
+import tempfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from unittest import TestCase
+from unittest.mock import patch
+from .context import pdfebc_web
+
+
+class ArchiveTest(TestCase):
+    def setUp(self):
+        self.trash_can = tempfile.TemporaryDirectory()
+        self.src_dir = os.path.join(self.trash_can.name, 'compressed_files')
+        os.mkdir(self.src_dir)
+        self.contents = {}
+        for i in range(5):
+            filename = '{}.pdf'.format(i)
+            self.contents[filename] = os.urandom(3000) + b'a' * 3000
+            with open(os.path.join(self.src_dir, filename), 'wb') as file:
+                file.write(self.contents[filename])
+        self.out = os.path.join(self.trash_can.name, 'archive')
+
+    def tearDown(self):
+        self.trash_can.cleanup()
+
+    def assert_tar_contents(self, path):
+        with tarfile.open(path, 'r') as tar:
+            for filename, content in self.contents.items():
+                member = tar.extractfile(os.path.join('compressed_files', filename))
+                self.assertEqual(content, member.read())
+
+    @patch('pdfebc_web.util.archive.BLOCK_SIZE', 1000)
+    def test_make_archive_tgz_in_parallel_blocks(self):
+        out = pdfebc_web.util.archive.make_archive(self.src_dir, self.out, 'tgz', workers=4)
+        self.assertEqual(self.out + '.tgz', out)
+        with open(out, 'rb') as file:
+            # every block is a separate gzip member
+            self.assertGreater(file.read().count(b'\x1f\x8b\x08'), 1)
+        with gzip.open(out) as file:
+            self.assertTrue(file.read())
+        self.assert_tar_contents(out)
+
+    @patch('pdfebc_web.util.archive.BLOCK_SIZE', 1000)
+    def test_make_archive_tgz_shuts_down_threads_on_error(self):
+        executors = []
+
+        def create_executor(*args, **kwargs):
+            executors.append(ThreadPoolExecutor(*args, **kwargs))
+            return executors[-1]
+
+        with patch('pdfebc_web.util.archive.ThreadPoolExecutor', side_effect=create_executor), \
+                patch('gzip.compress', side_effect=OSError('No space left on device')):
+            with self.assertRaises(OSError):
+                pdfebc_web.util.archive.make_archive(self.src_dir, self.out, 'tgz', workers=2)
+        with self.assertRaises(RuntimeError):
+            executors[0].submit(print)
+
+    def test_make_archive_tgz_level_zero(self):
+        out = pdfebc_web.util.archive.make_archive(self.src_dir, self.out, 'tgz', level=0)
+        self.assert_tar_contents(out)
+
+    def test_make_archive_tar(self):
+        out = pdfebc_web.util.archive.make_archive(self.src_dir, self.out, 'tar')
+        self.assertEqual(self.out + '.tar', out)
+        with open(out, 'rb') as file:
+            self.assertNotEqual(b'\x1f\x8b', file.read(2))
+        self.assert_tar_contents(out)
+
+    def test_make_archive_zip(self):
+        out = pdfebc_web.util.archive.make_archive(self.src_dir, self.out + '.zip', 'zip')
+        self.assertEqual(self.out + '.zip', out)
+        with zipfile.ZipFile(out) as zip_:
+            for info in zip_.infolist():
+                self.assertEqual(zipfile.ZIP_STORED, info.compress_type)
+            for filename, content in self.contents.items():
+                self.assertEqual(content, zip_.read('compressed_files/' + filename))
+
+    def test_make_archive_unknown_format(self):
+        with self.assertRaises(pdfebc_web.util.archive.ArchivingError):
+            pdfebc_web.util.archive.make_archive(self.src_dir, self.out, 'rar')
+
+    def test_make_archive_empty_source_dir(self):
+        with tempfile.TemporaryDirectory(dir=self.trash_can.name) as empty_dir:
+            for archive_format in ['tgz', 'tar', 'zip']:
+                with self.assertRaises(pdfebc_web.util.archive.ArchivingError):
+                    pdfebc_web.util.archive.make_archive(empty_dir, self.out, archive_format)
+
+    def test_archiving_error_is_reexported(self):
+        self.assertIs(pdfebc_web.util.archive.ArchivingError,
+                      pdfebc_web.util.file.ArchivingError)
+
+    def test_stream_archive_tar(self):
+        with open(self.out, 'wb') as file:
+            for chunk in pdfebc_web.util.archive.stream_archive(self.src_dir, 'tar',
+                                                                chunk_size=1000):
+                file.write(chunk)
+        self.assertEqual(0, os.stat(self.out).st_size % tarfile.RECORDSIZE)
+        self.assert_tar_contents(self.out)
+
+    def test_stream_archive_zip(self):
+        with open(self.out, 'wb') as file:
+            for chunk in pdfebc_web.util.archive.stream_archive(self.src_dir, 'zip',
+                                                                chunk_size=1000):
+                self.assertLessEqual(len(chunk), 2000)
+                file.write(chunk)
+        with zipfile.ZipFile(self.out) as zip_:
+            self.assertIsNone(zip_.testzip())
+            for filename, content in self.contents.items():
+                self.assertEqual(content, zip_.read('compressed_files/' + filename))
+
+    def test_stream_archive_only_given_files(self):
+        filepaths = [os.path.join(self.src_dir, filename) for filename in ['3.pdf', '1.pdf']]
+        for archive_format in ['tar', 'zip']:
+            with open(self.out, 'wb') as file:
+                for chunk in pdfebc_web.util.archive.stream_archive(self.src_dir, archive_format,
+                                                                    filepaths=filepaths):
+                    file.write(chunk)
+            if archive_format == 'tar':
+                with tarfile.open(self.out) as tar:
+                    names = [member.name for member in tar.getmembers() if member.isfile()]
+            else:
+                with zipfile.ZipFile(self.out) as zip_:
+                    names = zip_.namelist()
+            self.assertEqual(['compressed_files/1.pdf', 'compressed_files/3.pdf'], names)
+
+    def test_stream_archive_tgz_is_not_supported(self):
+        with self.assertRaises(pdfebc_web.util.archive.ArchivingError):
+            pdfebc_web.util.archive.stream_archive(self.src_dir, 'tgz')
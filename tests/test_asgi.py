@@ -0,0 +1,136 @@
+"""Unit tests for the pdfebc_web.asgi module.
+
+Author: Simon Larsén <slarse@kth.se>
+"""
+import asyncio
+import json
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import Mock, patch
+from .context import pdfebc_web
+
+CONTENT = b'%PDF-1.4\n' + b'x' * 1000
+
+
+def http_scope(method, path, headers=(), query_string=b''):
+    return {'type': 'http', 'method': method, 'path': path, 'query_string': query_string,
+            'headers': list(headers), 'client': ('127.0.0.1', 1234)}
+
+
+class AsyncFrontEndTest(TestCase):
+    def setUp(self):
+        self.trash_can = tempfile.TemporaryDirectory()
+        pdfebc_web.util.file.FILE_CACHE = self.trash_can.name
+        _, self.app = pdfebc_web.factory.create_app({'MANIFEST_STORE': 'memory',
+                                                     'LIMITS_STORE': 'memory',
+                                                     'JOB_REGISTRY': 'memory',
+                                                     'MAX_UPLOAD_SIZE': 2000})
+        self.fallback_scopes = []
+        self.front_end = pdfebc_web.asgi.AsyncFrontEnd(self.app, self.fallback)
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+        self.trash_can.cleanup()
+
+    async def fallback(self, scope, receive, send):
+        self.fallback_scopes.append(scope)
+
+    def request(self, scope, messages=({'type': 'http.request'},)):
+        """Run a request through the front end.
+
+        Returns:
+            Tuple[int, dict, bytes]: The status, headers and body of the response.
+        """
+        messages = list(messages)
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        self.loop.run_until_complete(self.front_end(scope, receive, send))
+        start = sent[0]
+        return (start['status'], dict(start['headers']),
+                b''.join(message.get('body', b'') for message in sent[1:]))
+
+    def upload(self, filename, chunks, headers=()):
+        messages = [{'type': 'http.request', 'body': chunk, 'more_body': True}
+                    for chunk in chunks]
+        messages.append({'type': 'http.request', 'body': b''})
+        return self.request(http_scope('PUT', '/api/upload/' + filename, headers), messages)
+
+    def test_upload_in_chunks(self):
+        status, headers, body = self.upload('file.pdf', [CONTENT[:10], CONTENT[10:]])
+        self.assertEqual(201, status)
+        self.assertEqual(len(CONTENT), json.loads(body.decode('utf-8'))['size'])
+        self.assertIn(b'set-cookie', headers)
+        session_id = self.front_end.load_session(http_scope('GET', '/', [
+            (b'cookie', headers[b'set-cookie'].split(b';')[0])]))['session_id']
+        with open(os.path.join(self.trash_can.name, session_id, 'file.pdf'), 'rb') as file:
+            self.assertEqual(CONTENT, file.read())
+        self.assertIn('file.pdf',
+                      self.app.extensions['pdfebc_web'].manifest_store.get(session_id))
+
+    def test_upload_is_precompressed(self):
+        precompress = Mock()
+        components = self.front_end.components
+        self.front_end.components = components._replace(
+            tasks=components.tasks._replace(precompress=precompress))
+        status, _, _ = self.upload('file.pdf', [CONTENT])
+        self.assertEqual(201, status)
+        precompress.assert_called_once()
+        self.assertEqual(('file.pdf', len(CONTENT)), (precompress.call_args[0][1],
+                                                       precompress.call_args[0][3]))
+
+    def test_upload_without_client_address(self):
+        get_upload_quotas = pdfebc_web.util.limits.get_upload_quotas
+        for headers, ip in [([(b'x-forwarded-for', b'10.0.0.1, 10.0.0.2')], '10.0.0.2'),
+                            ([], pdfebc_web.asgi.UNKNOWN_CLIENT)]:
+            scope = dict(http_scope('PUT', '/api/upload/file.pdf', headers), client=None)
+            with patch('pdfebc_web.asgi.get_upload_quotas',
+                       side_effect=get_upload_quotas) as mock_get_upload_quotas:
+                status, _, _ = self.request(scope, [{'type': 'http.request', 'body': CONTENT}])
+            self.assertEqual(201, status)
+            self.assertEqual(ip, mock_get_upload_quotas.call_args[0][2])
+
+    def test_upload_of_non_pdf_leaves_no_file(self):
+        status, headers, _ = self.upload('file.pdf', [b'not a pdf'])
+        self.assertEqual(415, status)
+        session_dir = os.listdir(self.trash_can.name)[0]
+        self.assertEqual([], os.listdir(os.path.join(self.trash_can.name, session_dir)))
+
+    def test_upload_too_large_by_content_length(self):
+        status, _, _ = self.upload('file.pdf', [CONTENT], [(b'content-length', b'3000')])
+        self.assertEqual(413, status)
+
+    def test_client_disconnect_leaves_no_file(self):
+        messages = [{'type': 'http.request', 'body': CONTENT[:10], 'more_body': True},
+                    {'type': 'http.disconnect'}]
+        status, _, _ = self.request(http_scope('PUT', '/api/upload/file.pdf'), messages)
+        self.assertEqual(400, status)
+        session_dir = os.listdir(self.trash_can.name)[0]
+        self.assertEqual([], os.listdir(os.path.join(self.trash_can.name, session_dir)))
+
+    def test_job_status_of_other_session(self):
+        status, _, _ = self.request(http_scope('GET', '/api/jobs/job'))
+        self.assertEqual(404, status)
+
+    @patch('pdfebc_web.asgi.get_job_status', autospec=True)
+    def test_job_status(self, mock_get_job_status):
+        mock_get_job_status.return_value = {'version': 'a', 'ready': True}
+        _, cookie = self.front_end.dump_session({'job_id': 'job'})
+        status, headers, body = self.request(http_scope(
+            'GET', '/api/jobs/job', [(b'cookie', cookie.split(b';')[0])]))
+        self.assertEqual(200, status)
+        self.assertEqual({'version': 'a', 'ready': True}, json.loads(body.decode('utf-8')))
+        cookie = dict(headers)[b'set-cookie'].split(b';')[0].split(b'=', 1)[1]
+        self.assertNotIn('job_id', self.front_end._serializer.loads(cookie.decode('latin-1')))
+
+    def test_other_routes_fall_back(self):
+        scope = http_scope('GET', '/')
+        self.loop.run_until_complete(self.front_end(scope, None, None))
+        self.assertEqual([scope], self.fallback_scopes)
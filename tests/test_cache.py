@@ -0,0 +1,125 @@
+"""Unit tests for the pdfebc_web.util.cache module.
+
+Author: Simon Larsén <slarse@kth.se>
+"""
+import os
+import tempfile
+import time
+from unittest import TestCase
+from unittest.mock import patch
+from .context import pdfebc_web
+from .test_engine import create_fake_gs, create_pdf
+
+GS_ARGS = ['-dPDFSETTINGS=/ebook']
+
+
+class CompressionCacheTest(TestCase):
+    def setUp(self):
+        self.trash_can = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self.trash_can.name, 'cache')
+        self.cache = pdfebc_web.util.cache.CompressionCache(self.cache_dir, 1000)
+        self.src = create_pdf(self.trash_can.name, 'src.pdf', 100)
+
+    def tearDown(self):
+        self.trash_can.cleanup()
+
+    def test_key_depends_on_content_and_settings(self):
+        other = create_pdf(self.trash_can.name, 'other.pdf', 100)
+        key = self.cache.key(self.src, 'gs', GS_ARGS)
+        self.assertEqual(key, self.cache.key(self.src, 'gs', GS_ARGS))
+        self.assertNotEqual(key, self.cache.key(other, 'gs', GS_ARGS))
+        self.assertNotEqual(key, self.cache.key(self.src, 'gs9', GS_ARGS))
+        self.assertNotEqual(key, self.cache.key(self.src, 'gs', ['-dPDFSETTINGS=/screen']))
+
+    def test_get_miss(self):
+        out = os.path.join(self.trash_can.name, 'out.pdf')
+        key = self.cache.key(self.src, 'gs', GS_ARGS)
+        self.assertFalse(self.cache.get(key, out))
+        self.assertFalse(os.path.exists(out))
+        self.assertEqual((0, 1), (self.cache.hits, self.cache.misses))
+
+    def test_put_then_get_hit(self):
+        out = os.path.join(self.trash_can.name, 'out.pdf')
+        key = self.cache.key(self.src, 'gs', GS_ARGS)
+        self.cache.put(key, self.src)
+        self.assertTrue(self.cache.get(key, out))
+        with open(self.src, 'rb') as src_file, open(out, 'rb') as out_file:
+            self.assertEqual(src_file.read(), out_file.read())
+        self.assertEqual((1, 0), (self.cache.hits, self.cache.misses))
+
+    def test_get_twice_to_same_out(self):
+        out = os.path.join(self.trash_can.name, 'out.pdf')
+        key = self.cache.key(self.src, 'gs', GS_ARGS)
+        self.cache.put(key, self.src)
+        self.assertTrue(self.cache.get(key, out))
+        self.assertTrue(self.cache.get(key, out))
+        self.assertEqual(['out.pdf', 'src.pdf'], sorted(os.listdir(self.trash_can.name))[1:])
+
+    def test_compressing_onto_earlier_hit_keeps_entry(self):
+        gs_binary = create_fake_gs(self.trash_can.name)
+        cache = pdfebc_web.util.cache.CompressionCache(self.cache_dir, 10 * 1024**2)
+        src = create_pdf(self.trash_can.name, 'large.pdf')
+        with open(src, 'rb') as file:
+            content = file.read()
+        out = os.path.join(tempfile.mkdtemp(dir=self.trash_can.name), 'large.pdf')
+        pdfebc_web.util.engine.compress_pdf(src, out, gs_binary, cache=cache)
+        key = cache.key(src, gs_binary, pdfebc_web.util.engine.GS_ARGS)
+        self.assertTrue(cache.get(key, out))
+        # The file is replaced and compressed again onto the output of the earlier attempt
+        with open(src, 'ab') as file:
+            file.write(b'%changed')
+        pdfebc_web.util.engine.compress_pdf(src, out, gs_binary, cache=cache)
+        other = os.path.join(tempfile.mkdtemp(dir=self.trash_can.name), 'large.pdf')
+        self.assertTrue(cache.get(key, other))
+        with open(other, 'rb') as file:
+            self.assertEqual(content, file.read())
+
+    def test_evicts_least_recently_used(self):
+        keys = []
+        for i in range(4):
+            src = create_pdf(self.trash_can.name, '{}.pdf'.format(i), 300)
+            key = self.cache.key(src, 'gs', GS_ARGS)
+            self.cache.put(key, src)
+            keys.append(key)
+            time.sleep(0.01)
+        self.assertLessEqual(self.cache.size(), 1000)
+        out_dir = tempfile.mkdtemp(dir=self.trash_can.name)
+        self.assertFalse(self.cache.get(keys[0], os.path.join(out_dir, '0.pdf')))
+        for i, key in enumerate(keys[1:], start=1):
+            self.assertTrue(self.cache.get(key, os.path.join(out_dir, '{}.pdf'.format(i))))
+
+    def test_put_scans_cache_only_when_full(self):
+        with patch.object(self.cache, '_entries', wraps=self.cache._entries) as mock_entries:
+            for i in range(3):
+                src = create_pdf(self.trash_can.name, '{}.pdf'.format(i), 300)
+                self.cache.put(self.cache.key(src, 'gs', GS_ARGS), src)
+            self.assertEqual(1, mock_entries.call_count)
+            src = create_pdf(self.trash_can.name, '3.pdf', 300)
+            self.cache.put(self.cache.key(src, 'gs', GS_ARGS), src)
+            self.assertEqual(2, mock_entries.call_count)
+        self.assertLessEqual(self.cache.size(), 900)
+
+    def test_put_same_key_is_not_counted_twice(self):
+        key = self.cache.key(self.src, 'gs', GS_ARGS)
+        for _ in range(20):
+            self.cache.put(key, self.src)
+        self.assertEqual(os.stat(self.src).st_size, self.cache._total)
+        self.assertEqual(os.stat(self.src).st_size, self.cache.size())
+
+    def test_put_file_larger_than_cache(self):
+        src = create_pdf(self.trash_can.name, 'big.pdf', 2000)
+        self.cache.put(self.cache.key(src, 'gs', GS_ARGS), src)
+        self.assertEqual(0, self.cache.size())
+
+    def test_engine_skips_gs_on_hit(self):
+        gs_binary = create_fake_gs(self.trash_can.name)
+        cache = pdfebc_web.util.cache.CompressionCache(self.cache_dir, 10 * 1024**2)
+        src = create_pdf(self.trash_can.name, 'large.pdf')
+        first = os.path.join(tempfile.mkdtemp(dir=self.trash_can.name), 'large.pdf')
+        second = os.path.join(tempfile.mkdtemp(dir=self.trash_can.name), 'large.pdf')
+        pdfebc_web.util.engine.compress_pdf(src, first, gs_binary, cache=cache)
+        with patch('subprocess.Popen', autospec=True) as mock_run:
+            pdfebc_web.util.engine.compress_pdf(src, second, gs_binary, cache=cache)
+            self.assertFalse(mock_run.called)
+        self.assertTrue(os.path.isfile(second))
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
@@ -0,0 +1,65 @@
+"""Unit tests for the pdfebc_web.util.download module.
+
+Author: Simon Larsén <slarse@kth.se>
+"""
+import os
+import tarfile
+import tempfile
+import time
+from unittest import TestCase
+from unittest.mock import patch
+from .context import pdfebc_web
+
+SECRET_KEY = 'secret'
+
+
+class DownloadTest(TestCase):
+    def setUp(self):
+        self.trash_can = tempfile.TemporaryDirectory()
+        self.downloads_dir = os.path.join(self.trash_can.name, '.downloads')
+        self.src_dir = os.path.join(self.trash_can.name, 'compressed_files')
+        os.mkdir(self.src_dir)
+        with open(os.path.join(self.src_dir, 'file.pdf'), 'wb') as file:
+            file.write(b'%PDF-1.4\n')
+
+    def tearDown(self):
+        self.trash_can.cleanup()
+
+    def test_create_download(self):
+        download_id = pdfebc_web.util.download.create_download(self.downloads_dir, self.src_dir)
+        path = pdfebc_web.util.download.get_download_path(self.downloads_dir, download_id)
+        with tarfile.open(path) as tar:
+            self.assertIn('compressed_files/file.pdf', tar.getnames())
+
+    def test_get_download_path_invalid_id(self):
+        for download_id in ['../../etc/passwd', '0' * 32]:
+            with self.assertRaises(pdfebc_web.util.download.DownloadError):
+                pdfebc_web.util.download.get_download_path(self.downloads_dir, download_id)
+
+    def test_sign_and_load(self):
+        token = pdfebc_web.util.download.sign_download_id(SECRET_KEY, 'abc')
+        self.assertEqual('abc', pdfebc_web.util.download.load_download_id(SECRET_KEY, token, 60))
+
+    def test_load_wrong_key(self):
+        token = pdfebc_web.util.download.sign_download_id(SECRET_KEY, 'abc')
+        with self.assertRaises(pdfebc_web.util.download.DownloadError):
+            pdfebc_web.util.download.load_download_id('other', token, 60)
+
+    def test_load_expired(self):
+        token = pdfebc_web.util.download.sign_download_id(SECRET_KEY, 'abc')
+        with patch('itsdangerous.TimestampSigner.get_timestamp', return_value=10**10):
+            with self.assertRaises(pdfebc_web.util.download.DownloadExpiredError):
+                pdfebc_web.util.download.load_download_id(SECRET_KEY, token, 60)
+
+    def test_sweep_downloads(self):
+        old_id = pdfebc_web.util.download.create_download(self.downloads_dir, self.src_dir)
+        new_id = pdfebc_web.util.download.create_download(self.downloads_dir, self.src_dir)
+        old_path = pdfebc_web.util.download.get_download_path(self.downloads_dir, old_id)
+        timestamp = time.time() - 7200
+        os.utime(old_path, (timestamp, timestamp))
+        self.assertEqual(1, pdfebc_web.util.download.sweep_downloads(self.downloads_dir, 3600))
+        self.assertFalse(os.path.exists(old_path))
+        pdfebc_web.util.download.get_download_path(self.downloads_dir, new_id)
+
+    def test_sweep_missing_downloads_dir(self):
+        self.assertEqual(0, pdfebc_web.util.download.sweep_downloads(self.downloads_dir, 3600))
@@ -0,0 +1,81 @@
+"""Unit tests for the pdfebc_web.util.eager module.
+
+Author: Simon Larsén <slarse@kth.se>
+"""
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from .context import pdfebc_web
+
+eager = pdfebc_web.util.eager
+
+SHA256 = 'a' * 64
+
+
+def copy(src, out, progress):
+    progress.started(src)
+    shutil.copyfile(src, out)
+    progress.finished(src, out, pdfebc_web.util.engine.COMPRESSED)
+
+
+class EagerTest(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.eager_dir = eager.get_eager_dir_path(self.tmpdir.name, 'ebook')
+        self.src = os.path.join(self.tmpdir.name, 'a.pdf')
+        with open(self.src, 'wb') as file:
+            file.write(b'%PDF-1.4\n')
+        self.out = os.path.join(self.tmpdir.name, 'out.pdf')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def collect(self, timeout=0):
+        return eager.collect(SHA256, self.eager_dir, self.out, timeout, poll_interval=0)
+
+    def test_collect_precompressed_file(self):
+        self.assertTrue(eager.precompress(self.src, SHA256, self.eager_dir, copy))
+        progress = self.collect()
+        self.assertEqual('done', progress['state'])
+        self.assertEqual('compressed', progress['decision'])
+        with open(self.out, 'rb') as file:
+            self.assertEqual(b'%PDF-1.4\n', file.read())
+
+    def test_collect_unclaimed_file_claims_it(self):
+        self.assertIsNone(self.collect())
+        self.assertFalse(eager.precompress(self.src, SHA256, self.eager_dir, copy))
+
+    def test_collect_waits_for_claimed_file(self):
+        self.assertTrue(eager.claim(self.eager_dir, SHA256))
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            os.remove(os.path.join(self.eager_dir, SHA256 + eager.CLAIM_EXTENSION))
+            eager.precompress(self.src, SHA256, self.eager_dir, copy)
+
+        progress = eager.collect(SHA256, self.eager_dir, self.out, 10, sleep=sleep)
+        self.assertEqual(1, len(sleeps))
+        self.assertEqual('done', progress['state'])
+
+    def test_collect_gives_up_on_claimed_file_after_timeout(self):
+        self.assertTrue(eager.claim(self.eager_dir, SHA256))
+        self.assertIsNone(self.collect())
+
+    def test_failed_precompression_releases_claim(self):
+        def fail(src, out, progress):
+            with open(out, 'wb'):
+                pass
+            raise pdfebc_web.util.engine.CompressionError("broken")
+
+        with self.assertRaises(pdfebc_web.util.engine.CompressionError):
+            eager.precompress(self.src, SHA256, self.eager_dir, fail)
+        self.assertEqual([], os.listdir(self.eager_dir))
+        self.assertIsNone(self.collect())
+
+    def test_precompress_does_not_recreate_session_dir(self):
+        shutil.rmtree(self.tmpdir.name)
+        with self.assertRaises(FileNotFoundError):
+            eager.precompress(self.src, SHA256, self.eager_dir, copy)
+        self.assertFalse(os.path.exists(self.tmpdir.name))
@@ -0,0 +1,284 @@
+"""Unit tests for the pdfebc_web.util.engine module.
+
+Author: Simon Larsén <slarse@kth.se>
+"""
+import os
+import resource
+import signal
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+from unittest import TestCase
+from unittest.mock import patch
+from .context import pdfebc_web
+import pdfebc_core.compress
+
+FAKE_GS = """#! {}
+import sys, shutil, time
+time.sleep(float({}))
+out = [arg for arg in sys.argv if arg.startswith('-sOutputFile=')][0].split('=', 1)[1]
+shutil.copyfile(sys.argv[-1], out)
+with open(out, 'ab') as file:
+    file.write(b'x' * {})
+"""
+HUNGRY_GS = """#! {}
+import sys
+# Busy loop, or allocate memory and fail like Ghostscript does when it runs out of it
+if {!r} == 'cpu':
+    while True:
+        pass
+try:
+    memory = bytearray(4 * 1024**3)
+except MemoryError:
+    sys.stderr.write('Error: /VMerror in --run--')
+    sys.exit(1)
+"""
+
+def create_fake_gs(directory, sleep=0, growth=0):
+    """Create an executable that behaves like Ghostscript by copying the source file to the
+    output file after sleeping for a while.
+
+    Args:
+        directory (str): Directory to put the executable in.
+        sleep (float): Seconds to sleep before copying.
+        growth (int): Amount of bytes to append to the output file.
+    Returns:
+        str: Path to the executable.
+    """
+    path = os.path.join(directory, 'fake_gs')
+    with open(path, 'w') as file:
+        file.write(FAKE_GS.format(sys.executable, sleep, growth))
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+    return path
+
+def create_hungry_gs(directory, resource):
+    """Create an executable that uses up a resource, like Ghostscript running a pathological
+    file.
+
+    Args:
+        directory (str): Directory to put the executable in.
+        resource (str): 'cpu' or 'memory'.
+    Returns:
+        str: Path to the executable.
+    """
+    path = os.path.join(directory, 'hungry_gs')
+    with open(path, 'w') as file:
+        file.write(HUNGRY_GS.format(sys.executable, resource))
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+    return path
+
+def create_pdf(directory, filename, size=pdfebc_core.compress.FILE_SIZE_LOWER_LIMIT):
+    """Create a file that looks like a PDF file.
+
+    Args:
+        directory (str): Directory to put the file in.
+        filename (str): Name of the file.
+        size (int): Size of the file in bytes.
+    Returns:
+        str: Path to the file.
+    """
+    path = os.path.join(directory, filename)
+    with open(path, 'wb') as file:
+        file.write(b'%PDF-1.4\n')
+        file.write(os.urandom(size - 9))
+    return path
+
+
+class EngineTest(TestCase):
+    def setUp(self):
+        self.trash_can = tempfile.TemporaryDirectory()
+        self.src_dir = os.path.join(self.trash_can.name, 'src')
+        self.out_dir = os.path.join(self.trash_can.name, 'out')
+        os.mkdir(self.src_dir)
+        os.mkdir(self.out_dir)
+        self.gs_binary = create_fake_gs(self.trash_can.name)
+
+    def tearDown(self):
+        self.trash_can.cleanup()
+
+    def test_get_pdf_paths(self):
+        expected = [create_pdf(self.src_dir, name, 10) for name in ['a.pdf', 'b.pdf']]
+        with open(os.path.join(self.src_dir, 'c.txt'), 'w'):
+            pass
+        self.assertEqual(expected, pdfebc_web.util.engine.get_pdf_paths(self.src_dir))
+
+    def test_compress_pdfs_returns_paths_in_order(self):
+        src_paths = [create_pdf(self.src_dir, '{}.pdf'.format(i)) for i in range(5)]
+        out_paths = pdfebc_web.util.engine.compress_pdfs(src_paths, self.out_dir, self.gs_binary,
+                                                         workers=3)
+        expected = [os.path.join(self.out_dir, os.path.basename(src)) for src in src_paths]
+        self.assertEqual(expected, out_paths)
+        for src, out in zip(src_paths, out_paths):
+            with open(src, 'rb') as src_file, open(out, 'rb') as out_file:
+                self.assertEqual(src_file.read(), out_file.read())
+
+    def test_compress_pdfs_runs_in_parallel(self):
+        gs_binary = create_fake_gs(self.trash_can.name, sleep=0.5)
+        src_paths = [create_pdf(self.src_dir, '{}.pdf'.format(i)) for i in range(4)]
+        start = time.monotonic()
+        pdfebc_web.util.engine.compress_pdfs(src_paths, self.out_dir, gs_binary, workers=4)
+        self.assertLess(time.monotonic() - start, 1.5)
+
+    @patch('subprocess.Popen', autospec=True)
+    def test_compress_pdf_small_file_is_copied(self, mock_run):
+        src = create_pdf(self.src_dir, 'small.pdf', 100)
+        out = os.path.join(self.out_dir, 'small.pdf')
+        pdfebc_web.util.engine.compress_pdf(src, out, self.gs_binary)
+        self.assertFalse(mock_run.called)
+        self.assertTrue(os.path.isfile(out))
+
+    def test_compress_pdf_timeout(self):
+        gs_binary = create_fake_gs(self.trash_can.name, sleep=10)
+        src = create_pdf(self.src_dir, 'slow.pdf')
+        out = os.path.join(self.out_dir, 'slow.pdf')
+        start = time.monotonic()
+        with self.assertRaises(pdfebc_web.util.engine.CompressionError) as context:
+            pdfebc_web.util.engine.compress_pdf(src, out, gs_binary, timeout=0.5)
+        self.assertEqual(pdfebc_web.util.engine.TIMED_OUT, context.exception.reason)
+        self.assertLess(time.monotonic() - start, 5)
+
+    def test_compress_pdf_cpu_limit(self):
+        gs_binary = create_hungry_gs(self.trash_can.name, 'cpu')
+        src = create_pdf(self.src_dir, 'a.pdf')
+        out = os.path.join(self.out_dir, 'a.pdf')
+        limits = pdfebc_web.util.engine.ResourceLimits(None, 1)
+        with self.assertRaises(pdfebc_web.util.engine.CompressionError) as context:
+            pdfebc_web.util.engine.compress_pdf(src, out, gs_binary, timeout=10, limits=limits)
+        self.assertEqual(pdfebc_web.util.engine.CPU_LIMIT, context.exception.reason)
+
+    def test_compress_pdf_memory_limit(self):
+        gs_binary = create_hungry_gs(self.trash_can.name, 'memory')
+        src = create_pdf(self.src_dir, 'a.pdf')
+        out = os.path.join(self.out_dir, 'a.pdf')
+        limits = pdfebc_web.util.engine.ResourceLimits(1024**3, None)
+        with self.assertRaises(pdfebc_web.util.engine.CompressionError) as context:
+            pdfebc_web.util.engine.compress_pdf(src, out, gs_binary, limits=limits)
+        self.assertEqual(pdfebc_web.util.engine.MEMORY_LIMIT, context.exception.reason)
+
+    def test_set_resource_limits_of_running_process(self):
+        process = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(10)'])
+        try:
+            limits = pdfebc_web.util.engine.ResourceLimits(1024**3, 10)
+            pdfebc_web.util.engine.set_resource_limits(process.pid, limits)
+            self.assertEqual((1024**3, 1024**3),
+                             resource.prlimit(process.pid, resource.RLIMIT_AS))
+            self.assertEqual((10, 11), resource.prlimit(process.pid, resource.RLIMIT_CPU))
+        finally:
+            process.kill()
+            process.wait()
+
+    def test_classify_failure(self):
+        engine = pdfebc_web.util.engine
+        limits = engine.ResourceLimits(1024**3, 10)
+        self.assertEqual(engine.CPU_LIMIT, engine.classify_failure(-signal.SIGXCPU, b'', limits))
+        self.assertEqual(engine.MEMORY_LIMIT,
+                         engine.classify_failure(-signal.SIGSEGV, b'', limits))
+        self.assertEqual(engine.MEMORY_LIMIT, engine.classify_failure(1, b'VMerror', None))
+        self.assertEqual(engine.BROKEN, engine.classify_failure(1, b'', limits))
+        self.assertEqual(engine.BROKEN, engine.classify_failure(-signal.SIGSEGV, b'', None))
+
+    def test_compress_pdfs_collects_failures(self):
+        src_paths = [create_pdf(self.src_dir, '{}.pdf'.format(i)) for i in range(3)]
+        run_ghostscript = pdfebc_web.util.engine.run_ghostscript
+
+        def fail_second(gs_binary, src, out, *args):
+            if src == src_paths[1]:
+                with open(out, 'wb') as file:
+                    file.write(b'%PDF-1.4\ntruncated')
+                raise pdfebc_web.util.engine.CompressionError(
+                    "Out of memory", pdfebc_web.util.engine.MEMORY_LIMIT)
+            run_ghostscript(gs_binary, src, out, *args)
+
+        failures = []
+        with patch('pdfebc_web.util.engine.run_ghostscript', side_effect=fail_second):
+            out_paths = pdfebc_web.util.engine.compress_pdfs(
+                src_paths, self.out_dir, self.gs_binary, workers=2, failures=failures)
+        self.assertEqual([os.path.join(self.out_dir, '0.pdf'),
+                          os.path.join(self.out_dir, '2.pdf')], out_paths)
+        self.assertEqual(['0.pdf', '2.pdf'], sorted(os.listdir(self.out_dir)))
+        self.assertEqual([src_paths[1]], [src for src, _ in failures])
+        self.assertEqual(pdfebc_web.util.engine.MEMORY_LIMIT, failures[0][1].reason)
+
+    def test_compress_pdf_gs_not_installed(self):
+        src = create_pdf(self.src_dir, 'file.pdf')
+        out = os.path.join(self.out_dir, 'file.pdf')
+        gs_binary = os.path.join(self.trash_can.name, 'not_gs')
+        with self.assertRaises(pdfebc_web.util.engine.CompressionError):
+            pdfebc_web.util.engine.compress_pdf(src, out, gs_binary)
+
+    @patch('subprocess.Popen', autospec=True)
+    def test_compress_pdf_skips_file_not_worth_compressing(self, mock_run):
+        src = create_pdf(self.src_dir, 'a.pdf')
+        out = os.path.join(self.out_dir, 'a.pdf')
+        stats = pdfebc_web.util.engine.CompressionStats()
+        with patch('pdfebc_web.util.analysis.is_worth_compressing', return_value=False):
+            pdfebc_web.util.engine.compress_pdf(src, out, self.gs_binary, analyze=True,
+                                                stats=stats)
+        self.assertFalse(mock_run.called)
+        with open(src, 'rb') as src_file, open(out, 'rb') as out_file:
+            self.assertEqual(src_file.read(), out_file.read())
+        self.assertEqual(1, stats.summary()['skipped']['files'])
+
+    def test_compress_pdf_keeps_smaller_original(self):
+        gs_binary = create_fake_gs(self.trash_can.name, growth=100)
+        src = create_pdf(self.src_dir, 'a.pdf')
+        out = os.path.join(self.out_dir, 'a.pdf')
+        stats = pdfebc_web.util.engine.CompressionStats()
+        pdfebc_web.util.engine.compress_pdf(src, out, gs_binary, stats=stats)
+        self.assertEqual(os.stat(src).st_size, os.stat(out).st_size)
+        self.assertEqual(1, stats.summary()['kept_original']['files'])
+
+    def test_compress_pdf_with_profile(self):
+        src = create_pdf(self.src_dir, 'a.pdf')
+        out = os.path.join(self.out_dir, 'a.pdf')
+        cache = pdfebc_web.util.cache.CompressionCache(os.path.join(self.trash_can.name, 'cache'),
+                                                       1024**2)
+        loaded = pdfebc_web.util.profiles.load_profiles(pdfebc_web.util.profiles.DEFAULT_PROFILES)
+        screen = loaded[pdfebc_web.util.profiles.SCREEN]
+        popen = subprocess.Popen
+        with patch('subprocess.Popen', side_effect=popen) as mock_run:
+            pdfebc_web.util.engine.compress_pdf(src, out, self.gs_binary, cache=cache,
+                                                profile=screen)
+            self.assertIn('-dPDFSETTINGS=/screen', mock_run.call_args[0][0])
+            pdfebc_web.util.engine.compress_pdf(src, out, self.gs_binary, cache=cache,
+                                                profile=screen)
+            self.assertEqual(1, mock_run.call_count)
+            pdfebc_web.util.engine.compress_pdf(src, out, self.gs_binary, cache=cache)
+            self.assertEqual(2, mock_run.call_count)
+            self.assertIn('-dPDFSETTINGS=/ebook', mock_run.call_args[0][0])
+
+    def test_compress_pdf_analyzes_for_the_target_resolution_of_the_profile(self):
+        # A 200 dpi JPEG image on a letter page, padded to be large enough to compress
+        src = os.path.join(self.src_dir, 'a.pdf')
+        with open(src, 'wb') as file:
+            file.write(b'%PDF-1.5\n1 0 obj\n<< /Type /Page /MediaBox [0 0 612 792] >>\nendobj\n'
+                       b'2 0 obj\n<< /Type /XObject /Subtype /Image /Width 1700 /Height 100 '
+                       b'/Filter /DCTDecode /Length 10 >>\nstream\n0123456789\nendstream\n'
+                       b'endobj\n%' + b'x' * pdfebc_core.compress.FILE_SIZE_LOWER_LIMIT +
+                       b'\n%%EOF\n')
+        out = os.path.join(self.out_dir, 'a.pdf')
+        loaded = pdfebc_web.util.profiles.load_profiles(pdfebc_web.util.profiles.DEFAULT_PROFILES)
+        for name, decision in [('ebook', 'skipped'), ('screen', 'kept_original'),
+                               ('lossless', 'kept_original')]:
+            stats = pdfebc_web.util.engine.CompressionStats()
+            pdfebc_web.util.engine.compress_pdf(src, out, self.gs_binary, analyze=True,
+                                                stats=stats, profile=loaded[name])
+            self.assertEqual(1, stats.summary()[decision]['files'], name)
+
+    def test_compression_stats_estimates_saved_seconds(self):
+        stats = pdfebc_web.util.engine.CompressionStats()
+        stats.record('compressed', 1000, 500, 2.0)
+        stats.record('skipped', 500, 500)
+        stats.record('small', 10, 10)
+        summary = stats.summary()
+        self.assertEqual(1, summary['compressed']['files'])
+        self.assertEqual(500, summary['compressed']['bytes_out'])
+        self.assertAlmostEqual(1.0, summary['estimated_seconds_saved'])
+        self.assertAlmostEqual(0.5, summary['ratio'])
+        self.assertAlmostEqual(2.0 * 1024**2 / 1000, summary['seconds_per_megabyte'])
+
+    def test_compress_pdfs_bad_worker_count(self):
+        with self.assertRaises(ValueError):
+            pdfebc_web.util.engine.compress_pdfs([], self.out_dir, self.gs_binary, workers=0)
@@ -164,6 +164,27 @@ class FileTest(TestCase):
             self.assertTrue(os.path.isdir(src_dir))
             mock_compress_multiple_files.assert_called_once()
 
+    @patch('pdfebc_web.util.engine.compress_pdfs', autospec=True, return_value=[])
+    @patch('pdfebc_core.compress.compress_multiple_pdfs', autospec=True, return_value=None)
+    def test_compress_uploaded_files_with_workers(self, mock_compress_multiple_pdfs,
+                                                  mock_compress_pdfs):
+        with tempfile.TemporaryDirectory() as src_dir:
+            gs_binary = 'gs'
+            pdfebc_web.util.file.compress_uploaded_files(src_dir, gs_binary, workers=4)
+            self.assertFalse(mock_compress_multiple_pdfs.called)
+            mock_compress_pdfs.assert_called_once_with(
+                [], os.path.join(src_dir, 'compressed_files'), gs_binary, workers=4,
+                timeout=pdfebc_web.util.engine.DEFAULT_TIMEOUT, status_callback=None, cache=None,
+                progress=None, analyze=False, stats=None, pool=None, limits=None, failures=None,
+                profile=None)
+
+    @patch('pdfebc_web.util.engine.compress_pdfs', autospec=True)
+    def test_compress_uploaded_files_out_dir_exists(self, mock_compress_pdfs):
+        src_dir = self.temp_source_dir.name
+        os.mkdir(os.path.join(src_dir, pdfebc_web.util.file.COMPRESSED_FILES_DIRNAME))
+        pdfebc_web.util.file.compress_uploaded_files(src_dir, 'gs', workers=1)
+        mock_compress_pdfs.assert_called_once()
+
     def test_compress_uploaded_files_no_src_dir(self):
         with tempfile.TemporaryDirectory() as src_dir:
             pass
@@ -0,0 +1,139 @@
+"""Unit tests for the pdfebc_web.util.gspool module.
+
+Author: Simon Larsén <slarse@kth.se>
+"""
+import os
+import stat
+import sys
+import tempfile
+from unittest import TestCase
+from .context import pdfebc_web
+from .test_engine import create_fake_gs
+
+gspool = pdfebc_web.util.gspool
+
+# Speaks the job protocol of the pool, copying the source file to the output file. Source files
+# named crash, hang or broken make it exit, hang or fail the job.
+FAKE_INTERPRETER = r"""#! {}
+import os, re, shutil, sys, time
+with open({!r}, 'a') as starts:
+    starts.write('{{}}\n'.format(os.getpid()))
+for line in sys.stdin:
+    print('noise that is not a marker', flush=True)
+    ready = re.match(r'\((pdfebc-job 0 ready)\\n\) print flush', line)
+    if ready:
+        print(ready.group(1), flush=True)
+        continue
+    out, src = re.search(r'/OutputFile \((.*?)\) >> setpagedevice \((.*?)\) run', line).groups()
+    failed, ok = re.search(r'\{{ \((.*? failed)\\n\) \}} \{{ \((.*? ok)\\n\) \}}', line).groups()
+    name = os.path.basename(src)
+    if name == 'crash.pdf':
+        sys.exit(1)
+    if name == 'hang.pdf':
+        time.sleep(60)
+    if name == 'broken.pdf':
+        print(failed, flush=True)
+        continue
+    shutil.copyfile(src, out)
+    print(ok, flush=True)
+"""
+
+
+class GhostscriptPoolTest(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.starts = os.path.join(self.tmpdir.name, 'starts')
+        self.gs_binary = os.path.join(self.tmpdir.name, 'fake_interpreter')
+        with open(self.gs_binary, 'w') as file:
+            file.write(FAKE_INTERPRETER.format(sys.executable, self.starts))
+        os.chmod(self.gs_binary, os.stat(self.gs_binary).st_mode | stat.S_IEXEC)
+        self.files_dir = os.path.join(self.tmpdir.name, 'files')
+        os.mkdir(self.files_dir)
+        self.pool = self.create_pool()
+
+    def tearDown(self):
+        self.pool.close()
+        self.tmpdir.cleanup()
+
+    def create_pool(self, **kwargs):
+        return gspool.GhostscriptPool(self.gs_binary, pdfebc_web.util.engine.GS_ARGS,
+                                      [self.files_dir], 2, **kwargs)
+
+    def create_file(self, filename):
+        path = os.path.join(self.files_dir, filename)
+        with open(path, 'wb') as file:
+            file.write(b'%PDF-1.4\n' + filename.encode('utf-8'))
+        return path
+
+    def compress(self, filename, timeout=10):
+        src = self.create_file(filename)
+        out = src + '.out'
+        self.pool.compress(src, out, timeout)
+        return out
+
+    def count_starts(self):
+        with open(self.starts) as file:
+            return len(file.readlines())
+
+    def test_interpreter_is_reused(self):
+        for filename in ('a.pdf', 'b.pdf', 'c.pdf'):
+            out = self.compress(filename)
+            with open(out, 'rb') as file:
+                self.assertEqual(b'%PDF-1.4\n' + filename.encode('utf-8'), file.read())
+        self.assertEqual(1, self.count_starts())
+
+    def test_interpreter_is_recycled_after_max_jobs(self):
+        self.pool = self.create_pool(max_jobs=2)
+        for filename in ('a.pdf', 'b.pdf', 'c.pdf'):
+            self.compress(filename)
+        self.assertEqual(2, self.count_starts())
+
+    def test_interpreter_is_recycled_above_max_memory(self):
+        self.pool = self.create_pool(max_memory=1)
+        self.compress('a.pdf')
+        self.compress('b.pdf')
+        self.assertEqual(2, self.count_starts())
+
+    def test_crashed_interpreter_is_replaced(self):
+        with self.assertRaises(gspool.GhostscriptPoolError):
+            self.compress('crash.pdf')
+        self.assertTrue(os.path.isfile(self.compress('a.pdf')))
+        self.assertEqual(2, self.count_starts())
+
+    def test_failed_job(self):
+        with self.assertRaises(gspool.GhostscriptPoolError):
+            self.compress('broken.pdf')
+
+    def test_timeout(self):
+        with self.assertRaises(gspool.GhostscriptTimeoutError):
+            self.compress('hang.pdf', timeout=0.5)
+
+    def test_accepts_only_files_in_allowed_dirs(self):
+        inside = os.path.join(self.files_dir, 'a.pdf')
+        self.assertTrue(self.pool.accepts(inside, inside + '.out'))
+        self.assertFalse(self.pool.accepts(os.path.join(self.tmpdir.name, 'a.pdf'), inside))
+
+    def test_pool_is_disabled_if_interpreters_cant_start(self):
+        pool = gspool.GhostscriptPool(os.path.join(self.tmpdir.name, 'missing'),
+                                      pdfebc_web.util.engine.GS_ARGS, [self.files_dir], 2)
+        src = self.create_file('a.pdf')
+        with self.assertRaises(gspool.GhostscriptPoolError):
+            pool.compress(src, src + '.out', 10)
+        self.assertFalse(pool.accepts(src, src + '.out'))
+
+    def test_engine_falls_back_to_subprocess(self):
+        gs_binary = create_fake_gs(self.tmpdir.name)
+        src = self.create_file('broken.pdf')
+        pdfebc_web.util.engine.run_ghostscript(gs_binary, src, src + '.out', 10, self.pool)
+        self.assertTrue(os.path.isfile(src + '.out'))
+
+
+class PsStringTest(TestCase):
+    def test_special_characters_are_escaped(self):
+        self.assertEqual(r'(a\\b \(c\) d\n)', gspool.ps_string('a\\b (c) d\n'))
+
+    def test_interpreter_command_drops_batch(self):
+        command = gspool.build_interpreter_command('gs', ['-dNOPAUSE', '-dBATCH'], ['/tmp'])
+        self.assertNotIn('-dBATCH', command)
+        self.assertIn('--permit-file-read=/tmp/', command)
+        self.assertEqual('-', command[-1])
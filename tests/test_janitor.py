@@ -0,0 +1,128 @@
+"""Unit tests for the pdfebc_web.util.janitor module.
+
+Author: Simon Larsén <slarse@kth.se>
+"""
+import os
+import tempfile
+import threading
+import time
+from unittest import TestCase
+from .context import pdfebc_web
+
+HOUR = 3600
+
+
+class JanitorTest(TestCase):
+    def setUp(self):
+        self.trash_can = tempfile.TemporaryDirectory()
+        self.file_cache = self.trash_can.name
+
+    def tearDown(self):
+        self.trash_can.cleanup()
+
+    def create_session_dir(self, name, age, sizes=()):
+        """Create a session upload directory with files of the given sizes, that was last
+        active age seconds ago.
+        """
+        path = os.path.join(self.file_cache, name)
+        os.mkdir(path)
+        timestamp = time.time() - age
+        for i, size in enumerate(sizes):
+            filepath = os.path.join(path, '{}.pdf'.format(i))
+            with open(filepath, 'wb') as file:
+                file.write(b'x' * size)
+            os.utime(filepath, (timestamp, timestamp))
+        os.utime(path, (timestamp, timestamp))
+        return path
+
+    def test_scan_session_dir(self):
+        path = self.create_session_dir('session', HOUR, [10, 20])
+        session_dir = pdfebc_web.util.janitor.scan_session_dir(path)
+        self.assertEqual(30, session_dir.size)
+        self.assertEqual(3, session_dir.inodes)
+        self.assertAlmostEqual(time.time() - HOUR, session_dir.last_activity, delta=5)
+
+    def test_sweep_evicts_expired_dirs(self):
+        old = self.create_session_dir('old', 2 * HOUR, [10])
+        empty = self.create_session_dir('empty', 2 * HOUR)
+        fresh = self.create_session_dir('fresh', 0, [10])
+        report = pdfebc_web.util.janitor.sweep_file_cache(self.file_cache, ttl=HOUR,
+                                                          batch_size=1)
+        self.assertEqual((2, 10, 3), tuple(report))
+        self.assertFalse(os.path.exists(old))
+        self.assertFalse(os.path.exists(empty))
+        self.assertTrue(os.path.exists(fresh))
+
+    def test_sweep_calls_on_evict(self):
+        old = self.create_session_dir('old', 2 * HOUR, [10])
+        self.create_session_dir('fresh', 0, [10])
+        evicted = []
+        pdfebc_web.util.janitor.sweep_file_cache(self.file_cache, ttl=HOUR,
+                                                 on_evict=evicted.append)
+        self.assertEqual([old], evicted)
+
+    def test_sweep_recent_file_keeps_dir_alive(self):
+        path = self.create_session_dir('session', 2 * HOUR, [10])
+        with open(os.path.join(path, 'new.pdf'), 'wb'):
+            pass
+        report = pdfebc_web.util.janitor.sweep_file_cache(self.file_cache, ttl=HOUR)
+        self.assertEqual(0, report.directories)
+        self.assertTrue(os.path.exists(path))
+
+    def test_sweep_keeps_busy_dirs(self):
+        busy = self.create_session_dir('busy', 2 * HOUR, [100])
+        old = self.create_session_dir('old', HOUR + 10, [100])
+        newest = self.create_session_dir('newest', 10, [100])
+        report = pdfebc_web.util.janitor.sweep_file_cache(
+            self.file_cache, ttl=HOUR, quota=150, is_busy=lambda path: path == busy)
+        self.assertEqual((2, 200), (report.directories, report.bytes))
+        self.assertTrue(os.path.exists(busy))
+        self.assertFalse(os.path.exists(old))
+        self.assertFalse(os.path.exists(newest))
+
+    def test_sweep_enforces_quota_oldest_first(self):
+        oldest = self.create_session_dir('oldest', 30, [100])
+        middle = self.create_session_dir('middle', 20, [100])
+        newest = self.create_session_dir('newest', 10, [100])
+        report = pdfebc_web.util.janitor.sweep_file_cache(self.file_cache, ttl=HOUR,
+                                                          quota=150)
+        self.assertEqual((2, 200), (report.directories, report.bytes))
+        self.assertFalse(os.path.exists(oldest))
+        self.assertFalse(os.path.exists(middle))
+        self.assertTrue(os.path.exists(newest))
+
+    def test_sweep_skips_hidden_entries(self):
+        hidden = self.create_session_dir('.compression_cache', 2 * HOUR, [10])
+        report = pdfebc_web.util.janitor.sweep_file_cache(self.file_cache, ttl=HOUR, quota=0)
+        self.assertEqual(0, report.directories)
+        self.assertTrue(os.path.exists(hidden))
+
+    def test_sweep_missing_file_cache(self):
+        missing = os.path.join(self.file_cache, 'missing')
+        report = pdfebc_web.util.janitor.sweep_file_cache(missing, ttl=HOUR)
+        self.assertEqual((0, 0, 0), tuple(report))
+
+    def test_background_sweep_runs_once_per_interval(self):
+        now = [0]
+        done = threading.Event()
+        sweeps = []
+
+        def sweep():
+            sweeps.append(now[0])
+            done.set()
+
+        maybe_sweep = pdfebc_web.util.janitor.create_background_sweep(
+            sweep, lambda: HOUR, clock=lambda: now[0])
+        self.assertTrue(maybe_sweep())
+        self.assertTrue(done.wait(5))
+        now[0] = HOUR - 1
+        self.assertFalse(maybe_sweep())
+        now[0] = HOUR
+        done.clear()
+        self.assertTrue(maybe_sweep())
+        self.assertTrue(done.wait(5))
+        self.assertEqual([0, HOUR], sweeps)
+
+    def test_background_sweep_disabled(self):
+        maybe_sweep = pdfebc_web.util.janitor.create_background_sweep(lambda: None, lambda: 0)
+        self.assertFalse(maybe_sweep())
@@ -0,0 +1,106 @@
+"""Unit tests for the pdfebc_web.util.jobs module.
+
+Author: Simon Larsén <slarse@kth.se>
+"""
+from unittest import TestCase
+from unittest.mock import MagicMock
+from .context import pdfebc_web
+
+SESSION_ID = 'session'
+
+
+class LocalJobRegistryTest(TestCase):
+    def setUp(self):
+        self.now = 0
+        self.registry = pdfebc_web.util.jobs.LocalJobRegistry(clock=lambda: self.now)
+
+    def test_register_returns_existing_job(self):
+        self.assertEqual('a', self.registry.register(SESSION_ID, 'a', 60))
+        self.assertEqual('a', self.registry.register(SESSION_ID, 'b', 60))
+        self.assertEqual('a', self.registry.get(SESSION_ID))
+
+    def test_release(self):
+        self.registry.register(SESSION_ID, 'a', 60)
+        self.registry.release(SESSION_ID, 'b')
+        self.assertEqual('a', self.registry.get(SESSION_ID))
+        self.registry.release(SESSION_ID, 'a')
+        self.assertIsNone(self.registry.get(SESSION_ID))
+        self.assertEqual('b', self.registry.register(SESSION_ID, 'b', 60))
+
+    def test_registration_expires(self):
+        self.registry.register(SESSION_ID, 'a', 60)
+        self.now = 61
+        self.assertEqual('b', self.registry.register(SESSION_ID, 'b', 60))
+
+    def test_session_lock(self):
+        with self.registry.session_lock(SESSION_ID, 60) as acquired:
+            self.assertTrue(acquired)
+            with self.registry.session_lock(SESSION_ID, 60) as acquired_again:
+                self.assertFalse(acquired_again)
+            with self.registry.session_lock('other', 60) as acquired_other:
+                self.assertTrue(acquired_other)
+        with self.registry.session_lock(SESSION_ID, 60) as acquired:
+            self.assertTrue(acquired)
+
+    def test_add_in_flight(self):
+        self.assertEqual(1, self.registry.add_in_flight(SESSION_ID, 1, 60))
+        self.assertEqual(2, self.registry.add_in_flight(SESSION_ID, 1, 60))
+        self.assertEqual(0, self.registry.add_in_flight('other', -1, 60))
+        self.assertEqual(1, self.registry.add_in_flight(SESSION_ID, -1, 60))
+        self.assertEqual(0, self.registry.add_in_flight(SESSION_ID, -2, 60))
+
+    def test_in_flight_expires(self):
+        self.registry.add_in_flight(SESSION_ID, 3, 60)
+        self.now = 61
+        self.assertEqual(1, self.registry.add_in_flight(SESSION_ID, 1, 60))
+
+
+class RedisJobRegistryTest(TestCase):
+    def setUp(self):
+        self.redis = MagicMock()
+        self.registry = pdfebc_web.util.jobs.RedisJobRegistry(self.redis)
+
+    def test_register(self):
+        self.redis.set.return_value = True
+        self.assertEqual('a', self.registry.register(SESSION_ID, 'a', 60))
+        self.redis.set.assert_called_once_with('pdfebc:jobs:' + SESSION_ID, 'a', ex=60, nx=True)
+
+    def test_register_returns_existing_job(self):
+        self.redis.set.return_value = False
+        self.redis.get.return_value = b'a'
+        self.assertEqual('a', self.registry.register(SESSION_ID, 'b', 60))
+
+    def test_release_compares_job_id(self):
+        self.registry.release(SESSION_ID, 'a')
+        self.redis.register_script.return_value.assert_called_once_with(
+            keys=['pdfebc:jobs:' + SESSION_ID], args=['a'])
+
+    def test_session_lock_releases(self):
+        lock = self.redis.lock.return_value
+        lock.acquire.return_value = True
+        with self.registry.session_lock(SESSION_ID, 60) as acquired:
+            self.assertTrue(acquired)
+        self.redis.lock.assert_called_once_with('pdfebc:jobs:lock:' + SESSION_ID, timeout=60)
+        lock.acquire.assert_called_once_with(blocking=False)
+        lock.release.assert_called_once_with()
+
+    def test_add_in_flight(self):
+        self.redis.register_script.return_value.return_value = 2
+        self.assertEqual(2, self.registry.add_in_flight(SESSION_ID, 1, 60))
+        self.redis.register_script.return_value.assert_called_once_with(
+            keys=['pdfebc:jobs:in-flight:' + SESSION_ID], args=[1, 60])
+
+
+class CreateJobRegistryTest(TestCase):
+    def test_memory(self):
+        self.assertIsInstance(pdfebc_web.util.jobs.create_job_registry('memory'),
+                              pdfebc_web.util.jobs.LocalJobRegistry)
+
+    def test_redis(self):
+        self.assertIsInstance(
+            pdfebc_web.util.jobs.create_job_registry('redis', 'redis://localhost:6379/0'),
+            pdfebc_web.util.jobs.RedisJobRegistry)
+
+    def test_unknown(self):
+        with self.assertRaises(ValueError):
+            pdfebc_web.util.jobs.create_job_registry('zookeeper')
@@ -0,0 +1,168 @@
+"""Unit tests for the pdfebc_web.util.limits module.
+
+Author: Simon Larsén <slarse@kth.se>
+"""
+import io
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+from .context import pdfebc_web
+
+Quota = pdfebc_web.util.limits.Quota
+Bucket = pdfebc_web.util.limits.Bucket
+QuotaExceededError = pdfebc_web.util.limits.QuotaExceededError
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class LocalLimiterTest(TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.limiter = pdfebc_web.util.limits.LocalLimiter(clock=self.clock)
+
+    def test_consume_burst_then_refill(self):
+        buckets = [Bucket('session', 0.5, 2)]
+        self.limiter.consume(buckets)
+        self.limiter.consume(buckets)
+        with self.assertRaises(pdfebc_web.util.limits.RateLimitError) as context:
+            self.limiter.consume(buckets)
+        self.assertEqual(2, context.exception.retry_after)
+        self.clock.now += 2
+        self.limiter.consume(buckets)
+
+    def test_consume_is_all_or_nothing(self):
+        self.limiter.consume([Bucket('ip', 1, 1)])
+        with self.assertRaises(pdfebc_web.util.limits.RateLimitError):
+            self.limiter.consume([Bucket('session', 1, 1), Bucket('ip', 1, 1)])
+        self.limiter.consume([Bucket('session', 1, 1)])
+
+    def test_disabled_bucket(self):
+        for _ in range(10):
+            self.limiter.consume([Bucket('session', None, 1)])
+
+    def test_reserve_and_remaining(self):
+        quotas = [Quota('session', 2, 100, 60), Quota('ip', None, 150, 60)]
+        self.limiter.reserve(quotas, 1, 80)
+        self.assertEqual((1, 20), self.limiter.remaining(quotas))
+        with self.assertRaises(pdfebc_web.util.limits.QuotaExceededError):
+            self.limiter.reserve(quotas, 1, 30)
+        self.assertEqual((1, 20), self.limiter.remaining(quotas))
+
+    def test_quota_expires_after_window(self):
+        quotas = [Quota('session', 1, None, 60)]
+        self.limiter.reserve(quotas, 1, 10)
+        with self.assertRaises(pdfebc_web.util.limits.QuotaExceededError):
+            self.limiter.reserve(quotas, 1, 10)
+        self.clock.now += 61
+        self.limiter.reserve(quotas, 1, 10)
+
+
+class RedisLimiterTest(TestCase):
+    def setUp(self):
+        self.redis = MagicMock()
+        self.scripts = [MagicMock(), MagicMock()]
+        self.redis.register_script.side_effect = self.scripts
+        self.limiter = pdfebc_web.util.limits.RedisLimiter(self.redis, clock=lambda: 2.0)
+
+    def test_consume(self):
+        token_bucket = self.scripts[0]
+        token_bucket.return_value = 0
+        self.limiter.consume([Bucket('session', 2, 3), Bucket('ip', None, 3)])
+        token_bucket.assert_called_once_with(keys=['session'], args=[2000, '0.002', 3])
+        token_bucket.return_value = 1500
+        with self.assertRaises(pdfebc_web.util.limits.RateLimitError) as context:
+            self.limiter.consume([Bucket('session', 2, 3)])
+        self.assertEqual(2, context.exception.retry_after)
+
+    def test_reserve(self):
+        quota = self.scripts[1]
+        quota.return_value = 0
+        quotas = [Quota('session', 2, None, 60)]
+        self.limiter.reserve(quotas, 1, 10)
+        quota.assert_called_once_with(keys=['session'], args=[1, 10, 2, -1, 60])
+        quota.return_value = 1
+        with self.assertRaises(pdfebc_web.util.limits.QuotaExceededError):
+            self.limiter.reserve(quotas, 1, 10)
+
+    def test_remaining(self):
+        self.redis.pipeline.return_value.execute.return_value = [(b'1', b'10'), (None, None)]
+        quotas = [Quota('session', 2, 100, 60), Quota('ip', 5, None, 60)]
+        self.assertEqual((1, 90), self.limiter.remaining(quotas))
+
+
+class StreamWithinQuotaTest(TestCase):
+    def setUp(self):
+        self.trash_can = tempfile.TemporaryDirectory()
+        self.limiter = pdfebc_web.util.limits.LocalLimiter()
+        self.out = os.path.join(self.trash_can.name, 'file.pdf')
+
+    def tearDown(self):
+        self.trash_can.cleanup()
+
+    def test_within_quota(self):
+        quotas = [Quota('session', 1, 100, 60)]
+        content = b'%PDF-1.4\n'
+        result = pdfebc_web.util.limits.stream_within_quota(
+            self.limiter, quotas, io.BytesIO(content), self.out, 1000)
+        self.assertEqual(len(content), result.size)
+        self.assertEqual((0, 100 - len(content)), self.limiter.remaining(quotas))
+
+    def test_upload_is_cut_off_at_quota(self):
+        quotas = [Quota('session', 10, 100, 60)]
+        with self.assertRaises(pdfebc_web.util.limits.QuotaExceededError):
+            pdfebc_web.util.limits.stream_within_quota(
+                self.limiter, quotas, io.BytesIO(b'%PDF-1.4\n' + b'x' * 200), self.out, 1000)
+        self.assertEqual([], os.listdir(self.trash_can.name))
+
+    def test_replacement_is_only_charged_for_the_bytes_it_adds(self):
+        quotas = [Quota('session', 1, 100, 60)]
+        pdfebc_web.util.limits.stream_within_quota(
+            self.limiter, quotas, io.BytesIO(b'%PDF-1.4\n' + b'x' * 41), self.out, 1000)
+        content = b'%PDF-1.4\n' + b'y' * 71
+        result = pdfebc_web.util.limits.stream_within_quota(
+            self.limiter, quotas, io.BytesIO(content), self.out, 1000, replaced_size=50)
+        self.assertEqual(len(content), result.size)
+        self.assertEqual((0, 20), self.limiter.remaining(quotas))
+
+    def test_rejected_replacement_keeps_earlier_upload(self):
+        quotas = [Quota('session', 10, 100, 60)]
+        content = b'%PDF-1.4\n' + b'x' * 41
+        pdfebc_web.util.limits.stream_within_quota(
+            self.limiter, quotas, io.BytesIO(content), self.out, 1000)
+        # A concurrent upload uses up the quota while this one is streamed
+        with patch.object(self.limiter, 'reserve', side_effect=QuotaExceededError('full')):
+            with self.assertRaises(QuotaExceededError):
+                pdfebc_web.util.limits.stream_within_quota(
+                    self.limiter, quotas, io.BytesIO(b'%PDF-1.4\n' + b'y' * 71), self.out,
+                    1000, replaced_size=len(content))
+        self.assertEqual(['file.pdf'], os.listdir(self.trash_can.name))
+        with open(self.out, 'rb') as file:
+            self.assertEqual(content, file.read())
+
+    def test_no_files_left(self):
+        quotas = [Quota('session', 0, None, 60)]
+        with self.assertRaises(pdfebc_web.util.limits.QuotaExceededError):
+            pdfebc_web.util.limits.stream_within_quota(
+                self.limiter, quotas, io.BytesIO(b'%PDF-1.4\n'), self.out, 1000)
+
+
+class CreateLimiterTest(TestCase):
+    def test_memory(self):
+        self.assertIsInstance(pdfebc_web.util.limits.create_limiter('memory'),
+                              pdfebc_web.util.limits.LocalLimiter)
+
+    def test_redis(self):
+        self.assertIsInstance(
+            pdfebc_web.util.limits.create_limiter('redis', 'redis://localhost:6379/0'),
+            pdfebc_web.util.limits.RedisLimiter)
+
+    def test_unknown(self):
+        with self.assertRaises(ValueError):
+            pdfebc_web.util.limits.create_limiter('memcached')
@@ -0,0 +1,197 @@
+"""Unit tests for the pdfebc_web.util.mail module.
+
+Author: Simon Larsén <slarse@kth.se>
+"""
+import os
+import smtplib
+import tempfile
+from unittest import TestCase
+from .context import pdfebc_web
+
+SMTP_CONFIG = pdfebc_web.util.mail.SmtpConfig('localhost', 25, 'sender@example.com',
+                                              'password', 'receiver@example.com')
+
+
+class FakeSmtpServer:
+    """A stand-in for an SMTP server that records what each connection does."""
+
+    def __init__(self):
+        self.connections = []
+        self.sent = []
+        self.attempts = 0
+        self.failures = {}
+
+    def connect(self, host, port, timeout=None):
+        connection = FakeSmtp(self)
+        self.connections.append(connection)
+        return connection
+
+
+class FakeSmtp:
+    def __init__(self, server):
+        self.server = server
+        self.logged_in = False
+        self.closed = False
+        self.alive = True
+
+    def starttls(self):
+        pass
+
+    def login(self, user, password):
+        self.logged_in = True
+
+    def noop(self):
+        if not self.alive:
+            raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+        return 250, b'OK'
+
+    def send_message(self, message):
+        self.server.attempts += 1
+        if self.server.attempts in self.server.failures:
+            raise self.server.failures[self.server.attempts]
+        self.server.sent.append(message)
+
+    def quit(self):
+        self.closed = True
+
+    def close(self):
+        self.closed = True
+
+
+def create_message(receiver='receiver@example.com'):
+    return pdfebc_web.util.mail.build_message('sender@example.com', receiver, 'Subject', '', [])
+
+
+class SmtpPoolTest(TestCase):
+    def setUp(self):
+        self.server = FakeSmtpServer()
+        self.pool = pdfebc_web.util.mail.SmtpPool(SMTP_CONFIG, smtp_factory=self.server.connect)
+
+    def test_connection_is_reused(self):
+        for _ in range(3):
+            with self.pool.connection() as smtp:
+                self.assertTrue(smtp.logged_in)
+        self.assertEqual(1, self.pool.connections_opened)
+
+    def test_dead_connection_is_replaced(self):
+        with self.pool.connection() as smtp:
+            pass
+        smtp.alive = False
+        with self.pool.connection() as new_smtp:
+            self.assertIsNot(smtp, new_smtp)
+        self.assertTrue(smtp.closed)
+        self.assertEqual(2, self.pool.connections_opened)
+
+    def test_connection_is_discarded_on_error(self):
+        with self.assertRaises(smtplib.SMTPServerDisconnected):
+            with self.pool.connection() as smtp:
+                raise smtplib.SMTPServerDisconnected()
+        self.assertTrue(smtp.closed)
+        with self.pool.connection() as new_smtp:
+            self.assertIsNot(smtp, new_smtp)
+
+    def test_close(self):
+        with self.pool.connection() as smtp:
+            pass
+        self.pool.close()
+        self.assertTrue(smtp.closed)
+
+
+class MailerTest(TestCase):
+    def setUp(self):
+        self.server = FakeSmtpServer()
+        self.pool = pdfebc_web.util.mail.SmtpPool(SMTP_CONFIG, smtp_factory=self.server.connect)
+        self.sleeps = []
+
+    def create_mailer(self, **kwargs):
+        return pdfebc_web.util.mail.Mailer(self.pool, backoff=1, sleep=self.sleeps.append,
+                                           **kwargs)
+
+    def test_send(self):
+        message = create_message()
+        self.create_mailer().send(message)
+        self.assertEqual([message], self.server.sent)
+
+    def test_retries_transient_failure_with_backoff(self):
+        self.server.failures = {1: smtplib.SMTPServerDisconnected(),
+                                2: smtplib.SMTPResponseException(421, b'Try again later')}
+        message = create_message()
+        self.create_mailer(retries=2).send(message)
+        self.assertEqual([message], self.server.sent)
+        self.assertEqual([1, 2], self.sleeps)
+        self.assertEqual(3, len(self.server.connections))
+
+    def test_gives_up_after_retries(self):
+        self.server.failures = {1: smtplib.SMTPServerDisconnected(),
+                                2: smtplib.SMTPServerDisconnected()}
+        with self.assertRaises(pdfebc_web.util.mail.DeliveryError):
+            self.create_mailer(retries=1).send(create_message())
+
+    def test_permanent_failure_is_not_retried(self):
+        self.server.failures = {1: smtplib.SMTPResponseException(552, b'Too large')}
+        with self.assertRaises(pdfebc_web.util.mail.DeliveryError):
+            self.create_mailer().send(create_message())
+        self.assertEqual([], self.sleeps)
+
+    def test_batch_resumes_after_failure(self):
+        messages = [create_message() for _ in range(3)]
+        self.server.failures = {2: smtplib.SMTPServerDisconnected()}
+        self.create_mailer().send_batch(messages)
+        self.assertEqual(messages, self.server.sent)
+
+
+class BuildMessageTest(TestCase):
+    def test_attachments(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filepath = os.path.join(tmpdir, 'file.pdf')
+            with open(filepath, 'wb') as file:
+                file.write(b'%PDF-1.4\n')
+            message = pdfebc_web.util.mail.build_message('a@example.com', 'b@example.com',
+                                                         'Subject', 'Text', [filepath])
+        attachment = message.get_payload()[1]
+        self.assertEqual('file.pdf', attachment.get_filename())
+        self.assertEqual(b'%PDF-1.4\n', attachment.get_payload(decode=True))
+
+
+class PlanMessagesTest(TestCase):
+    def setUp(self):
+        self.trash_can = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.trash_can.cleanup()
+
+    def create_files(self, sizes):
+        paths = []
+        for i, size in enumerate(sizes):
+            path = os.path.join(self.trash_can.name, '{}.pdf'.format(i))
+            with open(path, 'wb') as file:
+                file.write(b'x' * size)
+            paths.append(path)
+        return paths
+
+    def test_everything_fits_in_one_message(self):
+        paths = self.create_files([100, 200, 300])
+        self.assertEqual([paths], pdfebc_web.util.mail.plan_messages(paths, 10**6))
+
+    def test_split_below_limit(self):
+        paths = self.create_files([6000, 3000, 3000, 6000])
+        max_size = pdfebc_web.util.mail.MESSAGE_OVERHEAD + \
+            2 * pdfebc_web.util.mail.get_encoded_size(6000)
+        plan = pdfebc_web.util.mail.plan_messages(paths, max_size)
+        self.assertEqual([[paths[0], paths[3]], [paths[1], paths[2]]], plan)
+
+    def test_encoded_size_is_larger(self):
+        self.assertGreater(pdfebc_web.util.mail.get_encoded_size(3000), 4000)
+
+    def test_file_too_large(self):
+        paths = self.create_files([100, 10000])
+        with self.assertRaises(pdfebc_web.util.mail.AttachmentTooLargeError):
+            pdfebc_web.util.mail.plan_messages(paths, 5000)
+
+
+class GetSmtpConfigTest(TestCase):
+    def test_get_smtp_config(self):
+        email_config = {'EMAIL': {'user': 'sender@example.com', 'pass': 'password',
+                                  'receiver': 'receiver@example.com', 'smtp_server': 'localhost',
+                                  'smtp_port': '25'}}
+        self.assertEqual(SMTP_CONFIG, pdfebc_web.util.mail.get_smtp_config(email_config))
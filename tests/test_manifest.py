@@ -0,0 +1,76 @@
+"""Unit tests for the pdfebc_web.util.manifest module.
+
+Author: Simon Larsén <slarse@kth.se>
+"""
+from unittest import TestCase
+from unittest.mock import MagicMock
+from .context import pdfebc_web
+
+SESSION_ID = 'session'
+
+
+class LocalManifestStoreTest(TestCase):
+    def setUp(self):
+        self.store = pdfebc_web.util.manifest.LocalManifestStore()
+        self.entry = pdfebc_web.util.manifest.create_entry(10, 'abc', uploaded=1.0)
+
+    def test_get_empty(self):
+        self.assertEqual({}, self.store.get(SESSION_ID))
+
+    def test_add_and_get(self):
+        self.store.add(SESSION_ID, 'a.pdf', self.entry)
+        self.assertEqual({'a.pdf': {'size': 10, 'sha256': 'abc', 'uploaded': 1.0}},
+                         self.store.get(SESSION_ID))
+        self.assertEqual({}, self.store.get('other'))
+
+    def test_get_returns_copy(self):
+        self.store.add(SESSION_ID, 'a.pdf', self.entry)
+        self.store.get(SESSION_ID)['a.pdf']['size'] = 0
+        self.assertEqual(10, self.store.get(SESSION_ID)['a.pdf']['size'])
+
+    def test_remove(self):
+        self.store.add(SESSION_ID, 'a.pdf', self.entry)
+        self.store.add(SESSION_ID, 'b.pdf', self.entry)
+        self.store.remove(SESSION_ID, 'a.pdf')
+        self.store.remove(SESSION_ID, 'missing.pdf')
+        self.assertEqual(['b.pdf'], list(self.store.get(SESSION_ID)))
+
+    def test_clear(self):
+        self.store.add(SESSION_ID, 'a.pdf', self.entry)
+        self.store.clear(SESSION_ID)
+        self.assertEqual({}, self.store.get(SESSION_ID))
+
+
+class RedisManifestStoreTest(TestCase):
+    def setUp(self):
+        self.redis = MagicMock()
+        self.store = pdfebc_web.util.manifest.RedisManifestStore(self.redis, 60)
+
+    def test_add_sets_expiry(self):
+        entry = pdfebc_web.util.manifest.create_entry(10, 'abc', uploaded=1.0)
+        self.store.add(SESSION_ID, 'a.pdf', entry)
+        pipeline = self.redis.pipeline.return_value
+        pipeline.hset.assert_called_once()
+        pipeline.expire.assert_called_once_with('pdfebc:manifest:' + SESSION_ID, 60)
+        pipeline.execute.assert_called_once_with()
+
+    def test_get_decodes(self):
+        self.redis.hgetall.return_value = {
+            b'a.pdf': b'{"size": 10, "sha256": "abc", "uploaded": 1.0}'}
+        self.assertEqual({'a.pdf': {'size': 10, 'sha256': 'abc', 'uploaded': 1.0}},
+                         self.store.get(SESSION_ID))
+
+
+class CreateManifestStoreTest(TestCase):
+    def test_memory(self):
+        store = pdfebc_web.util.manifest.create_manifest_store('memory')
+        self.assertIsInstance(store, pdfebc_web.util.manifest.LocalManifestStore)
+
+    def test_redis(self):
+        store = pdfebc_web.util.manifest.create_manifest_store(
+            'redis', 'redis://localhost:6379/0', 60)
+        self.assertIsInstance(store, pdfebc_web.util.manifest.RedisManifestStore)
+
+    def test_unknown(self):
+        with self.assertRaises(ValueError):
+            pdfebc_web.util.manifest.create_manifest_store('mongodb')
@@ -0,0 +1,109 @@
+"""Unit tests for the pdfebc_web.util.metrics module.
+
+Author: Simon Larsén <slarse@kth.se>
+"""
+import os
+import tempfile
+from unittest import TestCase, skipUnless
+from unittest.mock import patch
+from celery import Celery, signals
+from .context import pdfebc_web
+
+metrics = pdfebc_web.util.metrics
+
+
+def get_sample(name, labels=None):
+    """Return the current value of a sample of the default registry, 0 if it is missing."""
+    value = metrics.prometheus_client.REGISTRY.get_sample_value(name, labels or {})
+    return value or 0
+
+
+class NoopMetricsTest(TestCase):
+    def test_metrics_are_noops_without_prometheus_client(self):
+        metric = metrics._NoopMetric()
+        metric.labels('a').inc()
+        metric.observe(1)
+        with metric.time():
+            pass
+        self.assertEqual(3, metric.time()(lambda x: x + 1)(2))
+
+    def test_nothing_to_generate_without_prometheus_client(self):
+        with patch.object(metrics, 'prometheus_client', None):
+            self.assertIsNone(metrics.generate_latest())
+
+
+@skipUnless(metrics.is_enabled(), 'prometheus_client is not installed')
+class RecordTest(TestCase):
+    def test_record_compression(self):
+        files = get_sample('pdfebc_compressed_files_total', {'decision': 'compressed'})
+        bytes_out = get_sample('pdfebc_compression_bytes_out_total', {'decision': 'compressed'})
+        ratios = get_sample('pdfebc_compression_ratio_sum')
+        metrics.record_compression('compressed', 1000, 250, 0.5)
+        self.assertEqual(files + 1, get_sample('pdfebc_compressed_files_total',
+                                               {'decision': 'compressed'}))
+        self.assertEqual(bytes_out + 250, get_sample('pdfebc_compression_bytes_out_total',
+                                                     {'decision': 'compressed'}))
+        self.assertAlmostEqual(ratios + 0.25, get_sample('pdfebc_compression_ratio_sum'))
+
+    def test_record_compression_without_ghostscript_skips_ratio(self):
+        ratios = get_sample('pdfebc_compression_ratio_count')
+        metrics.record_compression('small', 1000, 1000, 0)
+        self.assertEqual(ratios, get_sample('pdfebc_compression_ratio_count'))
+
+    def test_record_upload(self):
+        uploaded = get_sample('pdfebc_uploaded_bytes_total')
+        metrics.record_upload(1234, 0.1)
+        self.assertEqual(uploaded + 1234, get_sample('pdfebc_uploaded_bytes_total'))
+
+    def test_task_signals(self):
+        celery = Celery('test', broker='memory://', backend='cache+memory://')
+        celery.conf.task_always_eager = True
+
+        @celery.task
+        def succeed():
+            pass
+
+        runs = get_sample('pdfebc_task_duration_seconds_count', {'task': 'succeed'})
+        failures = get_sample('pdfebc_task_failures_total', {'task': 'succeed'})
+        succeed.apply()
+        signals.task_failure.send(sender=succeed, task_id='id', exception=RuntimeError())
+        self.assertEqual(runs + 1, get_sample('pdfebc_task_duration_seconds_count',
+                                              {'task': 'succeed'}))
+        self.assertEqual(failures + 1, get_sample('pdfebc_task_failures_total',
+                                                  {'task': 'succeed'}))
+
+
+@skipUnless(metrics.is_enabled(), 'prometheus_client is not installed')
+class PipelineCollectorTest(TestCase):
+    def setUp(self):
+        self.trash_can = tempfile.TemporaryDirectory()
+        self.celery = Celery('test', broker='memory://')
+        self.collector = metrics.PipelineCollector(self.celery, lambda: ['small', 'large'],
+                                                   lambda: self.trash_can.name)
+
+    def tearDown(self):
+        self.trash_can.cleanup()
+
+    def test_queue_depths(self):
+        self.celery.send_task('task', queue='small')
+        self.assertEqual({'small': 1, 'large': 0}, self.collector.get_queue_depths())
+
+    def test_file_cache_is_scanned_once_per_interval(self):
+        now = [0]
+        collector = metrics.PipelineCollector(self.celery, lambda: [],
+                                              lambda: self.trash_can.name,
+                                              scan_interval=60, clock=lambda: now[0])
+        self.assertEqual(0, collector.get_file_cache_size())
+        with open(os.path.join(self.trash_can.name, 'file.pdf'), 'wb') as file:
+            file.write(b'x' * 100)
+        now[0] = 59
+        self.assertEqual(0, collector.get_file_cache_size())
+        now[0] = 60
+        self.assertEqual(100, collector.get_file_cache_size())
+
+    def test_generate_latest_includes_file_cache_usage(self):
+        with open(os.path.join(self.trash_can.name, 'file.pdf'), 'wb') as file:
+            file.write(b'x' * 100)
+        latest = metrics.generate_latest([self.collector]).decode('utf-8')
+        self.assertIn('pdfebc_file_cache_bytes 100.0', latest)
+        self.assertIn('pdfebc_queue_depth{queue="small"} 0.0', latest)
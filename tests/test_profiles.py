@@ -0,0 +1,34 @@
+"""Unit tests for the pdfebc_web.util.profiles module.
+
+Author: Simon Larsén <slarse@kth.se>
+"""
+from unittest import TestCase
+from .context import pdfebc_web
+
+profiles = pdfebc_web.util.profiles
+
+
+class LoadProfilesTest(TestCase):
+    def test_default_profiles(self):
+        loaded = profiles.load_profiles(profiles.DEFAULT_PROFILES)
+        self.assertEqual([profiles.SCREEN, profiles.EBOOK, profiles.PRINTER, profiles.LOSSLESS],
+                         list(loaded))
+        self.assertEqual(1.0, loaded[profiles.EBOOK].cost)
+        with self.assertRaises(TypeError):
+            loaded['other'] = loaded[profiles.EBOOK]
+
+    def test_ebook_profile_has_the_arguments_of_pdfebc_core(self):
+        loaded = profiles.load_profiles(profiles.DEFAULT_PROFILES)
+        self.assertEqual(pdfebc_web.util.engine.GS_ARGS, loaded[profiles.EBOOK].gs_args)
+
+    def test_malformed_profiles(self):
+        for profile in [{'label': 'Fast', 'args': []},
+                        {'label': 'Fast', 'args': [], 'cost': 0},
+                        {'label': 'Fast', 'args': '-dPDFSETTINGS=/screen', 'cost': 1},
+                        {'label': 'Fast', 'args': [], 'cost': 1, 'target_dpi': 'high'}]:
+            with self.assertRaises(ValueError):
+                profiles.load_profiles({'fast': profile}, 'fast')
+
+    def test_missing_default_profile(self):
+        with self.assertRaises(ValueError):
+            profiles.load_profiles(profiles.DEFAULT_PROFILES, 'fast')
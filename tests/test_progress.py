@@ -0,0 +1,46 @@
+"""Unit tests for the pdfebc_web.util.progress module.
+
+Author: Simon Larsén <slarse@kth.se>
+"""
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import Mock
+from .context import pdfebc_web
+
+
+class ProgressReporterTest(TestCase):
+    def setUp(self):
+        self.trash_can = tempfile.TemporaryDirectory()
+        self.src = os.path.join(self.trash_can.name, 'src.pdf')
+        self.out = os.path.join(self.trash_can.name, 'out.pdf')
+        with open(self.src, 'wb') as file:
+            file.write(b'x' * 100)
+        with open(self.out, 'wb') as file:
+            file.write(b'x' * 40)
+        self.publish = Mock()
+        self.progress = pdfebc_web.util.progress.ProgressReporter(self.publish)
+
+    def tearDown(self):
+        self.trash_can.cleanup()
+
+    def test_queued(self):
+        self.progress.queued(self.src)
+        self.publish.assert_called_once_with(
+            'src.pdf', {'state': 'queued', 'bytes_in': 100, 'bytes_out': None, 'elapsed': None})
+
+    def test_started_then_finished(self):
+        self.progress.started(self.src)
+        self.progress.finished(self.src, self.out)
+        filename, progress = self.publish.call_args[0]
+        self.assertEqual('src.pdf', filename)
+        self.assertEqual('done', progress['state'])
+        self.assertEqual((100, 40), (progress['bytes_in'], progress['bytes_out']))
+        self.assertGreaterEqual(progress['elapsed'], 0)
+
+    def test_failed(self):
+        self.progress.started(self.src)
+        self.progress.failed(self.src, Exception('boom'))
+        _, progress = self.publish.call_args[0]
+        self.assertEqual('failed', progress['state'])
+        self.assertEqual('boom', progress['error'])
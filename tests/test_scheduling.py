@@ -0,0 +1,72 @@
+"""Unit tests for the pdfebc_web.util.scheduling module.
+
+Author: Simon Larsén <slarse@kth.se>
+"""
+from unittest import TestCase
+from .context import pdfebc_web
+
+MB = 1024**2
+
+
+class PlanJobTest(TestCase):
+    def plan(self, sizes, session_concurrency=2):
+        return pdfebc_web.util.scheduling.plan_job(sizes, 10 * MB, 'small', 'large',
+                                                   session_concurrency)
+
+    def test_small_job(self):
+        plan = self.plan([('a.pdf', MB)])
+        self.assertEqual(pdfebc_web.util.scheduling.SMALL, plan.size_class)
+        self.assertEqual('small', plan.queue)
+        self.assertEqual(0, plan.priority)
+        self.assertEqual([['a.pdf']], plan.chunks)
+
+    def test_large_job(self):
+        plan = self.plan([('a.pdf', 8 * MB), ('b.pdf', 8 * MB)])
+        self.assertEqual(pdfebc_web.util.scheduling.LARGE, plan.size_class)
+        self.assertEqual('large', plan.queue)
+        self.assertEqual(1, plan.priority)
+
+    def test_cost_weighs_size(self):
+        sizes = [('a.pdf', 8 * MB)]
+        cheap = pdfebc_web.util.scheduling.plan_job(sizes, 10 * MB, 'small', 'large', cost=0.5)
+        expensive = pdfebc_web.util.scheduling.plan_job(sizes, 10 * MB, 'small', 'large',
+                                                        cost=1.5)
+        self.assertEqual('small', cheap.queue)
+        self.assertEqual('large', expensive.queue)
+        self.assertEqual([['a.pdf']], expensive.chunks)
+
+    def test_priority_drops_with_size(self):
+        get_priority = pdfebc_web.util.scheduling.get_priority
+        self.assertEqual(0, get_priority(10 * MB, 10 * MB))
+        self.assertEqual(1, get_priority(15 * MB, 10 * MB))
+        self.assertEqual(3, get_priority(40 * MB, 10 * MB))
+        self.assertEqual(pdfebc_web.util.scheduling.MAX_PRIORITY,
+                         get_priority(10**6 * MB, 10 * MB))
+
+    def test_chunks_are_capped_and_balanced(self):
+        sizes = [('a.pdf', 5), ('b.pdf', 1), ('c.pdf', 3), ('d.pdf', 3), ('e.pdf', 2)]
+        plan = self.plan(sizes, session_concurrency=2)
+        self.assertEqual([['a.pdf', 'e.pdf'], ['b.pdf', 'c.pdf', 'd.pdf']], plan.chunks)
+
+    def test_no_more_chunks_than_files(self):
+        plan = self.plan([('a.pdf', 1), ('b.pdf', 1)], session_concurrency=8)
+        self.assertEqual(2, len(plan.chunks))
+
+    def test_priority_drops_with_tasks_in_flight(self):
+        plan = pdfebc_web.util.scheduling.plan_job
+        sizes = [('a.pdf', MB)]
+        self.assertEqual(0, plan(sizes, 10 * MB, 'small', 'large', 2, in_flight=1).priority)
+        self.assertEqual(1, plan(sizes, 10 * MB, 'small', 'large', 2, in_flight=2).priority)
+        self.assertEqual(pdfebc_web.util.scheduling.MAX_PRIORITY,
+                         plan(sizes, 10 * MB, 'small', 'large', 2, in_flight=100).priority)
+
+    def test_bad_session_concurrency(self):
+        with self.assertRaises(ValueError):
+            self.plan([('a.pdf', 1)], session_concurrency=0)
+
+
+class CreateTaskRoutesTest(TestCase):
+    def test_create_task_routes(self):
+        routes = pdfebc_web.util.scheduling.create_task_routes('small')
+        self.assertEqual({'queue': 'small'},
+                         routes['pdfebc_web.main.tasks.deliver_compressed_files'])
@@ -0,0 +1,144 @@
+"""Unit tests for the pdfebc_web.util.settings module.
+
+Author: Simon Larsén <slarse@kth.se>
+"""
+import os
+import signal
+import tempfile
+from unittest import TestCase
+from pdfebc_core import config_utils
+from .context import pdfebc_web
+
+APP_CONFIG = {'GS_BINARY': None,
+              'COMPRESSION_WORKERS': 4,
+              'COMPRESSION_TIMEOUT': 600,
+              'COMPRESSION_FAN_OUT': False,
+              'COMPRESSION_CACHE_SIZE': 1024,
+              'COMPRESSION_ANALYSIS': True,
+              'COMPRESSION_PROFILES': pdfebc_web.util.profiles.DEFAULT_PROFILES,
+              'DEFAULT_COMPRESSION_PROFILE': 'ebook',
+              'EAGER_COMPRESSION': False,
+              'GHOSTSCRIPT_MAX_MEMORY': None,
+              'GHOSTSCRIPT_MAX_CPU_SECONDS': None,
+              'GHOSTSCRIPT_POOL': False,
+              'GHOSTSCRIPT_POOL_MAX_JOBS': 100,
+              'GHOSTSCRIPT_POOL_MAX_MEMORY': None,
+              'JANITOR_INTERVAL': 3600,
+              'SESSION_TTL': 3600,
+              'FILE_CACHE_QUOTA': None,
+              'MAX_UPLOAD_SIZE': 1024,
+              'SMTP_POOL_SIZE': 2,
+              'SMTP_TIMEOUT': 30,
+              'SMTP_STARTTLS': True,
+              'SMTP_RETRIES': 3,
+              'SMTP_RETRY_BACKOFF': 1.0,
+              'MAX_MESSAGE_SIZE': 20 * 1024**2,
+              'LINK_DELIVERY_THRESHOLD': 50 * 1024**2,
+              'DOWNLOAD_LINK_TTL': 3600,
+              'SMALL_JOB_QUEUE': 'pdfebc-small',
+              'LARGE_JOB_QUEUE': 'pdfebc-large',
+              'SMALL_JOB_THRESHOLD': 10 * 1024**2,
+              'SESSION_CONCURRENCY': 4,
+              'SESSION_MAX_FILES': 100,
+              'SESSION_MAX_BYTES': 1024**3,
+              'IP_MAX_FILES': 1000,
+              'IP_MAX_BYTES': 10 * 1024**3,
+              'QUOTA_WINDOW': 24 * 3600,
+              'SESSION_COMPRESS_RATE': 1 / 60,
+              'SESSION_COMPRESS_BURST': 3,
+              'IP_COMPRESS_RATE': 1 / 10,
+              'IP_COMPRESS_BURST': 20,
+              'JOB_TTL': 3600,
+              'SECRET_KEY': 'secret',
+              'EXTERNAL_URL': 'http://localhost:5000'}
+
+
+class LoadSettingsTest(TestCase):
+    def setUp(self):
+        self.trash_can = tempfile.TemporaryDirectory()
+        self.config_path = os.path.join(self.trash_can.name, 'pdfebc', 'config.cnf')
+        config = config_utils.create_config(
+            [config_utils.EMAIL_SECTION_KEY, config_utils.DEFAULT_SECTION_KEY],
+            [{'user': 'sender@example.com', 'pass': 'password',
+              'receiver': 'receiver@example.com', 'smtp_server': 'localhost',
+              'smtp_port': '25'},
+             {'gs_binary': 'gs-from-config', 'src': '.', 'out': '.'}])
+        config_utils.write_config(config, self.config_path)
+
+    def tearDown(self):
+        self.trash_can.cleanup()
+
+    def test_defaults_without_config_file(self):
+        settings = pdfebc_web.util.settings.load_settings(APP_CONFIG, os.devnull, {})
+        self.assertEqual('gs', settings.gs_binary)
+        self.assertEqual(4, settings.compression_workers)
+        self.assertIsNone(settings.email_config)
+
+    def test_reads_config_file(self):
+        settings = pdfebc_web.util.settings.load_settings(APP_CONFIG, self.config_path, {})
+        self.assertEqual('gs-from-config', settings.gs_binary)
+        self.assertEqual('localhost', settings.email_config['EMAIL']['smtp_server'])
+        with self.assertRaises(TypeError):
+            settings.email_config['EMAIL']['smtp_server'] = 'elsewhere'
+
+    def test_app_config_overrides_config_file(self):
+        app_config = dict(APP_CONFIG, GS_BINARY='gs-from-app')
+        settings = pdfebc_web.util.settings.load_settings(app_config, self.config_path, {})
+        self.assertEqual('gs-from-app', settings.gs_binary)
+
+    def test_environment_overrides_everything(self):
+        environ = {'PDFEBC_WEB_GS_BINARY': 'gs-from-env',
+                   'PDFEBC_WEB_COMPRESSION_WORKERS': '8',
+                   'PDFEBC_WEB_COMPRESSION_FAN_OUT': 'yes',
+                   'PDFEBC_WEB_FILE_CACHE_QUOTA': '100'}
+        settings = pdfebc_web.util.settings.load_settings(APP_CONFIG, self.config_path, environ)
+        self.assertEqual('gs-from-env', settings.gs_binary)
+        self.assertEqual(8, settings.compression_workers)
+        self.assertTrue(settings.compression_fan_out)
+        self.assertEqual(100, settings.file_cache_quota)
+
+    def test_compression_profiles_from_environment(self):
+        environ = {'PDFEBC_WEB_COMPRESSION_PROFILES':
+                   '{"fast": {"label": "Fast", "args": ["-dPDFSETTINGS=/screen"], "cost": 0.5}}',
+                   'PDFEBC_WEB_DEFAULT_COMPRESSION_PROFILE': 'fast'}
+        settings = pdfebc_web.util.settings.load_settings(APP_CONFIG, os.devnull, environ)
+        self.assertEqual(['fast'], list(settings.compression_profiles))
+        self.assertEqual(0.5, settings.compression_profiles['fast'].cost)
+
+    def test_bad_environment_value(self):
+        for key, value in [('COMPRESSION_WORKERS', 'many'), ('COMPRESSION_FAN_OUT', 'maybe'),
+                           ('COMPRESSION_PROFILES', '[]'),
+                           ('DEFAULT_COMPRESSION_PROFILE', 'fast')]:
+            with self.assertRaises(pdfebc_web.util.settings.SettingsError):
+                pdfebc_web.util.settings.load_settings(APP_CONFIG, os.devnull,
+                                                       {'PDFEBC_WEB_' + key: value})
+
+
+class SettingsHolderTest(TestCase):
+    def test_reload_on_sighup(self):
+        environ = {}
+        holder = pdfebc_web.util.settings.SettingsHolder(
+            lambda: pdfebc_web.util.settings.load_settings(APP_CONFIG, os.devnull, environ))
+        previous = signal.getsignal(signal.SIGHUP)
+        try:
+            self.assertTrue(pdfebc_web.util.settings.install_reload_handler(holder))
+            old_settings = holder.current
+            environ['PDFEBC_WEB_COMPRESSION_WORKERS'] = '16'
+            os.kill(os.getpid(), signal.SIGHUP)
+            self.assertEqual(16, holder.current.compression_workers)
+            self.assertEqual(4, old_settings.compression_workers)
+        finally:
+            signal.signal(signal.SIGHUP, previous)
+
+    def test_failed_reload_keeps_old_settings(self):
+        environ = {}
+        holder = pdfebc_web.util.settings.SettingsHolder(
+            lambda: pdfebc_web.util.settings.load_settings(APP_CONFIG, os.devnull, environ))
+        previous = signal.getsignal(signal.SIGHUP)
+        try:
+            pdfebc_web.util.settings.install_reload_handler(holder)
+            environ['PDFEBC_WEB_COMPRESSION_WORKERS'] = 'many'
+            os.kill(os.getpid(), signal.SIGHUP)
+            self.assertEqual(4, holder.current.compression_workers)
+        finally:
+            signal.signal(signal.SIGHUP, previous)
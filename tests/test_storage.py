@@ -0,0 +1,252 @@
+"""Unit tests for the pdfebc_web.util.storage module.
+
+Author: Simon Larsén <slarse@kth.se>
+"""
+import datetime
+import hashlib
+import io
+import os
+import re
+import shutil
+import tempfile
+import threading
+import uuid
+from unittest import TestCase
+from unittest.mock import patch
+from .context import pdfebc_web
+
+storage = pdfebc_web.util.storage
+
+PART_SIZE = storage.MIN_PART_SIZE
+HOUR = 3600
+
+
+class ClientError(Exception):
+    """Stands in for botocore's ClientError."""
+
+    def __init__(self, code):
+        super().__init__(code)
+        self.response = {'Error': {'Code': code}}
+
+
+class FakeS3Client:
+    """An in-memory stand-in for an S3 client, with the subset of the API that the S3 storage
+    backend uses. Records the ranges of all ranged reads.
+    """
+
+    def __init__(self, clock=lambda: datetime.datetime.now(datetime.timezone.utc)):
+        self.objects = {}
+        self.metadata = {}
+        self.uploads = {}
+        self.ranges = []
+        self.clock = clock
+        self._lock = threading.Lock()
+
+    def put_object(self, Bucket, Key, Body, Metadata=None):
+        self.objects[(Bucket, Key)] = (bytes(Body), self.clock())
+        self.metadata[(Bucket, Key)] = dict(Metadata or {})
+
+    def create_multipart_upload(self, Bucket, Key, Metadata=None):
+        upload_id = uuid.uuid4().hex
+        self.uploads[upload_id] = {'metadata': Metadata}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.uploads[UploadId][PartNumber] = bytes(Body)
+        return {'ETag': '"{}"'.format(PartNumber)}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = self.uploads.pop(UploadId)
+        for part in MultipartUpload['Parts'][:-1]:
+            assert len(parts[part['PartNumber']]) >= storage.MIN_PART_SIZE
+        self.put_object(Bucket, Key, b''.join(parts[part['PartNumber']]
+                                              for part in MultipartUpload['Parts']),
+                        parts['metadata'])
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.uploads.pop(UploadId, None)
+
+    def head_object(self, Bucket, Key):
+        return {'ContentLength': len(self._get(Bucket, Key)),
+                'Metadata': self.metadata[(Bucket, Key)]}
+
+    def get_object(self, Bucket, Key, Range):
+        start, end = map(int, re.match(r'bytes=(\d+)-(\d+)$', Range).groups())
+        with self._lock:
+            self.ranges.append((Key, start, end))
+        return {'Body': io.BytesIO(self._get(Bucket, Key)[start:end + 1])}
+
+    def list_objects_v2(self, Bucket, Prefix, ContinuationToken=None):
+        keys = sorted(key for bucket, key in self.objects
+                      if bucket == Bucket and key.startswith(Prefix))
+        start = int(ContinuationToken or 0)
+        page = keys[start:start + 2]
+        response = {'Contents': [{'Key': key, 'Size': len(self.objects[(Bucket, key)][0]),
+                                  'LastModified': self.objects[(Bucket, key)][1]}
+                                 for key in page],
+                    'IsTruncated': start + 2 < len(keys)}
+        if response['IsTruncated']:
+            response['NextContinuationToken'] = str(start + 2)
+        return response
+
+    def delete_objects(self, Bucket, Delete):
+        for obj in Delete['Objects']:
+            self.objects.pop((Bucket, obj['Key']), None)
+            self.metadata.pop((Bucket, obj['Key']), None)
+
+    def _get(self, Bucket, Key):
+        try:
+            return self.objects[(Bucket, Key)][0]
+        except KeyError:
+            raise ClientError('404')
+
+
+class S3StorageTest(TestCase):
+    def setUp(self):
+        self.trash_can = tempfile.TemporaryDirectory()
+        pdfebc_web.util.file.FILE_CACHE = self.trash_can.name
+        self.client = FakeS3Client()
+        self.storage = storage.S3Storage(self.client, 'bucket', 'prefix/', part_size=PART_SIZE)
+        self.session_id = str(uuid.uuid4())
+
+    def tearDown(self):
+        self.trash_can.cleanup()
+
+    def upload(self, filename, content):
+        """Save a file in the local session upload directory and store it."""
+        path = os.path.join(self.storage.ensure_session_dir(self.session_id), filename)
+        with open(path, 'wb') as file:
+            file.write(content)
+        self.storage.save_upload(self.session_id, filename)
+        return path
+
+    def test_large_upload_is_stored_in_parts(self):
+        content = os.urandom(2 * PART_SIZE + 100)
+        path = self.upload('a.pdf', content)
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(content, self.client.objects[
+            ('bucket', 'prefix/sessions/{}/a.pdf'.format(self.session_id))][0])
+        self.assertEqual({}, self.client.uploads)
+
+    def test_list_uploads(self):
+        for filename in ('b.pdf', 'a.pdf', 'c.pdf'):
+            self.upload(filename, filename.encode('utf-8'))
+        self.assertEqual([('a.pdf', 5), ('b.pdf', 5), ('c.pdf', 5)],
+                         self.storage.list_uploads(self.session_id))
+
+    def test_fetch_session_with_ranged_reads(self):
+        content = os.urandom(2 * PART_SIZE + 100)
+        self.upload('a.pdf', content)
+        self.upload('b.pdf', b'%PDF-1.4\n')
+        session_upload_dir = self.storage.fetch_session(self.session_id)
+        with open(os.path.join(session_upload_dir, 'a.pdf'), 'rb') as file:
+            self.assertEqual(content, file.read())
+        key = 'prefix/sessions/{}/a.pdf'.format(self.session_id)
+        self.assertEqual([(key, 0, PART_SIZE - 1), (key, PART_SIZE, 2 * PART_SIZE - 1),
+                          (key, 2 * PART_SIZE, 2 * PART_SIZE + 99)],
+                         sorted(r for r in self.client.ranges if r[0] == key))
+        self.assertEqual(['a.pdf', 'b.pdf'], sorted(os.listdir(session_upload_dir)))
+
+    def test_fetch_reuses_only_identical_local_file(self):
+        self.upload('a.pdf', b'%PDF-1.4\nfirst')
+        path = self.storage.fetch_upload(self.session_id, 'a.pdf')
+        self.client.ranges.clear()
+        self.storage.fetch_upload(self.session_id, 'a.pdf')
+        self.assertEqual([], self.client.ranges)
+        # Replaced on another node by a file of the same size
+        key = 'prefix/sessions/{}/a.pdf'.format(self.session_id)
+        self.client.put_object('bucket', key, b'%PDF-1.4\nsecnd', Metadata={
+            'sha256': hashlib.sha256(b'%PDF-1.4\nsecnd').hexdigest()})
+        self.storage.fetch_upload(self.session_id, 'a.pdf')
+        with open(path, 'rb') as file:
+            self.assertEqual(b'%PDF-1.4\nsecnd', file.read())
+
+    def test_fetch_missing_upload(self):
+        with self.assertRaises(FileNotFoundError):
+            self.storage.fetch_upload(self.session_id, 'a.pdf')
+
+    def test_compressed_file_is_fetched_by_other_process(self):
+        self.upload('a.pdf', b'%PDF-1.4\n')
+        out_dir = os.path.join(self.storage.ensure_session_dir(self.session_id),
+                               'compressed_files')
+        os.makedirs(out_dir)
+        with open(os.path.join(out_dir, 'a.pdf'), 'wb') as file:
+            file.write(b'compressed')
+        self.storage.save_compressed(self.session_id, 'a.pdf')
+        self.assertEqual([('a.pdf', 9)], self.storage.list_uploads(self.session_id))
+        shutil.rmtree(self.storage.get_session_dir(self.session_id))
+        with open(self.storage.fetch_compressed(self.session_id, 'a.pdf'), 'rb') as file:
+            self.assertEqual(b'compressed', file.read())
+        with self.assertRaises(FileNotFoundError):
+            self.storage.fetch_compressed(self.session_id, 'b.pdf')
+
+    def test_delete_uploads_keeps_compressed_files(self):
+        self.upload('a.pdf', b'%PDF-1.4\n')
+        session_upload_dir = self.storage.fetch_session(self.session_id)
+        os.makedirs(os.path.join(session_upload_dir, 'compressed_files'))
+        with open(os.path.join(session_upload_dir, 'compressed_files', 'a.pdf'), 'wb') as file:
+            file.write(b'compressed')
+        self.storage.save_compressed(self.session_id, 'a.pdf')
+        self.storage.delete_uploads(self.session_id)
+        self.assertEqual(['compressed_files'], os.listdir(session_upload_dir))
+        self.assertEqual([], self.storage.list_uploads(self.session_id))
+        shutil.rmtree(session_upload_dir)
+        filepaths = self.storage.fetch_compressed_files(self.session_id)
+        self.assertEqual(['a.pdf'], [os.path.basename(path) for path in filepaths])
+        self.storage.delete_compressed_files(self.session_id)
+        self.assertEqual({}, self.client.objects)
+        self.assertFalse(os.path.exists(os.path.dirname(filepaths[0])))
+
+    def test_delete_session(self):
+        self.upload('a.pdf', b'%PDF-1.4\n')
+        self.storage.fetch_session(self.session_id)
+        self.storage.delete_session(self.session_id)
+        self.assertEqual({}, self.client.objects)
+        self.assertFalse(os.path.exists(self.storage.get_session_dir(self.session_id)))
+
+    def test_download_is_streamed_from_storage(self):
+        download_id = uuid.uuid4().hex
+        content = os.urandom(2 * PART_SIZE + 10)
+        self.storage.save_download(download_id, (content[offset:offset + 1000]
+                                                 for offset in range(0, len(content), 1000)))
+        self.assertEqual([], os.listdir(self.trash_can.name))
+        self.assertEqual({}, self.client.uploads)
+        archive, size = self.storage.open_download(download_id)
+        with archive:
+            self.assertEqual(content, archive.read())
+        self.assertEqual(len(content), size)
+
+    def test_open_missing_download(self):
+        with self.assertRaises(pdfebc_web.util.download.DownloadError):
+            self.storage.open_download(uuid.uuid4().hex)
+        with self.assertRaises(pdfebc_web.util.download.DownloadError):
+            self.storage.open_download('../sessions')
+
+    def test_sweep_deletes_expired_sessions_and_downloads(self):
+        old = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=2)
+        self.client.clock = lambda: old
+        self.upload('a.pdf', b'old')
+        self.client.put_object('bucket', 'prefix/downloads/{}.tar'.format(uuid.uuid4().hex),
+                               b'old')
+        self.client.clock = lambda: datetime.datetime.now(datetime.timezone.utc)
+        fresh_session_id, self.session_id = self.session_id, str(uuid.uuid4())
+        self.upload('b.pdf', b'fresh')
+        evicted = []
+        self.assertEqual(2, self.storage.sweep(HOUR, HOUR, on_evict=evicted.append))
+        self.assertEqual([fresh_session_id], evicted)
+        self.assertEqual([('bucket', 'prefix/sessions/{}/b.pdf'.format(self.session_id))],
+                         list(self.client.objects))
+
+
+class CreateStorageTest(TestCase):
+    def test_local(self):
+        self.assertIsInstance(storage.create_storage(storage.LOCAL), storage.LocalStorage)
+
+    def test_s3_without_boto3(self):
+        with patch.object(storage, 'boto3', None):
+            with self.assertRaises(ImportError):
+                storage.create_storage(storage.S3, bucket='bucket')
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            storage.create_storage('floppy')
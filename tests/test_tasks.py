@@ -0,0 +1,509 @@
+"""Unit tests for the pdfebc_web.main.tasks module.
+
+Author: Simon Larsén <slarse@kth.se>
+"""
+import os
+import shutil
+import tarfile
+import tempfile
+import uuid
+from unittest import TestCase
+from unittest.mock import patch
+from celery import Celery
+import pdfebc_core.config_utils
+from .context import pdfebc_web
+from .test_storage import FakeS3Client
+
+EMAIL_CONFIG = {'EMAIL': {'user': 'sender@example.com', 'pass': 'password',
+                          'receiver': 'receiver@example.com', 'smtp_server': 'localhost',
+                          'smtp_port': '25'}}
+
+def create_eager_celery():
+    """Create a Celery instance that executes all tasks locally and immediately.
+
+    Returns:
+        Celery: A Celery instance.
+    """
+    celery = Celery('test', broker='memory://', backend='cache+memory://')
+    celery.conf.task_always_eager = True
+    celery.conf.task_store_eager_result = True
+    return celery
+
+def create_app_config(**overrides):
+    """Create an app configuration with sane values for testing.
+
+    Returns:
+        dict: The configuration.
+    """
+    app_config = {'GS_BINARY': 'gs',
+                  'COMPRESSION_WORKERS': 2,
+                  'COMPRESSION_TIMEOUT': 10,
+                  'COMPRESSION_FAN_OUT': False,
+                  'COMPRESSION_PROFILES': pdfebc_web.util.profiles.DEFAULT_PROFILES,
+                  'DEFAULT_COMPRESSION_PROFILE': 'ebook',
+                  'COMPRESSION_CACHE_SIZE': 0,
+                  'COMPRESSION_ANALYSIS': True,
+                  'EAGER_COMPRESSION': False,
+                  'GHOSTSCRIPT_MAX_MEMORY': None,
+                  'GHOSTSCRIPT_MAX_CPU_SECONDS': None,
+                  'GHOSTSCRIPT_POOL': False,
+                  'GHOSTSCRIPT_POOL_MAX_JOBS': 100,
+                  'GHOSTSCRIPT_POOL_MAX_MEMORY': None,
+                  'JANITOR_INTERVAL': 0,
+                  'SESSION_TTL': 3600,
+                  'FILE_CACHE_QUOTA': None,
+                  'MAX_UPLOAD_SIZE': 1024**2,
+                  'SMTP_POOL_SIZE': 1,
+                  'SMTP_TIMEOUT': 10,
+                  'SMTP_STARTTLS': True,
+                  'SMTP_RETRIES': 0,
+                  'SMTP_RETRY_BACKOFF': 0,
+                  'MAX_MESSAGE_SIZE': 20 * 1024**2,
+                  'LINK_DELIVERY_THRESHOLD': 50 * 1024**2,
+                  'DOWNLOAD_LINK_TTL': 3600,
+                  'SMALL_JOB_QUEUE': 'pdfebc-small',
+                  'LARGE_JOB_QUEUE': 'pdfebc-large',
+                  'SMALL_JOB_THRESHOLD': 10 * 1024**2,
+                  'SESSION_CONCURRENCY': 4,
+                  'SESSION_MAX_FILES': 100,
+                  'SESSION_MAX_BYTES': 1024**3,
+                  'IP_MAX_FILES': 1000,
+                  'IP_MAX_BYTES': 10 * 1024**3,
+                  'QUOTA_WINDOW': 24 * 3600,
+                  'SESSION_COMPRESS_RATE': 1 / 60,
+                  'SESSION_COMPRESS_BURST': 3,
+                  'IP_COMPRESS_RATE': 1 / 10,
+                  'IP_COMPRESS_BURST': 20,
+                  'JOB_TTL': 3600,
+                  'SECRET_KEY': 'secret',
+                  'EXTERNAL_URL': 'http://localhost:5000'}
+    app_config.update(overrides)
+    return app_config
+
+def create_settings(**overrides):
+    """Create a settings holder with sane values for testing, and a fake email config.
+
+    Returns:
+        SettingsHolder: The settings.
+    """
+    def load():
+        settings = pdfebc_web.util.settings.load_settings(
+            create_app_config(**overrides), config_path=os.devnull, environ={})
+        return settings._replace(email_config=EMAIL_CONFIG)
+    return pdfebc_web.util.settings.SettingsHolder(load)
+
+
+class TasksTest(TestCase):
+    def setUp(self):
+        self.trash_can = tempfile.TemporaryDirectory()
+        pdfebc_web.util.file.FILE_CACHE = self.trash_can.name
+        self.session_id = str(uuid.uuid4())
+        pdfebc_web.util.file.create_session_upload_dir(self.session_id)
+        self.session_upload_dir = pdfebc_web.util.file.get_session_upload_dir_path(self.session_id)
+        self.filenames = ['a.pdf', 'b.pdf', 'c.pdf']
+        for filename in self.filenames:
+            with open(os.path.join(self.session_upload_dir, filename), 'wb') as file:
+                file.write(b'%PDF-1.4\n')
+
+    def tearDown(self):
+        self.trash_can.cleanup()
+
+    def assert_sent(self, mock_send, filenames):
+        """Assert that a single message with the files attached was sent."""
+        mock_send.assert_called_once()
+        message = mock_send.call_args[0][1]
+        self.assertEqual('receiver@example.com', message['To'])
+        self.assertEqual(filenames, [part.get_filename() for part in message.get_payload()[1:]])
+
+    def assert_only_compressed_files_kept(self):
+        """Assert that the uploads were deleted, and the compressed files were kept."""
+        self.assertEqual(['compressed_files'], os.listdir(self.session_upload_dir))
+        self.assertEqual(self.filenames, sorted(os.listdir(
+            os.path.join(self.session_upload_dir, 'compressed_files'))))
+
+    def assert_only_compressed_files_stored(self, client):
+        """Assert that only the compressed files of the session are left in the bucket."""
+        self.assertEqual(['sessions/{}/compressed_files/{}'.format(self.session_id, filename)
+                          for filename in self.filenames],
+                         sorted(key for _, key in client.objects))
+
+    @patch('pdfebc_web.util.mail.Mailer.send', autospec=True)
+    def test_submit_single_task(self, mock_send):
+        tasks = pdfebc_web.main.tasks.construct_tasks(create_eager_celery(), create_settings())
+        tasks.submit(self.session_id)
+        self.assert_sent(mock_send, self.filenames)
+        self.assert_only_compressed_files_kept()
+
+    @patch('pdfebc_web.util.mail.Mailer.send', autospec=True)
+    def test_delivery_clears_manifest(self, mock_send):
+        manifest_store = pdfebc_web.util.manifest.LocalManifestStore()
+        manifest_store.add(self.session_id, 'a.pdf',
+                           pdfebc_web.util.manifest.create_entry(9, 'abc'))
+        tasks = pdfebc_web.main.tasks.construct_tasks(create_eager_celery(), create_settings(),
+                                                      manifest_store)
+        tasks.submit(self.session_id)
+        self.assertEqual({}, manifest_store.get(self.session_id))
+
+    @patch('pdfebc_web.util.mail.Mailer.send', autospec=True)
+    def test_delivery_splits_messages(self, mock_send):
+        message_size = pdfebc_web.util.mail.MESSAGE_OVERHEAD + \
+            pdfebc_web.util.mail.get_encoded_size(9)
+        tasks = pdfebc_web.main.tasks.construct_tasks(
+            create_eager_celery(), create_settings(MAX_MESSAGE_SIZE=message_size))
+        tasks.submit(self.session_id)
+        self.assertEqual(len(self.filenames), mock_send.call_count)
+        self.assertEqual(['PDF files from pdfebc (1/3)', 'PDF files from pdfebc (2/3)',
+                          'PDF files from pdfebc (3/3)'],
+                         [call[0][1]['Subject'] for call in mock_send.call_args_list])
+
+    @patch('pdfebc_web.util.mail.Mailer.send', autospec=True)
+    def test_delivery_sends_download_link(self, mock_send):
+        tasks = pdfebc_web.main.tasks.construct_tasks(
+            create_eager_celery(), create_settings(LINK_DELIVERY_THRESHOLD=10))
+        tasks.submit(self.session_id)
+        message = mock_send.call_args[0][1]
+        self.assertEqual(1, len(message.get_payload()))
+        text = message.get_payload()[0].get_payload()
+        token = text.split('/api/downloads/')[1].strip()
+        download_id = pdfebc_web.util.download.load_download_id('secret', token, 3600)
+        path = pdfebc_web.util.download.get_download_path(
+            pdfebc_web.util.file.get_downloads_path(), download_id)
+        with tarfile.open(path) as tar:
+            self.assertEqual(['compressed_files/' + filename for filename in self.filenames],
+                             sorted(tar.getnames())[1:])
+        self.assert_only_compressed_files_kept()
+
+    def test_delivery_without_email_config(self):
+        settings = create_settings()
+        settings.current = settings.current._replace(email_config=None)
+        tasks = pdfebc_web.main.tasks.construct_tasks(create_eager_celery(), settings)
+        with self.assertRaises(pdfebc_core.config_utils.ConfigurationError):
+            tasks.deliver_compressed_files([], self.session_id)
+
+    @patch('pdfebc_web.util.mail.Mailer.send', autospec=True)
+    def test_submit_deletes_compressed_files_of_previous_job(self, mock_send):
+        tasks = pdfebc_web.main.tasks.construct_tasks(create_eager_celery(), create_settings())
+        tasks.submit(self.session_id)
+        with open(os.path.join(self.session_upload_dir, 'd.pdf'), 'wb') as file:
+            file.write(b'%PDF-1.4\n')
+        tasks.submit(self.session_id)
+        self.assertEqual(['d.pdf'], os.listdir(
+            os.path.join(self.session_upload_dir, 'compressed_files')))
+
+    @patch('pdfebc_web.util.mail.Mailer.send', autospec=True)
+    def test_submit_returns_job_in_flight(self, mock_send):
+        job_registry = pdfebc_web.util.jobs.LocalJobRegistry()
+        job_registry.register(self.session_id, 'in-flight', 3600)
+        tasks = pdfebc_web.main.tasks.construct_tasks(create_eager_celery(), create_settings(),
+                                                      job_registry=job_registry)
+        self.assertEqual('in-flight', tasks.submit(self.session_id))
+        mock_send.assert_not_called()
+        self.assertTrue(os.path.isdir(self.session_upload_dir))
+
+    @patch('pdfebc_web.util.mail.Mailer.send', autospec=True)
+    def test_submit_releases_job_when_done(self, mock_send):
+        job_registry = pdfebc_web.util.jobs.LocalJobRegistry()
+        tasks = pdfebc_web.main.tasks.construct_tasks(create_eager_celery(), create_settings(),
+                                                      job_registry=job_registry)
+        tasks.submit(self.session_id)
+        self.assertIsNone(job_registry.get(self.session_id))
+
+    @patch('pdfebc_web.util.mail.Mailer.send', autospec=True)
+    def test_task_skips_locked_session(self, mock_send):
+        job_registry = pdfebc_web.util.jobs.LocalJobRegistry()
+        tasks = pdfebc_web.main.tasks.construct_tasks(create_eager_celery(), create_settings(),
+                                                      job_registry=job_registry)
+        with job_registry.session_lock(self.session_id, 3600):
+            tasks.process_uploaded_files.apply((self.session_id,))
+        mock_send.assert_not_called()
+        self.assertEqual(sorted(self.filenames), sorted(os.listdir(self.session_upload_dir)))
+
+    @patch('pdfebc_web.util.mail.Mailer.send', autospec=True)
+    def test_submit_fan_out(self, mock_send):
+        tasks = pdfebc_web.main.tasks.construct_tasks(
+            create_eager_celery(), create_settings(COMPRESSION_FAN_OUT=True))
+        with patch.object(tasks.compress_uploaded_file, 'run',
+                          wraps=tasks.compress_uploaded_file.run) as mock_run:
+            tasks.submit(self.session_id)
+            self.assertEqual(len(self.filenames), mock_run.call_count)
+        self.assert_sent(mock_send, self.filenames)
+        self.assert_only_compressed_files_kept()
+
+    @patch('pdfebc_web.util.mail.Mailer.send', autospec=True)
+    def test_submit_fan_out_caps_session_concurrency(self, mock_send):
+        tasks = pdfebc_web.main.tasks.construct_tasks(
+            create_eager_celery(), create_settings(COMPRESSION_FAN_OUT=True,
+                                                   SESSION_CONCURRENCY=2))
+        with patch.object(tasks.compress_uploaded_chunk, 'run',
+                          wraps=tasks.compress_uploaded_chunk.run) as mock_run:
+            tasks.submit(self.session_id)
+            self.assertEqual(2, mock_run.call_count)
+        self.assert_sent(mock_send, self.filenames)
+
+    @patch('pdfebc_web.util.mail.Mailer.send', autospec=True)
+    def test_submit_fetches_files_from_storage(self, mock_send):
+        client = FakeS3Client()
+        storage = pdfebc_web.util.storage.S3Storage(client, 'bucket')
+        for filename in self.filenames:
+            storage.save_upload(self.session_id, filename)
+        self.assertEqual([], os.listdir(self.session_upload_dir))
+        tasks = pdfebc_web.main.tasks.construct_tasks(create_eager_celery(), create_settings(),
+                                                      storage=storage)
+        tasks.submit(self.session_id)
+        self.assert_sent(mock_send, self.filenames)
+        self.assert_only_compressed_files_stored(client)
+        self.assert_only_compressed_files_kept()
+
+    @patch('pdfebc_web.util.mail.Mailer.send', autospec=True)
+    def test_fan_out_delivers_files_compressed_on_other_workers(self, mock_send):
+        client = FakeS3Client()
+        storage = pdfebc_web.util.storage.S3Storage(client, 'bucket')
+        for filename in self.filenames:
+            storage.save_upload(self.session_id, filename)
+        tasks = pdfebc_web.main.tasks.construct_tasks(
+            create_eager_celery(), create_settings(COMPRESSION_FAN_OUT=True), storage=storage)
+        job_id = str(uuid.uuid4())
+        chunks = [tasks.compress_uploaded_chunk(self.session_id, self.filenames[:2], job_id),
+                  tasks.compress_uploaded_chunk(self.session_id, self.filenames[2:], job_id)]
+        # The delivering worker has none of the files of the session
+        shutil.rmtree(self.session_upload_dir)
+        tasks.deliver_compressed_files.apply((chunks, self.session_id), task_id=job_id)
+        self.assert_sent(mock_send, self.filenames)
+        self.assert_only_compressed_files_stored(client)
+
+    def create_eager_tasks(self, manifest_store):
+        """Construct tasks in eager mode, with distinct files in the session that are all in
+        the manifest.
+        """
+        for filename in self.filenames:
+            path = os.path.join(self.session_upload_dir, filename)
+            with open(path, 'wb') as file:
+                file.write(b'%PDF-1.4\n' + filename.encode('utf-8'))
+            manifest_store.add(self.session_id, filename, pdfebc_web.util.manifest.create_entry(
+                os.stat(path).st_size, pdfebc_web.util.cache.hash_file(path).hexdigest()))
+        return pdfebc_web.main.tasks.construct_tasks(
+            create_eager_celery(), create_settings(EAGER_COMPRESSION=True), manifest_store)
+
+    @patch('pdfebc_web.util.mail.Mailer.send', autospec=True)
+    def test_submit_eager_collects_precompressed_files(self, mock_send):
+        manifest_store = pdfebc_web.util.manifest.LocalManifestStore()
+        tasks = self.create_eager_tasks(manifest_store)
+        for filename, entry in manifest_store.get(self.session_id).items():
+            tasks.precompress(self.session_id, filename, entry['sha256'], entry['size'])
+        with patch('pdfebc_web.util.engine.compress_pdf', autospec=True) as mock_compress_pdf:
+            tasks.submit(self.session_id)
+        mock_compress_pdf.assert_not_called()
+        self.assert_sent(mock_send, self.filenames)
+        self.assert_only_compressed_files_kept()
+
+    @patch('pdfebc_web.util.mail.Mailer.send', autospec=True)
+    def test_submit_eager_compresses_files_that_were_not_precompressed(self, mock_send):
+        manifest_store = pdfebc_web.util.manifest.LocalManifestStore()
+        tasks = self.create_eager_tasks(manifest_store)
+        entry = manifest_store.get(self.session_id)['a.pdf']
+        tasks.precompress(self.session_id, 'a.pdf', entry['sha256'], entry['size'])
+        with patch('pdfebc_web.util.engine.compress_pdf', autospec=True,
+                   side_effect=pdfebc_web.util.engine.compress_pdf) as mock_compress_pdf:
+            tasks.submit(self.session_id)
+        self.assertEqual(['b.pdf', 'c.pdf'], sorted(os.path.basename(call[0][0]) for call in
+                                                    mock_compress_pdf.call_args_list))
+        self.assert_sent(mock_send, self.filenames)
+
+    @patch('pdfebc_web.util.mail.Mailer.send', autospec=True)
+    def test_submit_eager_ignores_precompressed_files_of_other_profiles(self, mock_send):
+        manifest_store = pdfebc_web.util.manifest.LocalManifestStore()
+        tasks = self.create_eager_tasks(manifest_store)
+        for filename, entry in manifest_store.get(self.session_id).items():
+            tasks.precompress(self.session_id, filename, entry['sha256'], entry['size'])
+        with patch('pdfebc_web.util.engine.compress_pdf', autospec=True,
+                   side_effect=pdfebc_web.util.engine.compress_pdf) as mock_compress_pdf:
+            tasks.submit(self.session_id, 'screen')
+        self.assertEqual(len(self.filenames), mock_compress_pdf.call_count)
+        self.assertEqual({'screen'}, {call[1]['profile'].name
+                                      for call in mock_compress_pdf.call_args_list})
+        self.assert_sent(mock_send, self.filenames)
+
+    @patch('pdfebc_web.util.mail.Mailer.send', autospec=True)
+    def test_submit_eager_collects_precompressed_files_of_chosen_profile(self, mock_send):
+        manifest_store = pdfebc_web.util.manifest.LocalManifestStore()
+        tasks = self.create_eager_tasks(manifest_store)
+        for filename, entry in manifest_store.get(self.session_id).items():
+            tasks.precompress(self.session_id, filename, entry['sha256'], entry['size'],
+                              'screen')
+        with patch('pdfebc_web.util.engine.compress_pdf', autospec=True) as mock_compress_pdf:
+            tasks.submit(self.session_id, 'screen')
+        mock_compress_pdf.assert_not_called()
+        self.assert_sent(mock_send, self.filenames)
+
+    @patch('pdfebc_web.util.mail.Mailer.send', autospec=True)
+    def test_submit_with_profile(self, mock_send):
+        for fan_out in [False, True]:
+            pdfebc_web.util.file.ensure_session_upload_dir(self.session_id)
+            for filename in self.filenames:
+                with open(os.path.join(self.session_upload_dir, filename), 'wb') as file:
+                    file.write(b'%PDF-1.4\n')
+            files = pdfebc_web.main.tasks.get_compression_stats('lossless').summary()['small']
+            tasks = pdfebc_web.main.tasks.construct_tasks(
+                create_eager_celery(), create_settings(COMPRESSION_FAN_OUT=fan_out))
+            tasks.submit(self.session_id, 'lossless')
+            self.assertEqual(
+                files['files'] + len(self.filenames),
+                pdfebc_web.main.tasks.get_compression_stats('lossless').summary()['small']['files'])
+
+    def test_submit_with_unknown_profile(self):
+        tasks = pdfebc_web.main.tasks.construct_tasks(create_eager_celery(), create_settings())
+        with self.assertRaises(ValueError):
+            tasks.submit(self.session_id, 'gold')
+
+    def test_precompress_skips_replaced_file(self):
+        manifest_store = pdfebc_web.util.manifest.LocalManifestStore()
+        tasks = self.create_eager_tasks(manifest_store)
+        tasks.precompress(self.session_id, 'a.pdf', 'stale', 9)
+        self.assertFalse(os.path.exists(
+            pdfebc_web.util.eager.get_eager_dir_path(self.session_upload_dir, 'ebook')))
+
+    def test_precompress_lowers_priority_of_sessions_with_tasks_in_flight(self):
+        job_registry = pdfebc_web.util.jobs.LocalJobRegistry()
+        tasks = pdfebc_web.main.tasks.construct_tasks(
+            create_eager_celery(), create_settings(EAGER_COMPRESSION=True),
+            job_registry=job_registry)
+        with patch.object(tasks.precompress_uploaded_file, 'apply_async') as mock_apply_async:
+            for index in range(5):
+                tasks.precompress(self.session_id, '{}.pdf'.format(index), 'sha256', 1)
+            tasks.precompress('other', 'a.pdf', 'sha256', 1)
+        self.assertEqual([0, 0, 0, 0, 1, 0], [call[1]['priority'] for call in
+                                              mock_apply_async.call_args_list])
+
+    def test_precompress_counts_finished_tasks_out(self):
+        manifest_store = pdfebc_web.util.manifest.LocalManifestStore()
+        job_registry = pdfebc_web.util.jobs.LocalJobRegistry()
+        self.create_eager_tasks(manifest_store)
+        tasks = pdfebc_web.main.tasks.construct_tasks(
+            create_eager_celery(), create_settings(EAGER_COMPRESSION=True), manifest_store,
+            job_registry=job_registry)
+        for filename, entry in manifest_store.get(self.session_id).items():
+            tasks.precompress(self.session_id, filename, entry['sha256'], entry['size'])
+        tasks.precompress(self.session_id, 'a.pdf', 'stale', 9)
+        self.assertEqual(0, job_registry.add_in_flight(self.session_id, 0, 60))
+
+    def test_sweep_keeps_sessions_with_running_jobs(self):
+        job_registry = pdfebc_web.util.jobs.LocalJobRegistry()
+        tasks = pdfebc_web.main.tasks.construct_tasks(
+            create_eager_celery(), create_settings(FILE_CACHE_QUOTA=1), job_registry=job_registry)
+        locked_session_id, idle_session_id = str(uuid.uuid4()), str(uuid.uuid4())
+        for session_id in [locked_session_id, idle_session_id]:
+            with open(os.path.join(pdfebc_web.util.file.ensure_session_upload_dir(session_id),
+                                   'a.pdf'), 'wb') as file:
+                file.write(b'%PDF-1.4\n')
+        job_registry.register(self.session_id, 'job', 3600)
+        with job_registry.session_lock(locked_session_id, 3600):
+            report = tasks.sweep_file_cache()
+        self.assertEqual(1, report['directories'])
+        self.assertTrue(os.path.isdir(self.session_upload_dir))
+        self.assertTrue(os.path.isdir(
+            pdfebc_web.util.file.get_session_upload_dir_path(locked_session_id)))
+        self.assertFalse(os.path.exists(
+            pdfebc_web.util.file.get_session_upload_dir_path(idle_session_id)))
+
+    def test_submit_routes_by_size(self):
+        for threshold, queue, priority in [(100, 'pdfebc-small', 0), (10, 'pdfebc-large', 2)]:
+            tasks = pdfebc_web.main.tasks.construct_tasks(
+                create_eager_celery(), create_settings(SMALL_JOB_THRESHOLD=threshold))
+            with patch.object(tasks.process_uploaded_files, 'apply_async') as mock_apply_async:
+                tasks.submit(self.session_id)
+            self.assertEqual(queue, mock_apply_async.call_args[1]['queue'])
+            self.assertEqual(priority, mock_apply_async.call_args[1]['priority'])
+
+    @patch('pdfebc_web.util.mail.Mailer.send', autospec=True)
+    def test_get_job_status(self, mock_send):
+        for fan_out in [False, True]:
+            pdfebc_web.util.file.ensure_session_upload_dir(self.session_id)
+            for filename in self.filenames:
+                with open(os.path.join(self.session_upload_dir, filename), 'wb') as file:
+                    file.write(b'%PDF-1.4\n')
+            celery = create_eager_celery()
+            tasks = pdfebc_web.main.tasks.construct_tasks(
+                celery, create_settings(COMPRESSION_FAN_OUT=fan_out))
+            job_id = tasks.submit(self.session_id)
+            status = pdfebc_web.main.tasks.get_job_status(celery, job_id)
+            self.assertEqual(job_id, status['job_id'])
+            self.assertEqual('SUCCESS', status['state'])
+            self.assertTrue(status['ready'])
+            self.assertEqual(set(self.filenames), set(status['files']))
+            for progress in status['files'].values():
+                self.assertEqual('done', progress['state'])
+                self.assertEqual(9, progress['bytes_out'])
+
+    @patch('pdfebc_web.util.mail.Mailer.send', autospec=True)
+    def test_submit_delivers_files_that_did_not_fail(self, mock_send):
+        compress_pdf = pdfebc_web.util.engine._compress_pdf
+
+        def fail_b(src, *args):
+            if os.path.basename(src) == 'b.pdf':
+                raise pdfebc_web.util.engine.CompressionError(
+                    "Out of memory", pdfebc_web.util.engine.MEMORY_LIMIT)
+            return compress_pdf(src, *args)
+
+        for fan_out in [False, True]:
+            mock_send.reset_mock()
+            pdfebc_web.util.file.ensure_session_upload_dir(self.session_id)
+            for filename in self.filenames:
+                with open(os.path.join(self.session_upload_dir, filename), 'wb') as file:
+                    file.write(b'%PDF-1.4\n')
+            celery = create_eager_celery()
+            tasks = pdfebc_web.main.tasks.construct_tasks(
+                celery, create_settings(COMPRESSION_FAN_OUT=fan_out))
+            with patch('pdfebc_web.util.engine._compress_pdf', side_effect=fail_b):
+                job_id = tasks.submit(self.session_id)
+            self.assert_sent(mock_send, ['a.pdf', 'c.pdf'])
+            self.assertIn('b.pdf', mock_send.call_args[0][1].get_payload()[0].get_payload())
+            status = pdfebc_web.main.tasks.get_job_status(celery, job_id)
+            self.assertEqual('SUCCESS', status['state'])
+            self.assertEqual('failed', status['files']['b.pdf']['state'])
+            self.assertEqual('memory_limit', status['files']['b.pdf']['reason'])
+            self.assertEqual(['b.pdf'], pdfebc_web.main.tasks.get_failed_files(celery, job_id))
+
+    @patch('pdfebc_web.util.mail.Mailer.send', autospec=True)
+    def test_fan_out_delivers_and_releases_job_after_unexpected_error(self, mock_send):
+        fetch_upload = pdfebc_web.util.storage.LocalStorage.fetch_upload
+
+        def fail_b(storage, session_id, filename):
+            if filename == 'b.pdf':
+                raise OSError("Disk on fire")
+            return fetch_upload(storage, session_id, filename)
+
+        celery = create_eager_celery()
+        job_registry = pdfebc_web.util.jobs.LocalJobRegistry()
+        tasks = pdfebc_web.main.tasks.construct_tasks(
+            celery, create_settings(COMPRESSION_FAN_OUT=True), job_registry=job_registry)
+        with patch('pdfebc_web.util.storage.LocalStorage.fetch_upload', autospec=True,
+                   side_effect=fail_b):
+            job_id = tasks.submit(self.session_id)
+        self.assert_sent(mock_send, ['a.pdf', 'c.pdf'])
+        self.assertEqual(['b.pdf'], pdfebc_web.main.tasks.get_failed_files(celery, job_id))
+        self.assertIsNone(job_registry.get(self.session_id))
+
+    @patch('pdfebc_web.util.mail.Mailer.send', autospec=True)
+    def test_delivery_fails_when_no_file_could_be_compressed(self, mock_send):
+        tasks = pdfebc_web.main.tasks.construct_tasks(create_eager_celery(), create_settings())
+        with patch.object(pdfebc_web.main.tasks, 'get_failed_files', return_value=['a.pdf']):
+            with self.assertRaises(pdfebc_web.util.engine.CompressionError):
+                tasks.deliver_compressed_files([[]], self.session_id)
+        self.assertFalse(mock_send.called)
+
+    def test_get_job_status_unknown_job(self):
+        celery = create_eager_celery()
+        status = pdfebc_web.main.tasks.get_job_status(celery, str(uuid.uuid4()))
+        self.assertEqual(pdfebc_web.main.tasks.EXPIRED_STATE, status['state'])
+        self.assertTrue(status['ready'])
+        self.assertEqual({}, status['files'])
+
+    def test_get_job_status_of_queued_job(self):
+        celery = create_eager_celery()
+        tasks = pdfebc_web.main.tasks.construct_tasks(celery, create_settings())
+        with patch.object(tasks.process_uploaded_files, 'apply_async'):
+            job_id = tasks.submit(self.session_id)
+        status = pdfebc_web.main.tasks.get_job_status(celery, job_id)
+        self.assertEqual('PENDING', status['state'])
+        self.assertFalse(status['ready'])
+        self.assertEqual(set(self.filenames), set(status['files']))
@@ -0,0 +1,118 @@
+"""Unit tests for the pdfebc_web.util.upload module.
+
+Author: Simon Larsén <slarse@kth.se>
+"""
+import hashlib
+import io
+import os
+import tempfile
+from unittest import TestCase
+from .context import pdfebc_web
+
+CONTENT = b'%PDF-1.4\n' + b'x' * 1000
+
+
+class StreamToFileTest(TestCase):
+    def setUp(self):
+        self.trash_can = tempfile.TemporaryDirectory()
+        self.out = os.path.join(self.trash_can.name, 'file.pdf')
+
+    def tearDown(self):
+        self.trash_can.cleanup()
+
+    def test_stream_to_file(self):
+        result = pdfebc_web.util.upload.stream_to_file(io.BytesIO(CONTENT), self.out, 2000,
+                                                       chunk_size=3)
+        self.assertEqual(self.out, result.path)
+        self.assertEqual(len(CONTENT), result.size)
+        self.assertEqual(hashlib.sha256(CONTENT).hexdigest(), result.sha256)
+        with open(self.out, 'rb') as file:
+            self.assertEqual(CONTENT, file.read())
+        self.assertEqual(['file.pdf'], os.listdir(self.trash_can.name))
+
+    def test_stream_to_file_too_large(self):
+        with self.assertRaises(pdfebc_web.util.upload.UploadTooLargeError):
+            pdfebc_web.util.upload.stream_to_file(io.BytesIO(CONTENT), self.out, 100)
+        self.assertEqual([], os.listdir(self.trash_can.name))
+
+    def test_stream_to_file_not_a_pdf(self):
+        with self.assertRaises(pdfebc_web.util.upload.NotAPdfError):
+            pdfebc_web.util.upload.stream_to_file(io.BytesIO(b'GIF89a' + CONTENT), self.out,
+                                                  2000, chunk_size=2)
+        self.assertEqual([], os.listdir(self.trash_can.name))
+
+    def test_stream_to_file_shorter_than_magic(self):
+        with self.assertRaises(pdfebc_web.util.upload.NotAPdfError):
+            pdfebc_web.util.upload.stream_to_file(io.BytesIO(b'%P'), self.out, 2000)
+
+    def test_check_size(self):
+        pdfebc_web.util.upload.check_size(10, 10)
+        with self.assertRaises(pdfebc_web.util.upload.UploadTooLargeError):
+            pdfebc_web.util.upload.check_size(11, 10)
+
+
+class ResumableUploadTest(TestCase):
+    def setUp(self):
+        self.trash_can = tempfile.TemporaryDirectory()
+        self.upload_dir = self.trash_can.name
+        self.upload_id = pdfebc_web.util.upload.create_resumable_upload(
+            self.upload_dir, 'file.pdf', len(CONTENT), 2000)
+
+    def tearDown(self):
+        self.trash_can.cleanup()
+
+    def test_create_resumable_upload(self):
+        upload = pdfebc_web.util.upload.get_resumable_upload(self.upload_dir, self.upload_id)
+        self.assertEqual({'filename': 'file.pdf', 'size': len(CONTENT), 'offset': 0}, upload)
+
+    def test_create_resumable_upload_too_large(self):
+        with self.assertRaises(pdfebc_web.util.upload.UploadTooLargeError):
+            pdfebc_web.util.upload.create_resumable_upload(self.upload_dir, 'file.pdf', 3000,
+                                                           2000)
+
+    def test_get_unknown_upload(self):
+        for upload_id in ['0' * 32, '../../etc/passwd']:
+            with self.assertRaises(pdfebc_web.util.upload.UploadNotFoundError):
+                pdfebc_web.util.upload.get_resumable_upload(self.upload_dir, upload_id)
+
+    def test_append_chunks_and_finalize(self):
+        offset = 0
+        for start in range(0, len(CONTENT), 300):
+            chunk = io.BytesIO(CONTENT[start:start + 300])
+            offset = pdfebc_web.util.upload.append_chunk(self.upload_dir, self.upload_id,
+                                                         offset, chunk)
+        self.assertEqual(len(CONTENT), offset)
+        result = pdfebc_web.util.upload.finalize_resumable_upload(self.upload_dir,
+                                                                  self.upload_id)
+        self.assertEqual(os.path.join(self.upload_dir, 'file.pdf'), result.path)
+        self.assertEqual(hashlib.sha256(CONTENT).hexdigest(), result.sha256)
+        with open(result.path, 'rb') as file:
+            self.assertEqual(CONTENT, file.read())
+        with self.assertRaises(pdfebc_web.util.upload.UploadNotFoundError):
+            pdfebc_web.util.upload.get_resumable_upload(self.upload_dir, self.upload_id)
+
+    def test_append_chunk_wrong_offset(self):
+        pdfebc_web.util.upload.append_chunk(self.upload_dir, self.upload_id, 0,
+                                            io.BytesIO(CONTENT[:100]))
+        with self.assertRaises(pdfebc_web.util.upload.UploadOffsetError) as context:
+            pdfebc_web.util.upload.append_chunk(self.upload_dir, self.upload_id, 0,
+                                                io.BytesIO(CONTENT[:100]))
+        self.assertEqual(100, context.exception.offset)
+
+    def test_append_chunk_beyond_declared_size(self):
+        with self.assertRaises(pdfebc_web.util.upload.UploadTooLargeError):
+            pdfebc_web.util.upload.append_chunk(self.upload_dir, self.upload_id, 0,
+                                                io.BytesIO(CONTENT + b'x'))
+        upload = pdfebc_web.util.upload.get_resumable_upload(self.upload_dir, self.upload_id)
+        self.assertEqual(0, upload['offset'])
+
+    def test_append_chunk_not_a_pdf(self):
+        with self.assertRaises(pdfebc_web.util.upload.NotAPdfError):
+            pdfebc_web.util.upload.append_chunk(self.upload_dir, self.upload_id, 0,
+                                                io.BytesIO(b'GIF89a'))
+
+    def test_finalize_incomplete_upload(self):
+        pdfebc_web.util.upload.append_chunk(self.upload_dir, self.upload_id, 0,
+                                            io.BytesIO(CONTENT[:100]))
+        with self.assertRaises(pdfebc_web.util.upload.UploadOffsetError):
+            pdfebc_web.util.upload.finalize_resumable_upload(self.upload_dir, self.upload_id)
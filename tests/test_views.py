@@ -0,0 +1,129 @@
+"""Unit tests for the pdfebc_web.main.views module.
+
+Author: Simon Larsén <slarse@kth.se>
+"""
+import hashlib
+import io
+import os
+import tempfile
+from unittest import TestCase, skipUnless
+from unittest.mock import patch
+from .context import pdfebc_web
+
+CONTENT = b'%PDF-1.4\n' + b'x' * 1000
+
+
+class IndexTest(TestCase):
+    def setUp(self):
+        self.trash_can = tempfile.TemporaryDirectory()
+        pdfebc_web.util.file.FILE_CACHE = self.trash_can.name
+        _, self.app = pdfebc_web.factory.create_app({'MANIFEST_STORE': 'memory',
+                                                     'LIMITS_STORE': 'memory',
+                                                     'JOB_REGISTRY': 'memory',
+                                                     'WTF_CSRF_ENABLED': False})
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        self.trash_can.cleanup()
+
+    def test_get_does_not_create_session_dir(self):
+        response = self.client.get('/')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([], os.listdir(self.trash_can.name))
+
+    def test_upload_is_listed_from_manifest(self):
+        response = self.client.post('/', data={'upload': (io.BytesIO(CONTENT), 'file.pdf'),
+                                               'submit': 'Submit'},
+                                    content_type='multipart/form-data')
+        self.assertEqual(200, response.status_code)
+        self.assertIn(b'<li>file.pdf</li>', response.data)
+        self.assertEqual(1, len(os.listdir(self.trash_can.name)))
+
+    def test_upload_is_compressed_right_away_in_eager_mode(self):
+        _, app = pdfebc_web.factory.create_app({'MANIFEST_STORE': 'memory',
+                                                'LIMITS_STORE': 'memory',
+                                                'JOB_REGISTRY': 'memory',
+                                                'WTF_CSRF_ENABLED': False,
+                                                'EAGER_COMPRESSION': True,
+                                                'CELERY_BROKER_URL': 'memory://',
+                                                'CELERY_ALWAYS_EAGER': True})
+        app.test_client().post('/', data={'upload': (io.BytesIO(CONTENT), 'file.pdf'),
+                                          'submit': 'Submit'},
+                               content_type='multipart/form-data')
+        session_upload_dir = os.path.join(self.trash_can.name, os.listdir(self.trash_can.name)[0])
+        eager_dir = pdfebc_web.util.eager.get_eager_dir_path(session_upload_dir, 'ebook')
+        result = hashlib.sha256(CONTENT).hexdigest() + pdfebc_web.util.eager.RESULT_EXTENSION
+        self.assertIn(result, os.listdir(eager_dir))
+
+    def test_compress_without_uploads(self):
+        response = self.client.post('/', data={'compress': 'Compress files'},
+                                    follow_redirects=True)
+        self.assertIn(b'There are no uploaded files to compress.', response.data)
+
+    def test_compress_with_chosen_profile(self):
+        _, app = pdfebc_web.factory.create_app({'MANIFEST_STORE': 'memory',
+                                                'LIMITS_STORE': 'memory',
+                                                'JOB_REGISTRY': 'memory',
+                                                'WTF_CSRF_ENABLED': False,
+                                                'CELERY_BROKER_URL': 'memory://',
+                                                'CELERY_RESULT_BACKEND': 'cache+memory://'})
+        client = app.test_client()
+        client.post('/', data={'upload': (io.BytesIO(CONTENT), 'file.pdf'), 'submit': 'Submit'},
+                    content_type='multipart/form-data')
+        with patch('pdfebc_web.main.tasks.scheduling.plan_job',
+                   wraps=pdfebc_web.util.scheduling.plan_job) as mock_plan_job, \
+                patch('celery.app.task.Task.apply_async') as mock_apply_async:
+            client.post('/', data={'profile': 'screen', 'compress': 'Compress files'})
+        self.assertEqual(0.8, mock_plan_job.call_args[0][-1])
+        self.assertEqual('screen', mock_apply_async.call_args[0][0][1])
+        self.assertIn(b'<option selected value="screen">', client.get('/').data)
+
+    def test_expired_job_is_dropped(self):
+        _, app = pdfebc_web.factory.create_app({'MANIFEST_STORE': 'memory',
+                                                'LIMITS_STORE': 'memory',
+                                                'JOB_REGISTRY': 'memory',
+                                                'CELERY_BROKER_URL': 'memory://',
+                                                'CELERY_RESULT_BACKEND': 'cache+memory://'})
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session[pdfebc_web.util.session.JOB_ID_KEY] = 'expired'
+        response = client.get('/')
+        self.assertNotIn(b'jobProgress', response.data)
+        with client.session_transaction() as session:
+            self.assertNotIn(pdfebc_web.util.session.JOB_ID_KEY, session)
+
+    def test_compress_with_unknown_profile(self):
+        self.client.post('/', data={'upload': (io.BytesIO(CONTENT), 'file.pdf'),
+                                    'submit': 'Submit'},
+                         content_type='multipart/form-data')
+        with patch('celery.app.task.Task.apply_async') as mock_apply_async:
+            response = self.client.post('/', data={'profile': 'gold', 'compress': 'Compress files'})
+        self.assertEqual(200, response.status_code)
+        self.assertFalse(mock_apply_async.called)
+
+    def test_profiles_are_listed(self):
+        response = self.client.get('/')
+        for profile in pdfebc_web.util.profiles.DEFAULT_PROFILES.values():
+            self.assertIn(profile['label'].encode('utf-8'), response.data)
+
+
+class MetricsTest(TestCase):
+    def setUp(self):
+        _, self.app = pdfebc_web.factory.create_app({'MANIFEST_STORE': 'memory',
+                                                     'LIMITS_STORE': 'memory',
+                                                     'JOB_REGISTRY': 'memory',
+                                                     'CELERY_BROKER_URL': 'memory://'})
+        self.client = self.app.test_client()
+
+    def test_not_found_without_prometheus_client(self):
+        with patch.object(pdfebc_web.util.metrics, 'prometheus_client', None):
+            self.assertEqual(404, self.client.get('/metrics').status_code)
+
+    @skipUnless(pdfebc_web.util.metrics.is_enabled(), 'prometheus_client is not installed')
+    def test_metrics(self):
+        self.client.get('/')
+        response = self.client.get('/metrics')
+        self.assertEqual(200, response.status_code)
+        self.assertIn(b'pdfebc_request_duration_seconds_count{view="main.index"}',
+                      response.data)
+        self.assertIn(b'pdfebc_queue_depth{queue="pdfebc-small"} 0.0', response.data)